@@ -0,0 +1,190 @@
+"""分析任务状态机 - 每次分析一行（analysis_jobs表），取代session中的分析状态
+
+状态切换只允许按 TRANSITIONS 进行，使用带条件的UPDATE（WHERE state IN 允许的来源状态），
+多个进程同时切换时只有一个成功，已结束的任务不会被迟到的进度覆盖：
+
+    queued  -> running / failed
+    running -> running（重试）/ queued（worker崩溃后重新排队）/ completed / failed
+
+状态由后台任务队列驱动（JobQueue.observe），web请求只负责创建任务和读取状态：
+- create() 只flush，与额度预留、BackgroundJob在同一事务中由 job_queue.enqueue 提交
+- 回调失败（或旧版本遗留）导致BackgroundJob已结束、分析任务仍处于queued/running时，
+  reap_orphans() 按BackgroundJob的最终状态补做切换（BackgroundJob不存在时标记失败），
+  由后台任务队列的调度线程定期执行（JobQueue.sweep），避免用户无法再提交新的分析
+- get_status() 按主键只读取状态相关的列；已结束的任务不会再变化，
+  在进程内缓存，重复查询不再访问数据库
+- 每次变化 version+1，状态接口据此生成ETag，多个节点返回的ETag一致
+"""
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, select, update
+
+logger = logging.getLogger(__name__)
+
+TRANSITIONS = {
+    'queued': ('running', 'failed'),
+    'running': ('running', 'queued', 'completed', 'failed'),
+    'completed': (),
+    'failed': (),
+}
+ACTIVE_STATES = ('queued', 'running')
+TERMINAL_STATES = ('completed', 'failed')
+
+FINISHED_CACHE_SIZE = 1024
+
+# BackgroundJob已结束、分析任务超过这么多秒没有变化时才视为遗留（给状态回调留出时间）
+ORPHAN_GRACE_SECONDS = 60
+
+_finished_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class InvalidTransition(Exception):
+    """不允许的状态切换"""
+
+
+def create(db_session, user_id, form_submission_id=None, project_name=None, quota_state=None):
+    """创建排队中的分析任务（只flush，不提交），返回AnalysisJob
+
+    调用方随后用同一个ID入队（job_queue.enqueue），两行在同一事务中提交。
+    quota_state: 同一事务中已预留额度时传 'reserved'（见quota_ledger.py）
+    """
+    from models import AnalysisJob
+
+    job = AnalysisJob(user_id=user_id, form_submission_id=form_submission_id,
+                      project_name=(project_name or '')[:200], state='queued', progress=0,
+                      stage='任务已排队，等待执行...', version=0, quota_state=quota_state)
+    db_session.add(job)
+    db_session.flush()
+    return job
+
+
+def active_for_user(db_session, user_id):
+    """用户排队或执行中的分析任务（多个标签页共用，防止重复提交）"""
+    from models import AnalysisJob
+
+    return db_session.execute(
+        select(AnalysisJob)
+        .where(AnalysisJob.user_id == user_id, AnalysisJob.state.in_(ACTIVE_STATES))
+        .order_by(AnalysisJob.created_at.desc())
+        .limit(1)).scalar()
+
+
+def transition(db_session, job_id, to_state, **values):
+    """切换状态，返回是否成功；当前状态不允许切换到to_state时不做修改并返回False"""
+    if to_state not in TRANSITIONS:
+        raise InvalidTransition(f"未知状态: {to_state}")
+    from models import AnalysisJob
+
+    sources = [state for state, targets in TRANSITIONS.items() if to_state in targets]
+    result = db_session.execute(
+        update(AnalysisJob)
+        .where(AnalysisJob.id == job_id, AnalysisJob.state.in_(sources))
+        .values(state=to_state, version=AnalysisJob.version + 1, updated_at=datetime.utcnow(), **values))
+    db_session.commit()
+    if result.rowcount != 1:
+        logger.warning(f"分析任务 {job_id} 无法切换到 {to_state}（任务不存在或状态不允许）")
+        return False
+    return True
+
+
+def update_progress(db_session, job_id, progress=None, stage=None):
+    """更新执行中任务的进度和阶段描述"""
+    from models import AnalysisJob
+
+    values = {}
+    if progress is not None:
+        values['progress'] = progress
+    if stage is not None:
+        values['stage'] = stage[:200]
+    if not values:
+        return False
+    result = db_session.execute(
+        update(AnalysisJob)
+        .where(AnalysisJob.id == job_id, AnalysisJob.state == 'running')
+        .values(version=AnalysisJob.version + 1, updated_at=datetime.utcnow(), **values))
+    db_session.commit()
+    return result.rowcount == 1
+
+
+def get_status(db_session, job_id):
+    """按主键读取任务状态（dict），不存在时返回None；已结束的任务从进程内缓存返回"""
+    from models import AnalysisJob
+
+    if not job_id:
+        return None
+    with _cache_lock:
+        cached = _finished_cache.get(job_id)
+        if cached is not None:
+            _finished_cache.move_to_end(job_id)
+            return cached
+
+    row = db_session.execute(
+        select(AnalysisJob.id, AnalysisJob.user_id, AnalysisJob.state, AnalysisJob.progress,
+               AnalysisJob.stage, AnalysisJob.result_id, AnalysisJob.error, AnalysisJob.version)
+        .where(AnalysisJob.id == job_id)).first()
+    if row is None:
+        return None
+    status = dict(row._mapping)
+    if status['state'] in TERMINAL_STATES:
+        with _cache_lock:
+            _finished_cache[job_id] = status
+            while len(_finished_cache) > FINISHED_CACHE_SIZE:
+                _finished_cache.popitem(last=False)
+    return status
+
+
+def handle_job_event(db_session, job_id, event, values):
+    """后台任务队列的状态回调：把BackgroundJob的变化同步为分析任务的状态切换"""
+    if event == 'progress':
+        update_progress(db_session, job_id, values.get('progress'), values.get('stage'))
+    elif event == 'running':
+        transition(db_session, job_id, 'running', started_at=values.get('started_at'))
+    elif event == 'queued':
+        transition(db_session, job_id, 'queued', stage=values.get('stage'))
+    elif event == 'completed':
+        transition(db_session, job_id, 'completed', result_id=values.get('result_ref'),
+                   progress=100, stage='分析完成！', finished_at=values.get('finished_at'))
+    elif event == 'failed':
+        transition(db_session, job_id, 'failed', error=values.get('error'),
+                   finished_at=values.get('finished_at'))
+
+
+def reap_orphans(db_session, grace_seconds=ORPHAN_GRACE_SECONDS):
+    """BackgroundJob已结束或不存在、但仍处于queued/running的分析任务：按BackgroundJob的结果补做切换
+
+    返回 [(job_id, event)]
+    """
+    from models import AnalysisJob, BackgroundJob
+
+    now = datetime.utcnow()
+    rows = db_session.execute(
+        select(AnalysisJob.id, BackgroundJob.status, BackgroundJob.result_ref, BackgroundJob.error,
+               BackgroundJob.finished_at)
+        .outerjoin(BackgroundJob, BackgroundJob.id == AnalysisJob.id)
+        .where(AnalysisJob.state.in_(ACTIVE_STATES),
+               AnalysisJob.updated_at < now - timedelta(seconds=grace_seconds),
+               or_(BackgroundJob.id.is_(None), BackgroundJob.status.in_(TERMINAL_STATES)))).all()
+    db_session.commit()
+
+    reaped = []
+    for job_id, status, result_ref, error, finished_at in rows:
+        if status == 'completed':
+            event, values = 'completed', {'result_ref': result_ref, 'finished_at': finished_at or now}
+        else:
+            event, values = 'failed', {'error': error or '后台任务不存在', 'finished_at': finished_at or now}
+        handle_job_event(db_session, job_id, event, values)
+        reaped.append((job_id, event))
+    if reaped:
+        logger.warning(f"补做遗留分析任务的状态切换: {reaped}")
+    return reaped
+
+
+def register(job_queue, db):
+    """订阅analysis类型后台任务的状态变化，并定期补做遗漏的切换"""
+    job_queue.observe('analysis', lambda job_id, event, values:
+                      handle_job_event(db.session, job_id, event, values))
+    job_queue.sweep(lambda: reap_orphans(db.session))
@@ -3,23 +3,27 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
+import base64
 import json
 import logging
 import traceback
 import uuid
 import time
 import signal
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_from_directory, Response, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_from_directory, Response, session, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_required, login_user, logout_user, current_user
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import case, func, tuple_, update
+from sqlalchemy.orm import DeclarativeBase, load_only
+
+import structured_logging
+from structured_logging import log_payload
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 class Base(DeclarativeBase):
@@ -28,6 +32,15 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 
 app = Flask(__name__)
+# Configure logging（格式和级别见structured_logging）
+structured_logging.configure(app)
+
+
+@app.before_request
+def _start_log_trace():
+    """每个请求一个trace_id（可由X-Request-ID指定），载荷日志按请求采样"""
+    structured_logging.start_trace((request.headers.get('X-Request-ID') or '')[:64] or None)
+
 app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key_change_in_production")
 
 # 启用调试模式以显示详细错误信息
@@ -46,6 +59,7 @@ if database_url and database_url.startswith('postgresql'):
     app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
         "pool_recycle": 300,
         "pool_pre_ping": True,
+        "json_serializer": lambda obj: json.dumps(obj, ensure_ascii=False),
         "pool_timeout": 20,
         "pool_size": 5,
         "max_overflow": 0,
@@ -59,6 +73,7 @@ else:
     app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
         "pool_recycle": 300,
         "pool_pre_ping": True,
+        "json_serializer": lambda obj: json.dumps(obj, ensure_ascii=False),
     }
 
 # 修复Session配置 - 确保session正常工作
@@ -73,9 +88,30 @@ ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx', 'xlsx', 'csv', 'md', 'json'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# 后台任务队列配置 - AI分析在有界线程池中执行，不占用web worker
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 4))  # 每个进程的并发分析上限
+app.config['JOB_WORKER_MODE'] = os.environ.get('JOB_WORKER_MODE', 'embedded')  # embedded / external
+
+# 异步上游调用 - 开启后分析任务在事件循环中用AsyncOpenAI执行，单进程可同时等待数百个上游请求
+app.config['AI_ASYNC_ENABLED'] = os.environ.get('AI_ASYNC_ENABLED', 'false').lower() == 'true'
+app.config['JOB_ASYNC_CONCURRENCY'] = int(os.environ.get('JOB_ASYNC_CONCURRENCY', 200))  # 每个进程的协程任务并发上限
+app.config['JOB_DB_THREADS'] = int(os.environ.get('JOB_DB_THREADS', 16))  # 协程任务执行数据库操作的线程数
+
+# 分析进度推送（SSE）配置 - 单次连接最长保持时间，到期后由浏览器EventSource自动重连
+# sync worker在连接期间整个进程只服务一个页面，默认只在gthread/gevent worker下开启（否则回退到轮询）
+SSE_WORKER_CLASSES = ('gthread', 'gevent')
+app.config['SSE_ENABLED'] = os.environ.get(
+    'SSE_ENABLED', str(os.environ.get('GUNICORN_WORKER_CLASS', 'sync') in SSE_WORKER_CLASSES)).lower() == 'true'
+app.config['SSE_MAX_DURATION'] = int(os.environ.get('SSE_MAX_DURATION', 30))
+
 # Initialize database
 db.init_app(app)
 
+# 服务端session：cookie中只保存session id，只有变化的key写回数据库（SESSION_BACKEND=cookie时使用Flask默认实现）
+from session_store import SESSION_BACKEND, DatabaseSessionInterface
+if SESSION_BACKEND == 'server':
+    app.session_interface = DatabaseSessionInterface()
+
 # Initialize Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -101,7 +137,33 @@ def get_file_size(file_storage):
     return size
 
 # 导入所有模型
-from models import User, KnowledgeItem, AnalysisResult, ModelConfig
+from models import User, KnowledgeItem, AnalysisResult, ModelConfig, BackgroundJob, AnalysisCacheEntry
+from json_documents import PatchError, json_array_contains, json_patch, json_text
+
+# 初始化后台任务队列
+from job_queue import JobQueue
+job_queue = JobQueue(app, db)
+
+# 分析任务状态表：由后台任务的状态变化驱动，session中只保存任务ID
+import analysis_jobs
+analysis_jobs.register(job_queue, db)
+
+# 额度在提交分析时预留，保存AI分析结果时确认，任务失败或使用备用方案时退回
+import quota_ledger
+quota_ledger.register(job_queue, db)
+
+# 上游调用的token数、费用和耗时：内存缓冲，后台线程批量写入用量账本
+import usage_ledger
+usage_ledger.ledger.init_app(app, db)
+
+import result_summary
+import search_index
+
+# 知识库文件上传后在后台提取文本、切分片段
+import knowledge_ingest
+knowledge_ingest.register(job_queue, db)
+
+from circuit_breaker import CircuitOpenError
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -124,6 +186,10 @@ def admin_required(f):
 with app.app_context():
     db.create_all()
 
+    # 为已有的表补齐新增的列
+    from db_migrations import run_startup_migrations
+    run_startup_migrations(db)
+
     # 创建默认管理员账号
     default_user = User.query.filter_by(phone='18302196515').first()
     if not default_user:
@@ -226,7 +292,7 @@ def logout():
 def get_form_data_from_db(session):
     """从FormSubmission表获取表单数据，优先获取用户最新提交的数据"""
     try:
-        app.logger.info(f"📍 get_form_data_from_db调用 - Session内容: {dict(session)}")
+        log_payload(app.logger, "📍 get_form_data_from_db调用 - Session内容", session)
         
         # 总是优先查找当前用户最新的表单提交记录，而不是依赖session
         if current_user and current_user.is_authenticated:
@@ -242,7 +308,7 @@ def get_form_data_from_db(session):
             app.logger.info(f"📍 查找用户{current_user.id}的最新FormSubmission: {recent_submission is not None}")
             
             if recent_submission and recent_submission.form_data_complete:
-                form_data = json.loads(recent_submission.form_data_complete)
+                form_data = recent_submission.form_data_complete
                 app.logger.info(f"✅ 获取到最新表单数据: {form_data.get('projectName', 'Unknown')} (ID: {recent_submission.id})")
                 
                 # 确保session与最新数据同步
@@ -262,7 +328,7 @@ def get_form_data_from_db(session):
             app.logger.info(f"📍 备用方案：通过submission_id查询: {form_submission is not None}")
             
             if form_submission and form_submission.form_data_complete:
-                form_data = json.loads(form_submission.form_data_complete)
+                form_data = form_submission.form_data_complete
                 app.logger.info(f"✅ 通过submission_id找到表单数据: {form_data.get('projectName', 'Unknown')}")
                 return form_data
         
@@ -280,28 +346,22 @@ def get_form_data_from_db(session):
         return session.get('analysis_form_data')
 
 def save_session_in_ajax():
-    """辅助函数：确保AJAX请求中session被正确保存，监控session大小"""
+    """辅助函数：AJAX请求中把session设为持久，并清理旧版本遗留的大数据
+
+    直接赋值的key会被自动保存，这里不再强制标记修改：服务端session只写回变化的key，
+    内容没变时不写数据库也不重新下发cookie。
+    """
     from flask import session
 
-    
-    # 计算session大小
-    session_size = len(json.dumps(dict(session), ensure_ascii=False))
-    app.logger.debug(f"Session size: {session_size} bytes")
-    
-    # 如果session过大，清理不必要的数据
-    if session_size > 3500:  # 留一些余量
-        app.logger.warning(f"Session size too large ({session_size} bytes), cleaning up...")
-        if 'analysis_result' in session:
-            del session['analysis_result']
-            app.logger.info("Removed analysis_result from session to reduce size")
-        if 'analysis_form_data' in session:
-            del session['analysis_form_data']
-            app.logger.info("Removed analysis_form_data from session to reduce size")
-    
-    session.permanent = True
-    session.modified = True
-    # 这会强制Flask重新计算session并设置cookie
-    app.logger.debug(f"Forcing session save - Status: {session.get('analysis_status')}, Result ID: {session.get('analysis_result_id')}")
+    # 结果和表单数据保存在数据库中，session只保留id
+    for key in ('analysis_result', 'analysis_form_data'):
+        if key in session:
+            del session[key]
+            app.logger.info(f"Removed {key} from session")
+
+    if not session.permanent:
+        session.permanent = True
+    app.logger.debug(f"Session saved - Status: {session.get('analysis_status')}, Result ID: {session.get('analysis_result_id')}")
 
 @app.route('/thinking')
 @login_required
@@ -319,14 +379,8 @@ def thinking_process():
         flash('请先填写项目信息', 'info')
         return redirect(url_for('index'))
 
-    # 确保分析状态正确初始化
-    if 'analysis_status' not in session:
-        session['analysis_status'] = 'not_started'
-        session['analysis_progress'] = 0
-        session['analysis_stage'] = '等待开始分析...'
-
-    app.logger.info(f"Thinking page loaded with status: {session.get('analysis_status')}")
-    return render_template('thinking_process.html')
+    app.logger.info(f"Thinking page loaded, analysis job: {session.get('analysis_job_id')}")
+    return render_template('thinking_process.html', sse_enabled=app.config['SSE_ENABLED'])
 
 @app.route('/thinking-demo')
 def thinking_demo():
@@ -377,19 +431,10 @@ def start_analysis():
     """专门用于启动AI分析的接口 - 增强错误处理，确保始终返回JSON"""
     # 最外层错误捕获 - 防止任何错误导致前端收到空响应
     try:
-        # 检查用户AI分析额度
+        # 检查用户AI分析额度（提交任务时再原子预留）
         if not current_user.has_quota():
             app.logger.warning(f"User {current_user.id} has no quota left: {current_user.quota_display}")
-            return jsonify({
-                'status': 'error',
-                'message': f'您的AI分析额度已用完（{current_user.quota_display}），请联系管理员增加额度',
-                'error_code': 'NO_QUOTA',
-                'quota_info': {
-                    'used': current_user.used_quota,
-                    'total': current_user.ai_quota,
-                    'remaining': current_user.remaining_quota
-                }
-            })
+            return _no_quota_response(current_user.used_quota, current_user.ai_quota)
         
         form_data = get_form_data_from_db(session)
         if not form_data:
@@ -399,15 +444,7 @@ def start_analysis():
                 'error_code': 'NO_FORM_DATA'
             })
         
-        # 重要：每次启动分析都强制重置状态，确保真正执行OpenAI API调用
-        app.logger.info(f"Force reset analysis status - Current: {session.get('analysis_status')}")
-        session['analysis_status'] = 'not_started'
-        session['analysis_started'] = False
-        session['analysis_progress'] = 0
-        if 'analysis_result_id' in session:
-            del session['analysis_result_id']
-        save_session_in_ajax()
-        
+        # 每次启动分析都创建新的分析任务（一次分析一行），不再在session中重置状态
         app.logger.info(f"Starting AI analysis for project: {form_data.get('projectName')}")
         
         # 启动分析
@@ -483,8 +520,8 @@ def start_analysis():
                         analysis_result = AnalysisResult()
                         analysis_result.id = fallback_id
                         analysis_result.user_id = current_user.id
-                        analysis_result.form_data = json.dumps(local_form_data, ensure_ascii=False)
-                        analysis_result.result_data = json.dumps(fallback_result, ensure_ascii=False)
+                        analysis_result.form_data = local_form_data
+                        analysis_result.result_data = fallback_result
                         analysis_result.project_name = project_name
                         analysis_result.project_description = local_form_data.get('projectDescription', '') if local_form_data else ''
                         analysis_result.team_size = len(local_form_data.get('keyPersons', [])) if local_form_data else 0
@@ -497,8 +534,8 @@ def start_analysis():
                     analysis_result = AnalysisResult()
                     analysis_result.id = fallback_id
                     analysis_result.user_id = current_user.id
-                    analysis_result.form_data = json.dumps(local_form_data, ensure_ascii=False)
-                    analysis_result.result_data = json.dumps(fallback_result, ensure_ascii=False)
+                    analysis_result.form_data = local_form_data
+                    analysis_result.result_data = fallback_result
                     analysis_result.project_name = project_name
                     analysis_result.project_description = local_form_data.get('projectDescription', '') if local_form_data else ''
                     analysis_result.team_size = len(local_form_data.get('keyPersons', [])) if local_form_data else 0
@@ -554,14 +591,41 @@ def get_session_data():
             'message': str(e)
         })
 
+# AI思考流展示内容，思考过程页面的轮询接口和SSE推送共用
+AI_THINKING_MESSAGES = [
+    '🧠 正在深度分析项目的市场潜力和可行性...',
+    '💡 构建非劳务收入管道的最优路径...',
+    '⚡ 评估各种资源组合的投资回报率...',
+    '🔍 识别潜在风险点并制定应对策略...',
+    '📊 计算预期收益和时间投入比例...',
+    '🎯 优化人员配置和资源分配方案...',
+    '🌟 寻找项目的独特竞争优势...',
+    '💰 设计可持续的盈利模式...',
+    '🚀 制定项目启动和扩张计划...',
+    '🔮 预测市场趋势和机会窗口...',
+    '⚙️ 整合资源链条，建立协作框架...',
+    '🎨 设计品牌价值和市场定位策略...',
+    '📈 制定收入阶梯和增长曲线...',
+    '🔬 研究用户需求和市场空白...',
+    '💎 挖掘隐藏的价值创造机会...',
+    '🌐 构建可扩展的商业生态系统...',
+    '⚡ OpenAI正在深度思考您的项目方案...',
+    '🤖 AI算法正在匹配最优收入模式...',
+    '📋 正在生成个性化的实施建议...'
+]
+
 @app.route('/get_ai_thinking_stream')
 @login_required
 def get_ai_thinking_stream():
     """AI思考流端点 - 为思考过程页面提供实时AI思考内容"""
     try:
         import random
-        # 检查分析状态
-        status = session.get('analysis_status', 'not_started')
+        # 检查分析状态（有分析任务时以任务表为准）
+        job_status = analysis_jobs.get_status(db.session, session.get('analysis_job_id'))
+        if job_status:
+            status = {'completed': 'completed', 'failed': 'error'}.get(job_status['state'], 'processing')
+        else:
+            status = session.get('analysis_status', 'not_started')
         
         if status == 'completed':
             return jsonify({
@@ -574,30 +638,7 @@ def get_ai_thinking_stream():
                 'content': '❌ 分析遇到问题，请稍后重试'
             })
         elif status in ['running', 'processing', 'not_started']:  # 增加not_started状态也能获取AI思考流
-            # 生成更丰富的AI思考内容，模拟真实的分析过程
-            thinking_content = [
-                '🧠 正在深度分析项目的市场潜力和可行性...',
-                '💡 构建非劳务收入管道的最优路径...',
-                '⚡ 评估各种资源组合的投资回报率...',
-                '🔍 识别潜在风险点并制定应对策略...',
-                '📊 计算预期收益和时间投入比例...',
-                '🎯 优化人员配置和资源分配方案...',
-                '🌟 寻找项目的独特竞争优势...',
-                '💰 设计可持续的盈利模式...',
-                '🚀 制定项目启动和扩张计划...',
-                '🔮 预测市场趋势和机会窗口...',
-                '⚙️ 整合资源链条，建立协作框架...',
-                '🎨 设计品牌价值和市场定位策略...',
-                '📈 制定收入阶梯和增长曲线...',
-                '🔬 研究用户需求和市场空白...',
-                '💎 挖掘隐藏的价值创造机会...',
-                '🌐 构建可扩展的商业生态系统...',
-                '⚡ OpenAI正在深度思考您的项目方案...',
-                '🤖 AI算法正在匹配最优收入模式...',
-                '📋 正在生成个性化的实施建议...'
-            ]
-            
-            content = random.choice(thinking_content)
+            content = random.choice(AI_THINKING_MESSAGES)
             return jsonify({
                 'status': 'available',
                 'content': content
@@ -656,6 +697,96 @@ def check_analysis_status():
                 status=500
             )
 
+@app.route('/analysis_events', methods=['GET'])
+@login_required
+def analysis_events():
+    """分析进度SSE推送 - 替代1秒一次的状态轮询
+
+    每次只按主键读取任务表的进度列，不读取表单数据、不写session；
+    单次连接最长保持SSE_MAX_DURATION秒，之后由浏览器EventSource携带
+    Last-Event-ID自动重连，不会长期占用web worker。
+    流式生成时还会推送已完成的结果片段（section事件），页面可提前展示真实内容。
+    """
+    job = job_queue.get(request.args.get('job_id') or session.get('analysis_job_id'))
+    if not job or (job.user_id != current_user.id and not current_user.is_admin):
+        return jsonify({
+            'status': 'error',
+            'message': '没有找到分析任务，请重新提交表单',
+            'error_code': 'NO_JOB'
+        }), 404
+
+    job_id = job.id
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    max_duration = app.config['SSE_MAX_DURATION']
+    db.session.close()  # 推送过程中不持有数据库连接
+
+    def sse_event(event, data, event_id=None):
+        lines = [f"event: {event}"]
+        if event_id is not None:
+            lines.append(f"id: {event_id}")
+        lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+        return "\n".join(lines) + "\n\n"
+
+    def event_stream():
+        import random
+
+        yield "retry: 2000\n\n"
+        seq = last_event_id if last_event_id is not None else -1
+        sent_sections = {}
+        deadline = time.time() + max_duration
+        next_thinking = time.time()
+        while time.time() < deadline:
+            snapshot = job_queue.snapshot(job_id)
+            if snapshot is None:
+                yield sse_event('done', {'status': 'error', 'message': '分析任务不存在',
+                                         'error_code': 'NO_JOB'})
+                return
+
+            if snapshot['event_seq'] != seq:
+                seq = snapshot['event_seq']
+                yield sse_event('stage', {
+                    'status': snapshot['status'],
+                    'stage_code': snapshot['stage_code'],
+                    'progress': snapshot['progress'] or 0,
+                    'stage': snapshot['stage'] or '分析正在进行中...'
+                }, event_id=seq)
+
+                # 流式生成中新完成的结果片段（overview、每条pipeline）
+                partial = json.loads(snapshot['partial_result']) if snapshot['partial_result'] else {}
+                for key, value in partial.items():
+                    entries = enumerate(value) if isinstance(value, list) else [(None, value)]
+                    for index, item in entries:
+                        if sent_sections.get((key, index)) == item:
+                            continue
+                        sent_sections[(key, index)] = item
+                        yield sse_event('section', {'key': key, 'index': index, 'value': item})
+
+            if snapshot['status'] == 'completed':
+                yield sse_event('done', {'status': 'completed', 'redirect_url': '/results',
+                                         'job_id': job_id}, event_id=seq)
+                return
+            if snapshot['status'] == 'failed':
+                yield sse_event('done', {
+                    'status': 'error',
+                    'message': f"分析过程遇到问题: {snapshot['error'] or '未知错误'}",
+                    'error_code': 'ANALYSIS_ERROR',
+                    'job_id': job_id
+                }, event_id=seq)
+                return
+
+            # 思考内容同时充当心跳，替代前端单独轮询/get_ai_thinking_stream
+            if time.time() >= next_thinking:
+                yield sse_event('thinking', {'content': random.choice(AI_THINKING_MESSAGES)})
+                next_thinking = time.time() + 4.5
+
+            # 同进程内的任务进度变化会立即唤醒；其他进程的任务按1秒间隔重新查询
+            job_queue.wait_for_update(timeout=1.0)
+
+    response = Response(stream_with_context(event_stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 禁止反向代理缓冲
+    return response
+
 def _internal_check_analysis_status():
     """内部状态检查函数"""
     from flask import session
@@ -663,6 +794,11 @@ def _internal_check_analysis_status():
 
     app.logger.info("=== Starting check_analysis_status ===")
 
+    # 优先读取分析任务状态：一次主键查询即可（已结束的任务走进程内缓存），无需解析表单数据
+    job_status = analysis_jobs.get_status(db.session, session.get('analysis_job_id'))
+    if job_status and job_status['user_id'] == current_user.id:
+        return _analysis_status_response(job_status)
+
     # 检查session数据
     try:
         form_data = get_form_data_from_db(session)
@@ -717,8 +853,8 @@ def _internal_check_analysis_status():
             fallback_id = str(uuid.uuid4())
             analysis_result = AnalysisResult()
             analysis_result.id = fallback_id
-            analysis_result.form_data = json.dumps(form_data, ensure_ascii=False)
-            analysis_result.result_data = json.dumps(fallback_result, ensure_ascii=False)
+            analysis_result.form_data = form_data
+            analysis_result.result_data = fallback_result
             analysis_result.project_name = form_data.get('projectName', '')
             analysis_result.project_description = form_data.get('projectDescription', '')
             analysis_result.team_size = len(form_data.get('keyPersons', []))
@@ -791,332 +927,313 @@ def _internal_check_analysis_status():
         'error_code': 'UNEXPECTED_STATUS'
     })
 
+def _no_quota_response(used, total):
+    return jsonify({
+        'status': 'error',
+        'message': f'您的AI分析额度已用完（{used}/{total}），请联系管理员增加额度',
+        'error_code': 'NO_QUOTA',
+        'quota_info': {
+            'used': used,
+            'total': total,
+            'remaining': max(0, total - used)
+        }
+    })
+
 def _handle_analysis_execution(form_data, session):
-    """处理AI分析执行"""
-    import traceback
+    """创建分析任务并加入后台任务队列，立即返回任务ID，不在请求线程中等待上游API"""
+    # 同一用户已有排队/执行中的任务时直接返回（包括其他标签页提交的），防止重复入队
+    active_job = analysis_jobs.active_for_user(db.session, current_user.id)
+    if active_job:
+        app.logger.warning(f"Analysis job already active: {active_job.id}, returning current status")
+        if session.get('analysis_job_id') != active_job.id:
+            session['analysis_job_id'] = active_job.id
+        return jsonify({
+            'status': 'processing',
+            'job_id': active_job.id,
+            'progress': active_job.progress or 10,
+            'stage': active_job.stage or '分析正在进行中...',
+            'message': '分析正在进行中，请稍候...'
+        })
 
-    import uuid
+    # 原子预留一次额度，与创建任务在同一事务中提交；并发提交不会超额
+    if quota_ledger.reserve(db.session, current_user.id) is None:
+        db.session.rollback()
+        quota = quota_ledger.usage(db.session, [current_user.id]).get(current_user.id)
+        app.logger.warning(f"User {current_user.id} has no quota left: {quota and quota['quota_display']}")
+        return _no_quota_response(quota['used_quota'], quota['ai_quota'])
 
+    # 额度预留、分析任务和后台任务在同一事务中提交（enqueue提交），任何一步失败都整体回滚
     try:
-        # 检查是否已经在执行中，防止重复调用
-        if session.get('analysis_started', False):
-            app.logger.warning("Analysis already started, returning current status")
-            return jsonify({
-                'status': 'processing',
-                'progress': session.get('analysis_progress', 50),
-                'stage': session.get('analysis_stage', '分析正在进行中...'),
-                'message': '分析正在进行中，请稍候...'
-            })
+        analysis_job = analysis_jobs.create(db.session, current_user.id,
+                                            form_submission_id=session.get('form_submission_id'),
+                                            project_name=form_data.get('projectName'),
+                                            quota_state=quota_ledger.RESERVED)
+        job = job_queue.enqueue('analysis', {
+            'form_data': form_data,
+            'form_submission_id': session.get('form_submission_id')
+        }, user_id=current_user.id, job_id=analysis_job.id)
+    except Exception:
+        db.session.rollback()
+        raise
+
+    # session中只记录任务ID，状态、进度和结果以analysis_jobs表为准
+    session['analysis_job_id'] = job.id
+    save_session_in_ajax()
+    app.logger.info(f"Analysis job enqueued: {job.id}")
+
+    return jsonify({
+        'status': 'processing',
+        'job_id': job.id,
+        'progress': 10,
+        'stage': job.stage,
+        'message': '分析任务已提交，正在排队执行...'
+    })
+
+def _analysis_status_response(job_status):
+    """将分析任务状态转换为前端轮询使用的JSON
+
+    不写session；响应带ETag（任务ID+版本号），状态没有变化时返回304。
+    """
+    job_id = job_status['id']
+    if job_status['state'] == 'completed':
+        payload = {'status': 'completed', 'redirect_url': '/results', 'job_id': job_id, 'progress': 100}
+    elif job_status['state'] == 'failed':
+        payload = {
+            'status': 'error',
+            'message': f"分析过程遇到问题: {job_status['error'] or '未知错误'}",
+            'error_code': 'ANALYSIS_ERROR',
+            'job_id': job_id
+        }
+    else:
+        # queued / running
+        stage = job_status['stage'] or '分析正在进行中...'
+        payload = {
+            'status': 'processing',
+            'job_id': job_id,
+            'progress': job_status['progress'] or 10,
+            'stage': stage,
+            'message': stage
+        }
+
+    response = jsonify(payload)
+    response.set_etag(f"{job_id}-{job_status['version']}")
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def _save_analysis_result(user, form_data, result, analysis_type, quota_job_id=None):
+    """保存分析结果（2分钟内相同项目的重复结果复用已有记录），返回AnalysisResult.id
+
+    quota_job_id: 预留了额度的分析任务ID，创建新记录时在同一事务中确认扣除；
+    复用已有记录时不确认，任务结束后预留被退回
+    """
+    project_name = form_data.get('projectName', '')
+
+    # 防止并发创建重复记录
+    try:
+        existing_result = AnalysisResult.query.filter_by(
+            user_id=user.id,
+            project_name=project_name,
+            analysis_type=analysis_type
+        ).order_by(AnalysisResult.created_at.desc()).first()
+
+        # 如果2分钟内已有相同的分析结果，使用现有的
+        if existing_result and datetime.utcnow() - existing_result.created_at < timedelta(minutes=2):
+            app.logger.info(f"⚠️ 检测到2分钟内的重复分析，使用现有记录: {existing_result.id}")
+            return existing_result.id
+
+        result_id = str(uuid.uuid4())
+        analysis_result = AnalysisResult()
+        analysis_result.id = result_id
+        analysis_result.user_id = user.id  # 关联任务所属用户
+        analysis_result.form_data = form_data
+        analysis_result.result_data = result
+        analysis_result.project_name = project_name
+        analysis_result.project_description = form_data.get('projectDescription', '')
+        analysis_result.team_size = len(form_data.get('keyPersons', []))
+        analysis_result.analysis_type = analysis_type
+        db.session.add(analysis_result)
+        # 确认预留的额度，与保存结果一起提交
+        charged = quota_ledger.charge(db.session, quota_job_id) if quota_job_id else False
+        db.session.commit()
+
+        if charged:
+            app.logger.info(f"✅ 创建新的分析记录: {result_id}，已确认任务 {quota_job_id} 预留的额度")
+        else:
+            app.logger.info(f"✅ 创建新的{analysis_type}记录: {result_id}")
+        return result_id
+
+    except Exception as db_error:
+        app.logger.error(f"❌ 数据库操作失败: {str(db_error)}")
+        db.session.rollback()
+        # 如果数据库操作失败，重新检查是否有其他并发请求已经创建了记录
+        existing_result = AnalysisResult.query.filter_by(
+            user_id=user.id,
+            project_name=project_name,
+            analysis_type=analysis_type
+        ).order_by(AnalysisResult.created_at.desc()).first()
+
+        if existing_result:
+            app.logger.info(f"⚠️ 并发冲突，使用已存在的记录: {existing_result.id}")
+            return existing_result.id
+        # 重新抛出异常，因为确实有问题
+        raise
+
+# 分析任务的阶段：阶段代码 -> (进度, 阶段描述)，SSE推送和状态轮询共用
+ANALYSIS_STAGES = {
+    'queued': (0, '任务已排队，等待执行...'),
+    'running': (20, '正在分析项目数据...'),
+    'prompt_built': (35, '已构建分析框架，准备调用AI...'),
+    'upstream_call': (50, '正在调用AI分析引擎...'),
+    'coalesced': (80, '已获取相同项目的并行分析结果...'),
+    'validating': (85, '正在校验分析结果...'),
+    'persisted': (95, '分析结果已保存...'),
+}
+
+def _analysis_reporters(report):
+    """返回分析任务的 (report_stage, report_section) 回调，同步和协程任务共用"""
+    def report_stage(stage_code):
+        progress, stage = ANALYSIS_STAGES[stage_code]
+        report(progress, stage, stage_code)
+
+    # 流式生成中已闭合的结果片段，写入任务表后由SSE推送给思考过程页面提前展示
+    partial = {}
+
+    def report_section(event):
+        key = event['key']
+        if event['type'] == 'item':
+            items = partial.setdefault(key, [])
+            del items[event['index']:]  # 流式重试时从该位置重新填充
+            items.append(event['value'])
+            report(min(80, 55 + 5 * len(items)), f'已生成第{len(items)}条收入管道...', partial=partial)
+        elif key == 'overview':
+            partial[key] = event['value']
+            report(55, '已生成局面分析，正在设计收入管道...', partial=partial)
+
+    return report_stage, report_section
+
+def _execute_analysis_job(job, payload, report):
+    """后台任务：执行AI分析并保存结果，返回AnalysisResult.id
+
+    运行在任务线程的应用上下文中，没有request/session/current_user，
+    进度按ANALYSIS_STAGES中的阶段写入任务表。
+    """
+    form_data = payload.get('form_data') or {}
+    user = db.session.get(User, job.user_id)
+    if user is None:
+        raise ValueError(f"任务所属用户不存在: {job.user_id}")
+
+    report_stage, report_section = _analysis_reporters(report)
+
+    try:
+        report_stage('running')
+        app.logger.info(f"Starting AI analysis job {job.id} for project: {form_data.get('projectName')}")
 
-        # 标记分析已开始，防止重复执行
-        session['analysis_started'] = True
-        session['analysis_status'] = 'processing'
-        session['analysis_progress'] = 10
-        session['analysis_stage'] = '开始AI分析...'
-        save_session_in_ajax()  # 使用辅助函数确保session被保存
-        app.logger.info("Starting AI analysis in request context - FIRST TIME")
-        app.logger.info(f"Form data for analysis: {json.dumps(form_data, ensure_ascii=False)[:200]}")
-
-        # 执行AI分析，设置进度追踪
-        session['analysis_progress'] = 30
-        session['analysis_stage'] = '正在分析项目数据...'
-        save_session_in_ajax()  # 使用辅助函数确保session被保存
-        
         # 使用强化的多层错误处理机制调用AI分析
         suggestions = None
         max_ai_retries = 2
         for retry_count in range(max_ai_retries):
             try:
                 app.logger.info(f"🚀 AI分析尝试 {retry_count + 1}/{max_ai_retries} - 即将调用generate_ai_suggestions")
-                suggestions = generate_ai_suggestions(form_data, session)
+                suggestions = generate_ai_suggestions(form_data, stage_callback=report_stage,
+                                                      section_callback=report_section, user_id=job.user_id)
                 app.logger.info(f"✅ generate_ai_suggestions成功返回，数据类型: {type(suggestions)}")
                 if suggestions:
                     app.logger.info("🎯 获得有效suggestions，跳出重试循环")
                     break  # 成功获得结果，跳出重试循环
                 else:
                     app.logger.warning("⚠️ generate_ai_suggestions返回了空结果")
+            except CircuitOpenError as circuit_error:
+                # 上游熔断中：不再重试，直接保存备用方案（不消耗额度）
+                app.logger.warning(f"⚡ 上游熔断，任务 {job.id} 直接使用备用方案: {str(circuit_error)}")
+                return _save_circuit_fallback(job.user_id, form_data, report_stage)
             except Exception as ai_error:
                 app.logger.error(f"💥 AI分析失败 (尝试 {retry_count + 1}): {str(ai_error)}")
-                app.logger.error(f"💥 异常类型: {type(ai_error).__name__}")
-                import traceback
                 app.logger.error(f"💥 完整错误堆栈: {traceback.format_exc()}")
                 if retry_count == max_ai_retries - 1:
                     # 最后一次尝试失败，生成备用方案
                     app.logger.info("🛡️ 最后尝试失败，生成备用方案")
                     suggestions = generate_fallback_result(form_data, "分析过程遇到技术问题，为您提供基础建议")
-                    session['analysis_fallback'] = True
-                    save_session_in_ajax()
                 else:
                     # 等待后重试
                     app.logger.warning(f"⏳ 等待3秒后进行第{retry_count + 2}次重试...")
                     time.sleep(3)
-                    continue
-
-        if suggestions and isinstance(suggestions, dict):
-            # 分析成功 - 将结果存储到数据库而不是session，避免session过大
-            import uuid
-            result_id = str(uuid.uuid4())
-
-            # 创建AnalysisResult实例（添加重复性检查）
-            from datetime import datetime, timedelta
-            
-            # 使用数据库锁防止并发重复保存
-            project_name = form_data.get('projectName', '')
-            
-            # 防止并发创建重复记录
-            try:
-                # 查询现有记录，检查是否存在重复
-                existing_result = AnalysisResult.query.filter_by(
-                    user_id=current_user.id,
-                    project_name=project_name,
-                    analysis_type='ai_analysis'
-                ).order_by(AnalysisResult.created_at.desc()).first()
-                
-                # 如果2分钟内已有相同的分析结果，使用现有的
-                if existing_result:
-                    time_diff = datetime.utcnow() - existing_result.created_at
-                    if time_diff < timedelta(minutes=2):
-                        app.logger.info(f"⚠️ 检测到2分钟内的重复分析，使用现有记录: {existing_result.id}")
-                        result_id = existing_result.id
-                        # 使用现有记录，无需操作数据库
-                    else:
-                        # 超过2分钟，创建新的分析结果
-                        analysis_result = AnalysisResult()
-                        analysis_result.id = result_id
-                        analysis_result.user_id = current_user.id  # 关联当前用户
-                        analysis_result.form_data = json.dumps(form_data, ensure_ascii=False)
-                        analysis_result.result_data = json.dumps(suggestions, ensure_ascii=False)
-                        analysis_result.project_name = project_name
-                        analysis_result.project_description = form_data.get('projectDescription', '')
-                        analysis_result.team_size = len(form_data.get('keyPersons', []))
-                        analysis_result.analysis_type = 'ai_analysis'
-                        db.session.add(analysis_result)
-                        db.session.commit()
-                        # 成功创建新记录后，消耗用户AI分析额度
-                        if current_user.consume_quota():
-                            db.session.commit()  # 保存额度变更
-                            app.logger.info(f"✅ 创建新的分析记录: {result_id}，消耗额度1次，剩余: {current_user.remaining_quota}")
-                        else:
-                            app.logger.warning(f"⚠️ 额度消耗失败，用户当前额度: {current_user.quota_display}")
-                else:
-                    # 没有现有分析结果，创建新的
-                    analysis_result = AnalysisResult()
-                    analysis_result.id = result_id
-                    analysis_result.user_id = current_user.id  # 关联当前用户
-                    analysis_result.form_data = json.dumps(form_data, ensure_ascii=False)
-                    analysis_result.result_data = json.dumps(suggestions, ensure_ascii=False)
-                    analysis_result.project_name = project_name
-                    analysis_result.project_description = form_data.get('projectDescription', '')
-                    analysis_result.team_size = len(form_data.get('keyPersons', []))
-                    analysis_result.analysis_type = 'ai_analysis'
-                    db.session.add(analysis_result)
-                    db.session.commit()
-                    # 成功创建新记录后，消耗用户AI分析额度
-                    if current_user.consume_quota():
-                        db.session.commit()  # 保存额度变更
-                        app.logger.info(f"✅ 创建首个分析记录: {result_id}，消耗额度1次，剩余: {current_user.remaining_quota}")
-                    else:
-                        app.logger.warning(f"⚠️ 额度消耗失败，用户当前额度: {current_user.quota_display}")
-                    
-            except Exception as db_error:
-                app.logger.error(f"❌ 数据库操作失败: {str(db_error)}")
-                db.session.rollback()
-                # 如果数据库操作失败，重新检查是否有其他并发请求已经创建了记录
-                existing_result = AnalysisResult.query.filter_by(
-                    user_id=current_user.id,
-                    project_name=project_name,
-                    analysis_type='ai_analysis'
-                ).order_by(AnalysisResult.created_at.desc()).first()
-                
-                if existing_result:
-                    app.logger.info(f"⚠️ 并发冲突，使用已存在的记录: {existing_result.id}")
-                    result_id = existing_result.id
-                else:
-                    # 重新抛出异常，因为确实有问题
-                    raise db_error
 
-            # 在session中只存储最小必要数据，避免cookie过大
-            # 只保存项目名称用于显示，完整数据从数据库读取
-            session['analysis_project_name'] = form_data.get('projectName', '')
-            session['analysis_result_id'] = result_id
-            session['analysis_status'] = 'completed'
-            session['analysis_started'] = False  # 重置开始标志
-            session['analysis_progress'] = 100  # 只有真正完成时才设置为100%
-            session['analysis_stage'] = '分析完成！'
-            # 清理大数据对象
-            if 'analysis_result' in session:
-                del session['analysis_result']
-            if 'analysis_form_data' in session:
-                del session['analysis_form_data']  # 删除大的form_data
-
-            # 使用辅助函数确保session在AJAX中被保存
-            save_session_in_ajax()
-
-            app.logger.info(f"AI analysis completed successfully, result stored with ID: {result_id}")
-            app.logger.info(f"Session updated - Status: {session.get('analysis_status')}, Result ID: {session.get('analysis_result_id')}")
-            app.logger.info(f"Session state after update - Permanent: {session.permanent}, Modified: {session.modified}")
-
-            # 立即返回成功响应，不需要额外处理
-            app.logger.info("About to return success response to frontend")
-            
-            try:
-                response = jsonify({
-                    'status': 'completed', 
-                    'message': '分析完成，正在跳转到结果页面...',
-                    'progress': 100
-                })
-                app.logger.info("Successfully created JSON response")
-                return response
-            except Exception as response_error:
-                app.logger.error(f"Error creating JSON response: {str(response_error)}")
-                # 即使JSON创建失败，也要确保前端知道分析完成了
-                session['analysis_status'] = 'completed'
-                save_session_in_ajax()
-                raise response_error
-        else:
+        if not suggestions or not isinstance(suggestions, dict):
             # 分析结果无效
-            app.logger.error("AI analysis returned invalid result")
-            session['analysis_status'] = 'error'
-            session['analysis_error'] = '分析结果无效'
-            return jsonify({
-                'status': 'error', 
-                'message': '分析结果无效，请重试',
-                'error_code': 'INVALID_RESULT'
-            })
+            raise ValueError('分析结果无效')
+
+        # 备用方案（上游调用失败）不确认额度，任务结束后预留被退回
+        from openai_service import FallbackResult
+        quota_job_id = None if isinstance(suggestions, FallbackResult) else job.id
+        result_id = _save_analysis_result(user, form_data, suggestions, 'ai_analysis', quota_job_id=quota_job_id)
+        report_stage('persisted')
+        app.logger.info(f"AI analysis job {job.id} completed, result stored with ID: {result_id}")
+        return result_id
 
     except Exception as analysis_error:
-        # 分析执行错误
-        error_msg = str(analysis_error)
-        app.logger.error(f"Analysis execution error: {error_msg}")
+        error_msg = str(analysis_error).lower()
+        app.logger.error(f"Analysis job execution error: {str(analysis_error)}")
         app.logger.error(f"Analysis traceback: {traceback.format_exc()}")
 
         # 如果是网络超时错误，立即生成备用方案
-        if ('timeout' in error_msg.lower() or 'connection' in error_msg.lower() or 
-            'ssl' in error_msg.lower() or 'network' in error_msg.lower() or
-            'read timeout' in error_msg.lower() or 'connect timeout' in error_msg.lower() or
-            'recv' in error_msg.lower() or 'systemexit' in error_msg.lower() or 'socket' in error_msg.lower()):
-            session['analysis_status'] = 'timeout'
+        if any(keyword in error_msg for keyword in ['timeout', 'connection', 'ssl', 'network', 'recv', 'systemexit', 'socket']):
             app.logger.info(f"Network/timeout error detected: {error_msg}, immediately generating fallback")
+            report(90, '网络不稳定，正在生成备用方案...')
+            fallback_result = generate_fallback_result(form_data)
+            result_id = _save_analysis_result(user, form_data, fallback_result, 'fallback')
+            report_stage('persisted')
+            return result_id
+        raise
+
+def _save_circuit_fallback(user_id, form_data, report_stage):
+    """上游熔断时保存备用方案（不消耗额度），返回AnalysisResult.id"""
+    fallback_result = generate_fallback_result(form_data, "AI服务暂时繁忙，为您提供基础建议")
+    result_id = _save_job_analysis_result(user_id, form_data, fallback_result, 'fallback')
+    report_stage('persisted')
+    return result_id
+
+def _save_job_analysis_result(user_id, form_data, result, analysis_type, quota_job_id=None):
+    """在数据库线程中加载任务所属用户并保存结果（协程任务通过run_sync调用）"""
+    user = db.session.get(User, user_id)
+    if user is None:
+        raise ValueError(f"任务所属用户不存在: {user_id}")
+    return _save_analysis_result(user, form_data, result, analysis_type, quota_job_id)
+
+async def _execute_analysis_job_async(job, payload, report, run_sync):
+    """_execute_analysis_job的协程版本（AI_ASYNC_ENABLED=true时使用）
+
+    上游调用在事件循环中等待，不占用线程；缓存查询、结果保存等数据库操作通过run_sync执行。
+    agenerate_income_paths在上游失败时已返回备用方案，这里不再重试。
+    """
+    from openai_service import FallbackResult, angela_ai
 
-            try:
-                fallback_result = generate_fallback_result(form_data)
-
-                # 保存备用方案到数据库（添加重复性检查）
-                from datetime import datetime, timedelta
-                import uuid
-
-                # 使用数据库锁防止并发重复保存fallback
-                project_name = form_data.get('projectName', '')
-                
-                try:
-                    # 查询现有fallback记录
-                    existing_fallback = AnalysisResult.query.filter_by(
-                        user_id=current_user.id,
-                        project_name=project_name,
-                        analysis_type='fallback'
-                    ).order_by(AnalysisResult.created_at.desc()).first()
-                    
-                    # 如果2分钟内已有相同的fallback，使用现有的
-                    if existing_fallback:
-                        time_diff = datetime.utcnow() - existing_fallback.created_at
-                        if time_diff < timedelta(minutes=2):
-                            app.logger.info(f"⚠️ 检测到2分钟内的重复fallback，使用现有记录: {existing_fallback.id}")
-                            fallback_id = existing_fallback.id
-                            # 使用现有记录，无需操作数据库
-                        else:
-                            # 超过2分钟，创建新的
-                            fallback_id = str(uuid.uuid4())
-                            analysis_result = AnalysisResult()
-                            analysis_result.id = fallback_id
-                            analysis_result.user_id = current_user.id  # 关联当前用户
-                            analysis_result.form_data = json.dumps(form_data, ensure_ascii=False)
-                            analysis_result.result_data = json.dumps(fallback_result, ensure_ascii=False)
-                            analysis_result.project_name = project_name
-                            analysis_result.project_description = form_data.get('projectDescription', '')
-                            analysis_result.team_size = len(form_data.get('keyPersons', []))
-                            analysis_result.analysis_type = 'fallback'
-                            db.session.add(analysis_result)
-                            db.session.commit()
-                            app.logger.info(f"✅ 创建新的fallback记录: {fallback_id}")
-                    else:
-                        # 没有现有fallback，创建新的
-                        fallback_id = str(uuid.uuid4())
-                        analysis_result = AnalysisResult()
-                        analysis_result.id = fallback_id
-                        analysis_result.user_id = current_user.id  # 关联当前用户
-                        analysis_result.form_data = json.dumps(form_data, ensure_ascii=False)
-                        analysis_result.result_data = json.dumps(fallback_result, ensure_ascii=False)
-                        analysis_result.project_name = project_name
-                        analysis_result.project_description = form_data.get('projectDescription', '')
-                        analysis_result.team_size = len(form_data.get('keyPersons', []))
-                        analysis_result.analysis_type = 'fallback'
-                        db.session.add(analysis_result)
-                        db.session.commit()
-                        app.logger.info(f"✅ 创建首个fallback记录: {fallback_id}")
-                        
-                except Exception as db_error:
-                    app.logger.error(f"❌ Fallback数据库操作失败: {str(db_error)}")
-                    db.session.rollback()
-                    # 查找是否有其他并发请求已经创建了记录
-                    existing_fallback = AnalysisResult.query.filter_by(
-                        user_id=current_user.id,
-                        project_name=project_name,
-                        analysis_type='fallback'
-                    ).order_by(AnalysisResult.created_at.desc()).first()
-                    
-                    if existing_fallback:
-                        app.logger.info(f"⚠️ Fallback并发冲突，使用已存在的记录: {existing_fallback.id}")
-                        fallback_id = existing_fallback.id
-                    else:
-                        # 重新抛出异常
-                        raise db_error
-
-                # 更新session状态为完成，只保存必要数据
-                session['analysis_project_name'] = form_data.get('projectName', '')
-                session['analysis_status'] = 'completed'
-                session['analysis_result_id'] = fallback_id
-                # 清理大数据
-                if 'analysis_result' in session:
-                    del session['analysis_result']
-                if 'analysis_form_data' in session:
-                    del session['analysis_form_data']
-
-                # 使用辅助函数确保session在AJAX中被保存
-                save_session_in_ajax()
-
-                app.logger.info(f"Fallback generated immediately due to timeout, ID: {fallback_id}")
-
-                # 创建response并确保session被保存
-                response = jsonify({
-                    'status': 'completed', 
-                    'message': '网络不稳定，已生成备用方案...',
-                    'progress': 100
-                })
-
-                from flask import make_response
-                response = make_response(response)
-
-                return response
+    form_data = payload.get('form_data') or {}
+    report_stage, report_section = _analysis_reporters(report)
+    report_stage('running')
+    app.logger.info(f"Starting async AI analysis job {job.id} for project: {form_data.get('projectName')}")
 
-            except Exception as fallback_error:
-                app.logger.error(f"Fallback generation failed: {str(fallback_error)}")
-                session['analysis_status'] = 'error'
-                session['analysis_started'] = False  # 重置开始标志，允许重试
-                session['analysis_error'] = '网络超时且备用方案生成失败，请重试'
-                return jsonify({
-                    'status': 'error', 
-                    'message': '网络连接问题，请检查网络后重试',
-                    'error_code': 'NETWORK_AND_FALLBACK_FAILED'
-                })
-        else:
-            session['analysis_status'] = 'error'
-            session['analysis_started'] = False  # 重置开始标志，允许重试
-            session['analysis_error'] = error_msg
-            return jsonify({
-                'status': 'error', 
-                'message': f'分析过程遇到问题: {error_msg}',
-                'error_code': 'EXECUTION_ERROR'
-            })
+    try:
+        suggestions = await angela_ai.agenerate_income_paths(
+            _convert_form_data(form_data), db.session, run_sync=run_sync,
+            stage_callback=report_stage, section_callback=report_section, user_id=job.user_id)
+    except CircuitOpenError as circuit_error:
+        app.logger.warning(f"⚡ 上游熔断，任务 {job.id} 直接使用备用方案: {str(circuit_error)}")
+        return await run_sync(_save_circuit_fallback, job.user_id, form_data, report_stage)
+    analysis_type = 'ai_analysis'
+    if not suggestions or not isinstance(suggestions, dict):
+        suggestions = generate_fallback_result(form_data, "分析过程遇到技术问题，为您提供基础建议")
+        analysis_type = 'fallback'
+
+    # 备用方案（上游调用失败）不确认额度，任务结束后预留被退回
+    quota_job_id = None if isinstance(suggestions, FallbackResult) else job.id
+    result_id = await run_sync(_save_job_analysis_result, job.user_id, form_data, suggestions,
+                               analysis_type, quota_job_id)
+    report_stage('persisted')
+    app.logger.info(f"Async AI analysis job {job.id} completed, result stored with ID: {result_id}")
+    return result_id
+
+job_queue.register('analysis', _execute_analysis_job_async if app.config['AI_ASYNC_ENABLED']
+                   else _execute_analysis_job)
 
 @app.route('/results')
 @login_required
@@ -1129,8 +1246,8 @@ def results():
         url_result_id = request.args.get('result_id')
         
         # 详细记录session状态和URL参数
-        app.logger.info(f"Results page accessed - Full session: {dict(session)}")
-        app.logger.info(f"Results page - Session ID: {request.cookies.get('session', 'No session cookie')}")
+        log_payload(app.logger, "Results page accessed - Full session", session)
+        app.logger.info(f"Results page - Session cookie present: {'session' in request.cookies}")
         app.logger.info(f"Results page - URL result_id parameter: {url_result_id}")
 
         # 如果URL中有result_id参数，优先使用它
@@ -1150,8 +1267,8 @@ def results():
                         return redirect(url_for('analysis_history'))
                     
                     # 解析数据并直接显示
-                    form_data = json.loads(analysis_record.form_data) if analysis_record.form_data else {}
-                    result_data = json.loads(analysis_record.result_data) if analysis_record.result_data else {}
+                    form_data = analysis_record.form_data or {}
+                    result_data = analysis_record.result_data or {}
                     
                     app.logger.info(f"Successfully loaded analysis record from URL parameter: {url_result_id}")
                     
@@ -1161,6 +1278,7 @@ def results():
                                          status='completed',
                                          history_mode=True,
                                          analysis_id=analysis_record.id,
+                                         result_etag=_result_etag(analysis_record.id, analysis_record.version),
                                          record_info={
                                              'id': analysis_record.id,
                                              'created_at': analysis_record.created_at_display,
@@ -1176,7 +1294,23 @@ def results():
                 flash('加载分析记录时发生错误', 'error')
                 return redirect(url_for('analysis_history'))
 
-        # 如果没有URL参数，继续使用原有的session逻辑
+        # 分析任务已完成：按任务记录的结果ID直接读取，不再走下面基于session的恢复逻辑
+        job_status = analysis_jobs.get_status(db.session, session.get('analysis_job_id'))
+        if job_status and job_status['state'] == 'completed' and job_status['user_id'] == current_user.id:
+            from models import AnalysisResult
+
+            analysis_record = db.session.get(AnalysisResult, job_status['result_id'])
+            if analysis_record and analysis_record.result_data:
+                return render_template('result_pipeline_redesigned.html',
+                                     form_data=analysis_record.form_data or {},
+                                     result=analysis_record.result_data,
+                                     status='completed',
+                                     analysis_id=analysis_record.id,
+                                     result_etag=_result_etag(analysis_record.id, analysis_record.version))
+            app.logger.warning(f"Analysis job {job_status['id']} completed but result {job_status['result_id']} not found")
+
+        # 没有分析任务（旧版本session）时，继续使用原有的session逻辑
+
         # Get form data and analysis status from session
         form_data = get_form_data_from_db(session)
         status = session.get('analysis_status', 'not_started')
@@ -1195,7 +1329,7 @@ def results():
                 analysis_record = AnalysisResult.query.filter_by(id=result_id).first()
                 if analysis_record:
                     if analysis_record.form_data and not form_data:
-                        form_data = json.loads(analysis_record.form_data)
+                        form_data = analysis_record.form_data
                         # 不要把大数据写回session，只更新项目名称
                         session['analysis_project_name'] = form_data.get('projectName', '')
                         session.permanent = True
@@ -1203,7 +1337,7 @@ def results():
                         app.logger.info(f"Recovered form data from database for result ID: {result_id}")
 
                     if analysis_record.result_data:
-                        result_data = json.loads(analysis_record.result_data)
+                        result_data = analysis_record.result_data
                         # 不要把结果数据写回session，会导致cookie过大
                         session['analysis_status'] = 'completed'
                         session.permanent = True
@@ -1234,8 +1368,8 @@ def results():
                         result_id = latest_ai_result.id
                         session['analysis_result_id'] = result_id
                         session['analysis_status'] = 'completed'
-                        result_data = json.loads(latest_ai_result.result_data)
-                        session['analysis_result'] = result_data
+                        # 结果只按id从数据库读取，不写入session
+                        result_data = latest_ai_result.result_data
                         session.permanent = True  # 添加permanent确保持久化
                         session.modified = True
                         status = 'completed'
@@ -1259,10 +1393,13 @@ def results():
                     project_description = form_data.get('projectDescription', '')
 
                     if project_name and project_description:
-                        # 查找匹配项目名称和描述关键词的AI分析结果
-                        ai_records = AnalysisResult.query.filter(
+                        # 按项目名查找AI分析结果（走表达式索引），只读取描述用于比对
+                        ai_records = db.session.query(
+                            AnalysisResult.id,
+                            json_text(AnalysisResult.form_data, 'projectDescription').label('description')
+                        ).filter(
                             AnalysisResult.analysis_type == 'ai_analysis',
-                            AnalysisResult.form_data.contains(f'"{project_name}"')
+                            json_text(AnalysisResult.form_data, 'projectName') == project_name
                         ).order_by(AnalysisResult.created_at.desc()).all()
 
                         # 进一步验证：检查描述中的关键词匹配
@@ -1270,20 +1407,14 @@ def results():
                         key_words = project_description[:50]  # 取描述前50字符作为关键特征
 
                         for record in ai_records:
-                            try:
-                                record_form_data = json.loads(record.form_data)
-                                record_description = record_form_data.get('projectDescription', '')
-                                # 检查描述是否包含相同的关键词
-                                if key_words in record_description or record_description[:50] in project_description:
-                                    matching_record = record
-                                    break
-                            except Exception as e:
-                                app.logger.debug(f"Failed to parse record form data: {str(e)}")
-                                continue
+                            record_description = record.description or ''
+                            # 检查描述是否包含相同的关键词
+                            if key_words in record_description or record_description[:50] in project_description:
+                                matching_record = db.session.get(AnalysisResult, record.id)
+                                break
 
                         if matching_record:
-                            result_data = json.loads(matching_record.result_data)
-                            session['analysis_result'] = result_data
+                            result_data = matching_record.result_data
                             session['analysis_result_id'] = matching_record.id
                             session.permanent = True
                             session.modified = True
@@ -1320,20 +1451,20 @@ def results():
                     if analysis_record and analysis_record.result_data:
                         # 额外验证：检查数据库记录的表单数据与session中的表单数据是否匹配
                         try:
-                            db_form_data = json.loads(analysis_record.form_data)
+                            db_form_data = analysis_record.form_data
                             session_project_name = form_data.get('projectName', '')
                             db_project_name = db_form_data.get('projectName', '')
 
                             if session_project_name and db_project_name and session_project_name != db_project_name:
                                 app.logger.warning(f"Data mismatch: session project '{session_project_name}' != database project '{db_project_name}' for result_id {result_id}")
                                 # 数据不匹配，尝试找正确的记录
-                                correct_records = AnalysisResult.query.filter(
+                                correct_record = AnalysisResult.query.filter(
                                     AnalysisResult.analysis_type == 'ai_analysis',
-                                    AnalysisResult.form_data.contains(f'"{session_project_name}"')
-                                ).order_by(AnalysisResult.created_at.desc()).all()
+                                    json_text(AnalysisResult.form_data, 'projectName') == session_project_name
+                                ).order_by(AnalysisResult.created_at.desc()).first()
 
-                                if correct_records:
-                                    analysis_record = correct_records[0]
+                                if correct_record:
+                                    analysis_record = correct_record
                                     result_id = analysis_record.id
                                     session['analysis_result_id'] = result_id
                                     session.permanent = True
@@ -1354,7 +1485,7 @@ def results():
                             app.logger.error(f"Failed to validate data consistency: {str(validate_error)}")
 
                         if analysis_record and analysis_record.result_data:
-                            suggestions = json.loads(analysis_record.result_data)
+                            suggestions = analysis_record.result_data
                             app.logger.info(f"Analysis completed - showing full results from database for ID: {result_id}")
                     else:
                         app.logger.warning(f"Analysis result not found in database: {result_id}")
@@ -1407,8 +1538,8 @@ def results():
                         analysis_result = AnalysisResult()
                         analysis_result.id = fallback_id
                         analysis_result.user_id = current_user.id  # 关联当前用户
-                        analysis_result.form_data = json.dumps(form_data, ensure_ascii=False)
-                        analysis_result.result_data = json.dumps(fallback_result, ensure_ascii=False)
+                        analysis_result.form_data = form_data
+                        analysis_result.result_data = fallback_result
                         analysis_result.project_name = form_data.get('projectName', '')
                         analysis_result.project_description = form_data.get('projectDescription', '')
                         analysis_result.team_size = len(form_data.get('keyPersons', []))
@@ -1456,7 +1587,7 @@ def results():
                     from models import AnalysisResult
                     analysis_record = AnalysisResult.query.filter_by(id=result_id).first()
                     if analysis_record and analysis_record.result_data:
-                        suggestions = json.loads(analysis_record.result_data)
+                        suggestions = analysis_record.result_data
                         app.logger.info(f"Found existing result in database for ID: {result_id}")
                         return render_template('result_pipeline_redesigned.html', 
                                              form_data=form_data, 
@@ -1480,8 +1611,8 @@ def results():
                     emergency_id = str(uuid.uuid4())
                     analysis_result = AnalysisResult()
                     analysis_result.id = emergency_id
-                    analysis_result.form_data = json.dumps(form_data, ensure_ascii=False)
-                    analysis_result.result_data = json.dumps(fallback_result, ensure_ascii=False)
+                    analysis_result.form_data = form_data
+                    analysis_result.result_data = fallback_result
                     analysis_result.project_name = form_data.get('projectName', '')
                     analysis_result.project_description = form_data.get('projectDescription', '')
                     analysis_result.team_size = len(form_data.get('keyPersons', []))
@@ -1531,7 +1662,7 @@ def generate():
         app.logger.info(f"Generate route accessed - Request method: {request.method}")
         app.logger.info(f"Generate route - Form data keys: {list(request.form.keys())}")
         app.logger.info(f"Generate route - Content type: {request.content_type}")
-        app.logger.info(f"Generate route - All form data: {dict(request.form)}")
+        log_payload(app.logger, "Generate route - All form data", request.form)
         
         # 初始化变量
         project_name = ''
@@ -1647,7 +1778,7 @@ def generate():
                     form_submission.project_name = form_data.get('projectName', '')
                     form_submission.project_description = form_data.get('projectDescription', '')
                     form_submission.key_persons_data = json.dumps(form_data.get('keyPersons', []), ensure_ascii=False)
-                    form_submission.form_data_complete = json.dumps(form_data, ensure_ascii=False)
+                    form_submission.form_data_complete = form_data
                     form_submission.status = 'submitted'
                     form_submission.created_at = datetime.utcnow()
                     form_submission.updated_at = datetime.utcnow()
@@ -1663,7 +1794,7 @@ def generate():
                 form_submission.project_name = form_data.get('projectName', '')
                 form_submission.project_description = form_data.get('projectDescription', '')
                 form_submission.key_persons_data = json.dumps(form_data.get('keyPersons', []), ensure_ascii=False)
-                form_submission.form_data_complete = json.dumps(form_data, ensure_ascii=False)
+                form_submission.form_data_complete = form_data
                 form_submission.status = 'submitted'
                 form_submission.created_at = datetime.utcnow()
                 form_submission.updated_at = datetime.utcnow()
@@ -1682,24 +1813,21 @@ def generate():
             db.session.rollback()
             raise
 
-        # 清理所有旧的分析相关数据，确保新项目不会使用旧的result_id
-        session['analysis_status'] = 'not_started'
-        session['analysis_started'] = False  # 重置开始标志
-        session['analysis_result'] = None
-        session['analysis_result_id'] = None  # 关键修复：清理旧的result_id
-        session['analysis_progress'] = 0
-        session['analysis_stage'] = '准备开始分析...'
-        session.pop('analysis_error', None)  # 清理可能存在的错误信息
+        # 新表单不再跟踪旧的分析任务；分析状态保存在analysis_jobs表中，
+        # 同时清理旧版本保存在session中的分析状态，确保新项目不会使用旧的result_id
+        for key in ('analysis_job_id', 'analysis_status', 'analysis_started', 'analysis_result',
+                    'analysis_result_id', 'analysis_progress', 'analysis_stage', 'analysis_error'):
+            session.pop(key, None)
 
         # 详细调试session存储
-        app.logger.info(f"Generate route - Before storing - Full session: {dict(session)}")
+        log_payload(app.logger, "Generate route - Before storing - Full session", session)
         session.permanent = True  # 设置session为永久性
         session.modified = True  # 确保session修改被保存
-        app.logger.info(f"Generate route - After storing - Full session: {dict(session)}")
+        log_payload(app.logger, "Generate route - After storing - Full session", session)
         app.logger.info(f"Generate route - Session permanent: {session.permanent}, Modified: {session.modified}")
 
         # Log the received data
-        app.logger.info(f"Received form data: {json.dumps(form_data, ensure_ascii=False, indent=2)}")
+        log_payload(app.logger, "Received form data", form_data)
         app.logger.info(f"Session data stored successfully - Temp ID: {session.get('analysis_form_id')}, Project: {session.get('analysis_project_name')}")
         
         # 验证session存储是否成功
@@ -1717,42 +1845,46 @@ def generate():
         flash('处理表单时发生错误，请重试', 'error')
         return redirect(url_for('index'))
 
-def generate_ai_suggestions(form_data, session=None):
-    """Generate AI suggestions using OpenAI API with enhanced error handling"""
+def _convert_form_data(form_data):
+    """转换表单数据格式以匹配openai_service的预期格式"""
+    return {
+        'projectName': form_data.get('projectName', form_data.get('project_name', '')),
+        'projectDescription': form_data.get('projectDescription', form_data.get('project_description', '')),
+        'keyPersons': form_data.get('keyPersons', form_data.get('key_persons', [])),
+        'externalResources': form_data.get('externalResources', form_data.get('external_resources', []))
+    }
+
+def generate_ai_suggestions(form_data, stage_callback=None, section_callback=None, user_id=None):
+    """Generate AI suggestions using OpenAI API with enhanced error handling
+
+    stage_callback(stage_code): 后台任务中用于上报阶段
+    section_callback(event): 后台任务中用于上报流式生成的结果片段
+    user_id: 用量账本中记录的用户
+    """
     import time
     import threading
     import concurrent.futures
 
     try:
 
-        from openai_service import AngelaAI
-
-        # 使用真正的AI服务生成方案
-        angela_ai = AngelaAI()
+        # 使用进程内共享的AI服务实例生成方案
+        from openai_service import angela_ai
 
         # 转换数据格式以匹配openai_service的预期格式
-        converted_data = {
-            'projectName': form_data.get('projectName', form_data.get('project_name', '')),
-            'projectDescription': form_data.get('projectDescription', form_data.get('project_description', '')),
-            'keyPersons': form_data.get('keyPersons', form_data.get('key_persons', [])),
-            'externalResources': form_data.get('externalResources', form_data.get('external_resources', []))
-        }
-
-        app.logger.info(f"Calling Angela AI with data: {json.dumps(converted_data, ensure_ascii=False)}")
+        converted_data = _convert_form_data(form_data)
 
-        # 更新进度：开始AI分析
-        if session:
-            session['analysis_progress'] = 50
-            session['analysis_stage'] = '正在调用AI分析引擎...'
-            save_session_in_ajax()  # 保存session确保前端能看到进度更新
+        log_payload(app.logger, "Calling Angela AI with data", converted_data)
 
         start_time = time.time()
         app.logger.info("=== 开始调用OpenAI API ===")
         # 调用AI生成服务，添加SSL错误处理
         try:
             app.logger.info("调用 angela_ai.generate_income_paths() 开始...")
-            ai_result = angela_ai.generate_income_paths(converted_data, db.session)
-            app.logger.info(f"=== OpenAI API调用成功，返回数据类型: {type(ai_result)}, 数据长度: {len(str(ai_result)) if ai_result else 0} ===")
+            ai_result = angela_ai.generate_income_paths(converted_data, db.session,
+                                                        stage_callback=stage_callback,
+                                                        section_callback=section_callback,
+                                                        user_id=user_id)
+            app.logger.info(f"=== OpenAI API调用成功，返回数据类型: {type(ai_result).__name__}, 顶层字段数: {len(ai_result) if ai_result else 0} ===")
             
             # 验证返回结果的有效性
             if not ai_result or not isinstance(ai_result, dict):
@@ -1765,6 +1897,9 @@ def generate_ai_suggestions(form_data, session=None):
             else:
                 app.logger.info("✅ 确认是真实OpenAI生成的内容")
             
+        except CircuitOpenError:
+            # 熔断中交给调用方处理（后台任务直接保存备用方案，不再重试）
+            raise
         except Exception as network_error:
             # 检查是否是SSL/网络相关错误
             error_str = str(network_error).lower()
@@ -1778,42 +1913,25 @@ def generate_ai_suggestions(form_data, session=None):
             if any(keyword in error_str for keyword in ['ssl', 'timeout', 'connection', 'network', 'recv', 'read', 'httpx', 'httpcore', 'systemexit', 'socket']):
                 # 网络/SSL/超时错误
                 app.logger.error(f"🌐 网络相关错误，使用备用方案: {str(network_error)}")
-                # 更新session状态为timeout
-                if session:
-                    session['analysis_status'] = 'timeout'
-                    session['analysis_error'] = f'网络连接问题: {str(network_error)[:100]}'  # 限制错误信息长度
-                    save_session_in_ajax()
                 # 返回网络错误的备用方案
                 return generate_fallback_result(form_data, "网络连接问题，为您提供基础建议")
             else:
                 # 其他类型的错误
                 app.logger.error(f"❌ 非网络错误，使用备用方案: {str(network_error)}")
-                # 更新session状态为error
-                if session:
-                    session['analysis_status'] = 'error'
-                    session['analysis_error'] = f'分析过程遇到问题: {str(network_error)[:100]}'
-                    save_session_in_ajax()
                 # 返回一般错误的备用方案
                 return generate_fallback_result(form_data, "分析过程遇到问题，为您提供基础建议")
 
-        # 更新进度：AI分析完成
-        if session:
-            session['analysis_progress'] = 90
-            session['analysis_stage'] = '正在生成分析报告...'
-            save_session_in_ajax()  # 保存session确保前端能看到进度更新
         elapsed_time = time.time() - start_time
 
         app.logger.info(f"AI analysis completed in {elapsed_time:.2f} seconds")
-        app.logger.info(f"AI generated result: {json.dumps(ai_result, ensure_ascii=False)}")
+        log_payload(app.logger, "AI generated result", ai_result)
 
         return ai_result
 
+    except CircuitOpenError:
+        raise
     except TimeoutError as e:
         app.logger.error(f"AI analysis timeout: {str(e)}")
-        # 设置超时状态到session，让前端显示
-        from flask import session
-        session['analysis_status'] = 'timeout'
-        session['analysis_error'] = '分析超时，为您提供基础建议'
         return generate_fallback_result(form_data, "分析超时，为您提供基础建议")
 
     except Exception as e:
@@ -1821,10 +1939,6 @@ def generate_ai_suggestions(form_data, session=None):
         app.logger.error(f"Error type: {type(e).__name__}")
         import traceback
         app.logger.error(f"Traceback: {traceback.format_exc()}")
-        # 设置错误状态到session
-        from flask import session
-        session['analysis_status'] = 'error'
-        session['analysis_error'] = f'分析遇到问题: {str(e)}'
         return generate_fallback_result(form_data, f"分析遇到问题，为您提供基础建议")
 
 def generate_fallback_result(form_data, reason="AI服务暂时不可用"):
@@ -1905,8 +2019,9 @@ def generate_fallback_result(form_data, reason="AI服务暂时不可用"):
             }
         ])
 
-    # 生成符合新assistant_prompt格式的【默认】备用结果
-    return {
+    # 生成符合新assistant_prompt格式的【默认】备用结果（不扣额度）
+    from openai_service import FallbackResult
+    return FallbackResult({
         "overview": {
             "situation": f"【默认方案】由于{reason}，基于您的项目「{project_name}」和现有{len(key_persons)}位关键人物，设计者处于统筹位置，通过整合各方资源形成非劳务收入管道。当前局势下需要明确各方动机匹配度并补齐关键角色。",
             "core_insight": "【默认】通过设计者的统筹位置，将各方资源串联形成闭环，设计者获得居间撮合费用和团队协作分成，避免纯劳务付出。",
@@ -1985,33 +2100,259 @@ def generate_fallback_result(form_data, reason="AI服务暂时不可用"):
                 }
             }
         ]
-    }
+    })
 
 # Knowledge Base Management Routes
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 20))
+HISTORY_MAX_PAGE_SIZE = 100
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+KNOWLEDGE_SEARCH_LIMIT = 200  # 后台知识库搜索最多显示的条目数
+ADMIN_USERS_PAGE_SIZE = int(os.environ.get('ADMIN_USERS_PAGE_SIZE', 50))
+ADMIN_USERS_MAX_PAGE_SIZE = 200
+USER_STATS_CACHE_SECONDS = float(os.environ.get('USER_STATS_CACHE_SECONDS', 30))
+# 用户列表允许的排序列
+USER_SORT_COLUMNS = ('id', 'created_at', 'last_login', 'name', 'phone', 'used_quota')
+
+_user_stats_cache = {}
+_user_stats_lock = threading.Lock()
+
+
+def _user_list_filters(query, keyword='', role='', status=''):
+    """用户列表的搜索和筛选条件（姓名或手机号包含关键字、角色、状态）"""
+    from sqlalchemy import or_
+
+    if keyword:
+        query = query.filter(or_(User.name.icontains(keyword, autoescape=True),
+                                 User.phone.contains(keyword, autoescape=True)))
+    if role in ('admin', 'user'):
+        query = query.filter(User.is_admin.is_(role == 'admin'))
+    if status in ('active', 'inactive'):
+        query = query.filter(User.active.is_(status == 'active'))
+    return query
+
+
+def _user_stats():
+    """用户总数、激活数、管理员数、本月新增数：一条聚合查询，结果缓存 USER_STATS_CACHE_SECONDS 秒"""
+    current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    with _user_stats_lock:
+        cached = _user_stats_cache.get(current_month)
+        if cached and time.time() - cached[0] < USER_STATS_CACHE_SECONDS:
+            return cached[1]
+
+    row = db.session.query(
+        func.count(User.id),
+        func.sum(case((User.active.is_(True), 1), else_=0)),
+        func.sum(case((User.is_admin.is_(True), 1), else_=0)),
+        func.sum(case((User.created_at >= current_month, 1), else_=0)),
+    ).one()
+    stats = {
+        'total': row[0] or 0,
+        'active': int(row[1] or 0),
+        'admin': int(row[2] or 0),
+        'recent': int(row[3] or 0),
+    }
+    with _user_stats_lock:
+        _user_stats_cache.clear()
+        _user_stats_cache[current_month] = (time.time(), stats)
+    return stats
+
+
+def _invalidate_user_stats():
+    """添加、修改、删除用户后清除统计缓存"""
+    with _user_stats_lock:
+        _user_stats_cache.clear()
+
+
+def _encode_history_cursor(record):
+    raw = f"{record.created_at.isoformat()}|{record.sequence_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def _decode_history_cursor(cursor):
+    """游标无效时抛出ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, sequence_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(sequence_id)
+    except Exception:
+        raise ValueError(f"无效的游标: {cursor}")
+
+
+def _history_scope(query):
+    """管理员看到所有记录，普通用户只能看到自己的记录"""
+    from models import AnalysisResult
+
+    if current_user.is_admin:
+        return query
+    return query.filter(AnalysisResult.user_id == current_user.id)
+
+
+def _history_list_query():
+    """只加载列表需要的列（不读取form_data/result_data）"""
+    from models import AnalysisResult
+
+    return _history_scope(AnalysisResult.query.options(load_only(
+        AnalysisResult.id, AnalysisResult.sequence_id, AnalysisResult.user_id, AnalysisResult.project_name,
+        AnalysisResult.project_description, AnalysisResult.team_size, AnalysisResult.analysis_type,
+        AnalysisResult.pipeline_count, AnalysisResult.pipeline_names, AnalysisResult.income_types,
+        AnalysisResult.created_at)))
+
+
+def _history_page(cursor=None, limit=HISTORY_PAGE_SIZE, income_type=None):
+    """按 (created_at, sequence_id) 倒序的游标分页
+
+    income_type: 只返回包含该收入类型管道的记录（按摘要列筛选）
+    返回 (记录列表, 下一页游标)；没有更多记录时游标为None。
+    """
+    from models import AnalysisResult
+
+    query = _history_list_query()
+    if income_type:
+        query = query.filter(json_array_contains(AnalysisResult.income_types, income_type))
+    if cursor:
+        created_at, sequence_id = _decode_history_cursor(cursor)
+        query = query.filter(tuple_(AnalysisResult.created_at, AnalysisResult.sequence_id) < (created_at, sequence_id))
+    records = query.order_by(AnalysisResult.created_at.desc(), AnalysisResult.sequence_id.desc()).limit(limit + 1).all()
+
+    next_cursor = _encode_history_cursor(records[limit - 1]) if len(records) > limit else None
+    return records[:limit], next_cursor
+
+
+def _income_type_arg():
+    """请求参数中的收入类型筛选；不是已知的收入类型时不筛选"""
+    income_type = request.args.get('income_type') or None
+    return income_type if income_type in result_summary.INCOME_TYPES else None
+
+
+def _history_search(query_text, page=1, per_page=SEARCH_PAGE_SIZE):
+    """全文搜索历史记录，按相关度排序，返回 (记录列表, 是否还有下一页)"""
+    from models import AnalysisResult
+
+    hits, has_more = search_index.search(db.session, query_text, search_index.DOC_ANALYSIS,
+                                         user_id=None if current_user.is_admin else current_user.id,
+                                         page=page, per_page=per_page)
+    ids = [hit['doc_id'] for hit in hits]
+    records = {record.id: record for record in
+               _history_list_query().filter(AnalysisResult.id.in_(ids)).all()} if ids else {}
+    return [records[record_id] for record_id in ids if record_id in records], has_more
+
+
+def _history_stats():
+    """统计卡片：在数据库中聚合，不加载记录"""
+    from models import AnalysisResult
+
+    row = _history_scope(db.session.query(
+        func.count(AnalysisResult.id).label('total'),
+        func.sum(case((AnalysisResult.analysis_type == 'ai_analysis', 1), else_=0)).label('ai_analysis'),
+        func.sum(case((AnalysisResult.analysis_type == 'fallback', 1), else_=0)).label('fallback'),
+        func.avg(AnalysisResult.team_size).label('avg_team_size'),
+    )).one()
+    return {
+        'total': row.total or 0,
+        'ai_analysis': int(row.ai_analysis or 0),
+        'fallback': int(row.fallback or 0),
+        'avg_team_size': int(row.avg_team_size or 0),
+    }
+
+
+def _history_record_dict(record):
+    return {
+        'id': record.id,
+        'project_name': record.project_name,
+        'project_description': record.project_description,
+        'team_size': record.team_size,
+        'pipeline_count': record.pipeline_count or 0,
+        'pipeline_names': record.pipeline_names or [],
+        'income_types': record.income_types or [],
+        'analysis_type': record.analysis_type,
+        'analysis_type_display': record.analysis_type_display,
+        'created_at_display': record.created_at_display,
+        'url': url_for('view_analysis_record', record_id=record.id),
+    }
+
+
 @app.route('/history')
 @login_required
 def analysis_history():
-    """历史分析记录页面"""
+    """历史分析记录页面（首页记录直接渲染，后续页面由 /api/history 滚动加载）"""
     try:
-        from models import AnalysisResult
-
-        # 根据用户身份显示不同的记录
-        if current_user.is_admin:
-            # 管理员可以看到所有分析记录
-            analysis_records = AnalysisResult.query.order_by(AnalysisResult.created_at.desc()).all()
-            app.logger.info(f"Admin user viewing {len(analysis_records)} analysis records")
+        income_type = _income_type_arg()
+        search_query = request.args.get('q', '').strip()
+        page = max(request.args.get('page', 1, type=int), 1)
+        has_more = False
+        if search_query:
+            # 搜索模式：按相关度排序、按页码翻页
+            analysis_records, has_more = _history_search(search_query, page)
+            next_cursor = None
         else:
-            # 普通用户只能看到自己的分析记录
-            analysis_records = AnalysisResult.query.filter_by(user_id=current_user.id).order_by(AnalysisResult.created_at.desc()).all()
-            app.logger.info(f"User {current_user.id} viewing {len(analysis_records)} analysis records")
+            analysis_records, next_cursor = _history_page(income_type=income_type)
+        stats = _history_stats()
+        app.logger.info(f"User {current_user.id} viewing analysis history: {stats['total']} records")
 
-        return render_template('history_apple.html', analysis_records=analysis_records)
+        return render_template('history_apple.html', analysis_records=analysis_records,
+                               next_cursor=next_cursor, stats=stats,
+                               income_types=result_summary.INCOME_TYPES, income_type=income_type,
+                               search_query=search_query, page=page, has_more=has_more)
 
     except Exception as e:
         app.logger.error(f"Error loading analysis history: {str(e)}")
         flash('加载历史记录时发生错误', 'error')
         return redirect(url_for('index'))
 
+
+@app.route('/api/history')
+@login_required
+def api_history():
+    """历史记录分页接口：?cursor=上一页返回的next_cursor&limit=每页条数&income_type=收入类型"""
+    try:
+        limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        try:
+            records, next_cursor = _history_page(request.args.get('cursor'), limit, _income_type_arg())
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        return jsonify({
+            'success': True,
+            'records': [_history_record_dict(record) for record in records],
+            'next_cursor': next_cursor,
+        })
+
+    except Exception as e:
+        app.logger.error(f"Error loading analysis history page: {str(e)}")
+        return jsonify({'success': False, 'error': '加载历史记录失败'}), 500
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    """全文搜索接口：?q=关键词&type=analysis|knowledge&page=页码&limit=每页条数
+
+    analysis: 历史分析记录（普通用户只搜索自己的记录）；knowledge: 知识库，仅管理员
+    """
+    try:
+        query_text = request.args.get('q', '').strip()
+        doc_type = request.args.get('type', search_index.DOC_ANALYSIS)
+        if not query_text:
+            return jsonify({'success': False, 'error': '请输入搜索关键词'}), 400
+        if doc_type not in (search_index.DOC_ANALYSIS, search_index.DOC_KNOWLEDGE):
+            return jsonify({'success': False, 'error': f'不支持的搜索类型: {doc_type}'}), 400
+        if doc_type == search_index.DOC_KNOWLEDGE and not current_user.is_admin:
+            return jsonify({'success': False, 'error': '需要管理员权限'}), 403
+
+        page = max(request.args.get('page', 1, type=int), 1)
+        limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        user_id = None if current_user.is_admin or doc_type == search_index.DOC_KNOWLEDGE else current_user.id
+        results, has_more = search_index.search(db.session, query_text, doc_type, user_id=user_id,
+                                                page=page, per_page=limit)
+        if doc_type == search_index.DOC_ANALYSIS:
+            for result in results:
+                result['url'] = url_for('view_analysis_record', record_id=result['doc_id'])
+
+        return jsonify({'success': True, 'results': results, 'page': page, 'has_more': has_more})
+
+    except Exception as e:
+        app.logger.error(f"Error searching {request.args.get('type')}: {str(e)}")
+        return jsonify({'success': False, 'error': '搜索失败'}), 500
+
 @app.route('/history/<record_id>')
 @login_required
 def view_analysis_record(record_id):
@@ -2031,9 +2372,8 @@ def view_analysis_record(record_id):
             flash('您没有权限查看此分析记录', 'error')
             return redirect(url_for('analysis_history'))
 
-        # 解析JSON数据
-        form_data = json.loads(record.form_data) if record.form_data else {}
-        result_data = json.loads(record.result_data) if record.result_data else {}
+        form_data = record.form_data or {}
+        result_data = record.result_data or {}
 
         app.logger.info(f"User {current_user.id} viewing analysis record: {record_id}")
 
@@ -2043,6 +2383,7 @@ def view_analysis_record(record_id):
                              status='completed',
                              history_mode=True,
                              analysis_id=record.id,
+                             result_etag=_result_etag(record.id, record.version),
                              record_info={
                                  'id': record.id,
                                  'created_at': record.created_at_display,
@@ -2058,17 +2399,32 @@ def view_analysis_record(record_id):
 @login_required
 @admin_required
 def api_users():
-    """管理中心用户API - 返回用户列表数据"""
+    """管理中心用户API - 分页返回用户列表和统计数据
+
+    参数: page / per_page（最大 ADMIN_USERS_MAX_PAGE_SIZE）、sort（USER_SORT_COLUMNS之一）、
+    order（asc/desc）、q（姓名或手机号包含）、role（admin/user）、status（active/inactive）
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', ADMIN_USERS_PAGE_SIZE, type=int), 1),
+                   ADMIN_USERS_MAX_PAGE_SIZE)
+    sort = request.args.get('sort', 'created_at')
+    order = request.args.get('order', 'desc')
+    if sort not in USER_SORT_COLUMNS or order not in ('asc', 'desc'):
+        return jsonify({'success': False, 'message': '排序参数无效'}), 400
+
     try:
-        users = User.query.all()
-        current_month = datetime.now().replace(day=1)
+        query = _user_list_filters(User.query, request.args.get('q', '').strip(),
+                                   request.args.get('role', ''), request.args.get('status', ''))
+        total = query.order_by(None).count()
+        column = getattr(User, sort)
+        ordering = (column.asc().nullsfirst(), User.id.asc()) if order == 'asc' \
+            else (column.desc().nullslast(), User.id.desc())
+        users = query.options(load_only(
+            User.id, User.name, User.phone, User.is_admin, User.active, User.created_at, User.last_login,
+            User.ai_quota, User.used_quota)).order_by(*ordering).offset((page - 1) * per_page).limit(per_page).all()
 
         users_data = []
         for user in users:
-            # 确保时间显示格式正确
-            created_at_display = user.created_at_display if user.created_at else '未知'
-            last_login_display = user.last_login_display if user.last_login else '从未登录'
-
             users_data.append({
                 'id': user.id,
                 'name': user.name or '未设置姓名',
@@ -2077,37 +2433,65 @@ def api_users():
                 'active': user.active,
                 'created_at': user.created_at.isoformat() if user.created_at else None,
                 'last_login': user.last_login.isoformat() if user.last_login else None,
-                'created_at_display': created_at_display,
-                'last_login_display': last_login_display,
+                'created_at_display': user.created_at_display if user.created_at else '未知',
+                'last_login_display': user.last_login_display,
                 'current_user_id': current_user.id,
                 # AI分析额度信息
-                'ai_quota': user.ai_quota,
-                'used_quota': user.used_quota,
-                'remaining_quota': user.remaining_quota,
-                'quota_display': user.quota_display,
-                'quota_usage_percentage': user.quota_usage_percentage
+                **quota_ledger.usage_values(user.ai_quota, user.used_quota)
             })
 
-        # 统计数据
-        stats = {
-            'total': len(users),
-            'active': len([u for u in users if u.active]),
-            'admin': len([u for u in users if u.is_admin]),
-            'recent': len([u for u in users if u.created_at and u.created_at >= current_month])
-        }
-
         return jsonify({
             'success': True,
             'users': users_data,
-            'stats': stats
+            'stats': _user_stats(),
+            'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'total': total,
+                'pages': (total + per_page - 1) // per_page,
+                'has_more': page * per_page < total,
+            }
         })
     except Exception as e:
+        db.session.rollback()
         app.logger.error(f"获取用户数据失败: {e}")
         return jsonify({
             'success': False,
             'message': '获取用户数据失败'
         }), 500
 
+@app.route('/admin/api/usage')
+@login_required
+@admin_required
+def api_usage():
+    """用量与费用报表 - 最近days天按日期、按用户、按模型的汇总（只查询usage_daily汇总表）"""
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+    return jsonify({
+        'success': True,
+        'days': days,
+        'daily': usage_ledger.daily_totals(db.session, days),
+        'users': usage_ledger.user_totals(db.session, days, limit),
+        'models': usage_ledger.model_totals(db.session, days),
+    })
+
+@app.route('/admin/api/users/quota')
+@login_required
+@admin_required
+def api_users_quota():
+    """用户额度使用情况 - 只读取额度列，不加载完整的用户行；ids=1,2,3 只返回指定用户"""
+    ids = request.args.get('ids', '')
+    try:
+        user_ids = [int(value) for value in ids.split(',') if value.strip()] if ids else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'ids参数无效'}), 400
+
+    usage = quota_ledger.usage(db.session, user_ids)
+    return jsonify({
+        'success': True,
+        'quota': {str(user_id): values for user_id, values in usage.items()}
+    })
+
 @app.route('/admin')
 @app.route('/admin/dashboard')
 @login_required
@@ -2124,10 +2508,15 @@ def admin_dashboard():
         query = query.filter_by(status=status_filter)
 
     if search_query:
-        query = query.filter(KnowledgeItem.original_filename.contains(search_query))
-
-    # 按上传时间倒序排列，只显示未删除的文件
-    knowledge_items = query.filter(KnowledgeItem.status != 'deleted').order_by(KnowledgeItem.upload_time.desc()).all()
+        # 全文搜索文件名和内容摘要，按相关度排序
+        hits, _ = search_index.search(db.session, search_query, search_index.DOC_KNOWLEDGE,
+                                      per_page=KNOWLEDGE_SEARCH_LIMIT)
+        ranked_ids = [int(hit['doc_id']) for hit in hits]
+        knowledge_items = query.filter(KnowledgeItem.id.in_(ranked_ids), KnowledgeItem.status != 'deleted').all()
+        knowledge_items.sort(key=lambda item: ranked_ids.index(item.id))
+    else:
+        # 按上传时间倒序排列，只显示未删除的文件
+        knowledge_items = query.filter(KnowledgeItem.status != 'deleted').order_by(KnowledgeItem.upload_time.desc()).all()
 
     return render_template('admin/dashboard_unified.html', 
                          knowledge_items=knowledge_items,
@@ -2179,6 +2568,7 @@ def admin_add_user():
 
             db.session.add(user)
             db.session.commit()
+            _invalidate_user_stats()
 
             user_type = '管理员' if is_admin else '普通用户'
             flash(f'{user_type} "{name}" 创建成功', 'success')
@@ -2254,6 +2644,7 @@ def admin_edit_user(user_id):
             if password:
                 user.set_password(password)
                 db.session.commit() # Commit again if password was changed
+            _invalidate_user_stats()
 
             flash('用户信息更新成功！', 'success')
             return redirect(url_for('admin_dashboard') + '?tab=users')
@@ -2285,6 +2676,7 @@ def admin_delete_user(user_id):
         username = user.name
         db.session.delete(user)
         db.session.commit()
+        _invalidate_user_stats()
 
         success_msg = f'用户 "{username}" 已删除'
         if is_ajax:
@@ -2341,8 +2733,9 @@ def upload_knowledge():
 
             db.session.add(knowledge_item)
             db.session.commit()
+            knowledge_ingest.enqueue(db.session, job_queue, knowledge_item)
 
-            flash(f'文件 "{file.filename}" 上传成功', 'success')
+            flash(f'文件 "{file.filename}" 上传成功，正在后台提取文本', 'success')
 
         except Exception as e:
             flash(f'上传失败: {str(e)}', 'error')
@@ -2397,6 +2790,7 @@ def upload_knowledge_multiple():
 
                 db.session.add(knowledge_item)
                 db.session.commit()
+                knowledge_ingest.enqueue(db.session, job_queue, knowledge_item)
 
                 upload_results.append({'filename': file.filename, 'status': 'success'})
                 success_count += 1
@@ -2459,6 +2853,7 @@ def create_text_knowledge():
 
         db.session.add(knowledge_item)
         db.session.commit()
+        knowledge_ingest.enqueue(db.session, job_queue, knowledge_item)
 
         flash(f'文本知识条目 "{title}" 创建成功', 'success')
 
@@ -2504,6 +2899,7 @@ def edit_text_knowledge(item_id):
         item.last_modified = datetime.utcnow()
 
         db.session.commit()
+        knowledge_ingest.enqueue(db.session, job_queue, item)
 
         flash(f'文本知识条目 "{title}" 更新成功', 'success')
 
@@ -2530,9 +2926,25 @@ def toggle_knowledge_status(item_id):
         return redirect(url_for('admin_dashboard'))
 
     db.session.commit()
+    knowledge_ingest.sync_index(db.session)
     flash(f'"{item.original_filename}" {message}', 'success')
     return redirect(url_for('admin_dashboard'))
 
+@app.route('/admin/knowledge/<int:item_id>/reingest', methods=['POST'])
+@login_required
+@admin_required
+def reingest_knowledge(item_id):
+    """重新提取知识库条目的文本（提取失败或上传于提取功能之前的文件）"""
+    item = KnowledgeItem.query.get_or_404(item_id)
+
+    if item.status == 'deleted':
+        flash('无法处理已删除的条目', 'error')
+        return redirect(url_for('admin_dashboard'))
+
+    knowledge_ingest.enqueue(db.session, job_queue, item)
+    flash(f'"{item.original_filename}" 已加入文本提取队列', 'success')
+    return redirect(url_for('admin_dashboard'))
+
 @app.route('/admin/knowledge/<int:item_id>/delete', methods=['POST'])
 @login_required
 @admin_required
@@ -2548,6 +2960,7 @@ def delete_knowledge(item_id):
         # 从数据库删除
         db.session.delete(item)
         db.session.commit()
+        knowledge_ingest.sync_index(db.session)
 
         flash(f'"{item.original_filename}" 已删除', 'success')
     except Exception as e:
@@ -2586,8 +2999,9 @@ def test_model_connection():
     """测试模型连接"""
     try:
         import time
-        from openai_service import client
+        from openai_service import upstream_pool
 
+        client = upstream_pool.client()
         start_time = time.time()
 
         # 发送简单的测试请求
@@ -2705,6 +3119,167 @@ def save_model_config_api():
         app.logger.error(f"错误追踪: {traceback.format_exc()}")
         return jsonify({'success': False, 'message': f'保存失败: {str(e)}'}), 500
 
+@app.route('/admin/api/cache_stats', methods=['GET'])
+@login_required
+@admin_required
+def get_cache_stats():
+    """分析结果缓存统计 - 命中次数即节省的上游调用次数"""
+    try:
+        import result_cache
+        return jsonify({'success': True, 'stats': result_cache.cache_stats(db.session)})
+    except Exception as e:
+        app.logger.error(f"获取缓存统计失败: {str(e)}")
+        return jsonify({'success': False, 'message': f'获取缓存统计失败: {str(e)}'}), 500
+
+@app.route('/admin/api/cache_stats/clear', methods=['POST'])
+@login_required
+@admin_required
+def clear_result_cache():
+    """清空分析结果缓存"""
+    try:
+        import result_cache
+        deleted = result_cache.clear_cache(db.session)
+        app.logger.info(f"管理员 {current_user.id} 清空结果缓存: {deleted} 条")
+        return jsonify({'success': True, 'message': f'已清空 {deleted} 条缓存', 'deleted': deleted})
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"清空结果缓存失败: {str(e)}")
+        return jsonify({'success': False, 'message': f'清空缓存失败: {str(e)}'}), 500
+
+@app.route('/admin/api/prompts', methods=['GET'])
+@login_required
+@admin_required
+def get_prompt_versions():
+    """当前进程已加载的提示词版本（指纹、长度、加载时间）"""
+    from prompt_registry import registry as prompt_registry
+    return jsonify({'success': True, 'prompts': prompt_registry.describe()})
+
+@app.route('/admin/api/prompts/reload', methods=['POST'])
+@login_required
+@admin_required
+def reload_prompts():
+    """强制重新加载提示词文件
+
+    只作用于处理本请求的进程；其他进程会在下次使用时通过文件mtime检测到变化。
+    """
+    try:
+        from prompt_registry import registry as prompt_registry
+        prompts = prompt_registry.reload()
+        app.logger.info(f"管理员 {current_user.id} 重新加载提示词: "
+                        f"{ {name: info['fingerprint'][:12] for name, info in prompts.items()} }")
+        return jsonify({'success': True, 'message': '提示词已重新加载', 'prompts': prompts})
+    except Exception as e:
+        app.logger.error(f"重新加载提示词失败: {str(e)}")
+        return jsonify({'success': False, 'message': f'重新加载失败: {str(e)}'}), 500
+
+@app.route('/admin/api/upstream_pool', methods=['GET'])
+@login_required
+@admin_required
+def get_upstream_pool_stats():
+    """上游API连接池使用情况（只包含处理本请求的进程）"""
+    try:
+        from openai_service import upstream_pool
+        return jsonify({'success': True, 'stats': upstream_pool.stats()})
+    except Exception as e:
+        app.logger.error(f"获取连接池统计失败: {str(e)}")
+        return jsonify({'success': False, 'message': f'获取统计失败: {str(e)}'}), 500
+
+@app.route('/admin/api/circuit', methods=['GET'])
+@login_required
+@admin_required
+def get_circuit_state():
+    """上游熔断器状态、窗口统计和自适应超时"""
+    try:
+        from circuit_breaker import get_breaker
+        breaker = get_breaker(request.args.get('provider', 'default'))
+        return jsonify({'success': True, 'circuit': breaker.describe(db.session)})
+    except Exception as e:
+        app.logger.error(f"获取熔断状态失败: {str(e)}")
+        return jsonify({'success': False, 'message': f'获取熔断状态失败: {str(e)}'}), 500
+
+@app.route('/admin/api/circuit/reset', methods=['POST'])
+@login_required
+@admin_required
+def reset_circuit():
+    """手动关闭上游熔断器（对所有进程生效）"""
+    try:
+        from circuit_breaker import get_breaker
+        breaker = get_breaker((request.get_json(silent=True) or {}).get('provider', 'default'))
+        breaker.reset(db.session)
+        app.logger.info(f"管理员 {current_user.id} 手动关闭了上游熔断器: {breaker.provider}")
+        return jsonify({'success': True, 'message': '熔断器已关闭', 'circuit': breaker.describe(db.session)})
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"关闭熔断器失败: {str(e)}")
+        return jsonify({'success': False, 'message': f'关闭熔断器失败: {str(e)}'}), 500
+
+@app.route('/admin/api/providers', methods=['GET'])
+@login_required
+@admin_required
+def get_upstream_providers():
+    """上游列表、各上游熔断状态，以及本进程的对冲统计"""
+    try:
+        from models import UpstreamProvider
+        from circuit_breaker import get_breaker
+        from openai_service import provider_registry
+
+        rows = UpstreamProvider.query.order_by(UpstreamProvider.priority, UpstreamProvider.id).all()
+        active = provider_registry.providers(db.session)
+        return jsonify({
+            'success': True,
+            'providers': [row.to_dict() for row in rows],
+            'route_order': [provider.name for provider in active],
+            'circuits': {provider.name: get_breaker(provider.name).describe(db.session) for provider in active},
+            'hedging': provider_registry.stats(),
+        })
+    except Exception as e:
+        app.logger.error(f"获取上游列表失败: {str(e)}")
+        return jsonify({'success': False, 'message': f'获取上游列表失败: {str(e)}'}), 500
+
+@app.route('/admin/api/providers', methods=['POST'])
+@login_required
+@admin_required
+def save_upstream_provider():
+    """新增或修改上游（按name），本进程立即生效，其他进程在列表缓存过期后生效"""
+    try:
+        from models import UpstreamProvider
+        from openai_service import provider_registry
+
+        data = request.get_json(silent=True) or {}
+        name = (data.get('name') or '').strip()
+        if not name:
+            return jsonify({'success': False, 'message': '上游标识不能为空'}), 400
+
+        provider = UpstreamProvider.query.filter_by(name=name).first()
+        if provider is None:
+            base_url = (data.get('base_url') or '').strip()
+            if not base_url.startswith(('http://', 'https://')):
+                return jsonify({'success': False, 'message': 'API地址必须以http://或https://开头'}), 400
+            provider = UpstreamProvider(name=name, base_url=base_url)
+            db.session.add(provider)
+        elif data.get('base_url'):
+            provider.base_url = data['base_url'].strip()
+        if 'api_key_env' in data:
+            provider.api_key_env = data['api_key_env'] or 'OPENAI_API_KEY'
+        if 'model_name' in data:
+            provider.model_name = data['model_name'] or None
+        if 'priority' in data:
+            provider.priority = int(data['priority'])
+        if 'is_active' in data:
+            provider.is_active = bool(data['is_active'])
+        db.session.commit()
+        provider_registry.invalidate()
+
+        app.logger.info(f"管理员 {current_user.id} 保存上游 {name}: {provider.base_url}")
+        return jsonify({'success': True, 'message': '上游已保存', 'provider': provider.to_dict()})
+    except (TypeError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'参数错误: {str(e)}'}), 400
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"保存上游失败: {str(e)}")
+        return jsonify({'success': False, 'message': f'保存上游失败: {str(e)}'}), 500
+
 @app.route('/profile/update', methods=['POST'])
 @login_required
 def update_user_profile():
@@ -2753,310 +3328,83 @@ def update_user_profile():
         return redirect(url_for('user_profile'))
 
 
-@app.route('/update_income_mechanism', methods=['POST'])
-@login_required
-def update_income_mechanism():
-    """更新收入类型配置"""
-    try:
-        # 获取请求数据
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'error': '无效的请求数据'}), 400
-        
-        pipeline_id = data.get('pipeline_id')
-        income_mechanism = data.get('income_mechanism')
-        
-        # 验证输入
-        if not pipeline_id or not income_mechanism:
-            return jsonify({'success': False, 'error': '缺少必要参数'}), 400
-        
-        if not all(key in income_mechanism for key in ['type', 'trigger', 'settlement']):
-            return jsonify({'success': False, 'error': '收入机制数据不完整'}), 400
-        
-        # 从session或URL获取当前的分析记录ID
-        analysis_id = None
-        
-        # 尝试从session获取
-        if 'analysis_result_id' in session:
-            analysis_id = session['analysis_result_id']
-        
-        # 如果session中没有，尝试从request args获取
-        if not analysis_id:
-            analysis_id = request.args.get('result_id')
-        
-        # 如果还是没有，从referer URL中解析
-        if not analysis_id:
-            referer = request.headers.get('Referer', '')
-            if '/history/' in referer:
-                analysis_id = referer.split('/history/')[-1].split('?')[0]
-            elif 'result_id=' in referer:
-                analysis_id = referer.split('result_id=')[-1].split('&')[0]
-        
-        if not analysis_id:
-            return jsonify({'success': False, 'error': '无法确定当前分析记录'}), 400
-        
-        app.logger.info(f"更新收入机制 - 分析ID: {analysis_id}, 管道ID: {pipeline_id}")
-        
-        # 查找分析记录
-        from models import AnalysisResult
-        analysis_record = AnalysisResult.query.filter_by(id=analysis_id).first()
-        
-        if not analysis_record:
-            return jsonify({'success': False, 'error': '找不到分析记录'}), 404
-        
-        # 权限检查
-        if not current_user.is_admin and analysis_record.user_id != current_user.id:
-            return jsonify({'success': False, 'error': '无权限修改此记录'}), 403
-        
-        # 解析现有的result_data
-        try:
-            result_data = json.loads(analysis_record.result_data) if analysis_record.result_data else {}
-        except json.JSONDecodeError:
-            return jsonify({'success': False, 'error': '分析数据格式错误'}), 500
-        
-        # 更新收入机制
-        if 'pipelines' in result_data:
-            for i, pipeline in enumerate(result_data['pipelines']):
-                # 匹配管道ID（支持多种ID格式）
-                current_pipeline_id = pipeline.get('id', f'pipeline_{i+1}')
-                if pipeline_id.endswith(str(i+1)) or current_pipeline_id == pipeline_id or pipeline_id == f'pipeline_{i+1}':
-                    if 'income_mechanism' not in pipeline:
-                        pipeline['income_mechanism'] = {}
-                    
-                    # 更新收入机制数据
-                    pipeline['income_mechanism']['type'] = income_mechanism['type']
-                    pipeline['income_mechanism']['trigger'] = income_mechanism['trigger']
-                    pipeline['income_mechanism']['settlement'] = income_mechanism['settlement']
-                    
-                    app.logger.info(f"已更新管道 {i+1} 的收入机制")
-                    break
-            else:
-                return jsonify({'success': False, 'error': '找不到指定的管道'}), 404
-        else:
-            return jsonify({'success': False, 'error': '分析结果中没有管道数据'}), 404
-        
-        # 保存更新后的数据
-        analysis_record.result_data = json.dumps(result_data, ensure_ascii=False)
-        analysis_record.updated_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        app.logger.info(f"收入机制更新成功 - 用户: {current_user.phone}, 分析ID: {analysis_id}")
-        
-        return jsonify({
-            'success': True,
-            'message': '收入类型更新成功',
-            'updated_mechanism': income_mechanism
-        })
-        
-    except Exception as e:
-        app.logger.error(f"更新收入机制失败: {str(e)}")
-        app.logger.error(f"错误详情: {traceback.format_exc()}")
-        return jsonify({'success': False, 'error': f'服务器错误: {str(e)}'}), 500
+def _result_etag(analysis_id, version):
+    return f'{analysis_id}-{version}'
 
 
-@app.route('/update_core_insight', methods=['POST'])
+@app.route('/api/analysis/<analysis_id>/result', methods=['PATCH'])
 @login_required
-def update_core_insight():
-    """更新核心洞察内容"""
+def patch_analysis_result(analysis_id):
+    """按RFC 6902（JSON Patch）修改分析结果
+
+    请求体为操作列表，例如 [{"op": "replace", "path": "/overview/core_insight", "value": "..."}]，
+    整批操作在一条UPDATE中执行（Postgres上为jsonb_set），不读出整份结果。
+    If-Match 携带结果页下发的ETag时做乐观并发控制：版本号已变化返回412；test操作不满足返回409。
+    """
     try:
-        # 获取请求数据
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'error': '无效的请求数据'}), 400
-        
-        analysis_id = data.get('analysis_id')
-        content = data.get('content')
-        
-        # 验证输入
-        if not analysis_id or not content:
-            return jsonify({'success': False, 'error': '缺少必要参数'}), 400
-        
-        if len(content.strip()) == 0:
-            return jsonify({'success': False, 'error': '核心洞察内容不能为空'}), 400
-        
-        app.logger.info(f"更新核心洞察 - 分析ID: {analysis_id}")
-        
-        # 查找分析记录
+        operations = request.get_json(force=True, silent=True)
+        if not isinstance(operations, list) or not operations:
+            return jsonify({'success': False, 'error': '请求体必须是非空的JSON Patch操作列表'}), 400
+
         from models import AnalysisResult
-        analysis_record = AnalysisResult.query.filter_by(id=analysis_id).first()
-        
-        if not analysis_record:
+
+        record = db.session.query(AnalysisResult.user_id, AnalysisResult.version).filter(
+            AnalysisResult.id == analysis_id).first()
+        if not record:
             return jsonify({'success': False, 'error': '找不到分析记录'}), 404
-        
+
         # 权限检查
-        if not current_user.is_admin and analysis_record.user_id != current_user.id:
+        if not current_user.is_admin and record.user_id != current_user.id:
             return jsonify({'success': False, 'error': '无权限修改此记录'}), 403
-        
-        # 解析现有的result_data
-        try:
-            result_data = json.loads(analysis_record.result_data) if analysis_record.result_data else {}
-        except json.JSONDecodeError:
-            return jsonify({'success': False, 'error': '分析数据格式错误'}), 500
-        
-        # 更新核心洞察
-        if 'overview' not in result_data:
-            result_data['overview'] = {}
-        
-        result_data['overview']['core_insight'] = content.strip()
-        
-        app.logger.info(f"已更新核心洞察内容")
-        
-        # 保存更新后的数据
-        analysis_record.result_data = json.dumps(result_data, ensure_ascii=False)
-        analysis_record.updated_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        app.logger.info(f"核心洞察更新成功 - 用户: {current_user.phone}, 分析ID: {analysis_id}")
-        
-        return jsonify({
-            'success': True,
-            'message': '核心洞察更新成功',
-            'updated_content': content.strip()
-        })
-        
-    except Exception as e:
-        app.logger.error(f"更新核心洞察失败: {str(e)}")
-        app.logger.error(f"错误详情: {traceback.format_exc()}")
-        return jsonify({'success': False, 'error': f'服务器错误: {str(e)}'}), 500
 
+        expected_version = None
+        if request.if_match and not request.if_match.star_tag:
+            prefix = f'{analysis_id}-'
+            versions = [tag[len(prefix):] for tag in request.if_match.as_set() if tag.startswith(prefix)]
+            if not versions or not versions[0].isdigit():
+                return jsonify({'success': False, 'error': 'If-Match与当前记录不匹配'}), 412
+            expected_version = int(versions[0])
 
-@app.route('/update_current_situation', methods=['POST'])
-@login_required
-def update_current_situation():
-    """更新当前现状内容"""
-    try:
-        # 获取请求数据
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'error': '无效的请求数据'}), 400
-        
-        analysis_id = data.get('analysis_id')
-        content = data.get('content')
-        
-        # 验证输入
-        if not analysis_id or not content:
-            return jsonify({'success': False, 'error': '缺少必要参数'}), 400
-        
-        if len(content.strip()) == 0:
-            return jsonify({'success': False, 'error': '当前现状内容不能为空'}), 400
-        
-        app.logger.info(f"更新当前现状 - 分析ID: {analysis_id}")
-        
-        # 查找分析记录
-        from models import AnalysisResult
-        analysis_record = AnalysisResult.query.filter_by(id=analysis_id).first()
-        
-        if not analysis_record:
-            return jsonify({'success': False, 'error': '找不到分析记录'}), 404
-        
-        # 权限检查
-        if not current_user.is_admin and analysis_record.user_id != current_user.id:
-            return jsonify({'success': False, 'error': '无权限修改此记录'}), 403
-        
-        # 解析现有的result_data
         try:
-            result_data = json.loads(analysis_record.result_data) if analysis_record.result_data else {}
-        except json.JSONDecodeError:
-            return jsonify({'success': False, 'error': '分析数据格式错误'}), 500
-        
-        # 更新当前现状
-        if 'overview' not in result_data:
-            result_data['overview'] = {}
-        
-        result_data['overview']['situation'] = content.strip()
-        
-        app.logger.info(f"已更新当前现状内容")
-        
-        # 保存更新后的数据
-        analysis_record.result_data = json.dumps(result_data, ensure_ascii=False)
-        analysis_record.updated_at = datetime.utcnow()
-        
+            document, conditions = json_patch(AnalysisResult.result_data, operations, db.engine.dialect.name)
+        except PatchError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        statement = update(AnalysisResult).where(AnalysisResult.id == analysis_id, *conditions)
+        if expected_version is not None:
+            statement = statement.where(AnalysisResult.version == expected_version)
+        row = db.session.execute(
+            statement.values(result_data=document, version=AnalysisResult.version + 1)
+            .returning(AnalysisResult.version)).first()
+        paths = [str(operation.get('path', '')) for operation in operations]
+        if row is not None and any(path.startswith('/pipelines') for path in paths):
+            # 管道名称或收入机制可能变化，同一事务内重新计算摘要列
+            result_summary.refresh(db.session, analysis_id)
+        if row is not None and any(path.startswith(('/pipelines', '/overview')) for path in paths):
+            # 批量UPDATE不触发ORM事件，被索引的管道名称和核心洞察变化时同一事务内刷新搜索索引
+            search_index.refresh_analysis(db.session, analysis_id)
         db.session.commit()
-        
-        app.logger.info(f"当前现状更新成功 - 用户: {current_user.phone}, 分析ID: {analysis_id}")
-        
-        return jsonify({
-            'success': True,
-            'message': '当前现状更新成功',
-            'updated_content': content.strip()
-        })
-        
-    except Exception as e:
-        app.logger.error(f"更新当前现状失败: {str(e)}")
-        app.logger.error(f"错误详情: {traceback.format_exc()}")
-        return jsonify({'success': False, 'error': f'服务器错误: {str(e)}'}), 500
 
+        if row is None:
+            current_version = db.session.query(AnalysisResult.version).filter(
+                AnalysisResult.id == analysis_id).scalar()
+            if expected_version is not None and current_version != expected_version:
+                app.logger.info(f"分析结果 {analysis_id} 版本冲突: 期望 {expected_version}, 当前 {current_version}")
+                response = jsonify({'success': False, 'error': '结果已被其他页面修改，请刷新后重试',
+                                    'version': current_version})
+                response.status_code = 412
+                response.set_etag(_result_etag(analysis_id, current_version))
+                return response
+            return jsonify({'success': False, 'error': 'test操作不满足，未做修改'}), 409
+
+        app.logger.info(f"分析结果已修改 - 用户: {current_user.phone}, 分析ID: {analysis_id}, "
+                        f"操作数: {len(operations)}, 版本: {row.version}")
+        response = jsonify({'success': True, 'version': row.version})
+        response.set_etag(_result_etag(analysis_id, row.version))
+        return response
 
-@app.route('/update_core_resources', methods=['POST'])
-@login_required
-def update_core_resources():
-    """更新核心资源内容"""
-    try:
-        # 获取请求数据
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'error': '无效的请求数据'}), 400
-        
-        analysis_id = data.get('analysis_id')
-        content = data.get('content')
-        
-        # 验证输入
-        if not analysis_id or not content:
-            return jsonify({'success': False, 'error': '缺少必要参数'}), 400
-        
-        if len(content.strip()) == 0:
-            return jsonify({'success': False, 'error': '核心资源内容不能为空'}), 400
-        
-        app.logger.info(f"更新核心资源 - 分析ID: {analysis_id}")
-        
-        # 查找分析记录
-        from models import AnalysisResult
-        analysis_record = AnalysisResult.query.filter_by(id=analysis_id).first()
-        
-        if not analysis_record:
-            return jsonify({'success': False, 'error': '找不到分析记录'}), 404
-        
-        # 权限检查
-        if not current_user.is_admin and analysis_record.user_id != current_user.id:
-            return jsonify({'success': False, 'error': '无权限修改此记录'}), 403
-        
-        # 解析现有的result_data
-        try:
-            result_data = json.loads(analysis_record.result_data) if analysis_record.result_data else {}
-        except json.JSONDecodeError:
-            return jsonify({'success': False, 'error': '分析数据格式错误'}), 500
-        
-        # 解析新的资源列表
-        resources_list = [r.strip() for r in content.split(',') if r.strip()]
-        
-        # 更新核心资源（在统筹方的resources字段中）
-        if 'pipelines' in result_data and result_data['pipelines']:
-            for pipeline in result_data['pipelines']:
-                if 'parties_structure' in pipeline:
-                    for party in pipeline['parties_structure']:
-                        if party.get('role_type') == '统筹方':
-                            party['resources'] = resources_list
-                            app.logger.info(f"已更新统筹方核心资源: {resources_list}")
-                            break
-        
-        # 保存更新后的数据
-        analysis_record.result_data = json.dumps(result_data, ensure_ascii=False)
-        analysis_record.updated_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        app.logger.info(f"核心资源更新成功 - 用户: {current_user.phone}, 分析ID: {analysis_id}")
-        
-        return jsonify({
-            'success': True,
-            'message': '核心资源更新成功',
-            'updated_resources': resources_list
-        })
-        
     except Exception as e:
-        app.logger.error(f"更新核心资源失败: {str(e)}")
+        db.session.rollback()
+        app.logger.error(f"修改分析结果失败: {str(e)}")
         app.logger.error(f"错误详情: {traceback.format_exc()}")
         return jsonify({'success': False, 'error': f'服务器错误: {str(e)}'}), 500
-
@@ -0,0 +1,352 @@
+"""上游熔断器和自适应超时 - 上游服务降级时直接返回备用方案，不再每次耗尽重试
+
+每次上游调用（含重试的每一次尝试）都记录到 upstream_call_samples 表，熔断状态保存在
+upstream_circuits 表中，所有gunicorn worker和独立worker共享同一个熔断器：
+- closed: 正常调用；统计窗口内失败率或慢调用比例超过阈值时打开
+- open: 直接拒绝调用（CircuitOpenError），调用方立即使用备用方案
+- half_open: 打开超过 CIRCUIT_OPEN_SECONDS 后，只放行一个探测请求（不重试），
+  成功则关闭熔断器，失败则重新打开
+状态切换都使用带条件的UPDATE，多个进程同时判断时只有一个能切换成功。
+
+自适应超时：根据窗口内成功调用耗时的p95计算本次调用的超时时间，
+样本不足时使用ModelConfig中配置的超时。
+"""
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_ENABLED = os.environ.get('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+WINDOW_SECONDS = int(os.environ.get('CIRCUIT_WINDOW_SECONDS', 120))
+MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', 5))
+FAILURE_RATE = float(os.environ.get('CIRCUIT_FAILURE_RATE', 0.5))
+SLOW_CALL_SECONDS = float(os.environ.get('CIRCUIT_SLOW_CALL_SECONDS', 90))
+SLOW_CALL_RATE = float(os.environ.get('CIRCUIT_SLOW_CALL_RATE', 0.8))
+OPEN_SECONDS = int(os.environ.get('CIRCUIT_OPEN_SECONDS', 60))
+PROBE_LEASE_SECONDS = 300  # 探测请求所在进程崩溃时，超过该时间允许其他进程重新探测
+
+ADAPTIVE_TIMEOUT_ENABLED = os.environ.get('ADAPTIVE_TIMEOUT_ENABLED', 'true').lower() == 'true'
+ADAPTIVE_TIMEOUT_MIN = float(os.environ.get('ADAPTIVE_TIMEOUT_MIN', 20))
+ADAPTIVE_TIMEOUT_MAX = float(os.environ.get('ADAPTIVE_TIMEOUT_MAX', 180))
+ADAPTIVE_TIMEOUT_MULTIPLIER = 1.5
+ADAPTIVE_MIN_SAMPLES = 20
+ADAPTIVE_SAMPLE_LIMIT = 200
+ADAPTIVE_CACHE_SECONDS = 30
+
+SAMPLE_RETENTION = timedelta(hours=1)
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，本次不调用上游"""
+
+
+class Permit:
+    """一次分析调用的上游许可：记录每次尝试的结果，调用结束后由record()写入数据库"""
+
+    def __init__(self, provider, timeout, probe=False):
+        self.provider = provider
+        self.timeout = timeout
+        self.probe = probe
+        self.samples = []
+
+    def record_attempt(self, success, latency, error=None, provider=None):
+        """provider: 对冲请求发往备用上游时记录实际的上游，默认为许可所属的上游"""
+        self.samples.append((success, latency, error, provider or self.provider))
+
+    @property
+    def succeeded(self):
+        return bool(self.samples) and self.samples[-1][0]
+
+
+class CircuitBreaker:
+    """跨进程共享的上游熔断器"""
+
+    def __init__(self, provider='default'):
+        self.provider = provider
+        self._lock = threading.Lock()
+        self._local_state = 'closed'  # 本进程最近一次读到的状态，重试前快速判断
+        self._timeout_cache = None  # (计算时间, 超时秒数或None)
+
+    # ---------- 调用前 ----------
+
+    def before_call(self, db_session, default_timeout):
+        """检查熔断状态并计算超时，返回Permit；熔断打开时抛出CircuitOpenError"""
+        timeout = self.adaptive_timeout(db_session, default_timeout)
+        if not CIRCUIT_ENABLED:
+            return Permit(self.provider, timeout)
+
+        from models import UpstreamCircuit
+
+        now = datetime.utcnow()
+        try:
+            row = self._get_row(db_session)
+            state, opened_at, probe_started_at = row.state, row.opened_at, row.probe_started_at
+            db_session.commit()
+        except Exception as e:
+            # 熔断器故障不影响正常调用
+            db_session.rollback()
+            logger.warning(f"读取熔断状态失败: {str(e)}")
+            return Permit(self.provider, timeout)
+
+        self._local_state = state
+        if state == 'closed':
+            return Permit(self.provider, timeout)
+
+        if state == 'open':
+            if opened_at and now < opened_at + timedelta(seconds=OPEN_SECONDS):
+                raise CircuitOpenError(f"上游熔断中，{OPEN_SECONDS}秒冷却期内直接使用备用方案")
+            claimed = self._transition(db_session, UpstreamCircuit.state == 'open',
+                                       UpstreamCircuit.opened_at == opened_at,
+                                       state='half_open', probe_started_at=now)
+        else:
+            # half_open: 已有探测请求在进行，除非其租约已过期
+            if probe_started_at and now < probe_started_at + timedelta(seconds=PROBE_LEASE_SECONDS):
+                raise CircuitOpenError("上游熔断探测中，直接使用备用方案")
+            claimed = self._transition(db_session, UpstreamCircuit.state == 'half_open',
+                                       UpstreamCircuit.probe_started_at == probe_started_at,
+                                       probe_started_at=now)
+        if not claimed:
+            raise CircuitOpenError("上游熔断中，其他请求正在探测")
+
+        self._local_state = 'half_open'
+        logger.info(f"熔断器半开，发起探测请求: {self.provider}")
+        # 探测请求使用冷启动超时，避免熔断期间的慢样本拉长超时
+        return Permit(self.provider, default_timeout, probe=True)
+
+    def allow_retry(self, permit):
+        """同一次调用内是否还允许重试：探测请求不重试，本进程已观察到熔断打开时不重试"""
+        if not CIRCUIT_ENABLED:
+            return True
+        return not permit.probe and self._local_state == 'closed'
+
+    # ---------- 调用后 ----------
+
+    def record(self, db_session, permit):
+        """写入本次调用的尝试记录，并根据结果切换熔断状态"""
+        if permit is None:
+            return
+        from models import UpstreamCallSample, UpstreamCircuit
+
+        now = datetime.utcnow()
+        try:
+            if not permit.samples:
+                # 探测许可未实际调用上游（例如构建请求时出错）：恢复为打开状态，下一个请求可立即探测
+                if permit.probe and CIRCUIT_ENABLED:
+                    self._transition(db_session, UpstreamCircuit.state == 'half_open',
+                                     state='open', probe_started_at=None)
+                return
+            db_session.execute(insert(UpstreamCallSample), [{
+                'provider': provider,
+                'success': success,
+                'latency_ms': int(latency * 1000),
+                'error': (error or '')[:100] or None,
+                'created_at': now,
+            } for success, latency, error, provider in permit.samples])
+            db_session.execute(delete(UpstreamCallSample).where(
+                UpstreamCallSample.created_at < now - SAMPLE_RETENTION))
+            db_session.commit()
+
+            if not CIRCUIT_ENABLED:
+                return
+            if permit.probe:
+                if permit.succeeded:
+                    self._transition(db_session, UpstreamCircuit.state == 'half_open',
+                                     state='closed', opened_at=None, probe_started_at=None, closed_at=now)
+                    self._local_state = 'closed'
+                    logger.info(f"探测请求成功，熔断器关闭: {self.provider}")
+                else:
+                    self._transition(db_session, UpstreamCircuit.state == 'half_open',
+                                     state='open', opened_at=now, probe_started_at=None)
+                    self._local_state = 'open'
+                    logger.warning(f"探测请求失败，熔断器重新打开: {self.provider}")
+                return
+
+            self._check_window(db_session, now)
+            # 对冲请求发往备用上游的记录同样计入备用上游的熔断判断
+            for provider in {sample[3] for sample in permit.samples} - {self.provider}:
+                get_breaker(provider)._check_window(db_session, now)
+        except Exception as e:
+            db_session.rollback()
+            logger.warning(f"记录上游调用结果失败: {str(e)}")
+
+    def _check_window(self, db_session, now):
+        """窗口内失败率或慢调用比例超过阈值时打开熔断器"""
+        from models import UpstreamCircuit
+
+        window = self.window_stats(db_session)
+        if self._should_trip(window):
+            self._get_row(db_session)
+            if self._transition(db_session, UpstreamCircuit.state == 'closed',
+                                state='open', opened_at=now):
+                logger.warning(f"上游熔断器打开: {self.provider}, 窗口统计 {window}")
+            self._local_state = 'open'
+
+    @staticmethod
+    def _should_trip(window):
+        if window['calls'] < MIN_CALLS:
+            return False
+        return (window['failures'] / window['calls'] >= FAILURE_RATE
+                or window['slow_calls'] / window['calls'] >= SLOW_CALL_RATE)
+
+    # ---------- 数据库操作 ----------
+
+    def _get_row(self, db_session):
+        from models import UpstreamCircuit
+
+        row = db_session.get(UpstreamCircuit, self.provider)
+        if row is not None:
+            return row
+        try:
+            db_session.execute(insert(UpstreamCircuit).values(
+                provider=self.provider, state='closed', updated_at=datetime.utcnow()))
+            db_session.commit()
+        except IntegrityError:
+            db_session.rollback()  # 其他进程已创建
+        return db_session.get(UpstreamCircuit, self.provider)
+
+    def _transition(self, db_session, *conditions, **values):
+        from models import UpstreamCircuit
+
+        values['updated_at'] = datetime.utcnow()
+        result = db_session.execute(
+            update(UpstreamCircuit)
+            .where(UpstreamCircuit.provider == self.provider, *conditions)
+            .values(**values))
+        db_session.commit()
+        return result.rowcount == 1
+
+    def window_stats(self, db_session):
+        """统计窗口内（且在最近一次恢复关闭之后）的调用次数、失败次数和慢调用次数"""
+        from models import UpstreamCallSample, UpstreamCircuit
+
+        since = datetime.utcnow() - timedelta(seconds=WINDOW_SECONDS)
+        closed_at = db_session.execute(
+            select(UpstreamCircuit.closed_at).where(UpstreamCircuit.provider == self.provider)).scalar()
+        if closed_at and closed_at > since:
+            since = closed_at
+        rows = db_session.execute(
+            select(UpstreamCallSample.success, UpstreamCallSample.latency_ms)
+            .where(UpstreamCallSample.provider == self.provider,
+                   UpstreamCallSample.created_at >= since)).all()
+        return {
+            'calls': len(rows),
+            'failures': sum(1 for success, _ in rows if not success),
+            'slow_calls': sum(1 for _, latency_ms in rows if latency_ms >= SLOW_CALL_SECONDS * 1000),
+        }
+
+    # ---------- 自适应超时 ----------
+
+    def is_closed(self, db_session):
+        """只读判断熔断器是否关闭（不会领取探测请求），用于选择对冲的备用上游"""
+        if not CIRCUIT_ENABLED:
+            return True
+        from models import UpstreamCircuit
+
+        try:
+            state = db_session.execute(
+                select(UpstreamCircuit.state).where(UpstreamCircuit.provider == self.provider)).scalar()
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            logger.warning(f"读取熔断状态失败: {str(e)}")
+            return True
+        return state in (None, 'closed')
+
+    def recent_latencies(self, db_session):
+        """最近成功调用的耗时（毫秒），最多ADAPTIVE_SAMPLE_LIMIT条"""
+        from models import UpstreamCallSample
+
+        latencies = db_session.execute(
+            select(UpstreamCallSample.latency_ms)
+            .where(UpstreamCallSample.provider == self.provider,
+                   UpstreamCallSample.success.is_(True))
+            .order_by(UpstreamCallSample.created_at.desc())
+            .limit(ADAPTIVE_SAMPLE_LIMIT)).scalars().all()
+        db_session.commit()
+        return latencies
+
+    def adaptive_timeout(self, db_session, default_timeout):
+        """根据最近成功调用耗时的p95计算超时（秒），样本不足时返回default_timeout"""
+        if not ADAPTIVE_TIMEOUT_ENABLED or db_session is None:
+            return default_timeout
+        cached = self._timeout_cache
+        if cached is not None and time.time() - cached[0] < ADAPTIVE_CACHE_SECONDS:
+            return cached[1] or default_timeout
+
+        try:
+            latencies = self.recent_latencies(db_session)
+        except Exception as e:
+            db_session.rollback()
+            logger.warning(f"计算自适应超时失败: {str(e)}")
+            return default_timeout
+
+        timeout = None
+        p95 = percentile(latencies, 0.95)
+        if len(latencies) >= ADAPTIVE_MIN_SAMPLES and p95 is not None:
+            timeout = round(min(ADAPTIVE_TIMEOUT_MAX,
+                                max(ADAPTIVE_TIMEOUT_MIN, p95 / 1000 * ADAPTIVE_TIMEOUT_MULTIPLIER)), 1)
+        with self._lock:
+            self._timeout_cache = (time.time(), timeout)
+        return timeout or default_timeout
+
+    # ---------- 后台管理 ----------
+
+    def describe(self, db_session):
+        """熔断器状态、窗口统计和当前超时，供后台管理查看"""
+        row = self._get_row(db_session)
+        window = self.window_stats(db_session)
+        return {
+            'provider': self.provider,
+            'enabled': CIRCUIT_ENABLED,
+            'state': row.state,
+            'opened_at': row.opened_at.isoformat() if row.opened_at else None,
+            'probe_started_at': row.probe_started_at.isoformat() if row.probe_started_at else None,
+            'window_seconds': WINDOW_SECONDS,
+            'window': window,
+            'thresholds': {
+                'min_calls': MIN_CALLS,
+                'failure_rate': FAILURE_RATE,
+                'slow_call_seconds': SLOW_CALL_SECONDS,
+                'slow_call_rate': SLOW_CALL_RATE,
+                'open_seconds': OPEN_SECONDS,
+            },
+            'adaptive_timeout': self._timeout_cache[1] if self._timeout_cache else None,
+        }
+
+    def reset(self, db_session):
+        """手动关闭熔断器"""
+        self._get_row(db_session)
+        self._transition(db_session, state='closed', opened_at=None, probe_started_at=None,
+                         closed_at=datetime.utcnow())
+        self._local_state = 'closed'
+
+
+def percentile(values, fraction):
+    """最近秩法计算百分位数，values为空时返回None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider='default'):
+    """按上游标识获取本进程的熔断器实例（状态本身保存在数据库中，各进程共享）"""
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
+
+
+breaker = get_breaker('default')
@@ -0,0 +1,206 @@
+"""轻量级数据库结构升级 - 应用启动时执行，保证已有部署的表结构与模型一致
+
+项目没有引入Alembic，db.create_all()只会创建缺失的表，不会给已有的表补列。
+这里用SQLAlchemy Inspector检查缺失的列，执行幂等的ALTER TABLE。
+"""
+import logging
+import warnings
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import SAWarning
+
+logger = logging.getLogger(__name__)
+
+
+def add_missing_columns(db, table_name, columns):
+    """为已存在的表补齐缺失的列
+
+    columns: {列名: 列定义DDL}，例如 {'event_seq': 'INTEGER NOT NULL DEFAULT 0'}
+    """
+    inspector = inspect(db.engine)
+    if not inspector.has_table(table_name):
+        return []
+
+    existing = {column['name'] for column in inspector.get_columns(table_name)}
+    added = []
+    for name, ddl in columns.items():
+        if name in existing:
+            continue
+        try:
+            db.session.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {name} {ddl}'))
+            db.session.commit()
+            added.append(name)
+        except Exception as e:
+            # 多个进程同时启动时可能已被其他进程添加
+            db.session.rollback()
+            logger.warning(f"添加列 {table_name}.{name} 失败: {str(e)}")
+
+    if added:
+        logger.info(f"数据库结构升级: {table_name} 新增列 {added}")
+    return added
+
+
+def convert_columns_to_jsonb(db, table_name, column_names):
+    """把保存JSON字符串的TEXT列原地转换为JSONB（仅Postgres）
+
+    无法解析的旧数据不会中断转换，保留为JSON字符串值。
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return []
+    inspector = inspect(db.engine)
+    if not inspector.has_table(table_name):
+        return []
+
+    types = {column['name']: str(column['type']).upper() for column in inspector.get_columns(table_name)}
+    converted = []
+    for name in column_names:
+        if name not in types or types[name] == 'JSONB':
+            continue
+        try:
+            db.session.execute(text(
+                "CREATE OR REPLACE FUNCTION pg_temp.try_jsonb(value TEXT) RETURNS JSONB AS $$ "
+                "BEGIN RETURN value::jsonb; EXCEPTION WHEN others THEN RETURN to_jsonb(value); END; "
+                "$$ LANGUAGE plpgsql IMMUTABLE"))
+            db.session.execute(text(
+                f'ALTER TABLE {table_name} ALTER COLUMN {name} TYPE JSONB USING pg_temp.try_jsonb({name})'))
+            db.session.commit()
+            converted.append(name)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"转换列 {table_name}.{name} 为JSONB失败: {str(e)}")
+
+    if converted:
+        logger.info(f"数据库结构升级: {table_name} 转换为JSONB的列 {converted}")
+    return converted
+
+
+def create_missing_indexes(db, table_name, indexes):
+    """创建表达式索引等create_all无法声明的索引
+
+    indexes: {索引名: {数据库方言: ON 之后的索引定义}}，例如
+    {'ix_x': {'postgresql': "((data ->> 'name'))", 'sqlite': "(json_extract(data, '$.name'))"}}
+    """
+    dialect = db.engine.dialect.name
+    inspector = inspect(db.engine)
+    if not inspector.has_table(table_name):
+        return []
+
+    with warnings.catch_warnings():
+        # 反射表达式索引时SQLAlchemy会警告不支持，只需要索引名
+        warnings.simplefilter('ignore', SAWarning)
+        existing = {index['name'] for index in inspector.get_indexes(table_name)}
+    created = []
+    for name, definitions in indexes.items():
+        if name in existing or dialect not in definitions:
+            continue
+        try:
+            db.session.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table_name} {definitions[dialect]}'))
+            db.session.commit()
+            created.append(name)
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"创建索引 {table_name}.{name} 失败: {str(e)}")
+
+    if created:
+        logger.info(f"数据库结构升级: {table_name} 新增索引 {created}")
+    return created
+
+
+def run_startup_migrations(db):
+    """按顺序执行所有幂等的结构升级"""
+    # 后台任务的阶段代码和事件序号（SSE进度推送）
+    add_missing_columns(db, 'background_jobs', {
+        'stage_code': 'VARCHAR(30)',
+        'event_seq': 'INTEGER NOT NULL DEFAULT 0',
+        'partial_result': 'TEXT',
+    })
+
+    # 表单数据和分析结果改为JSONB，按项目名查找走表达式索引（与json_documents.json_text生成的SQL一致）
+    convert_columns_to_jsonb(db, 'analysis_results', ['form_data', 'result_data'])
+    convert_columns_to_jsonb(db, 'form_submissions', ['form_data_complete'])
+    # 分析结果编辑接口的乐观并发版本号
+    add_missing_columns(db, 'analysis_results', {
+        'version': 'INTEGER NOT NULL DEFAULT 0',
+    })
+
+    # 历史记录游标分页（已有部署的表不会由create_all补建索引）
+    create_missing_indexes(db, 'analysis_results', {
+        name: {'postgresql': columns, 'sqlite': columns} for name, columns in (
+            ('ix_analysis_results_user_created_seq', '(user_id, created_at, sequence_id)'),
+            ('ix_analysis_results_created_seq', '(created_at, sequence_id)'),
+        )
+    })
+    create_missing_indexes(db, 'analysis_results', {
+        'ix_analysis_results_form_project_name': {
+            'postgresql': "((form_data ->> 'projectName'))",
+            'sqlite': "(json_extract(form_data, '$.projectName'))",
+        },
+    })
+
+    # 结果摘要列（历史记录卡片和按收入类型筛选），加列之前的记录分批补算
+    json_type = 'JSONB' if db.engine.dialect.name == 'postgresql' else 'JSON'
+    add_missing_columns(db, 'analysis_results', {
+        'pipeline_count': 'INTEGER',
+        'pipeline_names': json_type,
+        'income_types': json_type,
+    })
+    create_missing_indexes(db, 'analysis_results', {
+        'ix_analysis_results_income_types_gin': {
+            'postgresql': 'USING GIN (income_types jsonb_path_ops)',
+        },
+    })
+    try:
+        import result_summary
+        result_summary.backfill(db.session)
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"补算结果摘要失败: {str(e)}")
+
+    # 全文搜索索引表由create_all创建；Postgres上词元向量的GIN索引，加表之前的记录分批补建
+    create_missing_indexes(db, 'search_documents', {
+        'ix_search_documents_vector_gin': {
+            'postgresql': 'USING GIN (search_vector)',
+        },
+    })
+    try:
+        import search_index
+        search_index.backfill(db.session)
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"补建搜索索引失败: {str(e)}")
+
+    # 知识库文本提取状态（片段表由create_all创建）
+    add_missing_columns(db, 'knowledge_items', {
+        'ingest_status': 'VARCHAR(20)',
+        'ingest_error': 'VARCHAR(500)',
+        'chunk_count': 'INTEGER',
+        'text_length': 'INTEGER',
+        'ingested_at': 'TIMESTAMP',
+    })
+
+    # 分析任务的额度预留状态
+    add_missing_columns(db, 'analysis_jobs', {
+        'quota_state': 'VARCHAR(20)',
+    })
+
+    # 后台用户列表按注册时间分页
+    create_missing_indexes(db, 'users', {
+        'ix_users_created_id': {'postgresql': '(created_at, id)', 'sqlite': '(created_at, id)'},
+    })
+
+    # 遗留分析任务和额度预留的定期修复
+    create_missing_indexes(db, 'analysis_jobs', {
+        'ix_analysis_jobs_state_updated': {'postgresql': '(state, updated_at)', 'sqlite': '(state, updated_at)'},
+        'ix_analysis_jobs_quota_state': {'postgresql': '(quota_state, state)', 'sqlite': '(quota_state, state)'},
+    })
+
+    # 用量明细按上游请求记录，并合并了原prompt_token_usage表的token预算字段
+    add_missing_columns(db, 'usage_records', {
+        'hedge_lost': 'BOOLEAN NOT NULL DEFAULT FALSE',
+        'cache_key': 'VARCHAR(64)',
+        'tokenizer': 'VARCHAR(50)',
+        'input_budget': 'INTEGER',
+        'max_tokens': 'INTEGER',
+        'section_tokens': json_type,
+        'trimmed_sections': json_type,
+    })
@@ -1,13 +1,25 @@
 # Gunicorn configuration file
 import multiprocessing
+import os
 
 # Server socket
 bind = "0.0.0.0:5000"
 
 # Worker processes
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
-worker_connections = 1000
+# GUNICORN_WORKER_CLASS: sync（默认）/ gthread / gevent
+# - gthread: 每个进程GUNICORN_THREADS个线程，SSE长连接不再独占整个进程
+#   （SSE_ENABLED未设置时，只有gthread/gevent下才开启SSE进度推送，sync下页面使用轮询）
+# - gevent: 需要额外安装 `pip install gevent`；协程处理大量并发连接，
+#   此时后台任务线程池的线程也会变成greenlet，JOB_WORKERS可以设置得较大
+#   上游调用本身的高并发建议使用 AI_ASYNC_ENABLED=true 配合 sync/gthread worker；
+#   gevent会替换线程实现，不要与AI_ASYNC_ENABLED同时开启
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+threads = int(os.environ.get("GUNICORN_THREADS", 1 if worker_class == "sync" else 8))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+if worker_class == "gevent":
+    # gevent worker在fork之后才打补丁，预加载的应用会持有未打补丁的socket/线程
+    workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() + 1))
 
 # Timeout settings - 增加超时时间以支持OpenAI API慢响应
 timeout = 300  # 5分钟超时，足够处理最慢的OpenAI请求
@@ -18,7 +30,7 @@ max_requests = 1000
 max_requests_jitter = 50
 
 # Preload application code before the worker processes are forked
-preload_app = True
+preload_app = worker_class != "gevent"
 
 # Restart workers when code changes (for development)
 reload = True
@@ -29,4 +41,10 @@ reuse_port = True
 # Logging
 loglevel = "info"
 accesslog = "-"  # Log to stdout
-access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s'
\ No newline at end of file
+access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s'
+
+# 后台任务线程池 - preload_app时需要在fork之后的worker进程中启动
+def post_fork(server, worker):
+    from app import job_queue
+    if job_queue.mode == 'embedded':
+        job_queue.start()
@@ -0,0 +1,543 @@
+"""后台任务队列 - 数据库任务表 + 有界线程池
+
+web请求只负责入队并立即返回任务ID，耗时的AI分析在独立的有界线程池中执行，
+不再长时间占用gunicorn的sync worker。任务状态持久化在background_jobs表中，
+多个进程之间通过条件UPDATE抢占任务，保证同一任务只会被执行一次。
+
+运行模式（JOB_WORKER_MODE）：
+- embedded: 每个web进程内置一个有界线程池（默认）
+- external: web进程只入队，由 `python worker.py` 启动的独立进程执行
+
+处理函数为协程（async def）时，任务在进程内的后台事件循环中执行，等待上游API期间
+不占用线程，并发上限为JOB_ASYNC_CONCURRENCY；数据库操作通过run_sync交给一个小的
+数据库线程池执行（每次调用都有独立的应用上下文）。
+
+observe(kind, callback) 可以订阅某类任务的状态变化（领取、进度、重新排队、完成、失败），
+用于维护业务自己的状态表（如analysis_jobs）；回调失败只记录日志，sweep(callback) 注册的
+修复函数由调度线程每 JOB_SWEEP_INTERVAL 秒执行一次，用于补做遗漏的状态同步。
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import update
+
+import structured_logging
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """基于数据库的后台任务队列"""
+
+    def __init__(self, app=None, db=None):
+        self.app = None
+        self.db = None
+        self._handlers = {}
+        self._observers = {}
+        self._sweepers = []
+        self._swept_at = 0.0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._active = 0
+        self._active_async = 0
+        self._running = {}  # 本进程正在执行的任务 -> 领取时的attempts
+        self._heartbeat_at = 0.0
+        self._loop = None
+        self._db_executor = None
+        self._report_executor = None
+        self._stop_event = threading.Event()
+        # 本进程内的进度变化通知，SSE推送据此及时唤醒
+        self._changed = threading.Condition()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """绑定Flask应用并读取队列配置"""
+        self.app = app
+        self.db = db
+        self.max_workers = app.config.get('JOB_WORKERS', 4)
+        self.mode = app.config.get('JOB_WORKER_MODE', 'embedded')
+        self.poll_interval = app.config.get('JOB_POLL_INTERVAL', 2.0)
+        self.stale_after = app.config.get('JOB_STALE_AFTER', 600)
+        # 执行中的任务定期刷新心跳，上游长时间重试、没有进度上报时也不会被判定为僵死
+        self.heartbeat_interval = app.config.get('JOB_HEARTBEAT_INTERVAL', min(30, self.stale_after / 4))
+        self.sweep_interval = app.config.get('JOB_SWEEP_INTERVAL', 60)
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', 2)
+        self.async_concurrency = app.config.get('JOB_ASYNC_CONCURRENCY', 200)
+        self.db_threads = app.config.get('JOB_DB_THREADS', 16)
+        app.extensions['job_queue'] = self
+
+    @property
+    def worker_id(self):
+        """当前进程的worker标识"""
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def register(self, kind, handler=None):
+        """注册任务处理函数，可作为装饰器使用
+
+        处理函数签名: handler(job, payload, report) -> result_ref
+        report(progress, stage, stage_code, partial) 用于上报进度和已完成的部分结果
+
+        协程处理函数签名: async handler(job, payload, report, run_sync) -> result_ref
+        job只包含id/kind/user_id；await run_sync(func, *args) 在带应用上下文的数据库线程中
+        执行同步函数；report不阻塞事件循环，按调用顺序写入任务表
+        """
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+        if handler is not None:
+            return decorator(handler)
+        return decorator
+
+    def observe(self, kind, callback):
+        """订阅任务状态变化：callback(job_id, event, values)
+
+        event: running / progress / queued / completed / failed；values为本次写入的列。
+        在任务表写入提交后、同一线程的应用上下文中调用，回调异常只记录日志。
+        """
+        self._observers.setdefault(kind, []).append(callback)
+
+    def sweep(self, callback):
+        """注册定期执行的修复函数 callback()（在调度线程的应用上下文中调用，异常只记录日志）"""
+        self._sweepers.append(callback)
+
+    def _run_sweepers(self):
+        now = time.monotonic()
+        if now - self._swept_at < self.sweep_interval:
+            return
+        self._swept_at = now
+        for callback in self._sweepers:
+            try:
+                callback()
+            except Exception as e:
+                self.db.session.rollback()
+                logger.warning(f"任务修复函数执行失败: {str(e)}")
+
+    def _emit(self, kind, job_id, event, **values):
+        for callback in self._observers.get(kind, ()):
+            try:
+                callback(job_id, event, values)
+            except Exception as e:
+                self.db.session.rollback()
+                logger.warning(f"任务状态回调失败 {job_id} ({event}): {str(e)}")
+
+    # ---------- 入队与查询（web请求中调用） ----------
+
+    def enqueue(self, kind, payload, user_id=None, stage='任务已排队，等待执行...', job_id=None):
+        """创建任务并立即返回，不等待执行
+
+        job_id: 可选，由调用方预先生成（例如与业务状态表共用同一个ID）
+        提交时会一并提交session中尚未提交的修改（调用方可以把业务状态行与任务放在同一事务中）；
+        提交失败时回滚并抛出异常
+        """
+        from models import BackgroundJob
+
+        job = BackgroundJob()
+        if job_id:
+            job.id = job_id
+        job.kind = kind
+        job.user_id = user_id
+        job.payload = json.dumps(payload, ensure_ascii=False)
+        job.status = 'queued'
+        job.progress = 0
+        job.stage = stage
+        job.stage_code = 'queued'
+        job.event_seq = 0
+        self.db.session.add(job)
+        try:
+            self.db.session.commit()
+        except Exception:
+            self.db.session.rollback()
+            raise
+        logger.info(f"任务已入队: {job.id} ({kind})")
+
+        # 内置模式下如果本进程还有空闲槽位，直接提交执行
+        if self.mode == 'embedded':
+            self.start()
+            self._try_submit(job.id, kind)
+        return job
+
+    def get(self, job_id):
+        """按主键查询任务"""
+        from models import BackgroundJob
+        if not job_id:
+            return None
+        return self.db.session.get(BackgroundJob, job_id)
+
+    def report(self, job_id, progress=None, stage=None, stage_code=None, partial=None, kind=None, attempt=None):
+        """上报任务进度，同时刷新心跳；进度、阶段或部分结果变化时事件序号+1
+
+        attempt: 执行中的任务传入领取时的attempts，任务已被回收重新排队（或已结束）时不再写入
+        """
+        from models import BackgroundJob
+
+        values = {'heartbeat_at': datetime.utcnow()}
+        if progress is not None:
+            values['progress'] = progress
+        if stage is not None:
+            values['stage'] = stage
+        if stage_code is not None:
+            values['stage_code'] = stage_code
+        if partial is not None:
+            values['partial_result'] = json.dumps(partial, ensure_ascii=False)
+        if len(values) > 1:
+            values['event_seq'] = BackgroundJob.event_seq + 1
+        conditions = self._owned(job_id, attempt) if attempt is not None else (BackgroundJob.id == job_id,)
+        result = self.db.session.execute(update(BackgroundJob).where(*conditions).values(**values))
+        self.db.session.commit()
+        if result.rowcount != 1:
+            return
+        self._notify()
+        if kind is not None and (progress is not None or stage is not None):
+            self._emit(kind, job_id, 'progress', progress=progress, stage=stage)
+
+    def snapshot(self, job_id):
+        """只读取进度相关的列，供SSE推送和状态轮询使用
+
+        直接按主键查询列值，不经过ORM身份映射（保证每次读到最新数据），
+        读取后立即释放连接，长连接的推送请求不会一直占用连接池。
+        """
+        from models import BackgroundJob
+
+        try:
+            row = self.db.session.execute(
+                self.db.select(BackgroundJob.status, BackgroundJob.progress,
+                               BackgroundJob.stage, BackgroundJob.stage_code,
+                               BackgroundJob.event_seq, BackgroundJob.partial_result,
+                               BackgroundJob.result_ref, BackgroundJob.error)
+                .where(BackgroundJob.id == job_id)).first()
+        finally:
+            self.db.session.close()
+        return dict(row._mapping) if row is not None else None
+
+    def wait_for_update(self, timeout):
+        """等待本进程内的任何进度变化，超时返回False
+
+        其他进程（或独立worker）中的任务不会触发通知，调用方需按超时间隔重新查询。
+        """
+        with self._changed:
+            return self._changed.wait(timeout)
+
+    def _notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    # ---------- 线程池管理 ----------
+
+    def start(self):
+        """启动本进程的线程池和调度线程（fork之后需要重新创建）"""
+        with self._lock:
+            if self._pid == os.getpid() and self._executor is not None:
+                return
+            self._pid = os.getpid()
+            self._active = 0
+            self._running = {}
+            self._stop_event = threading.Event()
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix='job-worker')
+            dispatcher = threading.Thread(target=self._dispatch_loop,
+                                          name='job-dispatcher', daemon=True)
+            dispatcher.start()
+            logger.info(f"后台任务线程池已启动: {self.worker_id}, 并发上限 {self.max_workers}")
+            if any(self._is_async(kind) for kind in self._handlers):
+                self._start_event_loop()
+
+    def _is_async(self, kind):
+        return asyncio.iscoroutinefunction(self._handlers.get(kind))
+
+    def _start_event_loop(self):
+        """启动执行协程任务的后台事件循环，以及数据库线程池和进度上报线程"""
+        self._active_async = 0
+        self._db_executor = ThreadPoolExecutor(max_workers=self.db_threads,
+                                               thread_name_prefix='job-db')
+        # 单线程保证同一任务的进度上报和最终状态按调用顺序写入
+        self._report_executor = ThreadPoolExecutor(max_workers=1,
+                                                   thread_name_prefix='job-report')
+        self._loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=self._loop.run_forever,
+                                       name='job-event-loop', daemon=True)
+        loop_thread.start()
+        logger.info(f"后台任务事件循环已启动: {self.worker_id}, 协程任务并发上限 {self.async_concurrency}")
+
+    def stop(self, wait=True):
+        """停止调度并等待正在执行的任务结束"""
+        self._stop_event.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+        if self._loop is not None:
+            while wait and self._active_async > 0:
+                self._stop_event.wait(0.5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+            self._db_executor.shutdown(wait=wait)
+            self._report_executor.shutdown(wait=wait)
+
+    def run_forever(self):
+        """独立worker进程入口：持续领取并执行任务，直到收到退出信号"""
+        self.mode = 'external'
+        self.start()
+
+        def _handle_signal(signum, frame):
+            logger.info(f"收到退出信号 {signum}，等待正在执行的任务结束...")
+            self._stop_event.set()
+
+        signal.signal(signal.SIGTERM, _handle_signal)
+        signal.signal(signal.SIGINT, _handle_signal)
+        while not self._stop_event.wait(1):
+            pass
+        self.stop(wait=True)
+
+    def _try_submit(self, job_id, kind=None):
+        """有空闲槽位时提交任务，否则留在队列中等待调度线程领取"""
+        if self._loop is not None and self._is_async(kind):
+            with self._lock:
+                if self._active_async >= self.async_concurrency:
+                    return False
+                self._active_async += 1
+            asyncio.run_coroutine_threadsafe(self._run_async(job_id, kind), self._loop)
+            return True
+
+        with self._lock:
+            if self._executor is None or self._active >= self.max_workers:
+                return False
+            self._active += 1
+        self._executor.submit(self._run, job_id, kind)
+        return True
+
+    def _free_slots(self):
+        with self._lock:
+            free = self.max_workers - self._active
+            if self._loop is not None:
+                free += self.async_concurrency - self._active_async
+            return free
+
+    def _run(self, job_id, kind=None):
+        structured_logging.start_trace(job_id)
+        try:
+            with self.app.app_context():
+                attempt = self._claim(job_id, kind)
+                if attempt is not None:
+                    self._execute(job_id, attempt)
+        except Exception as e:
+            logger.error(f"后台任务执行异常 {job_id}: {str(e)}")
+            logger.error(traceback.format_exc())
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._running.pop(job_id, None)
+
+    def _with_context(self, func, *args):
+        with self.app.app_context():
+            return func(*args)
+
+    async def _run_async(self, job_id, kind=None):
+        structured_logging.start_trace(job_id)
+        loop = asyncio.get_running_loop()
+
+        async def run_sync(func, *args):
+            return await loop.run_in_executor(self._db_executor, self._with_context, func, *args)
+
+        async def run_ordered(func, *args):
+            return await loop.run_in_executor(self._report_executor, self._with_context, func, *args)
+
+        try:
+            attempt = await run_sync(self._claim, job_id, kind)
+            if attempt is not None:
+                await self._execute_async(job_id, attempt, run_sync, run_ordered)
+        except Exception as e:
+            logger.error(f"后台协程任务执行异常 {job_id}: {str(e)}")
+            logger.error(traceback.format_exc())
+        finally:
+            with self._lock:
+                self._active_async -= 1
+                self._running.pop(job_id, None)
+
+    def _load_job(self, job_id):
+        job = self.get(job_id)
+        info = SimpleNamespace(id=job.id, kind=job.kind, user_id=job.user_id)
+        return info, json.loads(job.payload or '{}')
+
+    async def _execute_async(self, job_id, attempt, run_sync, run_ordered):
+        """协程版的_execute：进度上报和最终状态都经过单线程的上报执行器，保证顺序"""
+        job, payload = await run_sync(self._load_job, job_id)
+        handler = self._handlers.get(job.kind)
+
+        def report(progress=None, stage=None, stage_code=None, partial=None):
+            # 可能在事件循环或数据库线程中调用，不等待写入完成
+            self._report_executor.submit(self._with_context, self.report, job_id,
+                                         progress, stage, stage_code, partial, job.kind, attempt)
+
+        try:
+            result_ref = await handler(job, payload, report, run_sync)
+            await run_ordered(self._finish, job_id, 'completed', result_ref, None, job.kind, attempt)
+            logger.info(f"后台协程任务完成: {job_id} -> {result_ref}")
+        except Exception as e:
+            logger.error(f"后台协程任务失败 {job_id}: {str(e)}")
+            logger.error(traceback.format_exc())
+            await run_ordered(self._finish, job_id, 'failed', None, str(e)[:500], job.kind, attempt)
+
+    def _claim(self, job_id, kind=None):
+        """原子抢占任务：只有状态仍为queued时才能领取成功，返回本次执行的attempts，领取失败返回None"""
+        from models import BackgroundJob
+
+        now = datetime.utcnow()
+        attempt = self.db.session.execute(
+            update(BackgroundJob)
+            .where(BackgroundJob.id == job_id, BackgroundJob.status == 'queued')
+            .values(status='running', started_at=now, heartbeat_at=now,
+                    stage_code='running', event_seq=BackgroundJob.event_seq + 1,
+                    worker_id=self.worker_id, attempts=BackgroundJob.attempts + 1)
+            .returning(BackgroundJob.attempts)).scalar()
+        self.db.session.commit()
+        self._notify()
+        if attempt is None:
+            return None
+        with self._lock:
+            self._running[job_id] = attempt
+        self._emit(kind, job_id, 'running', started_at=now)
+        return attempt
+
+    def _owned(self, job_id, attempt):
+        """本进程本次执行仍持有任务的条件：任务被回收重新排队、被其他worker领取或已结束时不成立"""
+        from models import BackgroundJob
+
+        return (BackgroundJob.id == job_id, BackgroundJob.status == 'running',
+                BackgroundJob.worker_id == self.worker_id, BackgroundJob.attempts == attempt)
+
+    def _execute(self, job_id, attempt):
+        """执行已领取的任务并记录最终状态"""
+        job = self.get(job_id)
+        handler = self._handlers.get(job.kind)
+        kind = job.kind
+        if handler is None:
+            self._finish(job_id, 'failed', error=f'未注册的任务类型: {kind}', kind=kind, attempt=attempt)
+            return
+
+        def report(progress=None, stage=None, stage_code=None, partial=None):
+            self.report(job_id, progress, stage, stage_code, partial, kind, attempt)
+
+        try:
+            payload = json.loads(job.payload or '{}')
+            result_ref = handler(job, payload, report)
+            self._finish(job_id, 'completed', result_ref=result_ref, kind=kind, attempt=attempt)
+            logger.info(f"后台任务完成: {job_id} -> {result_ref}")
+        except Exception as e:
+            self.db.session.rollback()
+            logger.error(f"后台任务失败 {job_id}: {str(e)}")
+            logger.error(traceback.format_exc())
+            self._finish(job_id, 'failed', error=str(e)[:500], kind=kind, attempt=attempt)
+
+    def _finish(self, job_id, status, result_ref=None, error=None, kind=None, attempt=None):
+        """写入最终状态；只有本次执行仍持有任务时生效，已被回收并由其他执行接管时返回False"""
+        from models import BackgroundJob
+
+        values = {'status': status, 'stage_code': status, 'finished_at': datetime.utcnow(),
+                  'event_seq': BackgroundJob.event_seq + 1}
+        if status == 'completed':
+            values.update(progress=100, stage='任务完成', result_ref=result_ref)
+        else:
+            values.update(stage='任务失败', error=error)
+        conditions = self._owned(job_id, attempt) if attempt is not None else (BackgroundJob.id == job_id,)
+        result = self.db.session.execute(update(BackgroundJob).where(*conditions).values(**values))
+        self.db.session.commit()
+        if result.rowcount != 1:
+            logger.warning(f"任务 {job_id} 已被回收或由其他执行接管，忽略本次执行的结果（{status}）")
+            return False
+        self._notify()
+        self._emit(kind, job_id, status, result_ref=result_ref, error=error,
+                   finished_at=values['finished_at'])
+        return True
+
+    # ---------- 调度线程 ----------
+
+    def _dispatch_loop(self):
+        """定期回收僵死任务，并领取其他进程未来得及执行的排队任务"""
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                with self.app.app_context():
+                    self._heartbeat()
+                    self._requeue_stale()
+                    self._run_sweepers()
+                    self._submit_pending()
+            except Exception as e:
+                logger.warning(f"任务调度循环异常: {str(e)}")
+
+    def _heartbeat(self):
+        """每 heartbeat_interval 秒刷新一次本进程正在执行的任务的心跳（一条UPDATE）"""
+        from models import BackgroundJob
+
+        now = time.monotonic()
+        with self._lock:
+            job_ids = list(self._running)
+            if not job_ids or now - self._heartbeat_at < self.heartbeat_interval:
+                return
+            self._heartbeat_at = now
+        self.db.session.execute(
+            update(BackgroundJob)
+            .where(BackgroundJob.id.in_(job_ids), BackgroundJob.status == 'running',
+                   BackgroundJob.worker_id == self.worker_id)
+            .values(heartbeat_at=datetime.utcnow()))
+        self.db.session.commit()
+
+    def _submit_pending(self):
+        from models import BackgroundJob
+
+        free = self._free_slots()
+        if free <= 0:
+            return
+        # 给入队进程留出直接提交的时间，避免刚入队的任务被其他进程抢走
+        grace = datetime.utcnow() - timedelta(seconds=1)
+        pending = self.db.session.execute(
+            self.db.select(BackgroundJob.id, BackgroundJob.kind)
+            .where(BackgroundJob.status == 'queued', BackgroundJob.created_at <= grace)
+            .order_by(BackgroundJob.created_at)
+            .limit(free)).all()
+        for job_id, kind in pending:
+            # 线程池和事件循环的槽位分别计算，一方已满时另一种任务仍可提交
+            self._try_submit(job_id, kind)
+
+    def _requeue_stale(self):
+        """心跳超时的running任务视为worker已崩溃：未超过重试次数则重新排队，否则标记失败"""
+        from models import BackgroundJob
+
+        deadline = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        stale = (BackgroundJob.status == 'running', BackgroundJob.heartbeat_at < deadline)
+        stale_jobs = self.db.session.execute(
+            self.db.select(BackgroundJob.id, BackgroundJob.kind, BackgroundJob.attempts)
+            .where(*stale)).all()
+        self.db.session.commit()
+
+        requeued = failed = 0
+        for job_id, kind, attempts in stale_jobs:
+            # 逐个带条件更新：心跳在此期间恢复的任务不受影响，并能通知状态订阅者
+            if attempts < self.max_attempts:
+                values = dict(status='queued', stage='任务重新排队...', stage_code='queued', worker_id=None)
+            else:
+                values = dict(status='failed', stage='任务失败', stage_code='failed', error='任务执行超时',
+                              finished_at=datetime.utcnow())
+            result = self.db.session.execute(
+                update(BackgroundJob).where(BackgroundJob.id == job_id, *stale)
+                .values(event_seq=BackgroundJob.event_seq + 1, **values))
+            self.db.session.commit()
+            if result.rowcount != 1:
+                continue
+            if values['status'] == 'queued':
+                requeued += 1
+                self._emit(kind, job_id, 'queued', stage=values['stage'])
+            else:
+                failed += 1
+                self._emit(kind, job_id, 'failed', error=values['error'], finished_at=values['finished_at'])
+        if requeued or failed:
+            logger.warning(f"回收僵死任务: 重新排队 {requeued}, 标记失败 {failed}")
@@ -0,0 +1,167 @@
+"""JSON文档列 - AnalysisResult.form_data/result_data、FormSubmission.form_data_complete
+
+Postgres上这些列为JSONB（旧部署的TEXT列由 db_migrations 在启动时原地转换），其他数据库（本地SQLite）为JSON：
+- JSONDocument: 列类型，读写直接是dict/list，视图中不再需要json.loads/json.dumps
+- json_text(): 文档顶层key的文本值，生成的SQL与启动时创建的表达式索引一致，按项目名查找可以走索引
+- json_array_contains(): 数组列包含某个值（摘要列 income_types 的筛选）
+- json_patch(): 把RFC 6902（JSON Patch）操作转换为数据库内的修改（jsonb_set / json_set），
+  编辑接口不必读出整份结果再整体写回
+"""
+import json
+import re
+
+from sqlalchemy import JSON, Boolean, String, bindparam, func, literal_column
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.types import Text
+
+JSONDocument = JSON().with_variant(JSONB(), 'postgresql')
+
+_KEY_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class json_text(FunctionElement):
+    """文档顶层key的文本值：Postgres为 (col ->> 'key')，SQLite为 json_extract(col, '$.key')
+
+    key直接写在SQL中（不使用绑定参数），这样才能与表达式索引匹配，因此只接受普通标识符。
+    """
+    type = String()
+    name = 'json_text'
+    inherit_cache = True
+
+    def __init__(self, column, key):
+        if not _KEY_PATTERN.match(key):
+            raise ValueError(f"不支持的JSON key: {key}")
+        super().__init__(column, literal_column(f"'{key}'"), literal_column(f"'$.{key}'"))
+
+
+@compiles(json_text, 'postgresql')
+def _json_text_postgresql(element, compiler, **kw):
+    column, key, _ = element.clauses
+    return f"({compiler.process(column, **kw)} ->> {compiler.process(key, **kw)})"
+
+
+@compiles(json_text)
+def _json_text_default(element, compiler, **kw):
+    column, _, path = element.clauses
+    return f"json_extract({compiler.process(column, **kw)}, {compiler.process(path, **kw)})"
+
+
+class json_array_contains(FunctionElement):
+    """数组列包含某个字符串：Postgres为 col @> jsonb_build_array(值)（可走GIN索引），SQLite使用json_each"""
+    type = Boolean()
+    name = 'json_array_contains'
+    inherit_cache = True
+
+    def __init__(self, column, value):
+        super().__init__(column, bindparam(None, value, type_=String))
+
+
+@compiles(json_array_contains, 'postgresql')
+def _json_array_contains_postgresql(element, compiler, **kw):
+    column, value = element.clauses
+    return f"({compiler.process(column, **kw)} @> jsonb_build_array({compiler.process(value, **kw)}))"
+
+
+@compiles(json_array_contains)
+def _json_array_contains_default(element, compiler, **kw):
+    column, value = element.clauses
+    return (f"EXISTS (SELECT 1 FROM json_each({compiler.process(column, **kw)}) "
+            f"WHERE json_each.value = {compiler.process(value, **kw)})")
+
+
+class PatchError(ValueError):
+    """无效或不支持的JSON Patch操作"""
+
+
+_INDEX_PATTERN = re.compile(r'^(0|[1-9][0-9]*)$')
+
+
+def parse_pointer(pointer):
+    """RFC 6901 JSON Pointer转换为路径元组；纯数字的段视为数组下标，'-'表示数组末尾"""
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise PatchError(f"无效的路径: {pointer!r}")
+    path = []
+    for token in pointer[1:].split('/'):
+        token = token.replace('~1', '/').replace('~0', '~')
+        path.append(int(token) if _INDEX_PATTERN.match(token) else token)
+    return tuple(path)
+
+
+def _parse_operation(operation):
+    if not isinstance(operation, dict):
+        raise PatchError("每个操作必须是对象")
+    op = operation.get('op')
+    if op not in ('add', 'replace', 'remove', 'test'):
+        raise PatchError(f"不支持的操作: {op!r}")
+    path = parse_pointer(operation.get('path'))
+    if op != 'remove' and 'value' not in operation:
+        raise PatchError(f"{op} 操作缺少value")
+    if '-' in path[:-1] or (path[-1] == '-' and op != 'add'):
+        raise PatchError(f"'-' 只能作为add操作路径的最后一段: {operation.get('path')}")
+    if op == 'add' and isinstance(path[-1], int):
+        raise PatchError(f"不支持插入到数组中间，请使用replace或在路径末尾使用'-': {operation.get('path')}")
+    return op, path, operation.get('value')
+
+
+def json_patch(column, operations, dialect_name):
+    """把RFC 6902操作列表转换为 (新文档表达式, WHERE条件列表)，整批修改在一条UPDATE中完成
+
+    - add/replace: 写入路径，缺失的中间对象会被创建；add的路径以'-'结尾时追加到数组末尾
+    - remove: 删除路径
+    - test: 转换为WHERE条件，不满足时UPDATE不修改任何行
+    不支持move/copy，也不支持插入到数组中间。
+    """
+    steps = [_parse_operation(operation) for operation in operations]
+    postgresql = dialect_name == 'postgresql'
+
+    if postgresql:
+        document = func.coalesce(column, func.jsonb_build_object())
+        # jsonb_set不会创建缺失的中间对象：先由浅到深补齐（以原值为准，已存在的保持不变）
+        targets = [path[:-1] if path[-1] == '-' else path for op, path, _ in steps if op in ('add', 'replace')]
+        parents = sorted({target[:depth] for target in targets
+                          for depth in range(1, len(target)) if isinstance(target[depth - 1], str)}, key=len)
+        for parent in parents:
+            document = func.jsonb_set(document, _pg_path(parent),
+                                      func.coalesce(column.op('#>')(_pg_path(parent)), func.jsonb_build_object()))
+    else:
+        document = func.coalesce(column, '{}')
+
+    conditions = []
+    for op, path, value in steps:
+        if postgresql:
+            if op == 'test':
+                conditions.append(document.op('#>')(_pg_path(path)) == bindparam(None, value, type_=JSONB))
+            elif op == 'remove':
+                document = document.op('#-')(_pg_path(path))
+            elif path[-1] == '-':
+                document = func.jsonb_insert(document, _pg_path(path[:-1] + (-1,)),
+                                             bindparam(None, value, type_=JSONB), True)
+            else:
+                document = func.jsonb_set(document, _pg_path(path), bindparam(None, value, type_=JSONB))
+        else:
+            if op == 'test':
+                conditions.append(document.op('->')(_sqlite_path(path)) == _sqlite_value(value))
+            elif op == 'remove':
+                document = func.json_remove(document, _sqlite_path(path))
+            elif path[-1] == '-':
+                document = func.json_insert(document, _sqlite_path(path[:-1]) + '[#]', _sqlite_value(value))
+            else:
+                document = func.json_set(document, _sqlite_path(path), _sqlite_value(value))
+    return document, conditions
+
+
+def _pg_path(path):
+    return bindparam(None, [str(part) for part in path], type_=ARRAY(Text))
+
+
+def _sqlite_path(path):
+    parts = ['$']
+    for part in path:
+        parts.append(f'[{part}]' if isinstance(part, int) else f'."{part}"')
+    return ''.join(parts)
+
+
+def _sqlite_value(value):
+    return func.json(bindparam(None, json.dumps(value, ensure_ascii=False), type_=Text))
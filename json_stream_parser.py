@@ -0,0 +1,143 @@
+"""增量JSON解析器 - 配合AI流式输出，在整个JSON完成之前提取已闭合的片段
+
+AI返回的是一个顶层JSON对象（如 {"overview": {...}, "pipelines": [...]}）。
+解析器逐字符跟踪嵌套层级和字符串状态，每当一个顶层字段的值在语法上闭合时
+产生一个 section 事件；对于 split_arrays 中指定的数组字段（如 pipelines），
+每个数组元素闭合时还会单独产生 item 事件，不必等整个数组结束。
+"""
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalJSONParser:
+    """流式JSON片段解析器
+
+    用法:
+        parser = IncrementalJSONParser(split_arrays=('pipelines',))
+        for chunk in stream:
+            for event in parser.feed(chunk):
+                ...
+        result = json.loads(parser.text)
+
+    事件格式:
+        {'type': 'section', 'key': 'overview', 'value': {...}}
+        {'type': 'item', 'key': 'pipelines', 'index': 0, 'value': {...}}
+    """
+
+    def __init__(self, split_arrays=('pipelines',)):
+        self.split_arrays = set(split_arrays)
+        self.sections = {}
+        self._text = ''
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._expect = None  # 顶层对象内: 'key' / 'colon' / 'value'
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+        self._item_start = None
+        self._item_index = 0
+
+    @property
+    def text(self):
+        """目前为止收到的完整文本"""
+        return self._text
+
+    def feed(self, chunk):
+        """输入一段新文本，返回本段文本中闭合的片段事件列表"""
+        events = []
+        if not chunk:
+            return events
+        self._text += chunk
+        text = self._text
+        while self._pos < len(text):
+            self._consume(text, self._pos, events)
+            self._pos += 1
+        return events
+
+    def _in_split_array(self):
+        return (len(self._stack) == 2 and self._stack[1] == '['
+                and self._key in self.split_arrays)
+
+    def _consume(self, text, i, events):
+        c = text[i]
+        depth = len(self._stack)
+
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif c == '\\':
+                self._escape = True
+            elif c == '"':
+                self._in_string = False
+                if depth == 1 and self._key_start is not None:
+                    self._key = json.loads(text[self._key_start:i + 1])
+                    self._key_start = None
+                    self._expect = 'colon'
+            return
+
+        if c.isspace():
+            return
+
+        # 记录顶层字段值 / 拆分数组元素的起始位置
+        if depth == 1 and self._expect == 'value' and c not in ',}':
+            self._value_start = i
+            self._expect = None
+        elif self._in_split_array() and self._item_start is None and c not in ',]':
+            self._item_start = i
+
+        if c == '"':
+            self._in_string = True
+            if depth == 1 and self._expect == 'key':
+                self._key_start = i
+        elif c in '{[':
+            self._stack.append(c)
+            if depth == 0:
+                self._expect = 'key'
+            elif depth == 1 and c == '[' and self._key in self.split_arrays:
+                self._item_index = 0
+        elif c in '}]':
+            if depth == 1:
+                self._finish_value(text, i, events)
+            elif depth == 2 and c == ']' and self._in_split_array():
+                self._finish_item(text, i, events)
+            if self._stack:
+                self._stack.pop()
+        elif c == ',':
+            if depth == 1:
+                self._finish_value(text, i, events)
+                self._expect = 'key'
+            elif self._in_split_array():
+                self._finish_item(text, i, events)
+        elif c == ':' and depth == 1 and self._expect == 'colon':
+            self._expect = 'value'
+
+    def _finish_value(self, text, end, events):
+        if self._value_start is None:
+            return
+        raw = text[self._value_start:end]
+        self._value_start = None
+        try:
+            value = json.loads(raw)
+        except ValueError as e:
+            logger.warning(f"流式JSON片段解析失败 ({self._key}): {str(e)}")
+            return
+        self.sections[self._key] = value
+        events.append({'type': 'section', 'key': self._key, 'value': value})
+
+    def _finish_item(self, text, end, events):
+        if self._item_start is None:
+            return
+        raw = text[self._item_start:end]
+        index = self._item_index
+        self._item_start = None
+        self._item_index += 1
+        try:
+            value = json.loads(raw)
+        except ValueError as e:
+            logger.warning(f"流式JSON数组元素解析失败 ({self._key}[{index}]): {str(e)}")
+            return
+        events.append({'type': 'item', 'key': self._key, 'index': index, 'value': value})
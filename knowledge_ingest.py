@@ -0,0 +1,238 @@
+"""知识库文本提取 - 上传的文件提取文本、规范化、切分为片段，保存在 knowledge_chunks 表
+
+上传请求只保存文件并入队（后台任务类型 knowledge_ingest），提取在后台任务队列中执行，
+管理员上传较大的docx/pdf时请求也会立即返回：
+
+    pending -> processing -> ready / failed / unsupported
+
+- 提取: txt/md/text 直接读取（utf-8，失败时按gb18030），csv逐行、json格式化输出，
+  docx直接解析压缩包中的word/document.xml（不依赖python-docx），pdf需要安装pypdf（可选依赖）
+- 规范化: 统一换行、去掉控制字符和全角空格、合并连续空白，段落之间保留一个空行
+- 切分: 每段约 KNOWLEDGE_CHUNK_SIZE 个字符，优先在段落、句子边界处断开，相邻片段重叠
+  KNOWLEDGE_CHUNK_OVERLAP 个字符；片段记录在规范化文本中的起止位置
+- 提取完成后更新检索索引（见knowledge_retrieval.py）
+"""
+import csv
+import importlib.util
+import io
+import json
+import logging
+import os
+import re
+import zipfile
+from datetime import datetime
+from xml.etree import ElementTree
+
+from sqlalchemy import delete, insert
+
+import knowledge_retrieval
+
+logger = logging.getLogger(__name__)
+
+JOB_KIND = 'knowledge_ingest'
+
+CHUNK_SIZE = int(os.environ.get('KNOWLEDGE_CHUNK_SIZE', 500))
+CHUNK_OVERLAP = int(os.environ.get('KNOWLEDGE_CHUNK_OVERLAP', 50))
+SUMMARY_LENGTH = 300
+
+PDF_AVAILABLE = importlib.util.find_spec('pypdf') is not None
+
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_CONTROL_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f\u200b\ufeff]')
+_INLINE_SPACE = re.compile(r'[ \t\u00a0\u3000]+')
+_BLANK_LINES = re.compile(r'\n{3,}')
+# 断开片段的位置，按优先级：段落、换行、句末标点、分句标点
+_BOUNDARIES = (re.compile(r'\n\n'), re.compile(r'\n'), re.compile(r'[。！？!?]|\.\s'), re.compile(r'[；;，,]'))
+
+
+class UnsupportedFileType(Exception):
+    """无法提取文本的文件类型"""
+
+
+# ---------- 提取 ----------
+
+def _decode(data):
+    for encoding in ('utf-8-sig', 'gb18030'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode('utf-8', errors='replace')
+
+
+def _extract_docx(path):
+    """按段落提取docx正文（表格中的单元格也是段落）"""
+    with zipfile.ZipFile(path) as archive:
+        xml = archive.read('word/document.xml')
+    paragraphs = []
+    for paragraph in ElementTree.fromstring(xml).iter(f'{_WORD_NS}p'):
+        parts = []
+        for node in paragraph.iter():
+            if node.tag == f'{_WORD_NS}t':
+                parts.append(node.text or '')
+            elif node.tag == f'{_WORD_NS}tab':
+                parts.append('\t')
+            elif node.tag in (f'{_WORD_NS}br', f'{_WORD_NS}cr'):
+                parts.append('\n')
+        paragraphs.append(''.join(parts))
+    return '\n\n'.join(paragraphs)
+
+
+def _extract_pdf(path):
+    if not PDF_AVAILABLE:
+        raise UnsupportedFileType("提取pdf文本需要安装pypdf: pip install pypdf")
+    from pypdf import PdfReader
+
+    return '\n\n'.join(page.extract_text() or '' for page in PdfReader(path).pages)
+
+
+def _extract_csv(data):
+    rows = csv.reader(io.StringIO(_decode(data)))
+    return '\n'.join(' | '.join(cell.strip() for cell in row) for row in rows)
+
+
+def _extract_json(data):
+    text = _decode(data)
+    try:
+        return json.dumps(json.loads(text), ensure_ascii=False, indent=2)
+    except ValueError:
+        return text
+
+
+def extract_text(path, file_type):
+    """按文件类型提取原始文本；不支持的类型抛出UnsupportedFileType"""
+    file_type = (file_type or '').lower()
+    if file_type == 'docx':
+        return _extract_docx(path)
+    if file_type == 'pdf':
+        return _extract_pdf(path)
+    if file_type not in ('txt', 'text', 'md', 'csv', 'json'):
+        raise UnsupportedFileType(f"不支持提取文本的文件类型: {file_type}")
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if file_type == 'csv':
+        return _extract_csv(data)
+    if file_type == 'json':
+        return _extract_json(data)
+    return _decode(data)
+
+
+def normalize(text):
+    """统一换行和空白，段落之间保留一个空行"""
+    text = _CONTROL_CHARS.sub('', text.replace('\r\n', '\n').replace('\r', '\n'))
+    lines = [_INLINE_SPACE.sub(' ', line).strip() for line in text.split('\n')]
+    return _BLANK_LINES.sub('\n\n', '\n'.join(lines)).strip()
+
+
+# ---------- 切分 ----------
+
+def _break_point(text, start, end):
+    """在 [start, end) 的后半段找最靠后的边界，返回断开位置；找不到时返回end"""
+    lower = start + (end - start) // 2
+    for pattern in _BOUNDARIES:
+        last = None
+        for match in pattern.finditer(text, lower, end):
+            last = match.end()
+        if last is not None:
+            return last
+    return end
+
+
+def chunk_text(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """切分为 [(start, end, content)]，content == text[start:end]"""
+    if size <= 0:
+        raise ValueError("片段长度必须大于0")
+    overlap = min(max(overlap, 0), size // 2)
+
+    chunks = []
+    start, length = 0, len(text)
+    while start < length:
+        end = min(start + size, length)
+        if end < length:
+            end = _break_point(text, start, end)
+        # 片段首尾不保留空白，起止位置随之调整
+        content_start, content_end = start, end
+        while content_start < content_end and text[content_start].isspace():
+            content_start += 1
+        while content_end > content_start and text[content_end - 1].isspace():
+            content_end -= 1
+        if content_start < content_end:
+            chunks.append((content_start, content_end, text[content_start:content_end]))
+        if end >= length:
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+# ---------- 后台任务 ----------
+
+def _set_status(db_session, item, status, error=None):
+    item.ingest_status = status
+    item.ingest_error = error[:500] if error else None
+    db_session.commit()
+
+
+def ingest(db_session, item_id, report=None):
+    """提取一个知识库条目的文本并替换其片段，返回条目ID（字符串）；条目不存在或已删除时返回None"""
+    from models import KnowledgeChunk, KnowledgeItem
+
+    item = db_session.get(KnowledgeItem, item_id)
+    if item is None or item.status == 'deleted':
+        return None
+    _set_status(db_session, item, 'processing')
+
+    try:
+        text = normalize(extract_text(item.file_path, item.file_type))
+    except UnsupportedFileType as e:
+        logger.info(f"知识库条目 {item_id} 不提取文本: {str(e)}")
+        _set_status(db_session, item, 'unsupported', str(e))
+        return str(item_id)
+    except Exception as e:
+        db_session.rollback()
+        _set_status(db_session, item, 'failed', f"文本提取失败: {str(e)}")
+        raise
+
+    if report:
+        report(progress=50, stage='正在切分文本...')
+    chunks = chunk_text(text)
+    db_session.execute(delete(KnowledgeChunk).where(KnowledgeChunk.knowledge_item_id == item_id))
+    if chunks:
+        now = datetime.utcnow()
+        db_session.execute(insert(KnowledgeChunk), [
+            {'knowledge_item_id': item_id, 'chunk_index': index, 'start_offset': start, 'end_offset': end,
+             'content': content, 'created_at': now}
+            for index, (start, end, content) in enumerate(chunks)])
+
+    item.chunk_count = len(chunks)
+    item.text_length = len(text)
+    item.ingested_at = datetime.utcnow()
+    if not item.content_summary:
+        item.content_summary = text[:SUMMARY_LENGTH]
+    _set_status(db_session, item, 'ready')
+    logger.info(f"知识库条目 {item_id} 文本提取完成: {len(text)} 字符, {len(chunks)} 个片段")
+    sync_index(db_session)
+    return str(item_id)
+
+
+def sync_index(db_session):
+    """条目提取完成或启用状态变化后更新本机的检索索引；失败时只记录日志，检索时会再次同步"""
+    try:
+        knowledge_retrieval.sync(db_session)
+    except Exception as e:
+        db_session.rollback()
+        logger.warning(f"更新知识库检索索引失败: {str(e)}")
+
+
+def enqueue(db_session, job_queue, item):
+    """标记为等待提取并入队，上传请求不等待提取完成"""
+    item.ingest_status = 'pending'
+    item.ingest_error = None
+    db_session.commit()
+    return job_queue.enqueue(JOB_KIND, {'knowledge_item_id': item.id}, stage='等待提取文本...')
+
+
+def register(job_queue, db):
+    """注册知识库文本提取的后台任务"""
+    job_queue.register(JOB_KIND, lambda job, payload, report:
+                       ingest(db.session, payload['knowledge_item_id'], report))
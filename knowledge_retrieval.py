@@ -0,0 +1,405 @@
+"""知识库检索 - 知识库片段的本地BM25索引，分析时检索与项目最相关的片段写入提示词
+
+索引文件保存在 KNOWLEDGE_INDEX_DIR（每台机器一份），由不可变的段文件和一个 manifest.json 组成：
+- 段文件: 一批知识库条目的全部片段，包含文档表、词元哈希（排序后二分查找）、倒排表和片段原文；
+  查询时以mmap只读打开，同一台机器上的所有gunicorn worker共享操作系统页缓存，不在各自进程内复制
+- 增量更新: sync() 对比数据库中已提取完成且启用的条目，只为新增或重新提取的条目写一个新段；
+  暂停、删除的条目只在manifest中标记，重新启用时不需要重建；段数超过上限或失效片段过多时合并为一个段
+- 词元与全文搜索一致（search_index.tokenize 的查询模式：中文二元组、英文单词），不依赖分词库
+- 写入方用文件锁互斥，manifest通过临时文件+rename原子替换；查询方每次检查manifest是否变化，
+  变化时重新打开段文件。检索时每隔 KNOWLEDGE_INDEX_SYNC_INTERVAL 秒同步一次，
+  多台机器部署时也能发现其他机器提取的新文件
+
+命中片段对应条目的 usage_count 在进程内累计，按 USAGE_FLUSH_INTERVAL 批量写回数据库。
+"""
+import bisect
+import fcntl
+import hashlib
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import bindparam, func, select, update
+
+from search_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = os.environ.get('KNOWLEDGE_INDEX_DIR', os.path.join('instance', 'knowledge_index'))
+TOP_K = int(os.environ.get('KNOWLEDGE_TOP_K', 5))
+MAX_CONTEXT_CHARS = int(os.environ.get('KNOWLEDGE_MAX_CONTEXT_CHARS', 2000))
+SYNC_INTERVAL = float(os.environ.get('KNOWLEDGE_INDEX_SYNC_INTERVAL', 60))
+USAGE_FLUSH_INTERVAL = 30
+MAX_SEGMENTS = 8
+MAX_QUERY_TOKENS = 64
+# 得分低于最高分这个比例的片段只是碰巧包含常见词元，不写入提示词
+MIN_RELATIVE_SCORE = 0.2
+
+# BM25参数
+K1 = 1.2
+B = 0.75
+
+_MAGIC = b'KBM1'
+# 段文件头: magic, 文档数, 词元数, 倒排项数, 词元总数
+_HEADER = struct.Struct('=4sIIIQ')
+_DOC_FIELDS = 5  # chunk_id, item_id, 词元数, 原文起止字节偏移
+_MANIFEST = 'manifest.json'
+
+
+def _term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _stamp(ingested_at):
+    return ingested_at.isoformat() if ingested_at else ''
+
+
+def _pad(size):
+    return -size % 8
+
+
+# ---------- 段文件 ----------
+
+def write_segment(path, chunks):
+    """把 [(chunk_id, item_id, content)] 写成一个段文件（先写临时文件再rename）"""
+    docs = array('I')
+    postings_by_term = {}
+    texts = []
+    text_offset = total_length = 0
+    for doc_index, (chunk_id, item_id, content) in enumerate(chunks):
+        counts = Counter(tokenize(content, for_query=True))
+        length = sum(counts.values())
+        encoded = content.encode('utf-8')
+        docs.extend((chunk_id, item_id, length, text_offset, text_offset + len(encoded)))
+        texts.append(encoded)
+        text_offset += len(encoded)
+        total_length += length
+        for term, tf in counts.items():
+            postings_by_term.setdefault(_term_hash(term), []).append((doc_index, tf))
+
+    hashes = array('Q', sorted(postings_by_term))
+    terms, postings = array('I'), array('I')
+    for term_hash in hashes:
+        entries = postings_by_term[term_hash]
+        terms.extend((len(postings) // 2, len(entries)))
+        for doc_index, tf in entries:
+            postings.extend((doc_index, tf))
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        header = _HEADER.pack(_MAGIC, len(chunks), len(hashes), len(postings) // 2, total_length)
+        for block in (header, docs.tobytes(), hashes.tobytes(), terms.tobytes(), postings.tobytes()):
+            f.write(block)
+            f.write(b'\0' * _pad(len(block)))
+        f.write(b''.join(texts))
+    os.replace(temp_path, path)
+
+
+class Segment:
+    """以mmap只读打开的段文件"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, self.doc_count, term_count, posting_count, self.total_length = _HEADER.unpack_from(view)
+        if magic != _MAGIC:
+            raise ValueError(f"无效的知识库索引段: {path}")
+
+        offset = _HEADER.size + _pad(_HEADER.size)
+
+        def section(size, fmt):
+            nonlocal offset
+            block = view[offset:offset + size].cast(fmt)
+            offset += size + _pad(size)
+            return block
+
+        self.docs = section(self.doc_count * _DOC_FIELDS * 4, 'I')
+        self.hashes = section(term_count * 8, 'Q')
+        self.terms = section(term_count * 2 * 4, 'I')
+        self.postings = section(posting_count * 2 * 4, 'I')
+        self.text = view[offset:]
+
+    def lookup(self, term_hash):
+        """返回 (倒排起始位置, 文档频率)，词元不存在时返回None"""
+        position = bisect.bisect_left(self.hashes, term_hash)
+        if position < len(self.hashes) and self.hashes[position] == term_hash:
+            return self.terms[position * 2], self.terms[position * 2 + 1]
+        return None
+
+    def doc(self, doc_index):
+        base = doc_index * _DOC_FIELDS
+        return tuple(self.docs[base:base + _DOC_FIELDS])
+
+    def content(self, doc_index):
+        _, _, _, start, end = self.doc(doc_index)
+        return bytes(self.text[start:end]).decode('utf-8')
+
+
+# ---------- 索引目录 ----------
+
+def _read_manifest(index_dir):
+    try:
+        with open(os.path.join(index_dir, _MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'version': 0, 'next_segment': 1, 'segments': [], 'live': {}}
+
+
+def _write_manifest(index_dir, manifest):
+    path = os.path.join(index_dir, _MANIFEST)
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(f'{path}.tmp', path)
+
+
+@contextmanager
+def _writer_lock(index_dir):
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_chunks(db_session, item_ids):
+    from models import KnowledgeChunk
+
+    return db_session.execute(
+        select(KnowledgeChunk.id, KnowledgeChunk.knowledge_item_id, KnowledgeChunk.content)
+        .where(KnowledgeChunk.knowledge_item_id.in_(item_ids))
+        .order_by(KnowledgeChunk.knowledge_item_id, KnowledgeChunk.chunk_index)).all()
+
+
+def sync(db_session, index_dir=None, rebuild=False):
+    """按数据库中已提取完成且启用的条目更新索引，返回是否有变化"""
+    from models import KnowledgeItem
+
+    index_dir = index_dir or INDEX_DIR
+    rows = db_session.execute(
+        select(KnowledgeItem.id, KnowledgeItem.ingested_at, KnowledgeItem.status)
+        .where(KnowledgeItem.ingest_status == 'ready')).all()
+    live = {str(item_id): _stamp(ingested_at) for item_id, ingested_at, status in rows if status == 'active'}
+
+    with _writer_lock(index_dir):
+        manifest = _read_manifest(index_dir)
+        segments = manifest['segments']
+        indexed = {}
+        for segment in segments:
+            indexed.update(segment['items'])
+        missing = {item_id: stamp for item_id, stamp in live.items() if indexed.get(item_id) != stamp}
+        if not rebuild and not missing and manifest['live'] == live:
+            return False
+
+        # 段中已失效的条目（暂停、删除或已重新提取）过多时合并
+        stale = sum(1 for segment in segments for item_id, stamp in segment['items'].items()
+                    if live.get(item_id) != stamp)
+        indexed_items = sum(len(segment['items']) for segment in segments)
+        if rebuild or len(segments) >= MAX_SEGMENTS or stale > max(indexed_items // 2, MAX_SEGMENTS):
+            segments, missing = [], live
+
+        if missing:
+            name = f"segment-{manifest['next_segment']:06d}.bin"
+            write_segment(os.path.join(index_dir, name),
+                          _load_chunks(db_session, [int(item_id) for item_id in missing]))
+            segments = segments + [{'file': name, 'items': missing}]
+            manifest['next_segment'] += 1
+
+        manifest.update(version=manifest['version'] + 1, segments=segments, live=live)
+        _write_manifest(index_dir, manifest)
+
+        # 已打开的段文件在其他进程中仍可读（删除后映射依然有效），下次查询时切换到新的manifest
+        referenced = {segment['file'] for segment in segments}
+        for name in os.listdir(index_dir):
+            if name.startswith('segment-') and name not in referenced:
+                os.remove(os.path.join(index_dir, name))
+
+    logger.info(f"知识库索引已更新: 版本 {manifest['version']}, {len(segments)} 个段, {len(live)} 个启用条目")
+    return True
+
+
+# ---------- 查询 ----------
+
+class KnowledgeIndex:
+    """进程内的只读视图，manifest变化时重新打开段文件"""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self._lock = threading.Lock()
+        self._signature = None
+        self._segments = []
+        self.version = 0
+
+    def _refresh(self):
+        try:
+            stat = os.stat(os.path.join(self.index_dir, _MANIFEST))
+        except FileNotFoundError:
+            self._segments, self._signature, self.version = [], None, 0
+            return
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if signature == self._signature:
+            return
+        manifest = _read_manifest(self.index_dir)
+        live = manifest['live']
+        segments = []
+        for entry in manifest['segments']:
+            dead = {int(item_id) for item_id, stamp in entry['items'].items() if live.get(item_id) != stamp}
+            segments.append((Segment(os.path.join(self.index_dir, entry['file'])), dead))
+        self._segments, self._signature, self.version = segments, signature, manifest['version']
+
+    def search(self, query, top_k=TOP_K):
+        """BM25检索，返回按得分排序的 [{chunk_id, item_id, score, content}]"""
+        tokens = list(dict.fromkeys(tokenize(query, for_query=True)))[:MAX_QUERY_TOKENS]
+        with self._lock:
+            self._refresh()
+            segments = self._segments
+        if not tokens or not segments:
+            return []
+
+        doc_count = sum(segment.doc_count for segment, _ in segments)
+        average_length = sum(segment.total_length for segment, _ in segments) / doc_count if doc_count else 0
+        if not average_length:
+            return []
+
+        scores = {}
+        for token in tokens:
+            term_hash = _term_hash(token)
+            found = [(segment, dead, segment.lookup(term_hash)) for segment, dead in segments]
+            found = [(segment, dead, entry) for segment, dead, entry in found if entry]
+            df = sum(entry[1] for _, _, entry in found)
+            if not df:
+                continue
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for segment, dead, (start, count) in found:
+                postings = segment.postings
+                for position in range(start * 2, (start + count) * 2, 2):
+                    doc_index, tf = postings[position], postings[position + 1]
+                    length = segment.docs[doc_index * _DOC_FIELDS + 2]
+                    key = (id(segment), doc_index)
+                    scores[key] = scores.get(key, 0.0) + idf * tf * (K1 + 1) / (
+                        tf + K1 * (1 - B + B * length / average_length))
+
+        by_id = {id(segment): (segment, dead) for segment, dead in segments}
+        results = []
+        for (segment_id, doc_index), score in heapq.nlargest(top_k * 4, scores.items(), key=lambda kv: kv[1]):
+            segment, dead = by_id[segment_id]
+            chunk_id, item_id, _, _, _ = segment.doc(doc_index)
+            if item_id in dead:
+                continue
+            if results and score < results[0]['score'] * MIN_RELATIVE_SCORE:
+                break
+            results.append({'chunk_id': chunk_id, 'item_id': item_id, 'score': round(score, 4),
+                            'content': segment.content(doc_index)})
+            if len(results) >= top_k:
+                break
+        return results
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+_last_sync = 0.0
+
+
+def get_index(index_dir=None):
+    index_dir = index_dir or INDEX_DIR
+    with _indexes_lock:
+        if index_dir not in _indexes:
+            _indexes[index_dir] = KnowledgeIndex(index_dir)
+        return _indexes[index_dir]
+
+
+# ---------- 使用次数 ----------
+
+_usage = Counter()
+_usage_lock = threading.Lock()
+_last_usage_flush = time.monotonic()
+
+
+def record_usage(item_ids):
+    with _usage_lock:
+        _usage.update(item_ids)
+
+
+def flush_usage(db_session, force=False):
+    """把累计的使用次数批量写回（每个条目一条UPDATE，同一次executemany）"""
+    global _last_usage_flush
+    from models import KnowledgeItem
+
+    with _usage_lock:
+        if not _usage or (not force and time.monotonic() - _last_usage_flush < USAGE_FLUSH_INTERVAL):
+            return 0
+        pending = dict(_usage)
+        _usage.clear()
+        _last_usage_flush = time.monotonic()
+
+    table = KnowledgeItem.__table__
+    try:
+        db_session.execute(
+            update(table).where(table.c.id == bindparam('item_id'))
+            .values(usage_count=func.coalesce(table.c.usage_count, 0) + bindparam('increment')),
+            [{'item_id': item_id, 'increment': count} for item_id, count in pending.items()])
+        db_session.commit()
+    except Exception as e:
+        db_session.rollback()
+        with _usage_lock:
+            _usage.update(pending)
+        logger.warning(f"写回知识库使用次数失败: {str(e)}")
+        return 0
+    return len(pending)
+
+
+# ---------- 提示词 ----------
+
+def build_query(form_data):
+    """检索词: 项目名称、背景，以及关键人物的资源和备注"""
+    parts = [form_data.get('projectName') or '', form_data.get('projectDescription') or '']
+    for person in form_data.get('keyPersons') or []:
+        if isinstance(person, dict):
+            parts.extend(str(resource) for resource in person.get('resources') or [])
+            parts.append(str(person.get('notes') or ''))
+    return '\n'.join(part for part in parts if part)
+
+
+def retrieve(db_session, query, top_k=TOP_K):
+    """检索最相关的启用片段；检索失败时返回空列表，不影响分析"""
+    global _last_sync
+    try:
+        if db_session is not None and time.monotonic() - _last_sync >= SYNC_INTERVAL:
+            _last_sync = time.monotonic()
+            sync(db_session)
+        results = get_index().search(query, top_k)
+    except Exception as e:
+        logger.warning(f"知识库检索失败: {str(e)}")
+        return []
+
+    if results and db_session is not None:
+        record_usage(result['item_id'] for result in results)
+        flush_usage(db_session)
+    return results
+
+
+def format_context(results, max_chars=MAX_CONTEXT_CHARS):
+    """检索结果格式化为提示词片段，返回 (文本, 指纹)；没有结果时返回 ('', '')"""
+    lines, used, chunk_ids = [], 0, []
+    for result in results:
+        content = result['content'][:max(max_chars - used, 0)]
+        if not content:
+            break
+        lines.append(f"{len(lines) + 1}. {content}")
+        used += len(content)
+        chunk_ids.append(str(result['chunk_id']))
+    if not lines:
+        return '', ''
+    fingerprint = hashlib.sha256(','.join(chunk_ids).encode()).hexdigest()[:16]
+    return '\n'.join(lines), fingerprint
@@ -0,0 +1,99 @@
+"""模型配置缓存 - 进程内缓存全部模型配置，按版本号失效
+
+- 读取: ModelConfig.get_config 从进程内缓存返回配置，每次分析不再查询 model_configs
+- 版本: config_versions 表中每类配置一行版本号，ModelConfig.set_config 在保存配置的同一事务中
+  把版本号加一（INSERT ... ON CONFLICT），提交后立即清除本进程的缓存
+- 其他进程: 距上次检查超过 MODEL_CONFIG_CHECK_SECONDS 秒（默认5）时按主键读取一次版本号，
+  版本变化才重新加载全部配置；后台修改最多在这个间隔后对所有gunicorn worker生效
+- 数据库不可用时继续使用已缓存的配置
+"""
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import select
+
+logger = logging.getLogger(__name__)
+
+CHECK_SECONDS = float(os.environ.get('MODEL_CONFIG_CHECK_SECONDS', 5))
+
+MODEL_CONFIGS = 'model_configs'
+
+
+def current_version(db_session, namespace):
+    """配置的当前版本号，从未修改过时为0"""
+    from models import ConfigVersion
+
+    return db_session.execute(
+        select(ConfigVersion.version).where(ConfigVersion.name == namespace)).scalar() or 0
+
+
+def bump_version(db_session, namespace):
+    """版本号加一（不提交，与修改配置在同一事务中）"""
+    from models import ConfigVersion
+
+    if db_session.get_bind().dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    table = ConfigVersion.__table__
+    db_session.execute(
+        dialect_insert(table).values(name=namespace, version=1)
+        .on_conflict_do_update(index_elements=['name'], set_={'version': table.c.version + 1}))
+
+
+class ConfigCache:
+    """一类配置的进程内缓存：loader(db_session) 返回全部配置"""
+
+    def __init__(self, namespace, loader):
+        self.namespace = namespace
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._values = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self, db_session):
+        with self._lock:
+            values, version, checked_at = self._values, self._version, self._checked_at
+        if values is not None and time.time() - checked_at < CHECK_SECONDS:
+            return values
+
+        try:
+            latest = current_version(db_session, self.namespace)
+            if values is None or latest != version:
+                values = self.loader(db_session)
+                logger.info(f"已加载配置 {self.namespace}（版本 {latest}）")
+        except Exception as e:
+            if values is None:
+                raise
+            db_session.rollback()
+            logger.warning(f"检查配置 {self.namespace} 的版本失败，继续使用缓存: {str(e)}")
+            latest = version
+
+        with self._lock:
+            self._values, self._version, self._checked_at = values, latest, time.time()
+        return values
+
+    def invalidate(self):
+        """本进程修改配置后立即重新加载（其他进程在下次检查版本时生效）"""
+        with self._lock:
+            self._values = None
+
+
+def _load_model_configs(db_session):
+    from models import ModelConfig
+
+    rows = db_session.execute(
+        select(ModelConfig.config_name, ModelConfig.model_name, ModelConfig.temperature, ModelConfig.max_tokens,
+               ModelConfig.timeout).where(ModelConfig.is_active.is_(True)))
+    return {row.config_name: {
+        'model': row.model_name,
+        'temperature': row.temperature,
+        'max_tokens': row.max_tokens,
+        'timeout': row.timeout,
+    } for row in rows}
+
+
+model_configs = ConfigCache(MODEL_CONFIGS, _load_model_configs)
@@ -4,6 +4,16 @@ from flask_login import UserMixin
 from werkzeug.security import check_password_hash, generate_password_hash
 import uuid
 
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm.attributes import set_committed_value
+
+import model_config_cache
+import quota_ledger
+import search_index
+from json_documents import JSONDocument
+from result_summary import summarize
+
 
 class User(UserMixin, db.Model):
     """用户登录模型"""
@@ -22,6 +32,10 @@ class User(UserMixin, db.Model):
     ai_quota = db.Column(db.Integer, default=10, nullable=False, comment='AI分析总额度')
     used_quota = db.Column(db.Integer, default=0, nullable=False, comment='已使用的AI分析次数')
 
+    __table_args__ = (
+        db.Index('ix_users_created_id', 'created_at', 'id'),
+    )
+
     def set_password(self, password):
         """设置密码"""
         self.password_hash = generate_password_hash(password)
@@ -78,11 +92,13 @@ class User(UserMixin, db.Model):
         return self.remaining_quota > 0
     
     def consume_quota(self):
-        """消耗一次AI分析额度"""
-        if self.has_quota():
-            self.used_quota += 1
-            return True
-        return False
+        """消耗一次AI分析额度（条件UPDATE原子扣减，不提交，见quota_ledger.py）"""
+        quota = quota_ledger.reserve(db.session, self.id)
+        if quota is None:
+            return False
+        set_committed_value(self, 'used_quota', quota[0])
+        set_committed_value(self, 'ai_quota', quota[1])
+        return True
     
     def set_quota(self, new_quota):
         """设置新的总额度（保持已使用额度不变）"""
@@ -122,6 +138,15 @@ class KnowledgeItem(db.Model):
     upload_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, comment='上传时间')
     last_modified = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, comment='最后修改时间')
     usage_count = db.Column(db.Integer, default=0, comment='使用次数')
+    # 文本提取（见knowledge_ingest.py），为空表示上传于提取功能之前
+    ingest_status = db.Column(db.String(20), comment='文本提取状态: pending/processing/ready/failed/unsupported')
+    ingest_error = db.Column(db.String(500), comment='文本提取失败原因')
+    chunk_count = db.Column(db.Integer, comment='文本片段数')
+    text_length = db.Column(db.Integer, comment='提取的文本字符数')
+    ingested_at = db.Column(db.DateTime, comment='最近一次文本提取完成时间')
+
+    chunks = db.relationship('KnowledgeChunk', backref='knowledge_item', lazy='dynamic',
+                             cascade='all, delete-orphan')
 
     def __repr__(self):
         return f'<KnowledgeItem {self.original_filename}>'
@@ -162,23 +187,66 @@ class KnowledgeItem(db.Model):
             return f"{self.file_size / (1024 * 1024):.1f} MB"
 
 
+class KnowledgeChunk(db.Model):
+    """知识库文本片段，起止位置为在规范化后全文中的字符偏移"""
+    __tablename__ = 'knowledge_chunks'
+
+    id = db.Column(db.Integer, primary_key=True)
+    knowledge_item_id = db.Column(db.Integer, db.ForeignKey('knowledge_items.id', ondelete='CASCADE'), nullable=False)
+    chunk_index = db.Column(db.Integer, nullable=False, comment='片段序号，从0开始')
+    start_offset = db.Column(db.Integer, nullable=False, comment='起始字符偏移')
+    end_offset = db.Column(db.Integer, nullable=False, comment='结束字符偏移（不含）')
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('knowledge_item_id', 'chunk_index', name='uq_knowledge_chunks_item_index'),
+    )
+
+    def __repr__(self):
+        return f'<KnowledgeChunk {self.knowledge_item_id}#{self.chunk_index}>'
+
+
+@event.listens_for(KnowledgeItem, 'after_insert')
+@event.listens_for(KnowledgeItem, 'after_update')
+def _index_knowledge_item(mapper, connection, target):
+    """知识库条目写入后同步搜索索引（标记为已删除时移除）"""
+    search_index.index_knowledge(connection, target)
+
+
+@event.listens_for(KnowledgeItem, 'after_delete')
+def _remove_knowledge_item(mapper, connection, target):
+    search_index.remove_document(connection, search_index.DOC_KNOWLEDGE, target.id)
+
+
 class AnalysisResult(db.Model):
     __tablename__ = 'analysis_results'
 
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     sequence_id = db.Column(db.Integer, nullable=False, index=True, server_default=db.text("nextval('analysis_results_sequence_id_seq')"), comment='自增数字ID，用于排序和索引')
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)  # 允许null以支持历史数据
-    form_data = db.Column(db.Text, nullable=False)  # JSON格式的表单数据
-    result_data = db.Column(db.Text, nullable=False)  # JSON格式的分析结果
+    form_data = db.Column(JSONDocument, nullable=False)  # 表单数据（Postgres上为JSONB）
+    result_data = db.Column(JSONDocument, nullable=False)  # 分析结果（Postgres上为JSONB）
     project_name = db.Column(db.String(200), nullable=False, index=True)
     project_description = db.Column(db.Text)
     team_size = db.Column(db.Integer, default=0)
     analysis_type = db.Column(db.String(50), default='ai_analysis')  # ai_analysis, fallback, emergency_fallback
+    version = db.Column(db.Integer, default=0, nullable=False, comment='每次修改结果+1，用于编辑接口的乐观并发控制（ETag）')
+    # 结果摘要（见result_summary.py），为空表示尚未补算
+    pipeline_count = db.Column(db.Integer, comment='管道数量')
+    pipeline_names = db.Column(JSONDocument, comment='管道名称列表')
+    income_types = db.Column(JSONDocument, comment='管道涉及的收入类型列表')
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
 
     # 关联用户
     user = db.relationship('User', backref='analysis_results')
 
+    # 历史记录按 (created_at, sequence_id) 倒序游标分页
+    __table_args__ = (
+        db.Index('ix_analysis_results_user_created_seq', 'user_id', 'created_at', 'sequence_id'),
+        db.Index('ix_analysis_results_created_seq', 'created_at', 'sequence_id'),
+    )
+
     @property
     def created_at_display(self):
         """格式化创建时间显示（UTC+8北京时间）"""
@@ -201,6 +269,33 @@ class AnalysisResult(db.Model):
     def __repr__(self):
         return f'<AnalysisResult {self.id}>'
 
+
+@event.listens_for(AnalysisResult, 'before_insert')
+@event.listens_for(AnalysisResult, 'before_update')
+def _fill_result_summary(mapper, connection, target):
+    """写入分析结果时同步计算摘要列"""
+    if inspect(target).attrs.result_data.history.has_changes():
+        for key, value in summarize(target.result_data).items():
+            setattr(target, key, value)
+
+
+@event.listens_for(AnalysisResult, 'after_insert')
+@event.listens_for(AnalysisResult, 'after_update')
+def _index_analysis_result(mapper, connection, target):
+    """分析结果、项目名称或描述变化时同步搜索索引"""
+    state = inspect(target)
+    if any(state.attrs[key].history.has_changes()
+           for key in ('result_data', 'project_name', 'project_description')):
+        overview = target.result_data.get('overview') if isinstance(target.result_data, dict) else None
+        search_index.index_analysis(connection, target.id, target.user_id, target.project_name,
+                                    target.project_description, target.pipeline_names, overview)
+
+
+@event.listens_for(AnalysisResult, 'after_delete')
+def _remove_analysis_result(mapper, connection, target):
+    search_index.remove_document(connection, search_index.DOC_ANALYSIS, target.id)
+
+
 class ModelConfig(db.Model):
     __tablename__ = 'model_configs'
 
@@ -238,20 +333,17 @@ class ModelConfig(db.Model):
             )
             db.session.add(config)
 
+        model_config_cache.bump_version(db.session, model_config_cache.MODEL_CONFIGS)
         db.session.commit()
+        model_config_cache.model_configs.invalidate()
         return config
 
     @classmethod
     def get_config(cls, config_name, default_model='gpt-4o-mini'):
-        """获取指定配置，如果不存在则返回默认值"""
-        config = cls.query.filter_by(config_name=config_name, is_active=True).first()
+        """获取指定配置，如果不存在则返回默认值（进程内缓存，见model_config_cache）"""
+        config = model_config_cache.model_configs.get(db.session).get(config_name)
         if config:
-            return {
-                'model': config.model_name,
-                'temperature': config.temperature,
-                'max_tokens': config.max_tokens,
-                'timeout': config.timeout
-            }
+            return dict(config)
         return {
             'model': default_model,
             'temperature': 0.7,
@@ -260,6 +352,17 @@ class ModelConfig(db.Model):
         }
 
 
+class ConfigVersion(db.Model):
+    """配置版本号 - 修改配置时加一，各进程据此判断缓存是否过期"""
+    __tablename__ = 'config_versions'
+
+    name = db.Column(db.String(50), primary_key=True)  # 配置类别，如 'model_configs'
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<ConfigVersion {self.name}: {self.version}>'
+
+
 class FormSubmission(db.Model):
     """表单提交记录模型 - 用于临时存储用户提交的表单数据"""
     __tablename__ = 'form_submissions'
@@ -269,7 +372,7 @@ class FormSubmission(db.Model):
     project_name = db.Column(db.String(200), nullable=False, index=True)
     project_description = db.Column(db.Text)
     key_persons_data = db.Column(db.Text, nullable=False)  # JSON格式的关键人物数据
-    form_data_complete = db.Column(db.Text, nullable=False)  # 完整表单数据JSON
+    form_data_complete = db.Column(JSONDocument, nullable=False)  # 完整表单数据（Postgres上为JSONB）
     status = db.Column(db.String(50), default='submitted')  # submitted, processing, completed, error
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -298,4 +401,258 @@ class FormSubmission(db.Model):
         return '未知时间'
 
     def __repr__(self):
-        return f'<FormSubmission {self.id}: {self.project_name}>'
\ No newline at end of file
+        return f'<FormSubmission {self.id}: {self.project_name}>'
+
+class AnalysisCacheEntry(db.Model):
+    """分析结果缓存 - 以规范化输入、提示词和模型配置的哈希为键，相同输入直接复用结果"""
+    __tablename__ = 'analysis_cache_entries'
+
+    cache_key = db.Column(db.String(64), primary_key=True, comment='sha256(规范化表单+提示词哈希+模型配置)')
+    result_data = db.Column(db.Text, nullable=False, comment='JSON格式的分析结果')
+    model_name = db.Column(db.String(100), comment='生成结果所用的模型')
+    size_bytes = db.Column(db.Integer, default=0, nullable=False, comment='结果大小')
+    hit_count = db.Column(db.Integer, default=0, nullable=False, comment='命中次数（即节省的上游调用次数）')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True, comment='最近写入或命中时间，用于LRU淘汰')
+
+    def __repr__(self):
+        return f'<AnalysisCacheEntry {self.cache_key[:12]}: {self.hit_count} hits>'
+
+class WebSession(db.Model):
+    """服务端session - cookie中只保存签名后的session id，数据保存在这里"""
+    __tablename__ = 'web_sessions'
+
+    sid = db.Column(db.String(64), primary_key=True, comment='随机session id')
+    data = db.Column(db.Text, nullable=False, default='{}', comment='session数据（Flask的带类型标记JSON）')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<WebSession {self.sid[:8]}>'
+
+class InflightLock(db.Model):
+    """进行中请求锁 - 相同输入的并发分析只允许一个请求调用上游，其余等待其结果"""
+    __tablename__ = 'inflight_locks'
+
+    lock_key = db.Column(db.String(64), primary_key=True, comment='输入哈希（与结果缓存键相同）')
+    owner = db.Column(db.String(150), nullable=False, comment='持有者 host:pid:thread')
+    acquired_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True, comment='租约到期时间，过期锁可被清理')
+
+    def __repr__(self):
+        return f'<InflightLock {self.lock_key[:12]}: {self.owner}>'
+
+class UpstreamCircuit(db.Model):
+    """上游熔断器状态 - 所有进程共享，状态切换使用带条件的UPDATE"""
+    __tablename__ = 'upstream_circuits'
+
+    provider = db.Column(db.String(50), primary_key=True, comment='上游标识')
+    state = db.Column(db.String(20), nullable=False, default='closed', comment='状态: closed/open/half_open')
+    opened_at = db.Column(db.DateTime, comment='最近一次打开时间')
+    probe_started_at = db.Column(db.DateTime, comment='半开状态下探测请求的开始时间')
+    closed_at = db.Column(db.DateTime, comment='最近一次恢复关闭的时间，此前的调用记录不再参与熔断判断')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<UpstreamCircuit {self.provider}: {self.state}>'
+
+class UpstreamCallSample(db.Model):
+    """上游调用记录 - 每次尝试一条，用于熔断判断和自适应超时"""
+    __tablename__ = 'upstream_call_samples'
+
+    id = db.Column(db.Integer, primary_key=True)
+    provider = db.Column(db.String(50), nullable=False, comment='上游标识')
+    success = db.Column(db.Boolean, nullable=False)
+    latency_ms = db.Column(db.Integer, nullable=False, comment='耗时毫秒')
+    error = db.Column(db.String(100), comment='失败时的异常类型')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_upstream_call_samples_provider_created', 'provider', 'created_at'),
+    )
+
+    def __repr__(self):
+        return f'<UpstreamCallSample {self.provider}: {self.success} {self.latency_ms}ms>'
+
+class UpstreamProvider(db.Model):
+    """上游提供方 - OpenAI兼容的API地址，按优先级选择主上游，其余作为对冲请求的备用上游
+
+    名为 default 的上游对应环境变量 OPENAI_BASE_URL，表中没有该行时也始终可用。
+    """
+    __tablename__ = 'upstream_providers'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False, unique=True, comment='上游标识，同时用于熔断器和调用记录')
+    base_url = db.Column(db.String(255), nullable=False, comment='OpenAI兼容的API地址，如 https://api.example.com/v1')
+    api_key_env = db.Column(db.String(100), nullable=False, default='OPENAI_API_KEY',
+                            comment='保存API密钥的环境变量名（数据库不保存密钥）')
+    model_name = db.Column(db.String(50), comment='该上游使用的模型名，为空时使用模型配置中的模型')
+    priority = db.Column(db.Integer, nullable=False, default=100, comment='数值越小越优先')
+    is_active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'base_url': self.base_url,
+            'api_key_env': self.api_key_env,
+            'model_name': self.model_name,
+            'priority': self.priority,
+            'is_active': self.is_active,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+    def __repr__(self):
+        return f'<UpstreamProvider {self.name}: {self.base_url}>'
+
+class AnalysisJob(db.Model):
+    """分析任务 - 每次分析一行，状态按 analysis_jobs.TRANSITIONS 切换
+
+    与执行它的BackgroundJob共用同一个ID；session中只保存该ID，
+    分析状态、进度和结果ID都以这里为准。
+    """
+    __tablename__ = 'analysis_jobs'
+
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    form_submission_id = db.Column(db.String(36), comment='分析所用的表单提交记录')
+    project_name = db.Column(db.String(200))
+    state = db.Column(db.String(20), nullable=False, default='queued', comment='状态: queued/running/completed/failed')
+    progress = db.Column(db.Integer, default=0, nullable=False, comment='进度百分比')
+    stage = db.Column(db.String(200), comment='当前阶段描述')
+    result_id = db.Column(db.String(36), comment='完成后的AnalysisResult.id')
+    error = db.Column(db.Text, comment='失败原因')
+    version = db.Column(db.Integer, default=0, nullable=False, comment='每次状态或进度变化+1，用作状态查询的ETag')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    quota_state = db.Column(db.String(20), comment='额度预留: reserved/charged/released（见quota_ledger.py）')
+
+    __table_args__ = (
+        db.Index('ix_analysis_jobs_user_state', 'user_id', 'state'),
+        db.Index('ix_analysis_jobs_user_created', 'user_id', 'created_at'),
+        db.Index('ix_analysis_jobs_state_updated', 'state', 'updated_at'),
+        db.Index('ix_analysis_jobs_quota_state', 'quota_state', 'state'),
+    )
+
+    def __repr__(self):
+        return f'<AnalysisJob {self.id}: {self.state}>'
+
+class BackgroundJob(db.Model):
+    """后台任务模型 - 基于数据库的任务队列，耗时任务在独立的有界线程池中执行"""
+    __tablename__ = 'background_jobs'
+
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    kind = db.Column(db.String(50), nullable=False, index=True, comment='任务类型，如 analysis')
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    payload = db.Column(db.Text, nullable=False, default='{}', comment='任务参数JSON')
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True, comment='状态: queued/running/completed/failed')
+    progress = db.Column(db.Integer, default=0, comment='进度百分比')
+    stage = db.Column(db.String(200), comment='当前阶段描述')
+    stage_code = db.Column(db.String(30), comment='阶段代码，如 queued/prompt_built/upstream_call')
+    event_seq = db.Column(db.Integer, default=0, nullable=False, comment='进度事件序号，每次阶段变化+1')
+    partial_result = db.Column(db.Text, comment='流式生成中已完成的结果片段(JSON)')
+    result_ref = db.Column(db.String(64), comment='结果引用，如AnalysisResult.id')
+    error = db.Column(db.Text, comment='失败原因')
+    attempts = db.Column(db.Integer, default=0, nullable=False, comment='已执行次数')
+    worker_id = db.Column(db.String(100), comment='领取任务的worker标识 host:pid')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime, comment='最近一次进度上报时间，用于回收僵死任务')
+    finished_at = db.Column(db.DateTime)
+
+    @property
+    def is_finished(self):
+        """任务是否已结束（成功或失败）"""
+        return self.status in ('completed', 'failed')
+
+    def __repr__(self):
+        return f'<BackgroundJob {self.id}: {self.kind} {self.status}>'
+
+
+class SearchDocument(db.Model):
+    """全文搜索索引（见search_index.py），分析记录和知识库条目各一行"""
+    __tablename__ = 'search_documents'
+
+    id = db.Column(db.Integer, primary_key=True)
+    doc_type = db.Column(db.String(20), nullable=False, comment='文档类型: analysis/knowledge')
+    doc_id = db.Column(db.String(36), nullable=False, comment='AnalysisResult.id 或 KnowledgeItem.id')
+    user_id = db.Column(db.Integer, nullable=True, comment='分析记录所属用户，用于按用户过滤')
+    title = db.Column(db.String(255), comment='标题（项目名称/文件名）')
+    snippet = db.Column(db.String(300), comment='结果列表中显示的摘要')
+    terms = db.Column(db.Text, nullable=False, default='', comment='空格分隔的词元（非Postgres数据库的LIKE检索）')
+    search_vector = db.Column(db.Text().with_variant(TSVECTOR(), 'postgresql'), comment='加权词元向量（Postgres，GIN索引）')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('doc_type', 'doc_id', name='uq_search_documents_doc'),
+        db.Index('ix_search_documents_type_user', 'doc_type', 'user_id'),
+    )
+
+    def __repr__(self):
+        return f'<SearchDocument {self.doc_type}:{self.doc_id}>'
+
+
+class UsageRecord(db.Model):
+    """用量明细 - 每次上游请求（或缓存命中）一行，由usage_ledger后台批量写入"""
+    __tablename__ = 'usage_records'
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=True, comment='发起分析的用户，非任务调用时为空')
+    model = db.Column(db.String(100), nullable=False)
+    provider = db.Column(db.String(50), nullable=False, default='', comment='上游名称，缓存命中时为空')
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    completion_tokens = db.Column(db.Integer, nullable=False, default=0)
+    tokens_estimated = db.Column(db.Boolean, nullable=False, default=False, comment='上游未返回usage，按本地计数估算')
+    cost = db.Column(db.Float, nullable=False, default=0, comment='费用（美元）')
+    latency_ms = db.Column(db.Integer, nullable=False, default=0, comment='本次请求的耗时')
+    retries = db.Column(db.Integer, nullable=False, default=0, comment='第几次重试，0为首次请求')
+    cache_hit = db.Column(db.Boolean, nullable=False, default=False)
+    success = db.Column(db.Boolean, nullable=False, default=True)
+    hedge_lost = db.Column(db.Boolean, nullable=False, default=False, comment='对冲请求中落败的一路')
+    # 提示词token预算（见prompt_budget.py），缓存命中时为空
+    cache_key = db.Column(db.String(64), comment='结果缓存键，关联同一输入的多次请求')
+    tokenizer = db.Column(db.String(50), comment='o200k_base/cl100k_base，未安装tiktoken时为estimate')
+    input_budget = db.Column(db.Integer, comment='输入token预算')
+    max_tokens = db.Column(db.Integer, comment='请求的max_tokens')
+    section_tokens = db.Column(JSONDocument, comment='各提示词片段的token数')
+    trimmed_sections = db.Column(JSONDocument, comment='因超出预算被裁剪的片段')
+
+    __table_args__ = (
+        db.Index('ix_usage_records_user_created', 'user_id', 'created_at'),
+    )
+
+    def __repr__(self):
+        return f'<UsageRecord {self.model}: {self.prompt_tokens}+{self.completion_tokens}>'
+
+
+class UsageDaily(db.Model):
+    """用量日汇总 - 按 (日期, 用户, 模型, 上游) 累加，费用报表只查询这张表"""
+    __tablename__ = 'usage_daily'
+
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, comment='日期（UTC+8）')
+    user_id = db.Column(db.Integer, nullable=False, default=0, comment='0表示没有关联用户')
+    model = db.Column(db.String(100), nullable=False)
+    provider = db.Column(db.String(50), nullable=False, default='')
+    calls = db.Column(db.Integer, nullable=False, default=0)
+    cache_hits = db.Column(db.Integer, nullable=False, default=0)
+    failures = db.Column(db.Integer, nullable=False, default=0)
+    retries = db.Column(db.Integer, nullable=False, default=0)
+    prompt_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    completion_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    cost = db.Column(db.Float, nullable=False, default=0)
+    latency_ms = db.Column(db.BigInteger, nullable=False, default=0, comment='上游调用耗时合计')
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'user_id', 'model', 'provider', name='uq_usage_daily_key'),
+        db.Index('ix_usage_daily_user_day', 'user_id', 'day'),
+    )
+
+    def __repr__(self):
+        return f'<UsageDaily {self.day} user={self.user_id} {self.model}: {self.calls}>'
@@ -3,25 +3,56 @@ import json
 import logging
 import ssl
 import time
-from openai import OpenAI
+from types import SimpleNamespace
 from typing import Dict, List, Any, Optional
 
+import knowledge_retrieval
+import prompt_budget
+import result_cache
+import single_flight
+import usage_ledger
+from prompt_registry import registry as prompt_registry
+from json_stream_parser import IncrementalJSONParser
+from upstream_pool import UpstreamPool
+from upstream_providers import HedgeCancelled, ProviderRegistry, arun_hedged, run_hedged
+from circuit_breaker import CircuitOpenError, get_breaker
+from structured_logging import log_payload
+
 # OpenAI客户端初始化
 # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
 # do not change this unless explicitly requested by the user
 import httpx
+import openai
+
+# 上游API地址，默认使用laozhang.ai中转API；压测时可指向本地stub（tests/stub_upstream.py）
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.laozhang.ai/v1')
+
+# 进程内共享的上游客户端连接池，重试复用已建立的连接
+upstream_pool = UpstreamPool(OPENAI_BASE_URL)
 
-# 创建带优化连接配置的客户端 - 使用laozhang.ai中转API
-client = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY"),
-    base_url="https://api.laozhang.ai/v1",  # 使用中转API
-    timeout=httpx.Timeout(120.0, connect=30.0),  # 增加超时：连接30秒，读取120秒
-    http_client=httpx.Client(limits=httpx.Limits(max_connections=10,
-                                                 max_keepalive_connections=5),
-                             timeout=httpx.Timeout(120.0, connect=30.0)))
+# 多上游列表（default即上面的连接池），主上游响应慢时向备用上游发起对冲请求
+provider_registry = ProviderRegistry(upstream_pool)
 
 logger = logging.getLogger(__name__)
 
+# 流式输出开关：开启后AI分析以stream=True调用，已闭合的JSON片段（overview、每条pipeline）
+# 会在完整响应结束前推送给调用方
+STREAMING_ENABLED = os.environ.get('AI_STREAMING_ENABLED', 'true').lower() == 'true'
+# 流式输出时请求上游在最后一个片段中返回usage（stream_options.include_usage），用于用量账本；
+# 上游不支持该参数时关闭，token数改为本地估算
+STREAM_INCLUDE_USAGE = os.environ.get('AI_STREAM_INCLUDE_USAGE', 'true').lower() == 'true'
+STREAM_OPTIONS = {'stream_options': {'include_usage': True}} if STREAM_INCLUDE_USAGE else {}
+
+# 可重试的上游错误：网络/超时/TLS错误，以及上游返回的5xx和429
+# （SDK自身的重试已关闭，见upstream_pool，重试次数只由这里的循环决定）
+RETRYABLE_ERRORS = (httpx.TimeoutException, httpx.TransportError, openai.APIConnectionError,
+                    openai.InternalServerError, openai.RateLimitError,
+                    ConnectionError, TimeoutError, OSError, ssl.SSLError)
+
+
+class FallbackResult(dict):
+    """备用方案（上游调用失败时生成的默认结果），调用方据此不扣除AI分析额度"""
+
 
 class AngelaAI:
     """Angela - 非劳务收入管道设计AI服务"""
@@ -31,37 +62,15 @@ class AngelaAI:
         self.default_max_tokens = 2500  # 默认token数量
         
     def load_prompt_from_file(self, prompt_type: str) -> str:
-        """从文件加载prompt"""
-        try:
-            if prompt_type == 'system':
-                file_path = 'prompts/system_prompt.txt'
-            elif prompt_type == 'assistant':
-                file_path = 'prompts/assistant_prompt.txt'
-            else:
-                raise ValueError(f"不支持的prompt类型: {prompt_type}")
-                
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-            
-            logger.info(f"成功加载{prompt_type} prompt，长度: {len(content)}字符")
-            return content
-        except Exception as e:
-            logger.error(f"加载{prompt_type} prompt失败: {e}")
-            # 返回备用prompt
-            if prompt_type == 'system':
-                return "你是Angela，专业的非劳务收入路径设计师。"
-            else:
-                return "现在我将为你分析这个项目的非劳务收入设计方案。"
+        """获取prompt内容（进程内缓存，文件变化时自动重新加载）"""
+        return prompt_registry.get(prompt_type).content
 
     def get_model_config(self, config_type='main_analysis'):
-        """从数据库获取模型配置"""
+        """获取模型配置（进程内缓存，后台修改后按版本号失效）"""
         try:
             # 延迟导入避免循环导入问题
-            import importlib
-            models_module = importlib.import_module('models')
-            ModelConfig = getattr(models_module, 'ModelConfig')
-            config = ModelConfig.get_config(config_type, self.default_model)
-            return config
+            from models import ModelConfig
+            return ModelConfig.get_config(config_type, self.default_model)
         except Exception as e:
             logger.warning(f"Failed to get model config: {e}, using defaults")
             return {
@@ -71,39 +80,47 @@ class AngelaAI:
                 'timeout': 45
             }
 
-    def _call_openai_with_retry(self, **kwargs):
-        """调用OpenAI API，带强化重试机制"""
+    def _call_openai_with_retry(self, stream_callback=None, permit=None, route=None, user_id=None,
+                                budget=None, cache_key=None, **kwargs):
+        """调用OpenAI API，带强化重试机制
+
+        stream_callback(event): 提供时使用流式输出，每个闭合的JSON片段回调一次；
+        流式中途失败会整体重试，已推送的片段会被重新推送（按key/index覆盖即可）
+        permit: 熔断器许可，记录每次尝试的结果和耗时；熔断打开后不再重试
+        route: provider_registry.route()的结果，有备用上游时每次尝试都做对冲；
+        未提供时使用default上游
+        user_id / budget / cache_key: 记入用量账本；每次发往上游的请求（含失败的重试和对冲落败的一路）
+        各记录一行，budget为prompt_budget的token预算
+        """
         logger.info("=== _call_openai_with_retry方法被调用 ===")
         logger.info(
             f"传入参数: model={kwargs.get('model')}, timeout={kwargs.get('timeout')}"
         )
+        meter = SimpleNamespace(user_id=user_id, budget=budget, cache_key=cache_key)
+        return self._call_with_retries(stream_callback, permit, route, meter, kwargs)
+
+    def _call_with_retries(self, stream_callback, permit, route, meter, kwargs):
         max_retries = 3  # 增加重试次数提高成功率
         for attempt in range(max_retries):
+            if attempt > 0 and permit is not None and not get_breaker(permit.provider).allow_retry(permit):
+                raise CircuitOpenError("上游熔断中，停止重试")
             try:
                 logger.info(
                     f"正在调用OpenAI API (尝试 {attempt + 1}/{max_retries})...")
 
-                # 为每次重试创建新的客户端连接，提升SSL连接稳定性
-                if attempt > 0:
-                    # 使用更保守的超时设置
-                    fresh_client = OpenAI(
-                        api_key=os.environ.get("OPENAI_API_KEY"),
-                        base_url="https://api.laozhang.ai/v1",  # 使用中转API
-                        timeout=httpx.Timeout(150.0, connect=45.0, read=150.0)  # 进一步增加超时时间，提升稳定性
-                    )
-                    response = fresh_client.chat.completions.create(**kwargs)
-                    logger.info("✅ OpenAI API调用成功")
-                    return response
+                if route is not None and route.alternate is not None:
+                    def call(provider, entrant):
+                        return self._attempt(provider, attempt, stream_callback, permit, entrant, meter, kwargs)
+                    _, response = run_hedged(provider_registry, call, route.primary,
+                                             route.alternate, route.hedge_delay)
                 else:
-                    response = client.chat.completions.create(**kwargs)
-                    logger.info("✅ OpenAI API调用成功")
-                    return response
-
-            except (httpx.TimeoutException, httpx.ConnectError,
-                    ConnectionError, httpx.ReadTimeout, httpx.ConnectTimeout,
-                    TimeoutError, OSError, ConnectionResetError,
-                    BrokenPipeError, ssl.SSLError, ssl.SSLEOFError) as e:
-                if attempt < max_retries - 1:
+                    response = self._attempt(route.primary if route else None, attempt,
+                                             stream_callback, permit, None, meter, kwargs)
+                logger.info("✅ OpenAI API调用成功")
+                return response
+
+            except RETRYABLE_ERRORS as e:
+                if attempt < max_retries - 1 and (permit is None or get_breaker(permit.provider).allow_retry(permit)):
                     wait_time = 2 * (attempt + 1)  # 缩短等待时间: 2s, 4s
                     logger.warning(
                         f"OpenAI API网络超时 (尝试 {attempt + 1}): {str(e)}, {wait_time}秒后重试..."
@@ -119,9 +136,226 @@ class AngelaAI:
                 logger.error(f"💥 OpenAI API调用遇到其他错误: {str(e)}")
                 logger.error(f"💥 错误类型: {type(e).__name__}")
                 logger.error(f"💥 完整堆栈: {traceback.format_exc()}")
-                logger.error(f"💥 传入的参数: {kwargs}")
+                log_payload(logger, "💥 传入的参数", kwargs)
                 raise e
 
+    @staticmethod
+    def _record_usage(meter, provider, attempt, kwargs, response, started_at, hedge_lost=False):
+        """把一次上游请求放入用量账本的缓冲，不访问数据库"""
+        message = response.choices[0].message if response is not None and response.choices else None
+        usage_ledger.ledger.record(
+            model=kwargs.get('model'), provider=provider.name if provider is not None else 'default',
+            user_id=meter.user_id, usage=getattr(response, 'usage', None), messages=kwargs.get('messages'),
+            completion_text=message.content if message is not None else None,
+            latency_ms=int((time.time() - started_at) * 1000), retries=attempt,
+            success=response is not None and not hedge_lost, hedge_lost=hedge_lost, budget=meter.budget, cache_key=meter.cache_key)
+
+    def _attempt(self, provider, attempt, stream_callback, permit, entrant, meter, kwargs):
+        """向一个上游发起一次请求，记录熔断器结果和用量；provider为None时使用default上游
+
+        entrant: 对冲中的一路，非流式响应返回时声明胜出，落败时抛出HedgeCancelled（用量记为对冲落败）
+        """
+        pool = provider.pool if provider is not None else upstream_pool
+        # 重试时使用更保守的超时，共用连接池（断开的连接由连接池丢弃，不会被复用）
+        kwargs = dict(kwargs, timeout=pool.attempt_timeout(kwargs.get('timeout'), attempt))
+        if provider is not None and provider.model_name:
+            kwargs['model'] = provider.model_name
+        started_at = time.time()
+        response = None
+        hedge_lost = False
+        try:
+            api_client = pool.client()
+            if stream_callback is not None:
+                response = self._consume_stream(api_client, stream_callback, entrant=entrant, **kwargs)
+            else:
+                response = api_client.chat.completions.create(**kwargs)
+                if entrant is not None:
+                    entrant.claim()
+        except HedgeCancelled:
+            hedge_lost = True
+            raise
+        except RETRYABLE_ERRORS as e:
+            if permit is not None:
+                permit.record_attempt(False, time.time() - started_at, type(e).__name__,
+                                      provider=provider and provider.name)
+            raise
+        finally:
+            self._record_usage(meter, provider, attempt, kwargs, response, started_at, hedge_lost)
+        if permit is not None:
+            permit.record_attempt(True, time.time() - started_at, provider=provider and provider.name)
+        return response
+
+    async def _aattempt(self, provider, attempt, stream_callback, permit, entrant, meter, kwargs):
+        """_attempt的异步版本；对冲落败被取消时不记录熔断器结果，用量记为对冲落败"""
+        import asyncio
+
+        pool = provider.pool if provider is not None else upstream_pool
+        kwargs = dict(kwargs, timeout=pool.attempt_timeout(kwargs.get('timeout'), attempt))
+        if provider is not None and provider.model_name:
+            kwargs['model'] = provider.model_name
+        started_at = time.time()
+        response = None
+        hedge_lost = False
+        try:
+            api_client = pool.async_client()
+            if stream_callback is not None:
+                response = await self._aconsume_stream(api_client, stream_callback, entrant=entrant, **kwargs)
+            else:
+                response = await api_client.chat.completions.create(**kwargs)
+                if entrant is not None:
+                    entrant.claim()
+        except (HedgeCancelled, asyncio.CancelledError):
+            hedge_lost = entrant is not None
+            raise
+        except RETRYABLE_ERRORS as e:
+            if permit is not None:
+                permit.record_attempt(False, time.time() - started_at, type(e).__name__,
+                                      provider=provider and provider.name)
+            raise
+        finally:
+            self._record_usage(meter, provider, attempt, kwargs, response, started_at, hedge_lost)
+        if permit is not None:
+            permit.record_attempt(True, time.time() - started_at, provider=provider and provider.name)
+        return response
+
+    @staticmethod
+    def _sse_chunk(line):
+        """解析一行SSE数据，非数据行和结束标记返回None"""
+        if not line.startswith('data:'):
+            return None
+        data = line[5:].strip()
+        if not data or data == '[DONE]':
+            return None
+        chunk = json.loads(data)
+        if chunk.get('error'):
+            raise ValueError(f"流式输出返回错误: {chunk['error']}")
+        return chunk
+
+    @staticmethod
+    def _chunk_delta(chunk):
+        """片段中的增量文本，没有时返回None（最后一个只带usage的片段没有choices）"""
+        choices = chunk.get('choices') or []
+        if not choices:
+            return None
+        return (choices[0].get('delta') or {}).get('content') or None
+
+    @staticmethod
+    def _stream_response(text, usage):
+        """与非流式调用相同结构的响应对象"""
+        message = SimpleNamespace(content=text)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                               usage=SimpleNamespace(**usage) if usage else None)
+
+    def _consume_stream(self, api_client, stream_callback, entrant=None, **kwargs):
+        """以流式方式调用并增量解析JSON，返回与非流式调用相同结构的响应对象
+
+        直接读取原始SSE响应直到结束：SDK的Stream在[DONE]处提前关闭响应，
+        未读完的连接会被连接池丢弃，下一次调用又要重新建立TLS连接。
+        entrant: 对冲请求中的一路，输出首个片段前声明胜出，已落败时抛出HedgeCancelled
+        """
+        parser = IncrementalJSONParser(split_arrays=('pipelines',))
+        raw = api_client.chat.completions.with_raw_response.create(stream=True, **STREAM_OPTIONS, **kwargs)
+        http_response = raw.http_response
+        first_chunk_at = None
+        usage = None
+        start_time = time.time()
+        try:
+            for line in http_response.iter_lines():
+                if entrant is not None:
+                    entrant.check()
+                chunk = self._sse_chunk(line)
+                if chunk is None:
+                    continue
+                usage = chunk.get('usage') or usage
+                delta = self._chunk_delta(chunk)
+                if not delta:
+                    continue
+                if first_chunk_at is None:
+                    if entrant is not None:
+                        entrant.claim()
+                    first_chunk_at = time.time()
+                    logger.info(f"流式输出首个片段耗时: {first_chunk_at - start_time:.2f}秒")
+                self._emit_stream_events(parser, delta, stream_callback)
+        finally:
+            http_response.close()
+
+        logger.info(f"流式输出完成，共 {len(parser.text)} 字符，耗时 {time.time() - start_time:.2f}秒")
+        return self._stream_response(parser.text, usage)
+
+    @staticmethod
+    def _emit_stream_events(parser, delta, stream_callback):
+        for event in parser.feed(delta):
+            try:
+                stream_callback(event)
+            except Exception as e:
+                # 片段推送失败不影响完整结果
+                logger.warning(f"流式片段回调失败: {str(e)}")
+
+    async def _acall_openai_with_retry(self, stream_callback=None, permit=None, route=None, user_id=None,
+                                       budget=None, cache_key=None, **kwargs):
+        """_call_openai_with_retry的异步版本，重试策略相同，等待期间不占用线程"""
+        meter = SimpleNamespace(user_id=user_id, budget=budget, cache_key=cache_key)
+        return await self._acall_with_retries(stream_callback, permit, route, meter, kwargs)
+
+    async def _acall_with_retries(self, stream_callback, permit, route, meter, kwargs):
+        import asyncio
+
+        max_retries = 3
+        for attempt in range(max_retries):
+            if attempt > 0 and permit is not None and not get_breaker(permit.provider).allow_retry(permit):
+                raise CircuitOpenError("上游熔断中，停止重试")
+            try:
+                if route is not None and route.alternate is not None:
+                    def call(provider, entrant):
+                        return self._aattempt(provider, attempt, stream_callback, permit, entrant, meter, kwargs)
+                    _, response = await arun_hedged(provider_registry, call, route.primary,
+                                                    route.alternate, route.hedge_delay)
+                else:
+                    response = await self._aattempt(route.primary if route else None, attempt,
+                                                    stream_callback, permit, None, meter, kwargs)
+                logger.info("✅ OpenAI API异步调用成功")
+                return response
+
+            except RETRYABLE_ERRORS as e:
+                if attempt < max_retries - 1 and (permit is None or get_breaker(permit.provider).allow_retry(permit)):
+                    wait_time = 2 * (attempt + 1)
+                    logger.warning(
+                        f"OpenAI API网络超时 (尝试 {attempt + 1}): {str(e)}, {wait_time}秒后重试..."
+                    )
+                    await asyncio.sleep(wait_time)
+                    continue
+                logger.error(f"OpenAI API网络超时，最终失败: {str(e)}")
+                raise ConnectionError("OpenAI API网络连接超时，请稍后重试")
+            except Exception as e:
+                logger.error(f"💥 OpenAI API异步调用遇到其他错误: {type(e).__name__}: {str(e)}")
+                raise
+
+    async def _aconsume_stream(self, api_client, stream_callback, entrant=None, **kwargs):
+        """_consume_stream的异步版本"""
+        parser = IncrementalJSONParser(split_arrays=('pipelines',))
+        raw = await api_client.chat.completions.with_raw_response.create(stream=True, **STREAM_OPTIONS, **kwargs)
+        http_response = raw.http_response
+        usage = None
+        start_time = time.time()
+        try:
+            async for line in http_response.aiter_lines():
+                if entrant is not None:
+                    entrant.check()
+                chunk = self._sse_chunk(line)
+                if chunk is None:
+                    continue
+                usage = chunk.get('usage') or usage
+                delta = self._chunk_delta(chunk)
+                if delta:
+                    if entrant is not None and not parser.text:
+                        entrant.claim()
+                    self._emit_stream_events(parser, delta, stream_callback)
+        finally:
+            await http_response.aclose()
+
+        logger.info(f"异步流式输出完成，共 {len(parser.text)} 字符，耗时 {time.time() - start_time:.2f}秒")
+        return self._stream_response(parser.text, usage)
+
     def format_role_to_chinese(self, role_identifier: str) -> str:
         """将英文角色标识符转换为中文显示"""
         role_mapping = {
@@ -192,145 +426,301 @@ class AngelaAI:
         ])
 
     def get_core_knowledge_fallback(self) -> str:
-        """当知识库检索失败时的核心知识要点"""
+        """知识库没有检索到相关内容时的核心知识要点"""
         return """• 非劳务收入核心公式：意识+能量+能力（行动）=结果
 • 七大类型：租金（万物皆可租）、利息、股份/红利、版权、专利、企业连锁、团队收益
 • 三步法则：盘资源→搭管道→动真格
 • 核心原则：让关键环节的关键人物都高兴，严格区分需换取的人物资源vs可直接动用的外部资源
 • 成功要素：1)设计共赢机制 2)掌握核心信息+筛选规则 3)前置合作规则"""
 
-    def generate_income_paths(self, form_data: Dict[str, Any],
-                              db_session) -> Dict[str, Any]:
-        """生成非劳务收入路径"""
-        logger.info("=== Angela AI generate_income_paths方法开始 ===")
-        logger.info(f"输入数据: {json.dumps(form_data, ensure_ascii=False)}")
-        try:
-            # 提取表单数据
-            project_name = form_data.get('projectName', '未命名项目')
-            project_description = form_data.get('projectDescription', '')
-            key_persons = form_data.get('keyPersons', [])
-            external_resources = form_data.get('externalResources', [])
-
-            # 从文件加载system prompt和assistant prompt
-            system_prompt = self.load_prompt_from_file('system')
-            assistant_prompt_prefix = self.load_prompt_from_file('assistant')
-
-            # 构造用户提示
-            user_content = f"""【项目名称】{project_name}
-【项目背景】{project_description}
-
-【关键人物】（含角色、资源、动机）"""
-
-            for i, person in enumerate(key_persons):
-                name = person.get('name', f'人物{i+1}')
-                role = person.get('role', '')  # 修正：使用role而不是roles
-                resources = person.get('resources', [])
-                make_happy = person.get('make_happy',
-                                        '')  # 修正：使用make_happy而不是makeHappy
-                notes = person.get('notes', '')
-
-                # 将英文角色标识符转换为中文显示名称
-                role_chinese = self.format_role_to_chinese(
-                    role) if role else "未指定"
-                role_type = self.get_role_type_by_identifier(
-                    role) if role else "其他方"
-
-                user_content += f"""
+    def _prepare_analysis(self, form_data: Dict[str, Any], db_session,
+                          stage_callback=None, wait=True) -> SimpleNamespace:
+        """构建上游请求参数，并检查结果缓存和进行中的相同请求（同步，涉及数据库）
+
+        返回的 prepared.cached_result 不为None时可直接使用，无需调用上游；
+        prepared.lease 为single-flight租约，调用结束后由调用方释放
+        wait=False: 相同输入的请求正在进行时不等待，直接返回（prepared.lease.waiting为True），
+        由调用方在事件循环中等待后调用 _route_analysis
+        """
+        # 提取表单数据
+        project_name = form_data.get('projectName', '未命名项目')
+        project_description = form_data.get('projectDescription', '')
+        key_persons = form_data.get('keyPersons', [])
+        external_resources = form_data.get('externalResources', [])
+
+        # 从提示词注册表获取system prompt和assistant prompt（含版本指纹）
+        system_version = prompt_registry.get('system')
+        assistant_version = prompt_registry.get('assistant')
+        system_prompt = system_version.content
+        assistant_prompt_prefix = assistant_version.content
+
+        # 构造用户提示：按片段收集，超出token预算时从优先级低的片段开始裁剪
+        # （知识库参考最先，其次是靠后的关键人物，最后是项目背景）
+        user_sections = [
+            prompt_budget.Section('project', f"【项目名称】{project_name}\n", required=True),
+            prompt_budget.Section('project_description', f"【项目背景】{project_description}",
+                                  priority=2000),
+            prompt_budget.Section('key_persons', "\n\n【关键人物】（含角色、资源、动机）", required=True),
+        ]
+
+        for i, person in enumerate(key_persons):
+            name = person.get('name', f'人物{i+1}')
+            role = person.get('role', '')  # 修正：使用role而不是roles
+            resources = person.get('resources', [])
+            make_happy = person.get('make_happy',
+                                    '')  # 修正：使用make_happy而不是makeHappy
+            notes = person.get('notes', '')
+
+            # 将英文角色标识符转换为中文显示名称
+            role_chinese = self.format_role_to_chinese(
+                role) if role else "未指定"
+            role_type = self.get_role_type_by_identifier(
+                role) if role else "其他方"
+
+            user_sections.append(prompt_budget.Section(f'person_{i + 1}', f"""
 - 人物：{name}｜角色：{role_chinese}（{role_type}）
   资源：{", ".join(resources) if resources else "无"}
   动机标签（如何让TA高兴）：{self.format_make_happy(make_happy)}
-  备注：{notes if notes else "无"}"""
-
-            # 构建关键人物列表用于提示
-            key_persons_names = ', '.join([
-                person.get('name', f'人物{i+1}')
-                for i, person in enumerate(key_persons)
-            ])
-
-            # 使用从文件加载的assistant prompt
-            assistant_prompt = assistant_prompt_prefix
-
-            # 获取模型配置
-            model_config = self.get_model_config('main_analysis')
-            logger.info(f"模型配置: {model_config}")
-
-            # 打印prompt长度信息
-            total_prompt = system_prompt + user_content + assistant_prompt
-            logger.info(f"===== OpenAI API Request Info =====")
-            logger.info(f"Model: {model_config['model']}")
-            logger.info(f"Max tokens: {model_config['max_tokens']}")
-            logger.info(f"System prompt length: {len(system_prompt)} chars")
-            logger.info(f"User content length: {len(user_content)} chars")
-            logger.info(
-                f"Assistant prompt length: {len(assistant_prompt)} chars")
-            logger.info(f"Total prompt length: {len(total_prompt)} chars")
-            logger.info(f"===== Full Prompt Content =====")
-            logger.info(f"System: {system_prompt[:500]}..." if len(
-                system_prompt) > 500 else f"System: {system_prompt}")
-            logger.info(f"User: {user_content[:500]}..." if len(user_content) >
-                        500 else f"User: {user_content}")
-            logger.info(f"Assistant: {assistant_prompt[:500]}..." if len(
-                assistant_prompt) > 500 else f"Assistant: {assistant_prompt}")
-            logger.info(f"================================")
+  备注：{notes if notes else "无"}""", priority=1000 - i))
+
+        # 知识库中与项目最相关的片段（本地BM25索引），没有命中时使用核心知识要点
+        knowledge_hits = knowledge_retrieval.retrieve(db_session, knowledge_retrieval.build_query(form_data))
+        knowledge_text, knowledge_fingerprint = knowledge_retrieval.format_context(knowledge_hits)
+        logger.info(f"知识库检索命中 {len(knowledge_hits)} 个片段")
+        user_sections.append(prompt_budget.Section('knowledge', f"""
+
+【参考知识】
+{knowledge_text or self.get_core_knowledge_fallback()}""", priority=0))
+
+        # 获取模型配置
+        model_config = self.get_model_config('main_analysis')
+        logger.info(f"模型配置: {model_config}")
+
+        # 按模型计数token，裁剪到输入预算内，max_tokens不超过上下文窗口的剩余空间
+        assembler = prompt_budget.PromptAssembler(model_config['model'], model_config['max_tokens'])
+        assembler.add_message('system', [prompt_budget.Section('system', system_prompt, required=True)])
+        assembler.add_message('user', user_sections)
+        assembler.add_message('assistant', [prompt_budget.Section('assistant', assistant_prompt_prefix,
+                                                                  required=True)])
+        messages, budget = assembler.build()
+
+        if stage_callback:
+            stage_callback('prompt_built')
+
+        prepared = SimpleNamespace(
+            cache_key=None, cached_result=None, lease=None, permit=None, route=None,
+            model_config=model_config, budget=budget,
+            request_kwargs=dict(
+                model=model_config['model'],
+                messages=messages,
+                response_format={"type": "json_object"},
+                temperature=model_config['temperature'],
+                max_tokens=budget.max_tokens,
+                timeout=model_config['timeout']))
+
+        # 相同输入（表单+提示词+模型配置）直接返回缓存结果，不调用上游
+        if result_cache.CACHE_ENABLED and db_session is not None:
+            cache_key = result_cache.compute_cache_key(
+                form_data, system_version.fingerprint, assistant_version.fingerprint, model_config,
+                knowledge_fingerprint)
+            prepared.cache_key = cache_key
+            prepared.cached_result = result_cache.get_cached_result(db_session, cache_key)
+            if prepared.cached_result is not None:
+                logger.info(f"✅ 命中结果缓存 {cache_key[:12]}，跳过上游调用")
+                return prepared
+
+            # 相同输入的并发请求只由一个请求调用上游，其余等待其写入缓存的结果
+            prepared.lease = single_flight.acquire(db_session, cache_key, wait=wait)
+            if prepared.lease.waiting:
+                return prepared
+
+        return self._route_analysis(prepared, db_session, stage_callback)
+
+    def _route_analysis(self, prepared: SimpleNamespace, db_session, stage_callback=None) -> SimpleNamespace:
+        """复用并发请求的结果，或选择本次调用的上游（同步，涉及数据库）；出错时释放租约"""
+        try:
+            lease = prepared.lease
+            if lease is not None and not lease.is_leader:
+                if stage_callback:
+                    stage_callback('coalesced')
+                prepared.cached_result = result_cache.get_cached_result(db_session, prepared.cache_key)
+                if prepared.cached_result is not None:
+                    logger.info(f"✅ 复用并发请求的分析结果 {prepared.cache_key[:12]}，跳过上游调用")
+                    return prepared
+                logger.warning(f"并发请求未产生可用结果，自行调用上游 {prepared.cache_key[:12]}")
+
+            # 选择主上游和对冲的备用上游；所有上游都熔断时抛出CircuitOpenError，
+            # 由调用方直接使用备用方案；超时按主上游近期p95自适应
+            if db_session is not None:
+                prepared.route = provider_registry.route(db_session, prepared.model_config['timeout'])
+                prepared.permit = prepared.route.permit
+                prepared.request_kwargs['timeout'] = prepared.permit.timeout
+        except Exception:
+            if prepared.lease is not None:
+                prepared.lease.release()
+            raise
+
+        # 打印token预算信息
+        budget = prepared.budget
+        logger.info(f"===== OpenAI API Request Info =====")
+        logger.info(f"Model: {budget.model} (tokenizer: {budget.tokenizer})")
+        logger.info(f"Prompt tokens: {budget.prompt_tokens}/{budget.input_budget}, max tokens: {budget.max_tokens}")
+        logger.info(f"Section tokens: {budget.section_tokens}")
+        logger.info(f"================================")
+        return prepared
+
+    def _finish_analysis(self, prepared: SimpleNamespace, response, db_session,
+                         stage_callback=None) -> Dict[str, Any]:
+        """解析并校验上游响应，成功后写入结果缓存（同步，涉及数据库）"""
+        # 如果响应为None（网络错误），抛出异常而不是返回备用方案
+        if response is None:
+            logger.error("💥 OpenAI API返回None，这通常意味着连接失败")
+            raise ConnectionError("OpenAI API连接失败，响应为None")
+
+        if stage_callback:
+            stage_callback('validating')
+
+        # 解析响应
+        result_text = response.choices[0].message.content
+        if not result_text:
+            raise ValueError("AI返回内容为空")
+        result = json.loads(result_text)
+
+        # 验证结果结构
+        if not self._validate_result_structure(result):
+            raise ValueError("AI返回结构不完整")
+
+        if prepared.cache_key:
+            result_cache.store_result(db_session, prepared.cache_key, result,
+                                      prepared.model_config['model'])
+        return result
+
+    @staticmethod
+    def _record_cache_hit(prepared: SimpleNamespace, user_id):
+        """命中结果缓存（或复用并发请求的结果）也记入用量账本，token数和费用为0"""
+        usage_ledger.ledger.record(model=prepared.model_config['model'], user_id=user_id, cache_hit=True)
+
+    def _log_generation_error(self, e: Exception):
+        import traceback
+        if isinstance(e, json.JSONDecodeError):
+            logger.error(f"💥 JSON parsing error: {e}")
+            logger.error(f"💥 Full traceback: {traceback.format_exc()}")
+            # 尝试记录响应文本
+            logger.error("💥 AI response parsing failed - checking for response content")
+            return
+        logger.error(f"💥 AI generation error: {e}")
+        logger.error(f"💥 Error type: {type(e).__name__}")
+        logger.error(f"💥 Full traceback: {traceback.format_exc()}")
+        logger.error(
+            f"💥 This error caused fallback result to be used instead of real OpenAI analysis"
+        )
+
+    def generate_income_paths(self, form_data: Dict[str, Any],
+                              db_session, stage_callback=None,
+                              section_callback=None, user_id=None) -> Dict[str, Any]:
+        """生成非劳务收入路径
+
+        stage_callback(stage_code): 可选，在 prompt_built / upstream_call / validating
+        三个阶段被调用，用于后台任务推送进度
+        section_callback(event): 可选，流式模式下每个闭合的结果片段回调一次，
+        事件格式见 IncrementalJSONParser
+        user_id: 可选，用量账本中记录的用户
+        """
+        logger.info("=== Angela AI generate_income_paths方法开始 ===")
+        log_payload(logger, "输入数据", form_data)
+        prepared = None
+        try:
+            prepared = self._prepare_analysis(form_data, db_session, stage_callback)
+            if prepared.cached_result is not None:
+                self._record_cache_hit(prepared, user_id)
+                return prepared.cached_result
 
             # 调用OpenAI API，带重试机制和错误处理
             logger.info("=== 即将调用_call_openai_with_retry ===")
+            if stage_callback:
+                stage_callback('upstream_call')
+            stream_callback = section_callback if STREAMING_ENABLED else None
             try:
                 response = self._call_openai_with_retry(
-                    model=model_config['model'],
-                    messages=[{
-                        "role": "system",
-                        "content": system_prompt
-                    }, {
-                        "role": "user",
-                        "content": user_content
-                    }, {
-                        "role": "assistant",
-                        "content": assistant_prompt
-                    }],
-                    response_format={"type": "json_object"},
-                    temperature=model_config['temperature'],
-                    max_tokens=model_config['max_tokens'],
-                    timeout=model_config['timeout'])
-
-                # 如果响应为None（网络错误），抛出异常而不是返回备用方案
-                if response is None:
-                    logger.error("💥 OpenAI API返回None，这通常意味着连接失败")
-                    raise ConnectionError("OpenAI API连接失败，响应为None")
-
+                    stream_callback=stream_callback, permit=prepared.permit, route=prepared.route,
+                    user_id=user_id, budget=prepared.budget, cache_key=prepared.cache_key,
+                    **prepared.request_kwargs)
+            except CircuitOpenError:
+                raise
             except Exception as api_error:
                 logger.error(f"OpenAI API调用失败: {str(api_error)}")
                 # 抛出连接错误让上层处理
                 raise ConnectionError(f"OpenAI API连接失败: {str(api_error)}")
 
-            # 解析响应
-            result_text = response.choices[0].message.content
-            if not result_text:
-                raise ValueError("AI返回内容为空")
-            result = json.loads(result_text)
+            result = self._finish_analysis(prepared, response, db_session, stage_callback)
+            return result
 
-            # 验证结果结构
-            if not self._validate_result_structure(result):
-                raise ValueError("AI返回结构不完整")
+        except CircuitOpenError as e:
+            # 熔断中不使用内部备用方案，交给调用方直接生成备用结果
+            logger.warning(f"⚡ {str(e)}")
+            raise
+        except Exception as e:
+            self._log_generation_error(e)
+            return self._get_fallback_result(form_data)
+        finally:
+            if prepared is not None:
+                if prepared.permit is not None:
+                    get_breaker(prepared.permit.provider).record(db_session, prepared.permit)
+                if prepared.lease is not None:
+                    prepared.lease.release()
+
+    async def agenerate_income_paths(self, form_data: Dict[str, Any],
+                                     db_session, run_sync=None, stage_callback=None,
+                                     section_callback=None, user_id=None) -> Dict[str, Any]:
+        """generate_income_paths的异步版本：上游调用在事件循环中等待，不占用线程
+
+        run_sync(func, *args): 可等待对象，用于在数据库线程（带应用上下文）中执行
+        缓存查询、结果写入等同步操作；未提供时使用asyncio.to_thread
+        """
+        import asyncio
+
+        run_sync = run_sync or asyncio.to_thread
+        logger.info("=== Angela AI agenerate_income_paths方法开始 ===")
+        prepared = None
+        try:
+            prepared = await run_sync(self._prepare_analysis, form_data, db_session, stage_callback, False)
+            if prepared.lease is not None and prepared.lease.waiting:
+                # 相同输入的请求正在进行：在事件循环中等待，不占用数据库线程
+                await prepared.lease.wait_async(run_sync)
+                prepared = await run_sync(self._route_analysis, prepared, db_session, stage_callback)
+            if prepared.cached_result is not None:
+                self._record_cache_hit(prepared, user_id)
+                return prepared.cached_result
+
+            if stage_callback:
+                stage_callback('upstream_call')
+            stream_callback = section_callback if STREAMING_ENABLED else None
+            try:
+                response = await self._acall_openai_with_retry(
+                    stream_callback=stream_callback, permit=prepared.permit, route=prepared.route,
+                    user_id=user_id, budget=prepared.budget, cache_key=prepared.cache_key,
+                    **prepared.request_kwargs)
+            except CircuitOpenError:
+                raise
+            except Exception as api_error:
+                logger.error(f"OpenAI API异步调用失败: {str(api_error)}")
+                raise ConnectionError(f"OpenAI API连接失败: {str(api_error)}")
 
+            result = await run_sync(self._finish_analysis, prepared, response, db_session, stage_callback)
             return result
 
-        except json.JSONDecodeError as e:
-            import traceback
-            logger.error(f"💥 JSON parsing error: {e}")
-            logger.error(f"💥 Full traceback: {traceback.format_exc()}")
-            # 尝试记录响应文本
-            logger.error("💥 AI response parsing failed - checking for response content")
-            return self._get_fallback_result(form_data)
+        except CircuitOpenError as e:
+            logger.warning(f"⚡ {str(e)}")
+            raise
         except Exception as e:
-            import traceback
-            logger.error(f"💥 AI generation error: {e}")
-            logger.error(f"💥 Error type: {type(e).__name__}")
-            logger.error(f"💥 Full traceback: {traceback.format_exc()}")
-            logger.error(
-                f"💥 This error caused fallback result to be used instead of real OpenAI analysis"
-            )
+            self._log_generation_error(e)
             return self._get_fallback_result(form_data)
+        finally:
+            if prepared is not None:
+                if prepared.permit is not None:
+                    await run_sync(get_breaker(prepared.permit.provider).record, db_session, prepared.permit)
+                if prepared.lease is not None:
+                    await run_sync(prepared.lease.release)
 
     def _validate_result_structure(self, result: Dict[str, Any]) -> bool:
         """验证返回结果的结构完整性（基于最新pipelines结构）"""
@@ -506,7 +896,7 @@ class AngelaAI:
                     "通过互利共赢的合作模式，实现各方价值最大化"
                 })
 
-        return {
+        return FallbackResult({
             "overview": {
                 "situation":
                 f"基于【意识+能量+能力=结果】公式分析：{project_name}具备初步资源基础，设计者作为统筹方整合现有关键人物资源，构建撮合型非劳务收入管道。意识来自设计者的规则设计，能量来自关键人物的积极参与，能力借用各方专业资源。",
@@ -571,4 +961,8 @@ class AngelaAI:
                     "建立标准化的筛选和匹配流程，培训助手处理日常对接工作，设计自动化的信息收集和初步筛选系统"
                 }
             }]
-        }
+        })
+
+
+# 进程内共享的服务实例（无状态，可在线程间复用）
+angela_ai = AngelaAI()
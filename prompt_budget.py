@@ -0,0 +1,174 @@
+"""提示词token预算 - 按模型计数token，超出预算时按优先级裁剪提示词片段，并按剩余空间设置max_tokens
+
+- 计数: 安装tiktoken时按模型的编码精确计数（gpt-4o系列为o200k_base，其他为cl100k_base），
+  未安装时按字符估算（中日韩字符每字1个token，其他字符每3个1个token），估算值偏大，不会低估
+- 预算: 输入最多 PROMPT_INPUT_BUDGET 个token，并且不超过 上下文窗口 - PROMPT_MIN_OUTPUT_TOKENS；
+  超出时从优先级最低的可裁剪片段开始截断（知识库参考、靠后的关键人物、项目背景），
+  system/assistant提示词和项目名称不裁剪
+- max_tokens: 模型配置的max_tokens，超过上下文窗口剩余空间时相应减少
+- 每次上游请求的预算随用量账本（usage_ledger）一起记录在 usage_records 表，用于成本和耗时分析
+"""
+import importlib.util
+import logging
+import os
+import re
+import threading
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+TIKTOKEN_AVAILABLE = importlib.util.find_spec('tiktoken') is not None
+
+INPUT_BUDGET = int(os.environ.get('PROMPT_INPUT_BUDGET', 12000))
+MIN_OUTPUT_TOKENS = int(os.environ.get('PROMPT_MIN_OUTPUT_TOKENS', 1500))
+DEFAULT_CONTEXT_WINDOW = int(os.environ.get('PROMPT_CONTEXT_WINDOW', 128000))
+
+# 模型名前缀 -> 上下文窗口（按前缀最长匹配）
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-4o': 128000,
+    'gpt-4.1': 1047576,
+    'gpt-4-turbo': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'o1': 200000,
+    'o3': 200000,
+    'o4': 200000,
+}
+_O200K_PREFIXES = ('gpt-4o', 'gpt-4.1', 'o1', 'o3', 'o4')
+
+# chat格式每条消息的固定开销和回复引导token
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+TRUNCATION_MARK = '…（已截断）'
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def _encoding(model):
+    name = 'o200k_base' if (model or '').startswith(_O200K_PREFIXES) else 'cl100k_base'
+    with _encodings_lock:
+        if name not in _encodings:
+            import tiktoken
+
+            _encodings[name] = tiktoken.get_encoding(name)
+        return _encodings[name]
+
+
+def tokenizer_name(model):
+    return _encoding(model).name if TIKTOKEN_AVAILABLE else 'estimate'
+
+
+def count_tokens(text, model):
+    """文本的token数"""
+    if not text:
+        return 0
+    if TIKTOKEN_AVAILABLE:
+        return len(_encoding(model).encode(text, disallowed_special=()))
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 2) // 3
+
+
+def truncate_to_tokens(text, max_tokens, model):
+    """截断到不超过max_tokens个token（含截断标记），不足以放下标记时返回空字符串"""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    room = max_tokens - count_tokens(TRUNCATION_MARK, model)
+    if room <= 0:
+        return ''
+    if TIKTOKEN_AVAILABLE:
+        encoding = _encoding(model)
+        kept = encoding.decode(encoding.encode(text, disallowed_special=())[:room])
+    else:
+        # 估算模式下二分查找最长前缀
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if count_tokens(text[:middle], model) <= room:
+                low = middle
+            else:
+                high = middle - 1
+        kept = text[:low]
+    return kept.rstrip() + TRUNCATION_MARK
+
+
+def context_window(model):
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if (model or '').startswith(prefix)]
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_WINDOW
+
+
+class Section:
+    """提示词片段：priority越小越先被裁剪，required的片段不裁剪"""
+
+    def __init__(self, name, text, priority=0, required=False):
+        self.name = name
+        self.text = text or ''
+        self.priority = priority
+        self.required = required
+        self.tokens = 0
+
+    def __repr__(self):
+        return f'<Section {self.name}: {self.tokens} tokens>'
+
+
+class PromptAssembler:
+    """按消息收集片段，超出预算时裁剪，生成messages和max_tokens"""
+
+    def __init__(self, model, configured_max_tokens, input_budget=None):
+        self.model = model
+        self.configured_max_tokens = configured_max_tokens
+        self.window = context_window(model)
+        if input_budget is None:
+            input_budget = INPUT_BUDGET
+        self.input_budget = max(min(input_budget, self.window - MIN_OUTPUT_TOKENS), 0)
+        self._messages = []
+
+    def add_message(self, role, sections):
+        """sections: Section列表，按顺序拼接为一条消息的内容"""
+        self._messages.append((role, [section for section in sections if section.text]))
+
+    def _total(self):
+        overhead = TOKENS_PER_MESSAGE * len(self._messages) + TOKENS_PER_REPLY
+        return overhead + sum(section.tokens for _, sections in self._messages for section in sections)
+
+    def build(self):
+        """返回 (messages, budget)
+
+        budget: model / tokenizer / input_budget / prompt_tokens / max_tokens /
+        section_tokens（各片段裁剪后的token数）/ trimmed（被裁剪的片段名）
+        """
+        for _, sections in self._messages:
+            for section in sections:
+                section.tokens = count_tokens(section.text, self.model)
+
+        trimmed = []
+        optional = sorted((section for _, sections in self._messages for section in sections
+                           if not section.required), key=lambda section: section.priority)
+        for section in optional:
+            excess = self._total() - self.input_budget
+            if excess <= 0:
+                break
+            section.text = truncate_to_tokens(section.text, max(section.tokens - excess, 0), self.model)
+            section.tokens = count_tokens(section.text, self.model)
+            trimmed.append(section.name)
+
+        prompt_tokens = self._total()
+        if prompt_tokens > self.input_budget:
+            logger.warning(f"提示词必需部分 {prompt_tokens} tokens 超出输入预算 {self.input_budget}")
+        max_tokens = max(min(self.configured_max_tokens, self.window - prompt_tokens), 1)
+
+        section_tokens = {}
+        for _, sections in self._messages:
+            for section in sections:
+                section_tokens[section.name] = section_tokens.get(section.name, 0) + section.tokens
+        messages = [{'role': role, 'content': ''.join(section.text for section in sections)}
+                    for role, sections in self._messages]
+        budget = SimpleNamespace(model=self.model, tokenizer=tokenizer_name(self.model),
+                                 input_budget=self.input_budget, prompt_tokens=prompt_tokens,
+                                 max_tokens=max_tokens, section_tokens=section_tokens, trimmed=trimmed)
+        if trimmed:
+            logger.info(f"提示词超出预算，已裁剪: {', '.join(trimmed)}（{prompt_tokens}/{self.input_budget} tokens）")
+        return messages, budget
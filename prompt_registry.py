@@ -0,0 +1,126 @@
+"""提示词注册表 - 进程内缓存提示词文件，文件变化时自动重新加载
+
+每次分析不再重新打开、读取提示词文件：首次使用时加载并缓存内容，
+之后每次只比较文件的 mtime / inode / size，变化时才重新读取。
+每个提示词版本都带有内容的sha256指纹，结果缓存、审计等可以直接用指纹区分提示词版本。
+后台管理的重新加载接口可以强制刷新。
+"""
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PROMPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts')
+
+PROMPT_FILES = {
+    'system': 'system_prompt.txt',
+    'assistant': 'assistant_prompt.txt',
+}
+
+# 文件无法读取且从未成功加载过时使用的备用提示词
+FALLBACK_PROMPTS = {
+    'system': "你是Angela，专业的非劳务收入路径设计师。",
+    'assistant': "现在我将为你分析这个项目的非劳务收入设计方案。",
+}
+
+
+class PromptVersion:
+    """某个提示词的一个已加载版本"""
+
+    def __init__(self, prompt_type, content, path, stat_key=None):
+        self.prompt_type = prompt_type
+        self.content = content
+        self.path = path
+        self.stat_key = stat_key
+        self.fingerprint = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        self.loaded_at = datetime.utcnow()
+
+    @property
+    def is_fallback(self):
+        return self.stat_key is None
+
+    def to_dict(self):
+        return {
+            'prompt_type': self.prompt_type,
+            'path': self.path,
+            'fingerprint': self.fingerprint,
+            'length': len(self.content),
+            'loaded_at': self.loaded_at.isoformat(),
+            'is_fallback': self.is_fallback,
+        }
+
+
+class PromptRegistry:
+    """进程内的提示词缓存"""
+
+    def __init__(self, prompt_dir=PROMPT_DIR, files=None):
+        self.prompt_dir = prompt_dir
+        self.files = dict(files or PROMPT_FILES)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _path(self, prompt_type):
+        if prompt_type not in self.files:
+            raise ValueError(f"不支持的prompt类型: {prompt_type}")
+        return os.path.join(self.prompt_dir, self.files[prompt_type])
+
+    def get(self, prompt_type):
+        """返回提示词的当前版本，文件变化时重新加载"""
+        path = self._path(prompt_type)
+        try:
+            st = os.stat(path)
+            stat_key = (st.st_mtime_ns, st.st_ino, st.st_size)
+        except OSError as e:
+            stat_key = None
+            stat_error = e
+
+        current = self._versions.get(prompt_type)
+        if current is not None and stat_key is not None and current.stat_key == stat_key:
+            return current
+
+        with self._lock:
+            current = self._versions.get(prompt_type)
+            if current is not None and stat_key is not None and current.stat_key == stat_key:
+                return current
+            if stat_key is None:
+                if current is not None:
+                    # 文件暂时不可读时继续使用上一次成功加载的版本
+                    logger.warning(f"读取{prompt_type} prompt失败，继续使用已加载版本: {stat_error}")
+                    return current
+                logger.error(f"加载{prompt_type} prompt失败: {stat_error}，使用备用prompt")
+                version = PromptVersion(prompt_type, FALLBACK_PROMPTS[prompt_type], path)
+            else:
+                version = self._load(prompt_type, path, stat_key, current)
+            self._versions[prompt_type] = version
+            return version
+
+    def _load(self, prompt_type, path, stat_key, current):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = f.read().strip()
+        except Exception as e:
+            if current is not None:
+                logger.warning(f"读取{prompt_type} prompt失败，继续使用已加载版本: {e}")
+                return current
+            logger.error(f"加载{prompt_type} prompt失败: {e}，使用备用prompt")
+            return PromptVersion(prompt_type, FALLBACK_PROMPTS[prompt_type], path)
+
+        version = PromptVersion(prompt_type, content, path, stat_key)
+        logger.info(f"已加载{prompt_type} prompt，长度: {len(content)}字符，指纹: {version.fingerprint[:12]}")
+        return version
+
+    def reload(self):
+        """清空缓存并重新加载所有提示词，返回各提示词的版本信息"""
+        with self._lock:
+            self._versions.clear()
+        return self.describe()
+
+    def describe(self):
+        """所有提示词的当前版本信息"""
+        return {prompt_type: self.get(prompt_type).to_dict() for prompt_type in self.files}
+
+
+registry = PromptRegistry()
@@ -0,0 +1,128 @@
+"""AI分析额度账本 - 条件UPDATE原子扣减，分析任务完成时确认或退回
+
+以前的做法是在Python中先检查再加一（has_quota() 后 used_quota += 1），并发分析可能超额，
+并且保存结果和扣额度各提交一次。现在：
+
+- 预留: 提交分析时执行一条
+      UPDATE users SET used_quota = used_quota + 1 WHERE id = ? AND used_quota < ai_quota RETURNING ...
+  没有返回行即额度不足；预留状态记录在分析任务行上（analysis_jobs.quota_state = 'reserved'），
+  与创建任务在同一事务中提交
+- 确认: 保存AI分析结果时在同一事务中把任务的预留改为 'charged'（不额外提交）
+- 退回: 任务失败、或完成但没有确认（备用方案、复用2分钟内的已有结果）时，
+  预留改为 'released' 并把 used_quota 减一；由后台任务队列的状态回调触发，
+  上游调用失败不会扣额度。worker崩溃后重新排队的任务保留预留，重新执行时再确认
+- 兜底: 状态回调失败、或任务由 analysis_jobs.reap_orphans 补做结束时，已结束但仍为预留状态的任务
+  由后台任务队列的定期修复（release_stale）退回
+
+每一步都是带状态条件的UPDATE，多个进程同时确认/退回同一任务时只有一个生效。
+"""
+import logging
+
+from sqlalchemy import case, select, update
+
+logger = logging.getLogger(__name__)
+
+RESERVED = 'reserved'
+CHARGED = 'charged'
+RELEASED = 'released'
+
+
+def reserve(db_session, user_id):
+    """原子预留一次额度（不提交），返回预留后的 (used_quota, ai_quota)；额度不足时返回None"""
+    from models import User
+
+    row = db_session.execute(
+        update(User)
+        .where(User.id == user_id, User.used_quota < User.ai_quota)
+        .values(used_quota=User.used_quota + 1)
+        .returning(User.used_quota, User.ai_quota)
+        .execution_options(synchronize_session=False)).first()
+    return tuple(row) if row is not None else None
+
+
+def charge(db_session, job_id):
+    """确认任务预留的额度（不提交，与保存结果在同一事务中），返回是否确认成功
+
+    任务已被退回（例如超时被标记失败后才完成）时返回False，不会重复扣减。
+    """
+    from models import AnalysisJob
+
+    result = db_session.execute(
+        update(AnalysisJob)
+        .where(AnalysisJob.id == job_id, AnalysisJob.quota_state == RESERVED)
+        .values(quota_state=CHARGED))
+    return result.rowcount == 1
+
+
+def release(db_session, job_id):
+    """退回任务仍处于预留状态的额度并提交，返回是否退回"""
+    from models import AnalysisJob, User
+
+    user_id = db_session.execute(
+        update(AnalysisJob)
+        .where(AnalysisJob.id == job_id, AnalysisJob.quota_state == RESERVED)
+        .values(quota_state=RELEASED)
+        .returning(AnalysisJob.user_id)).scalar()
+    if user_id is None:
+        db_session.commit()
+        return False
+    db_session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(used_quota=case((User.used_quota > 0, User.used_quota - 1), else_=0))
+        .execution_options(synchronize_session=False))
+    db_session.commit()
+    logger.info(f"分析任务 {job_id} 未产生AI分析结果，已退回用户 {user_id} 的预留额度")
+    return True
+
+
+def release_stale(db_session):
+    """已结束（completed/failed）但仍处于预留状态的任务：退回额度，返回退回的任务数
+
+    确认发生在任务结束之前（保存结果时），已结束的任务仍为预留即不会再被确认。
+    """
+    from analysis_jobs import TERMINAL_STATES
+    from models import AnalysisJob
+
+    job_ids = db_session.execute(
+        select(AnalysisJob.id)
+        .where(AnalysisJob.quota_state == RESERVED, AnalysisJob.state.in_(TERMINAL_STATES))).scalars().all()
+    db_session.commit()
+    released = sum(1 for job_id in job_ids if release(db_session, job_id))
+    if released:
+        logger.warning(f"退回了 {released} 个已结束任务遗留的额度预留")
+    return released
+
+
+def usage(db_session, user_ids=None):
+    """只读取额度相关的列：{user_id: {ai_quota, used_quota, remaining_quota, quota_display, quota_usage_percentage}}"""
+    from models import User
+
+    query = select(User.id, User.ai_quota, User.used_quota)
+    if user_ids is not None:
+        query = query.where(User.id.in_(user_ids))
+    return {row.id: usage_values(row.ai_quota, row.used_quota) for row in db_session.execute(query)}
+
+
+def usage_values(ai_quota, used_quota):
+    """额度显示字段（与User的额度属性一致）"""
+    return {
+        'ai_quota': ai_quota,
+        'used_quota': used_quota,
+        'remaining_quota': max(0, ai_quota - used_quota),
+        'quota_display': f"{used_quota}/{ai_quota}",
+        'quota_usage_percentage': 100 if ai_quota <= 0 else min(100, (used_quota / ai_quota) * 100),
+    }
+
+
+def handle_job_event(db_session, job_id, event, values):
+    """后台任务队列的状态回调：任务失败或完成时退回未确认的预留"""
+    if event in ('completed', 'failed'):
+        release(db_session, job_id)
+
+
+def register(job_queue, db):
+    """订阅analysis类型后台任务的结束事件，并定期退回回调遗漏的预留（在analysis_jobs.register之后调用）"""
+    job_queue.observe('analysis', lambda job_id, event, values:
+                      handle_job_event(db.session, job_id, event, values))
+    job_queue.sweep(lambda: release_stale(db.session))
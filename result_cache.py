@@ -0,0 +1,169 @@
+"""分析结果缓存 - 相同输入直接返回已存储的结果，不再调用上游API
+
+缓存键是以下内容规范化后的sha256：
+- 表单数据（字符串去除首尾空白、忽略空字段、字典键排序）
+- system / assistant 提示词的版本指纹（修改提示词后旧缓存自然失效）
+- ModelConfig 中 main_analysis 的模型、温度、最大token数
+缓存条目带TTL，总数超过上限时按最近使用时间淘汰（LRU）。
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+CACHE_TTL_HOURS = int(os.environ.get('RESULT_CACHE_TTL_HOURS', 168))  # 默认7天
+CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 1000))
+
+
+def _sha256(text):
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+
+def normalize_form_data(value):
+    """递归规范化表单数据：字符串去首尾空白，去掉空字段"""
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, dict):
+        normalized = {key: normalize_form_data(item) for key, item in value.items()}
+        return {key: item for key, item in normalized.items() if item not in ('', None, [], {})}
+    if isinstance(value, list):
+        return [normalize_form_data(item) for item in value]
+    return value
+
+
+def compute_cache_key(form_data, system_fingerprint, assistant_fingerprint, model_config, knowledge_fingerprint=''):
+    """计算缓存键，提示词使用prompt_registry提供的版本指纹，知识库检索结果使用命中片段的指纹"""
+    material = {
+        'form_data': normalize_form_data(form_data),
+        'system_prompt': system_fingerprint,
+        'assistant_prompt': assistant_fingerprint,
+        'knowledge': knowledge_fingerprint,
+        'model': model_config.get('model'),
+        'temperature': model_config.get('temperature'),
+        'max_tokens': model_config.get('max_tokens'),
+    }
+    return _sha256(json.dumps(material, ensure_ascii=False, sort_keys=True))
+
+
+def get_cached_result(db_session, cache_key):
+    """查询未过期的缓存结果，命中时累加命中次数并刷新最近使用时间"""
+    from models import AnalysisCacheEntry
+
+    now = datetime.utcnow()
+    try:
+        result_data = db_session.execute(
+            select(AnalysisCacheEntry.result_data)
+            .where(AnalysisCacheEntry.cache_key == cache_key,
+                   AnalysisCacheEntry.expires_at > now)).scalar()
+        if result_data is None:
+            return None
+        db_session.execute(
+            update(AnalysisCacheEntry)
+            .where(AnalysisCacheEntry.cache_key == cache_key)
+            .values(hit_count=AnalysisCacheEntry.hit_count + 1, last_used_at=now))
+        db_session.commit()
+        return json.loads(result_data)
+    except Exception as e:
+        # 缓存故障不影响正常分析
+        db_session.rollback()
+        logger.warning(f"读取结果缓存失败: {str(e)}")
+        return None
+
+
+def store_result(db_session, cache_key, result, model_name=None):
+    """写入缓存并按TTL和容量上限淘汰旧条目"""
+    from models import AnalysisCacheEntry
+
+    now = datetime.utcnow()
+    result_data = json.dumps(result, ensure_ascii=False)
+    try:
+        entry = db_session.get(AnalysisCacheEntry, cache_key)
+        if entry is None:
+            entry = AnalysisCacheEntry()
+            entry.cache_key = cache_key
+            entry.hit_count = 0
+            db_session.add(entry)
+        entry.result_data = result_data
+        entry.model_name = model_name
+        entry.size_bytes = len(result_data.encode('utf-8'))
+        entry.created_at = now
+        entry.last_used_at = now
+        entry.expires_at = now + timedelta(hours=CACHE_TTL_HOURS)
+        db_session.commit()
+    except IntegrityError:
+        # 并发写入同一个键，保留先写入的结果
+        db_session.rollback()
+        return
+    except Exception as e:
+        db_session.rollback()
+        logger.warning(f"写入结果缓存失败: {str(e)}")
+        return
+
+    evict(db_session)
+
+
+def evict(db_session):
+    """删除过期条目；条目数超过上限时删除最久未使用的条目"""
+    from models import AnalysisCacheEntry
+
+    try:
+        expired = db_session.execute(
+            delete(AnalysisCacheEntry).where(AnalysisCacheEntry.expires_at <= datetime.utcnow()))
+        overflow = db_session.execute(select(func.count(AnalysisCacheEntry.cache_key))).scalar() - CACHE_MAX_ENTRIES
+        evicted = 0
+        if overflow > 0:
+            stale_keys = db_session.execute(
+                select(AnalysisCacheEntry.cache_key)
+                .order_by(AnalysisCacheEntry.last_used_at.asc())
+                .limit(overflow)).scalars().all()
+            evicted = db_session.execute(
+                delete(AnalysisCacheEntry).where(AnalysisCacheEntry.cache_key.in_(stale_keys))).rowcount
+        db_session.commit()
+        if expired.rowcount or evicted:
+            logger.info(f"结果缓存淘汰: 过期 {expired.rowcount}, 超出容量 {evicted}")
+    except Exception as e:
+        db_session.rollback()
+        logger.warning(f"结果缓存淘汰失败: {str(e)}")
+
+
+def cache_stats(db_session):
+    """缓存统计，用于后台管理查看缓存节省的上游调用"""
+    from models import AnalysisCacheEntry
+
+    row = db_session.execute(select(
+        func.count(AnalysisCacheEntry.cache_key),
+        func.coalesce(func.sum(AnalysisCacheEntry.hit_count), 0),
+        func.count(AnalysisCacheEntry.cache_key).filter(AnalysisCacheEntry.hit_count > 0),
+        func.coalesce(func.sum(AnalysisCacheEntry.size_bytes), 0),
+        func.coalesce(func.sum(AnalysisCacheEntry.hit_count * AnalysisCacheEntry.size_bytes), 0),
+        func.max(AnalysisCacheEntry.last_used_at),
+    )).one()
+    entries, total_hits, entries_with_hits, total_bytes, saved_bytes, last_used_at = row
+    return {
+        'enabled': CACHE_ENABLED,
+        'ttl_hours': CACHE_TTL_HOURS,
+        'max_entries': CACHE_MAX_ENTRIES,
+        'entries': entries,
+        'entries_with_hits': entries_with_hits,
+        'total_hits': int(total_hits),
+        'saved_upstream_calls': int(total_hits),
+        'saved_output_bytes': int(saved_bytes),
+        'total_bytes': int(total_bytes),
+        'last_used_at': last_used_at.isoformat() if last_used_at else None,
+    }
+
+
+def clear_cache(db_session):
+    """清空所有缓存条目，返回删除数量"""
+    from models import AnalysisCacheEntry
+
+    deleted = db_session.execute(delete(AnalysisCacheEntry)).rowcount
+    db_session.commit()
+    return deleted
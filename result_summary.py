@@ -0,0 +1,76 @@
+"""分析结果摘要 - 历史记录列表、筛选只需要的几个字段，冗余保存在 analysis_results 的摘要列中
+
+- pipeline_count / pipeline_names: 管道数量和名称
+- income_types: 管道收入机制涉及的收入类型（七大类，去重保持顺序），Postgres上有GIN索引，
+  按类型筛选（例如所有“居间”方案）不需要读取result_data
+- 关键人物数量沿用已有的 team_size 列
+
+写入AnalysisResult时由ORM事件自动计算（见models.py）；JSON Patch修改管道后由编辑接口重新计算；
+加列之前的记录在启动时由 backfill() 分批补算。
+"""
+import logging
+
+from sqlalchemy import select, update
+
+logger = logging.getLogger(__name__)
+
+# 与提示词中的七大非劳务收入类型一致
+INCOME_TYPES = ('租金', '利息', '股份', '版权', '居间', '企业连锁', '团队收益')
+
+BACKFILL_BATCH_SIZE = 200
+
+
+def summarize(result_data):
+    """从分析结果计算摘要列的值"""
+    pipelines = result_data.get('pipelines') if isinstance(result_data, dict) else None
+    if not isinstance(pipelines, list):
+        pipelines = []
+
+    names, income_types = [], []
+    for pipeline in pipelines:
+        if not isinstance(pipeline, dict):
+            continue
+        names.append(str(pipeline.get('name') or ''))
+        mechanism = pipeline.get('income_mechanism')
+        mechanism_type = str(mechanism.get('type') or '') if isinstance(mechanism, dict) else ''
+        # 类型可能是组合，例如“居间+股份”
+        for income_type in INCOME_TYPES:
+            if income_type in mechanism_type and income_type not in income_types:
+                income_types.append(income_type)
+
+    return {'pipeline_count': len(pipelines), 'pipeline_names': names, 'income_types': income_types}
+
+
+def refresh(db_session, analysis_id):
+    """按数据库中当前的管道数据重新计算摘要（不提交，和修改结果的UPDATE在同一事务中）"""
+    from models import AnalysisResult
+
+    pipelines = db_session.execute(
+        select(AnalysisResult.result_data['pipelines']).where(AnalysisResult.id == analysis_id)).scalar()
+    db_session.execute(
+        update(AnalysisResult).where(AnalysisResult.id == analysis_id)
+        .values(**summarize({'pipelines': pipelines})))
+
+
+def backfill(db_session, batch_size=BACKFILL_BATCH_SIZE):
+    """为还没有摘要的记录（pipeline_count为空）分批补算，返回处理的记录数"""
+    from models import AnalysisResult
+
+    total = 0
+    while True:
+        rows = db_session.execute(
+            select(AnalysisResult.id, AnalysisResult.result_data['pipelines'])
+            .where(AnalysisResult.pipeline_count.is_(None))
+            .limit(batch_size)).all()
+        if not rows:
+            break
+        for analysis_id, pipelines in rows:
+            db_session.execute(
+                update(AnalysisResult).where(AnalysisResult.id == analysis_id)
+                .values(**summarize({'pipelines': pipelines})))
+        db_session.commit()
+        total += len(rows)
+
+    if total:
+        logger.info(f"已为 {total} 条分析记录补算结果摘要")
+    return total
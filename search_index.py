@@ -0,0 +1,197 @@
+"""全文搜索 - 分析记录和知识库的统一索引（search_documents表）
+
+中文没有空格分隔，Postgres内置的分词配置切不开，这里也不依赖zhparser等扩展：
+- 写入时在Python中切分词元：连续的中日韩字符取单字和相邻二元组，英文和数字按单词，统一小写；
+  查询时连续的中文只取二元组（单个字时取单字），所有词元都要命中
+- Postgres: 词元以 to_tsvector('simple', ...) 保存在 search_vector 列（GIN索引），
+  标题权重A、正文B、其他内容C，按 ts_rank_cd 排序分页，查询耗时取决于命中的记录数而不是总记录数
+- 其他数据库（本地SQLite）: 在 terms 列上逐个词元LIKE匹配，按命中的词元数排序，只用于开发环境
+
+分析记录和知识库条目写入时由ORM事件同步索引（见models.py），JSON Patch修改结果后由编辑接口刷新，
+加索引之前的记录在启动时由 backfill() 分批补建。
+"""
+import logging
+import re
+from datetime import datetime
+
+from sqlalchemy import String, and_, case, cast, delete, func, insert, literal, literal_column, select
+
+logger = logging.getLogger(__name__)
+
+DOC_ANALYSIS = 'analysis'
+DOC_KNOWLEDGE = 'knowledge'
+
+SNIPPET_LENGTH = 120
+BACKFILL_BATCH_SIZE = 200
+
+_CJK = '\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_TOKEN_PATTERN = re.compile(f'[{_CJK}]+|[a-z0-9]+')
+_CJK_PATTERN = re.compile(f'[{_CJK}]')
+
+
+def tokenize(text, for_query=False):
+    """切分词元（保持原文顺序，不去重）"""
+    tokens = []
+    for run in _TOKEN_PATTERN.findall((text or '').lower()):
+        if not _CJK_PATTERN.match(run) or len(run) == 1:
+            tokens.append(run)
+            continue
+        if not for_query:
+            tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def _query_tokens(query):
+    return list(dict.fromkeys(tokenize(query, for_query=True)))
+
+
+# ---------- 写入 ----------
+
+def index_document(connection, doc_type, doc_id, title, body='', extra='', user_id=None, snippet=None):
+    """写入或替换一条索引记录；connection可以是ORM事件中的连接或 db.session.connection()"""
+    from models import SearchDocument
+
+    table = SearchDocument.__table__
+    weighted = [(title, 'A'), (body, 'B'), (extra, 'C')]
+    terms = ' '.join(token for text, _ in weighted for token in tokenize(text))
+    values = {
+        'doc_type': doc_type,
+        'doc_id': str(doc_id),
+        'user_id': user_id,
+        'title': (title or '')[:255],
+        'snippet': (snippet if snippet is not None else body or extra or '').strip()[:SNIPPET_LENGTH],
+        'terms': f' {terms} ',
+        'updated_at': datetime.utcnow(),
+    }
+    if connection.dialect.name == 'postgresql':
+        vector = None
+        for text, weight in weighted:
+            # 权重写成SQL常量（"char"类型参数不接受varchar绑定参数）
+            part = func.setweight(func.to_tsvector('simple', ' '.join(tokenize(text))),
+                                  literal_column(f"'{weight}'"))
+            vector = part if vector is None else vector.op('||')(part)
+        values['search_vector'] = vector
+
+    connection.execute(delete(table).where(table.c.doc_type == doc_type, table.c.doc_id == str(doc_id)))
+    connection.execute(insert(table).values(**values))
+
+
+def remove_document(connection, doc_type, doc_id):
+    from models import SearchDocument
+
+    table = SearchDocument.__table__
+    connection.execute(delete(table).where(table.c.doc_type == doc_type, table.c.doc_id == str(doc_id)))
+
+
+def _overview_text(overview):
+    if not isinstance(overview, dict):
+        return ''
+    return '\n'.join(str(overview[key]) for key in ('core_insight', 'situation') if overview.get(key))
+
+
+def index_analysis(connection, record_id, user_id, project_name, project_description, pipeline_names, overview):
+    """分析记录：项目名为标题，项目描述为正文，管道名称和核心洞察/现状为其他内容"""
+    extra = '\n'.join(part for part in (' '.join(pipeline_names or []), _overview_text(overview)) if part)
+    index_document(connection, DOC_ANALYSIS, record_id, project_name, project_description or '', extra,
+                   user_id=user_id)
+
+
+def index_knowledge(connection, item):
+    """知识库条目：已删除的条目从索引中移除"""
+    if item.status == 'deleted':
+        remove_document(connection, DOC_KNOWLEDGE, item.id)
+        return
+    index_document(connection, DOC_KNOWLEDGE, item.id, item.original_filename, item.content_summary or '')
+
+
+def refresh_analysis(db_session, analysis_id):
+    """按数据库中的当前内容重建一条分析记录的索引（不提交，和修改结果的UPDATE在同一事务中）"""
+    from models import AnalysisResult
+
+    row = db_session.execute(
+        select(AnalysisResult.user_id, AnalysisResult.project_name, AnalysisResult.project_description,
+               AnalysisResult.pipeline_names, AnalysisResult.result_data['overview'].label('overview'))
+        .where(AnalysisResult.id == analysis_id)).first()
+    if row is not None:
+        index_analysis(db_session.connection(), analysis_id, row.user_id, row.project_name,
+                       row.project_description, row.pipeline_names, row.overview)
+
+
+def backfill(db_session, batch_size=BACKFILL_BATCH_SIZE):
+    """为还没有索引的分析记录和知识库条目分批建索引，返回处理的记录数"""
+    from models import AnalysisResult, KnowledgeItem, SearchDocument
+
+    total = 0
+    while True:
+        rows = db_session.execute(
+            select(AnalysisResult.id, AnalysisResult.user_id, AnalysisResult.project_name,
+                   AnalysisResult.project_description, AnalysisResult.pipeline_names,
+                   AnalysisResult.result_data['overview'].label('overview'))
+            .outerjoin(SearchDocument, and_(SearchDocument.doc_type == DOC_ANALYSIS,
+                                            SearchDocument.doc_id == AnalysisResult.id))
+            .where(SearchDocument.id.is_(None))
+            .limit(batch_size)).all()
+        if not rows:
+            break
+        connection = db_session.connection()
+        for row in rows:
+            index_analysis(connection, row.id, row.user_id, row.project_name, row.project_description,
+                           row.pipeline_names, row.overview)
+        db_session.commit()
+        total += len(rows)
+
+    items = db_session.execute(
+        select(KnowledgeItem)
+        .outerjoin(SearchDocument, and_(SearchDocument.doc_type == DOC_KNOWLEDGE,
+                                        SearchDocument.doc_id == cast(KnowledgeItem.id, String)))
+        .where(SearchDocument.id.is_(None), KnowledgeItem.status != 'deleted')).scalars().all()
+    if items:
+        connection = db_session.connection()
+        for item in items:
+            index_knowledge(connection, item)
+        db_session.commit()
+        total += len(items)
+
+    if total:
+        logger.info(f"已为 {total} 条记录补建搜索索引")
+    return total
+
+
+# ---------- 查询 ----------
+
+def search(db_session, query, doc_type, user_id=None, page=1, per_page=20):
+    """按相关度排序的搜索结果
+
+    user_id不为空时只返回该用户的记录（普通用户搜索自己的分析记录）。
+    返回 (结果列表, 是否还有下一页)，结果为 {doc_id, title, snippet, rank}。
+    """
+    from models import SearchDocument
+
+    tokens = _query_tokens(query)
+    if not tokens:
+        return [], False
+
+    conditions = [SearchDocument.doc_type == doc_type]
+    if user_id is not None:
+        conditions.append(SearchDocument.user_id == user_id)
+
+    if db_session.get_bind().dialect.name == 'postgresql':
+        ts_query = func.plainto_tsquery('simple', ' '.join(tokens))
+        conditions.append(SearchDocument.search_vector.op('@@')(ts_query))
+        rank = func.ts_rank_cd(SearchDocument.search_vector, ts_query)
+    else:
+        matches = [SearchDocument.terms.like(f'% {token} %') for token in tokens]
+        conditions.append(and_(*matches))
+        rank = sum((case((match, 1), else_=0) for match in matches), literal(0))
+
+    rows = db_session.execute(
+        select(SearchDocument.doc_id, SearchDocument.title, SearchDocument.snippet, rank.label('rank'))
+        .where(*conditions)
+        .order_by(rank.desc(), SearchDocument.updated_at.desc())
+        .offset((page - 1) * per_page)
+        .limit(per_page + 1)).all()
+
+    results = [{'doc_id': row.doc_id, 'title': row.title, 'snippet': row.snippet, 'rank': float(row.rank)}
+               for row in rows[:per_page]]
+    return results, len(rows) > per_page
@@ -0,0 +1,199 @@
+"""服务端session存储 - cookie中只保存签名后的session id，数据保存在 web_sessions 表中
+
+Flask默认把整个session签名后放进cookie，每次修改都要重新签名并下发整个cookie。
+这里改为：
+- cookie只有一个随机id（签名防伪造），只在新建session或续期时下发
+- 请求结束时逐个key与读取时的快照比较，只把真正变化的key合并写回数据库；
+  只设置 session.modified = True 而内容没变时不写数据库、不下发cookie
+- 合并写入在行锁内读取最新数据再覆盖变化的key，同一用户的并发请求（轮询、SSE）
+  不会互相覆盖对方写入的其他key
+- 过期时间最多每 SESSION_TOUCH_INTERVAL 秒续期一次，过期记录在新建session时按概率清理
+- 登录、退出或切换用户（_user_id变化）时换一个新的session id并删除旧记录，
+  登录前被他人获知的session id不能用来冒用登录后的会话（session固定攻击）
+- 使用独立的数据库连接读写，不会提交视图函数中未提交的ORM修改
+
+SESSION_BACKEND=cookie 时使用Flask默认的cookie session。
+"""
+import logging
+import os
+import random
+import secrets
+from datetime import datetime, timedelta
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import delete, insert, select, update
+from werkzeug.datastructures import CallbackDict
+
+logger = logging.getLogger(__name__)
+
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'server').lower()
+TOUCH_INTERVAL = int(os.environ.get('SESSION_TOUCH_INTERVAL', 300))
+CLEANUP_PROBABILITY = 0.01
+
+# Flask-Login保存登录用户id的key，变化时更换session id
+USER_KEY = '_user_id'
+
+serializer = TaggedJSONSerializer()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """记录读取时快照的session，用于计算变化的key"""
+
+    def __init__(self, initial=None, sid=None, new=False, expires_at=None):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.new = new
+        self.expires_at = expires_at
+        self.modified = False
+        self.accessed = False
+        self._snapshot = {key: serializer.dumps(value) for key, value in (initial or {}).items()}
+
+    def changes(self):
+        """与快照相比变化的key：返回(新值字典, 被删除的key列表)"""
+        updated = {}
+        for key, value in self.items():
+            if self._snapshot.get(key) != serializer.dumps(value):
+                updated[key] = value
+        deleted = [key for key in self._snapshot if key not in self]
+        return updated, deleted
+
+    def user_changed(self):
+        """登录用户（Flask-Login的_user_id）与读取时不同"""
+        current = serializer.dumps(self[USER_KEY]) if USER_KEY in self else None
+        return self._snapshot.get(USER_KEY) != current
+
+
+class DatabaseSessionInterface(SessionInterface):
+    """把session保存在数据库中的SessionInterface"""
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-session')
+
+    @staticmethod
+    def _engine(app):
+        return app.extensions['sqlalchemy'].engine
+
+    def open_session(self, app, request):
+        from models import WebSession
+
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return ServerSession(new=True)
+        try:
+            sid = self._signer(app).unsign(cookie).decode()
+        except BadSignature:
+            # 包括切换前的cookie session，视为新会话
+            return ServerSession(new=True)
+
+        try:
+            with self._engine(app).connect() as conn:
+                row = conn.execute(
+                    select(WebSession.data, WebSession.expires_at).where(WebSession.sid == sid)).first()
+        except Exception as e:
+            logger.warning(f"读取session失败: {str(e)}")
+            return ServerSession(new=True)
+        if row is None or row.expires_at < datetime.utcnow():
+            return ServerSession(new=True)
+        return ServerSession(serializer.loads(row.data), sid=sid, expires_at=row.expires_at)
+
+    def save_session(self, app, session, response):
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified and not session.new:
+                self._delete(app, session.sid)
+                response.delete_cookie(self.get_cookie_name(app), domain=self.get_cookie_domain(app),
+                                       path=self.get_cookie_path(app))
+            return
+
+        now = datetime.utcnow()
+        lifetime = app.permanent_session_lifetime
+        try:
+            if session.new:
+                self._insert(app, session, now, now + lifetime)
+            elif session.modified and session.user_changed():
+                self._rotate(app, session, now, now + lifetime)
+            else:
+                updated, deleted = session.changes() if session.modified else ({}, [])
+                touch = session.expires_at - now < lifetime - timedelta(seconds=TOUCH_INTERVAL)
+                if not updated and not deleted and not touch:
+                    return
+                self._merge(app, session.sid, updated, deleted, now, now + lifetime)
+                if not touch:
+                    return
+        except Exception as e:
+            logger.error(f"保存session失败: {str(e)}")
+            return
+
+        # 只有新建或续期时才下发cookie
+        response.set_cookie(
+            self.get_cookie_name(app),
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=self.get_cookie_domain(app),
+            path=self.get_cookie_path(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    # ---------- 数据库操作 ----------
+
+    def _insert(self, app, session, now, expires_at):
+        from models import WebSession
+
+        with self._engine(app).begin() as conn:
+            conn.execute(insert(WebSession).values(
+                sid=session.sid, data=serializer.dumps(dict(session)),
+                created_at=now, updated_at=now, expires_at=expires_at))
+            if random.random() < CLEANUP_PROBABILITY:
+                result = conn.execute(delete(WebSession).where(WebSession.expires_at < now))
+                if result.rowcount:
+                    logger.info(f"清理过期session {result.rowcount} 条")
+
+    def _rotate(self, app, session, now, expires_at):
+        """用新的session id保存完整数据，同一事务中删除旧记录"""
+        from models import WebSession
+
+        old_sid, session.sid = session.sid, secrets.token_urlsafe(32)
+        with self._engine(app).begin() as conn:
+            conn.execute(delete(WebSession).where(WebSession.sid == old_sid))
+            conn.execute(insert(WebSession).values(
+                sid=session.sid, data=serializer.dumps(dict(session)),
+                created_at=now, updated_at=now, expires_at=expires_at))
+
+    def _merge(self, app, sid, updated, deleted, now, expires_at):
+        """在行锁内把变化的key合并到最新数据上；只续期时不改data"""
+        from models import WebSession
+
+        with self._engine(app).begin() as conn:
+            values = {'updated_at': now, 'expires_at': expires_at}
+            if updated or deleted:
+                row = conn.execute(
+                    select(WebSession.data).where(WebSession.sid == sid).with_for_update()).first()
+                data = serializer.loads(row.data) if row else {}
+                data.update(updated)
+                for key in deleted:
+                    data.pop(key, None)
+                values['data'] = serializer.dumps(data)
+                if row is None:
+                    # 记录已被清理（例如刚好过期），重新创建
+                    conn.execute(insert(WebSession).values(sid=sid, created_at=now, **values))
+                    return
+            conn.execute(update(WebSession).where(WebSession.sid == sid).values(**values))
+
+    def _delete(self, app, sid):
+        from models import WebSession
+
+        try:
+            with self._engine(app).begin() as conn:
+                conn.execute(delete(WebSession).where(WebSession.sid == sid))
+        except Exception as e:
+            logger.warning(f"删除session失败: {str(e)}")
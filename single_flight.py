@@ -0,0 +1,256 @@
+"""进行中请求合并（single-flight）- 相同输入的并发分析只调用一次上游API
+
+第一个到达的请求（leader）在 inflight_locks 表中插入以输入哈希为主键的锁记录，
+调用上游并把结果写入结果缓存；其余请求（follower）插入失败后等待锁释放，
+再从结果缓存读取leader的结果。
+- 同一进程内的follower通过threading.Event立即被唤醒
+- 其他进程（gunicorn的其他worker、独立worker）按轮询间隔检查锁记录
+- 锁带租约到期时间（SINGLE_FLIGHT_LEASE），leader所在进程的心跳线程每 1/3 租约续期一次；
+  follower一直等到锁被释放，租约过期（leader所在进程崩溃，不再续期）时由follower接手成为leader，
+  不会因为等待时间短于leader的执行时间而重复调用上游
+- 异步任务中的follower用 Lease.wait_async() 在事件循环中等待，不占用数据库线程
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = int(os.environ.get('SINGLE_FLIGHT_LEASE', 60))
+HEARTBEAT_INTERVAL = max(LEASE_SECONDS / 3, 1)
+# 兜底：leader进程存活但长时间没有结束时，follower最多等待的秒数
+WAIT_TIMEOUT = int(os.environ.get('SINGLE_FLIGHT_WAIT_TIMEOUT', 1800))
+POLL_INTERVAL = 0.5
+
+_local_lock = threading.Lock()
+_local_events = {}
+# 本进程持有的锁：key -> (engine, owner)，由心跳线程续期
+_held = {}
+_heartbeat_pid = None
+
+
+class Lease:
+    """锁租约：is_leader为True时持有锁，处理结束后必须调用release()
+
+    waiting为True时相同输入的请求仍在进行，调用方用 wait() / wait_async() 等待；
+    等待期间leader的租约过期时本请求接手，is_leader变为True。
+    """
+
+    def __init__(self, db_session, key, is_leader, event=None, polling=False, deadline=None):
+        self.db_session = db_session
+        self.key = key
+        self.is_leader = is_leader
+        self.waiting = deadline is not None
+        self.deadline = deadline
+        self._event = event
+        # 本线程代表本进程轮询数据库（锁由其他进程持有），本进程的其他follower等本线程的事件
+        self._polling = polling
+        self._released = not is_leader
+
+    def poll(self):
+        """检查一次，返回是否仍需等待"""
+        if not self.waiting:
+            return False
+        done = self._poll_lock() if self._polling else self._event.is_set()
+        if not done and time.time() >= self.deadline:
+            logger.warning(f"等待相同输入的分析结果超时 {self.key[:12]}")
+            done = True
+        if done:
+            self.waiting = False
+            if self._polling and not self.is_leader:
+                _wake_local(self.key, self._event)
+        return self.waiting
+
+    def _poll_lock(self):
+        """锁已释放或本请求已接手时返回True"""
+        try:
+            expires_at = _lock_expiry(self.db_session, self.key)
+            if expires_at is None:
+                return True
+            if expires_at >= datetime.utcnow():
+                return False
+            logger.warning(f"相同输入的分析租约已过期（leader未续期），接手执行 {self.key[:12]}")
+            if _try_insert(self.db_session, self.key):
+                self.is_leader = True
+                self._released = False
+                return True
+            return False
+        except Exception as e:
+            self.db_session.rollback()
+            logger.warning(f"检查进行中请求锁失败 {self.key[:12]}: {str(e)}")
+            return True
+
+    def wait(self):
+        """阻塞等待，返回self"""
+        while self.waiting:
+            if self._polling:
+                time.sleep(POLL_INTERVAL)
+            else:
+                self._event.wait(POLL_INTERVAL)
+            self.poll()
+        return self
+
+    async def wait_async(self, run_sync):
+        """在事件循环中等待，只有查询数据库时才通过run_sync(func)占用数据库线程，返回self"""
+        import asyncio
+
+        while self.waiting:
+            await asyncio.sleep(POLL_INTERVAL)
+            if self._polling:
+                await run_sync(self.poll)
+            else:
+                self.poll()
+        return self
+
+    def release(self):
+        """释放锁并唤醒本进程内等待的follower（放弃等待时也要调用）"""
+        if self.waiting:
+            self.waiting = False
+            if self._polling:
+                _wake_local(self.key, self._event)
+        if self._released:
+            return
+        self._released = True
+        from models import InflightLock
+
+        with _local_lock:
+            _held.pop(self.key, None)
+        try:
+            self.db_session.execute(delete(InflightLock).where(InflightLock.lock_key == self.key))
+            self.db_session.commit()
+        except Exception as e:
+            # 释放失败时锁会在租约到期后被清理
+            self.db_session.rollback()
+            logger.warning(f"释放进行中请求锁失败 {self.key[:12]}: {str(e)}")
+        finally:
+            _wake_local(self.key, self._event)
+
+
+def _wake_local(key, event):
+    with _local_lock:
+        if _local_events.get(key) is event:
+            del _local_events[key]
+    event.set()
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _try_insert(db_session, key, retry_expired=True):
+    from models import InflightLock
+
+    now = datetime.utcnow()
+    owner = _owner()
+    try:
+        db_session.execute(insert(InflightLock).values(
+            lock_key=key, owner=owner, acquired_at=now,
+            expires_at=now + timedelta(seconds=LEASE_SECONDS)))
+        db_session.commit()
+    except IntegrityError:
+        db_session.rollback()
+        # 清理leader崩溃后遗留的过期锁，然后重新竞争一次
+        expired = db_session.execute(delete(InflightLock).where(
+            InflightLock.lock_key == key, InflightLock.expires_at < now))
+        db_session.commit()
+        if expired.rowcount and retry_expired:
+            return _try_insert(db_session, key, retry_expired=False)
+        return False
+    with _local_lock:
+        _held[key] = (db_session.get_bind(), owner)
+    _ensure_heartbeat()
+    return True
+
+
+def _lock_expiry(db_session, key):
+    """锁的租约到期时间，锁不存在时返回None"""
+    from models import InflightLock
+
+    expires_at = db_session.execute(
+        select(InflightLock.expires_at).where(InflightLock.lock_key == key)).scalar()
+    db_session.commit()  # 结束只读事务，下次查询能看到其他进程的提交
+    return expires_at
+
+
+# ---------- 心跳 ----------
+
+def renew_leases():
+    """为本进程持有的锁续期，返回续期的条数"""
+    from models import InflightLock
+
+    with _local_lock:
+        held = list(_held.items())
+    renewed = 0
+    expires_at = datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+    for engine in {engine for _, (engine, _) in held}:
+        keys = [key for key, (held_engine, _) in held if held_engine is engine]
+        owners = {owner for _, (held_engine, owner) in held if held_engine is engine}
+        try:
+            with engine.begin() as conn:
+                result = conn.execute(
+                    update(InflightLock)
+                    .where(InflightLock.lock_key.in_(keys), InflightLock.owner.in_(owners))
+                    .values(expires_at=expires_at))
+            renewed += result.rowcount
+        except Exception as e:
+            logger.warning(f"进行中请求锁续期失败: {str(e)}")
+    return renewed
+
+
+def _ensure_heartbeat():
+    """启动本进程的续期线程（fork之后需要重新创建）"""
+    global _heartbeat_pid
+    with _local_lock:
+        if _heartbeat_pid == os.getpid():
+            return
+        _heartbeat_pid = os.getpid()
+    threading.Thread(target=_heartbeat_loop, name='single-flight-heartbeat', daemon=True).start()
+
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        if _held:
+            renew_leases()
+
+
+def acquire(db_session, key, wait_timeout=WAIT_TIMEOUT, wait=True):
+    """获取key的执行权
+
+    返回 Lease：
+    - is_leader=True: 本请求负责调用上游，结束后调用 lease.release()
+    - is_leader=False: 已有相同请求执行完毕（或等待超时），调用方应先读取结果缓存
+    wait=False: 不等待，lease.waiting为True时由调用方 wait_async() 等待，结束后同样调用release()
+    """
+    with _local_lock:
+        event = _local_events.get(key)
+        if event is None:
+            event = threading.Event()
+            _local_events[key] = event
+            local_leader = True
+        else:
+            local_leader = False
+
+    deadline = time.time() + wait_timeout
+    if not local_leader:
+        logger.info(f"相同输入的分析正在本进程进行，等待其结果 {key[:12]}")
+        lease = Lease(db_session, key, False, event, deadline=deadline)
+    else:
+        try:
+            if _try_insert(db_session, key):
+                return Lease(db_session, key, True, event)
+        except Exception as e:
+            db_session.rollback()
+            logger.warning(f"获取进行中请求锁失败 {key[:12]}: {str(e)}")
+            _wake_local(key, event)
+            return Lease(db_session, key, False)
+        # 其他进程持有锁：本线程作为本进程的代表轮询等待，其余线程等本线程的事件
+        logger.info(f"相同输入的分析正在其他进程进行，等待其结果 {key[:12]}")
+        lease = Lease(db_session, key, False, event, polling=True, deadline=deadline)
+    return lease.wait() if wait else lease
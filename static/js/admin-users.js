@@ -1,13 +1,35 @@
 /* 管理中心用户管理功能 */
 
 let currentUsersData = [];
+let currentUsersPage = 1;
 
-// 加载用户数据
-async function loadUsersData() {
+// 当前的搜索和筛选条件（由服务端分页查询）
+function getUserQueryParams() {
+    const searchInput = document.getElementById('user-search') || document.getElementById('userSearch');
+    const roleSelect = document.getElementById('user-role-filter');
+    const statusSelect = document.getElementById('userStatusFilter');
+
+    const params = new URLSearchParams();
+    if (searchInput && searchInput.value.trim()) {
+        params.set('q', searchInput.value.trim());
+    }
+    if (roleSelect && roleSelect.value) {
+        params.set('role', roleSelect.value);
+    }
+    if (statusSelect && statusSelect.value) {
+        params.set('status', statusSelect.value);
+    }
+    return params;
+}
+
+// 加载用户数据（一页）
+async function loadUsersData(page = currentUsersPage) {
     console.log('用户管理页面功能已初始化');
 
     try {
-        const response = await fetch('/admin/api/users', {
+        const params = getUserQueryParams();
+        params.set('page', page);
+        const response = await fetch(`/admin/api/users?${params.toString()}`, {
             method: 'GET',
             headers: {
                 'X-Requested-With': 'XMLHttpRequest'
@@ -22,8 +44,10 @@ async function loadUsersData() {
 
         if (data.success) {
             currentUsersData = data.users;
+            currentUsersPage = data.pagination ? data.pagination.page : 1;
             updateUserStats(data.stats);
             renderUsersTable(data.users);
+            renderUsersPagination(data.pagination);
         } else {
             showToast(data.message || '加载用户数据失败', 'error');
         }
@@ -56,6 +80,39 @@ function updateUserStats(stats) {
     document.getElementById('recent-users').textContent = stats.recent;
 }
 
+// 渲染分页
+function renderUsersPagination(pagination) {
+    const container = document.getElementById('usersTableContainer');
+    if (!container) {
+        return;
+    }
+    let pager = document.getElementById('usersPagination');
+    if (!pager) {
+        pager = document.createElement('div');
+        pager.id = 'usersPagination';
+        pager.className = 'users-pagination d-flex justify-content-between align-items-center mt-3';
+        container.insertAdjacentElement('afterend', pager);
+    }
+    if (!pagination || pagination.pages <= 1) {
+        pager.innerHTML = pagination ? `<span class="text-muted">共 ${pagination.total} 位用户</span>` : '';
+        return;
+    }
+
+    pager.innerHTML = `
+        <span class="text-muted">第 ${pagination.page} / ${pagination.pages} 页，共 ${pagination.total} 位用户</span>
+        <div>
+            <button class="btn btn-outline-secondary btn-sm me-2" ${pagination.page <= 1 ? 'disabled' : ''}
+                    onclick="loadUsersData(${pagination.page - 1})">
+                <i class="fas fa-chevron-left me-1"></i>上一页
+            </button>
+            <button class="btn btn-outline-secondary btn-sm" ${pagination.has_more ? '' : 'disabled'}
+                    onclick="loadUsersData(${pagination.page + 1})">
+                下一页<i class="fas fa-chevron-right ms-1"></i>
+            </button>
+        </div>
+    `;
+}
+
 // 渲染用户卡片列表
 function renderUsersTable(users) {
     const container = document.getElementById('usersTableContainer');
@@ -158,26 +215,9 @@ function renderUsersTable(users) {
     container.innerHTML = cardsHTML;
 }
 
-// 过滤用户
+// 过滤用户（服务端筛选，从第一页开始）
 function filterUsers() {
-    const searchTerm = document.getElementById('userSearch').value.toLowerCase();
-    const statusFilter = document.getElementById('userStatusFilter').value;
-
-    let filteredUsers = currentUsersData.filter(user => {
-        const matchesSearch = user.name.toLowerCase().includes(searchTerm) || 
-                             user.phone.includes(searchTerm);
-
-        let matchesStatus = true;
-        if (statusFilter === 'active') {
-            matchesStatus = user.active;
-        } else if (statusFilter === 'inactive') {
-            matchesStatus = !user.active;
-        }
-
-        return matchesSearch && matchesStatus;
-    });
-
-    renderUsersTable(filteredUsers);
+    loadUsersData(1);
 }
 
 // 添加用户表单提交
@@ -198,10 +238,38 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 });
 
+// 获取符合当前筛选条件的全部用户（逐页请求）
+async function fetchAllUsers() {
+    const params = getUserQueryParams();
+    params.set('per_page', 200);
+    const users = [];
+    for (let page = 1; ; page++) {
+        params.set('page', page);
+        const response = await fetch(`/admin/api/users?${params.toString()}`, {
+            headers: { 'X-Requested-With': 'XMLHttpRequest' }
+        });
+        const data = await response.json();
+        if (!data.success) {
+            throw new Error(data.message || '获取用户数据失败');
+        }
+        users.push(...data.users);
+        if (!data.pagination || !data.pagination.has_more) {
+            return users;
+        }
+    }
+}
+
 // 导出用户数据功能
-function exportUsers() {
-    // 获取当前显示的用户数据
-    const users = currentUsersData || [];
+async function exportUsers() {
+    // 导出符合当前筛选条件的所有用户（不只是当前页）
+    let users;
+    try {
+        users = await fetchAllUsers();
+    } catch (error) {
+        console.error('导出用户数据失败:', error);
+        showToast('导出失败，请稍后重试', 'error');
+        return;
+    }
 
     if (users.length === 0) {
         showToast('暂无用户数据可导出', 'error');
@@ -354,42 +422,9 @@ function refreshUsers() {
 // 确保refreshUsers函数全局可访问
 window.refreshUsers = refreshUsers;
 
-// 搜索用户函数
+// 搜索用户函数（服务端搜索，从第一页开始）
 function searchUsers() {
-    console.log('搜索用户被调用');
-    const searchInput = document.getElementById('user-search') || document.getElementById('userSearch');
-    const roleSelect = document.getElementById('user-role-filter') || document.getElementById('userStatusFilter');
-
-    const searchTerm = searchInput ? searchInput.value.toLowerCase() : '';
-    const roleFilter = roleSelect ? roleSelect.value : '';
-
-    console.log('搜索条件:', { searchTerm, roleFilter });
-
-    if (!currentUsersData || currentUsersData.length === 0) {
-        console.log('没有用户数据可搜索');
-        return;
-    }
-
-    let filteredUsers = currentUsersData.filter(user => {
-        const matchesSearch = (user.name && user.name.toLowerCase().includes(searchTerm)) || 
-                             (user.phone && user.phone.includes(searchTerm));
-
-        let matchesRole = true;
-        if (roleFilter === 'admin') {
-            matchesRole = user.is_admin;
-        } else if (roleFilter === 'user') {
-            matchesRole = !user.is_admin;
-        } else if (roleFilter === 'active') {
-            matchesRole = user.active;
-        } else if (roleFilter === 'inactive') {
-            matchesRole = !user.active;
-        }
-
-        return matchesSearch && matchesRole;
-    });
-
-    console.log('筛选后的用户:', filteredUsers);
-    renderUsersTable(filteredUsers);
+    loadUsersData(1);
 }
 
 // 确保所有函数全局可访问
@@ -0,0 +1,176 @@
+"""结构化日志 - JSON格式输出、按模块设置级别、载荷日志采样与脱敏
+
+- 格式: LOG_FORMAT=json（默认）时每条日志一行JSON：time / level / logger / message / trace_id，
+  以及通过 extra= 传入的字段；LOG_FORMAT=text 为本地开发用的可读格式
+- 级别: LOG_LEVEL 为根级别（默认INFO），LOG_LEVELS='app=DEBUG,openai_service=WARNING' 按模块覆盖；
+  httpx / httpcore / openai / urllib3 默认WARNING，不再输出每个请求的连接调试日志
+- 载荷: 表单、session、AI结果等大对象用 log_payload() 记录，只有logger开启DEBUG、
+  或当前请求/任务被采样（LOG_PAYLOAD_SAMPLE_RATE，默认0）时才记录；
+  序列化推迟到日志真正输出时，按 REDACT_KEYS 脱敏并截断到 LOG_PAYLOAD_MAX_CHARS 个字符
+- 脱敏: 输出的消息中手机号只保留前3位和后4位
+- 跟踪: 每个web请求和后台任务调用 start_trace()，同一次分析的日志带相同的trace_id
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import uuid
+from collections.abc import Mapping
+from datetime import datetime, timezone
+
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', 0))
+PAYLOAD_MAX_CHARS = int(os.environ.get('LOG_PAYLOAD_MAX_CHARS', 4000))
+
+# 第三方库默认只输出警告，LOG_LEVELS可以覆盖
+DEFAULT_MODULE_LEVELS = {
+    'httpx': 'WARNING',
+    'httpcore': 'WARNING',
+    'openai': 'WARNING',
+    'urllib3': 'WARNING',
+}
+
+# 载荷中这些键的值替换为 REDACTED（不区分大小写；含password/secret/api_key的键也会脱敏）
+REDACT_KEYS = {'password', 'password_hash', 'api_key', 'authorization', 'cookie', 'session', 'token', '_id',
+               'access_token', 'refresh_token', 'csrf_token', '_csrf_token', 'secret_key'}
+REDACT_SUBSTRINGS = ('password', 'secret', 'api_key')
+REDACTED = '***'
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s'
+
+_PHONE_PATTERN = re.compile(r'(?<!\d)(1[3-9]\d)\d{4}(\d{4})(?!\d)')
+
+# LogRecord自带的属性，其余属性来自extra=，作为JSON字段输出
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'trace_id'}
+
+_trace = contextvars.ContextVar('log_trace', default=None)
+
+
+def parse_levels(value):
+    """'app=DEBUG,httpx=WARNING' -> {'app': 'DEBUG', 'httpx': 'WARNING'}"""
+    levels = {}
+    for item in (value or '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def start_trace(trace_id=None, sampled=None):
+    """开始一次请求或后台任务的跟踪，返回trace_id；sampled为None时按LOG_PAYLOAD_SAMPLE_RATE随机采样"""
+    trace_id = str(trace_id or uuid.uuid4().hex[:16])
+    if sampled is None:
+        sampled = PAYLOAD_SAMPLE_RATE > 0 and random.random() < PAYLOAD_SAMPLE_RATE
+    _trace.set((trace_id, sampled))
+    return trace_id
+
+
+def current_trace_id():
+    trace = _trace.get()
+    return trace[0] if trace else None
+
+
+def trace_sampled():
+    trace = _trace.get()
+    return bool(trace and trace[1])
+
+
+def redact(value, depth=0):
+    """复制一份载荷，敏感键的值替换为 REDACTED"""
+    if depth > 20:
+        return '…'
+    if isinstance(value, Mapping):
+        redacted = {}
+        for key, item in value.items():
+            name = str(key).lower()
+            if name in REDACT_KEYS or any(part in name for part in REDACT_SUBSTRINGS):
+                redacted[key] = REDACTED
+            else:
+                redacted[key] = redact(item, depth + 1)
+        return redacted
+    if isinstance(value, (list, tuple, set)):
+        return [redact(item, depth + 1) for item in value]
+    return value
+
+
+def redact_text(text):
+    return _PHONE_PATTERN.sub(r'\1****\2', text)
+
+
+class Payload:
+    """延迟序列化的日志参数：只有日志真正输出时才脱敏、序列化和截断"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        try:
+            text = json.dumps(redact(self.value), ensure_ascii=False, default=str)
+        except Exception as e:
+            text = f'<无法序列化: {e}>'
+        if len(text) > PAYLOAD_MAX_CHARS:
+            text = f'{text[:PAYLOAD_MAX_CHARS]}…（共{len(text)}字符）'
+        return text
+
+
+def log_payload(logger, label, value):
+    """记录一个大对象：采样的请求以INFO级别记录，否则只在DEBUG级别记录；未开启时没有任何序列化开销"""
+    level = logging.INFO if trace_sampled() else logging.DEBUG
+    if logger.isEnabledFor(level):
+        logger.log(level, '%s: %s', label, Payload(value))
+
+
+class ContextFilter(logging.Filter):
+    """补充trace_id，并对输出的消息脱敏（只对通过级别过滤、确实要输出的日志执行）"""
+
+    def filter(self, record):
+        record.trace_id = current_trace_id() or '-'
+        # 只格式化一次（Payload参数在这里序列化），格式化器直接使用结果
+        record.msg, record.args = redact_text(record.getMessage()), None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id and trace_id != '-':
+            entry['trace_id'] = trace_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = redact(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure(app=None):
+    """配置根logger的输出格式和各模块的级别（已有其他handler时只设置级别）
+
+    app: Flask应用；DEBUG模式下Flask会把app.logger设为DEBUG，这里改为与LOG_LEVEL一致（LOG_LEVELS可覆盖）
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    handler.addFilter(ContextFilter())
+    logging.basicConfig(handlers=[handler])
+
+    logging.getLogger().setLevel(LOG_LEVEL)
+    levels = dict(DEFAULT_MODULE_LEVELS, **parse_levels(os.environ.get('LOG_LEVELS')))
+    if app is not None:
+        levels.setdefault(app.logger.name, LOG_LEVEL)
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
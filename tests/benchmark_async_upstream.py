@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+异步上游调用压测 - 对比同步线程池和AsyncOpenAI两种方式在大量并发上游请求下的吞吐
+- 在本进程内启动 tests/stub_upstream.py 的桩服务（固定延迟），不访问真实API
+- 同步方式受线程数限制（与JOB_WORKERS相同的含义），异步方式只受连接池上限限制
+
+用法:
+    python tests/benchmark_async_upstream.py --requests 300 --delay 1 --threads 4
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_upstream import StubUpstream
+
+
+def _request_kwargs():
+    return dict(model='stub', messages=[{"role": "user", "content": "benchmark"}],
+                response_format={"type": "json_object"}, temperature=0.7, max_tokens=100)
+
+
+def run_sync_benchmark(angela_ai, total, threads, stream):
+    callback = (lambda event: None) if stream else None
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(angela_ai._call_openai_with_retry, stream_callback=callback,
+                                   **_request_kwargs()) for _ in range(total)]
+        ok = sum(1 for f in futures if f.result().choices[0].message.content)
+    return ok, time.time() - start
+
+
+async def run_async_benchmark(angela_ai, total, stream):
+    callback = (lambda event: None) if stream else None
+    start = time.time()
+    responses = await asyncio.gather(*[
+        angela_ai._acall_openai_with_retry(stream_callback=callback, **_request_kwargs())
+        for _ in range(total)])
+    ok = sum(1 for r in responses if r.choices[0].message.content)
+    return ok, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="异步上游调用压测")
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--delay', type=float, default=1.0)
+    parser.add_argument('--threads', type=int, default=4, help='同步方式的线程数（对应JOB_WORKERS）')
+    parser.add_argument('--stream', action='store_true', help='使用流式输出')
+    args = parser.parse_args()
+
+    # 桩服务运行在独立的事件循环线程中
+    stub = StubUpstream(delay=args.delay)
+    stub_loop = asyncio.new_event_loop()
+    threading.Thread(target=stub_loop.run_forever, daemon=True).start()
+    port = asyncio.run_coroutine_threadsafe(stub.start(), stub_loop).result()
+
+    os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{port}/v1'
+    os.environ.setdefault('OPENAI_API_KEY', 'stub')
+    from openai_service import angela_ai, upstream_pool
+
+    print(f"📋 桩服务延迟 {args.delay}秒，请求数 {args.requests}，流式: {args.stream}")
+
+    sync_total = min(args.requests, args.threads * 5)
+    ok, elapsed = run_sync_benchmark(angela_ai, sync_total, args.threads, args.stream)
+    print(f"📋 同步线程池 ({args.threads}线程): {ok}/{sync_total} 成功, 耗时 {elapsed:.2f}秒, "
+          f"吞吐 {ok / elapsed:.1f} 请求/秒")
+
+    stub.max_in_flight = 0
+    ok, elapsed = asyncio.run(run_async_benchmark(angela_ai, args.requests, args.stream))
+    print(f"📋 AsyncOpenAI: {ok}/{args.requests} 成功, 耗时 {elapsed:.2f}秒, "
+          f"吞吐 {ok / elapsed:.1f} 请求/秒, 上游最大并发 {stub.max_in_flight}")
+
+    stats = upstream_pool.stats()
+    print(f"📋 连接池: 请求 {stats['requests']}, 新建连接 {stats['connections_opened']}, "
+          f"复用率 {stats['connection_reuse_ratio']}, HTTP/2: {stats['http2_enabled']}")
+
+    status = "✅" if ok == args.requests else "❌"
+    print(f"{status} 异步方式完成 {ok}/{args.requests}")
+    return 0 if ok == args.requests else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
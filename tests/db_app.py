@@ -0,0 +1,29 @@
+"""测试用的应用和数据库 - 在临时SQLite数据库上导入app
+
+models通过 `from app import db` 引用应用，必须先导入app；导入时会在临时数据库上建表。
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_DB_DIR = tempfile.mkdtemp(prefix='incomestream-tests-')
+os.environ['DATABASE_URL'] = f'sqlite:///{_DB_DIR}/test.db'
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+
+import app as app_module  # noqa: E402
+
+app = app_module.app
+db = app_module.db
+
+
+def create_user(phone, ai_quota=10, used_quota=0):
+    """创建测试用户，返回id"""
+    from models import User
+
+    user = User(phone=phone, name=f'测试{phone[-4:]}', ai_quota=ai_quota, used_quota=used_quota)
+    user.set_password('test-password')
+    db.session.add(user)
+    db.session.commit()
+    return user.id
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+本地上游API桩服务 - 模拟 /v1/chat/completions，用于异步上游调用的并发压测
+- 每个请求固定延迟后返回一个结构完整的分析结果JSON
+- stream=true 时按SSE分块返回，与OpenAI流式接口格式一致
+- 只依赖标准库asyncio，可以同时挂起数千个请求
+
+用法:
+    python tests/stub_upstream.py --port 8765 --delay 2
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python main.py
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+STUB_RESULT = {
+    "overview": {
+        "situation": "桩服务返回的局面分析",
+        "core_insight": "桩服务返回的核心洞察",
+        "gaps": ["缺少交付方"],
+        "suggested_roles_to_hunt": [],
+    },
+    "pipelines": [
+        {
+            "id": f"pipeline_{i}",
+            "name": f"收入管道{i}",
+            "income_mechanism": {"type": "分成", "trigger": "成交", "settlement": "月结"},
+            "parties_structure": [{
+                "party": "设计者", "role_type": "统筹方", "resources": ["渠道"],
+                "role_value": "撮合", "make_them_happy": "分成",
+            }],
+            "mvp": "最小验证", "weak_link": "薄弱环节", "revenue_trigger": "首单成交",
+            "anti_bypass_strategies": ["签约"], "risks_and_planB": ["备选方案"],
+            "first_step": "第一步",
+            "labor_load_estimate": {"hours_per_week": "2", "level": "低", "alternative": "外包"},
+        }
+        for i in range(1, 4)
+    ],
+}
+
+
+class StubUpstream:
+    """固定延迟的OpenAI兼容接口"""
+
+    def __init__(self, delay=1.0, chunk_size=64, status=200):
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.status = status  # 非200时返回错误响应，模拟上游故障
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._handle, host, port, backlog=4096)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            # 支持keep-alive：同一连接上循环处理请求
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                await self._respond(writer, json.loads(body or b'{}'))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, payload):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            content = json.dumps(STUB_RESULT, ensure_ascii=False)
+            created = int(time.time())
+            # 桩服务按字符数报告token数
+            prompt_tokens = sum(len(message.get('content') or '') for message in payload.get('messages', []))
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content),
+                     "total_tokens": prompt_tokens + len(content)}
+            if self.status != 200:
+                body = json.dumps({"error": {"message": "stub upstream failure", "type": "server_error"}}).encode()
+                writer.write(f'HTTP/1.1 {self.status} Error\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            elif payload.get('stream'):
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                             b'Transfer-Encoding: chunked\r\n\r\n')
+                for start in range(0, len(content), self.chunk_size):
+                    chunk = {"id": "stub", "object": "chat.completion.chunk", "created": created,
+                             "model": payload.get('model', 'stub'),
+                             "choices": [{"index": 0, "finish_reason": None,
+                                          "delta": {"content": content[start:start + self.chunk_size]}}]}
+                    self._write_chunk(writer, f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+                if (payload.get('stream_options') or {}).get('include_usage'):
+                    chunk = {"id": "stub", "object": "chat.completion.chunk", "created": created,
+                             "model": payload.get('model', 'stub'), "choices": [], "usage": usage}
+                    self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n")
+                self._write_chunk(writer, "data: [DONE]\n\n")
+                writer.write(b'0\r\n\r\n')
+            else:
+                body = json.dumps({
+                    "id": "stub", "object": "chat.completion", "created": created,
+                    "model": payload.get('model', 'stub'),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": usage,
+                }, ensure_ascii=False).encode('utf-8')
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def _write_chunk(writer, text):
+        data = text.encode('utf-8')
+        writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+
+async def _serve(port, delay, status):
+    stub = StubUpstream(delay=delay, status=status)
+    port = await stub.start(port=port)
+    print(f"📋 桩服务已启动: http://127.0.0.1:{port}/v1 (延迟 {delay}秒)")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地上游API桩服务")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=2.0)
+    parser.add_argument('--status', type=int, default=200, help='非200时模拟上游故障')
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args.port, args.delay, args.status))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""分析任务状态机测试 - 状态切换表的约束，以及在SQLite上的条件切换、活动任务查询和遗留任务修复"""
+
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis_jobs
+
+
+def test_terminal_states_cannot_transition():
+    for state in analysis_jobs.TERMINAL_STATES:
+        assert analysis_jobs.TRANSITIONS[state] == ()
+
+
+def test_all_targets_are_known_states():
+    for targets in analysis_jobs.TRANSITIONS.values():
+        assert set(targets) <= set(analysis_jobs.TRANSITIONS)
+    assert set(analysis_jobs.ACTIVE_STATES) | set(analysis_jobs.TERMINAL_STATES) == set(analysis_jobs.TRANSITIONS)
+
+
+def test_unknown_state_is_rejected():
+    with pytest.raises(analysis_jobs.InvalidTransition):
+        analysis_jobs.transition(None, 'job', 'cancelled')
+
+
+# ---------- 数据库 ----------
+
+@pytest.fixture
+def ctx(monkeypatch):
+    from db_app import app, app_module, create_user
+
+    # 入队后不在本进程执行
+    monkeypatch.setattr(app_module.job_queue, 'mode', 'external')
+    with app.app_context():
+        yield app_module, create_user(f'139{uuid.uuid4().int % 10 ** 8:08d}')
+
+
+def _job(db, job_id):
+    from models import AnalysisJob
+
+    db.session.expire_all()
+    return db.session.get(AnalysisJob, job_id)
+
+
+def test_transition_is_conditional_on_source_state(ctx):
+    app_module, user_id = ctx
+    db = app_module.db
+    job = analysis_jobs.create(db.session, user_id, project_name='p')
+    db.session.commit()
+
+    assert analysis_jobs.transition(db.session, job.id, 'completed') is False
+    assert analysis_jobs.transition(db.session, job.id, 'running') is True
+    assert analysis_jobs.transition(db.session, job.id, 'completed', result_id='r1') is True
+    assert analysis_jobs.transition(db.session, job.id, 'failed') is False
+    job = _job(db, job.id)
+    assert (job.state, job.result_id, job.version) == ('completed', 'r1', 2)
+
+
+def test_active_for_user_and_job_events(ctx):
+    app_module, user_id = ctx
+    db = app_module.db
+    job = analysis_jobs.create(db.session, user_id, project_name='p')
+    db.session.commit()
+    assert analysis_jobs.active_for_user(db.session, user_id).id == job.id
+
+    analysis_jobs.handle_job_event(db.session, job.id, 'running', {'started_at': datetime.utcnow()})
+    analysis_jobs.handle_job_event(db.session, job.id, 'progress', {'progress': 40, 'stage': '调用上游'})
+    assert (_job(db, job.id).state, _job(db, job.id).progress) == ('running', 40)
+
+    analysis_jobs.handle_job_event(db.session, job.id, 'completed',
+                                   {'result_ref': 'r2', 'finished_at': datetime.utcnow()})
+    # 迟到的进度不会覆盖已结束的任务
+    analysis_jobs.handle_job_event(db.session, job.id, 'progress', {'progress': 50})
+    job = _job(db, job.id)
+    assert (job.state, job.progress, job.result_id) == ('completed', 100, 'r2')
+    assert analysis_jobs.active_for_user(db.session, user_id) is None
+
+
+def test_create_is_committed_together_with_enqueue(ctx):
+    app_module, user_id = ctx
+    db = app_module.db
+    job = analysis_jobs.create(db.session, user_id, project_name='rolled back')
+    job_id = job.id
+    db.session.rollback()
+    assert _job(db, job_id) is None
+
+    job = analysis_jobs.create(db.session, user_id, project_name='p')
+    app_module.job_queue.enqueue('test-job', {}, user_id=user_id, job_id=job.id)
+    db.session.rollback()
+    assert _job(db, job.id).state == 'queued'
+    assert app_module.job_queue.get(job.id).status == 'queued'
+
+
+def test_reap_orphans(ctx):
+    from models import BackgroundJob
+
+    app_module, user_id = ctx
+    db = app_module.db
+    old = datetime.utcnow() - timedelta(seconds=analysis_jobs.ORPHAN_GRACE_SECONDS + 5)
+
+    completed = analysis_jobs.create(db.session, user_id)
+    missing = analysis_jobs.create(db.session, user_id)
+    recent = analysis_jobs.create(db.session, user_id)
+    completed.state = missing.state = recent.state = 'running'
+    completed.updated_at = missing.updated_at = old
+    for job in (completed, recent):
+        db.session.add(BackgroundJob(id=job.id, kind='test-job', payload='{}', status='completed',
+                                     result_ref='r3', event_seq=0))
+    db.session.commit()
+
+    reaped = dict(analysis_jobs.reap_orphans(db.session))
+    assert reaped == {completed.id: 'completed', missing.id: 'failed'}
+    assert (_job(db, completed.id).state, _job(db, completed.id).result_id) == ('completed', 'r3')
+    assert _job(db, missing.id).state == 'failed'
+    # 刚有变化的任务留给状态回调处理
+    assert _job(db, recent.id).state == 'running'
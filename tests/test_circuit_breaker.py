@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""熔断器测试 - 打开阈值判断和自适应超时使用的百分位计算"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from circuit_breaker import CircuitBreaker, Permit, percentile
+
+
+def test_percentile_nearest_rank():
+    assert percentile([], 0.95) is None
+    assert percentile([5], 0.95) == 5
+    assert percentile(list(range(1, 101)), 0.95) == 95
+    assert percentile([30, 10, 20], 0.5) == 20
+
+
+def test_trips_only_with_enough_calls():
+    should_trip = CircuitBreaker._should_trip
+    assert not should_trip({'calls': 2, 'failures': 2, 'slow_calls': 0})
+    assert should_trip({'calls': 10, 'failures': 5, 'slow_calls': 0})
+    assert not should_trip({'calls': 10, 'failures': 4, 'slow_calls': 0})
+    assert should_trip({'calls': 10, 'failures': 0, 'slow_calls': 8})
+
+
+def test_probe_does_not_retry():
+    breaker = CircuitBreaker('test')
+    assert breaker.allow_retry(Permit('test', 45))
+    assert not breaker.allow_retry(Permit('test', 45, probe=True))
+
+    permit = Permit('test', 45)
+    permit.record_attempt(False, 1.0, 'APITimeoutError')
+    permit.record_attempt(True, 2.0)
+    assert permit.succeeded
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""后台任务队列测试 - 执行中的心跳，以及被回收后旧执行的结果不会覆盖新执行"""
+
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from db_app import app, db, app_module
+
+KIND = 'test-job'
+
+
+def _enqueue():
+    from models import BackgroundJob
+
+    job = BackgroundJob(id=str(uuid.uuid4()), kind=KIND, payload='{}', status='queued', progress=0,
+                        stage='排队', stage_code='queued', event_seq=0)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+def _job(job_id):
+    from models import BackgroundJob
+
+    db.session.expire_all()
+    return db.session.get(BackgroundJob, job_id)
+
+
+def test_finish_ignored_after_job_was_requeued_and_reclaimed():
+    queue = app_module.job_queue
+    with app.app_context():
+        job_id = _enqueue()
+        first = queue._claim(job_id, KIND)
+        assert first == 1
+
+        # 心跳超时被回收后重新领取（第二次执行）
+        _job(job_id).heartbeat_at = datetime.utcnow() - timedelta(seconds=queue.stale_after + 1)
+        db.session.commit()
+        queue._requeue_stale()
+        assert _job(job_id).status == 'queued'
+        second = queue._claim(job_id, KIND)
+        assert second == 2
+
+        # 第一次执行迟到的结果和进度被忽略
+        assert queue._finish(job_id, 'failed', error='旧执行', kind=KIND, attempt=first) is False
+        queue.report(job_id, progress=90, kind=KIND, attempt=first)
+        job = _job(job_id)
+        assert (job.status, job.progress) == ('running', 0)
+
+        assert queue._finish(job_id, 'completed', result_ref='r', kind=KIND, attempt=second) is True
+        assert queue._finish(job_id, 'failed', error='重复', kind=KIND, attempt=second) is False
+        job = _job(job_id)
+        assert (job.status, job.result_ref) == ('completed', 'r')
+        queue._running.clear()
+
+
+def test_heartbeat_keeps_running_job_alive(monkeypatch):
+    queue = app_module.job_queue
+    with app.app_context():
+        job_id = _enqueue()
+        attempt = queue._claim(job_id, KIND)
+        old = datetime.utcnow() - timedelta(seconds=queue.stale_after - 1)
+        _job(job_id).heartbeat_at = old
+        db.session.commit()
+
+        monkeypatch.setattr(queue, '_heartbeat_at', 0.0)
+        queue._heartbeat()
+        assert _job(job_id).heartbeat_at > old + timedelta(seconds=queue.stale_after - 10)
+
+        queue._requeue_stale()
+        assert _job(job_id).status == 'running'
+        assert queue._finish(job_id, 'completed', kind=KIND, attempt=attempt) is True
+        queue._running.clear()
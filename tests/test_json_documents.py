@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""JSON文档列测试 - 数据库内执行的JSON Patch与可走表达式索引的查找"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, insert, select, text, update
+from sqlalchemy.dialects import postgresql
+
+from json_documents import JSONDocument, PatchError, json_array_contains, json_patch, json_text
+
+metadata = MetaData()
+documents = Table('documents', metadata, Column('id', Integer, primary_key=True), Column('data', JSONDocument))
+
+
+def make_engine():
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX ix_documents_name ON documents (json_extract(data, '$.projectName'))"))
+        conn.execute(insert(documents).values(id=1, data={
+            'projectName': '咖啡店', 'pipelines': [{'id': 'p1', 'income_mechanism': {'type': 'a'}}]}))
+    return engine
+
+
+def apply(engine, operations):
+    document, conditions = json_patch(documents.c.data, operations, engine.dialect.name)
+    with engine.begin() as conn:
+        result = conn.execute(update(documents).where(documents.c.id == 1, *conditions).values(data=document))
+        return result.rowcount, conn.execute(select(documents.c.data)).scalar()
+
+
+def test_patch_applies_batch_and_creates_missing_objects():
+    engine = make_engine()
+    rowcount, data = apply(engine, [
+        {'op': 'test', 'path': '/pipelines/0/id', 'value': 'p1'},
+        {'op': 'replace', 'path': '/pipelines/0/income_mechanism/type', 'value': '分成'},
+        {'op': 'add', 'path': '/overview/core_insight', 'value': '洞察'},
+        {'op': 'add', 'path': '/pipelines/-', 'value': {'id': 'p2'}},
+        {'op': 'remove', 'path': '/projectName'},
+    ])
+    assert rowcount == 1
+    assert data == {'pipelines': [{'id': 'p1', 'income_mechanism': {'type': '分成'}}, {'id': 'p2'}],
+                    'overview': {'core_insight': '洞察'}}
+
+
+def test_failed_test_operation_leaves_document_unchanged():
+    engine = make_engine()
+    rowcount, data = apply(engine, [
+        {'op': 'test', 'path': '/pipelines/0/id', 'value': 'other'},
+        {'op': 'remove', 'path': '/projectName'},
+    ])
+    assert rowcount == 0
+    assert data['projectName'] == '咖啡店'
+
+
+def test_unsupported_operations_are_rejected():
+    for operation in ({'op': 'move', 'from': '/a', 'path': '/b'},
+                      {'op': 'add', 'path': '/pipelines/0', 'value': {}},
+                      {'op': 'replace', 'path': 'overview'}):
+        with pytest.raises(PatchError):
+            json_patch(documents.c.data, [operation], 'sqlite')
+
+
+def test_json_text_lookup_uses_expression_index():
+    engine = make_engine()
+    query = select(documents.c.id).where(json_text(documents.c.data, 'projectName') == '咖啡店')
+    with engine.connect() as conn:
+        assert conn.execute(query).scalars().all() == [1]
+        plan = conn.execute(text('EXPLAIN QUERY PLAN ' + str(query.compile(
+            engine, compile_kwargs={'literal_binds': True})))).all()
+    assert 'ix_documents_name' in plan[0][-1]
+    assert str(json_text(documents.c.data, 'projectName').compile(dialect=postgresql.dialect())) == \
+        "(documents.data ->> 'projectName')"
+
+
+def test_json_array_contains():
+    engine = make_engine()
+    with engine.begin() as conn:
+        conn.execute(insert(documents).values(id=2, data=['居间', '股份']))
+        matched = conn.execute(select(documents.c.id).where(json_array_contains(documents.c.data, '股份'))).scalars().all()
+    assert matched == [2]
+    assert str(json_array_contains(documents.c.data, '居间').compile(dialect=postgresql.dialect())) == \
+        "(documents.data @> jsonb_build_array(%(param_1)s::VARCHAR))"
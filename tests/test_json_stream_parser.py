@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""增量JSON解析器测试 - 验证流式片段按闭合顺序产出且与完整解析结果一致"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_stream_parser import IncrementalJSONParser
+
+SAMPLE = {
+    'overview': {'situation': '设计者作为统筹方，连接"门店"与{供应商}', 'gaps': ['缺少流量', '缺少供应链']},
+    'pipelines': [
+        {'id': 'pipeline_1', 'name': '社区团购管道', 'risks_and_planB': [{'risk': '压价]', 'planB': '换供应商'}]},
+        {'id': 'pipeline_2', 'name': '会员储值管道', 'labor_load_estimate': {'hours_per_week': 2}},
+    ],
+    'version': 2,
+}
+
+
+def feed_in_chunks(text, size):
+    parser = IncrementalJSONParser(split_arrays=('pipelines',))
+    events = []
+    for i in range(0, len(text), size):
+        events.extend(parser.feed(text[i:i + size]))
+    return parser, events
+
+
+def test_sections_and_items_match_full_parse():
+    text = json.dumps(SAMPLE, ensure_ascii=False, indent=2)
+    for size in (1, 7, 64, len(text)):
+        parser, events = feed_in_chunks(text, size)
+        sections = {e['key']: e['value'] for e in events if e['type'] == 'section'}
+        items = [e['value'] for e in events if e['type'] == 'item']
+        assert sections == SAMPLE
+        assert items == SAMPLE['pipelines']
+        assert json.loads(parser.text) == SAMPLE
+
+
+def test_items_emitted_before_array_closes():
+    text = json.dumps(SAMPLE, ensure_ascii=False)
+    cut = text.index('pipeline_2')
+    parser = IncrementalJSONParser(split_arrays=('pipelines',))
+    events = parser.feed(text[:cut])
+    assert [(e['type'], e['key'], e.get('index')) for e in events] == [
+        ('section', 'overview', None),
+        ('item', 'pipelines', 0),
+    ]
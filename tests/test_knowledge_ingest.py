@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""知识库文本提取测试 - 提取、规范化与切分"""
+
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_ingest import UnsupportedFileType, chunk_text, extract_text, normalize
+
+
+def test_normalize_collapses_whitespace_and_blank_lines():
+    assert normalize('租金\u3000\u3000模式\r\n\r\n\r\n\r\n第二段\u200b\x01  \n') == '租金 模式\n\n第二段'
+
+
+def test_chunks_cover_text_and_break_at_sentences():
+    text = '第一段说明。' * 60 + '\n\n' + '第二段，内容较长。' * 80
+    chunks = chunk_text(text, size=200, overlap=20)
+    assert all(text[start:end] == content for start, end, content in chunks)
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(text)
+    for (_, previous_end, previous), (start, _, _) in zip(chunks, chunks[1:]):
+        assert previous.endswith(('。', '\n'))
+        assert previous_end - 20 <= start < previous_end
+
+
+def test_extract_docx_and_gb18030_text(tmp_path):
+    docx = tmp_path / 'guide.docx'
+    with zipfile.ZipFile(docx, 'w') as archive:
+        archive.writestr('word/document.xml',
+                         '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+                         '<w:p><w:r><w:t>居间</w:t></w:r><w:r><w:tab/><w:t>分成</w:t></w:r></w:p>'
+                         '<w:p><w:r><w:t>第二段</w:t></w:r></w:p></w:body></w:document>')
+    assert extract_text(str(docx), 'docx') == '居间\t分成\n\n第二段'
+
+    text_file = tmp_path / 'a.txt'
+    text_file.write_bytes('租金模式'.encode('gb18030'))
+    assert extract_text(str(text_file), 'txt') == '租金模式'
+
+    with pytest.raises(UnsupportedFileType):
+        extract_text(str(text_file), 'xlsx')
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""知识库检索测试 - mmap段文件上的BM25检索"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_retrieval import KnowledgeIndex, _write_manifest, format_context, write_segment
+
+CHUNKS = [
+    (1, 10, '租金模式：把闲置的场地和设备出租，收取固定租金。'),
+    (2, 20, '居间模式：撮合供需双方成交，按成交额收取居间佣金。'),
+    (3, 30, '企业连锁：标准化门店复制，收取加盟费。'),
+]
+
+
+def make_index(tmp_path, live):
+    write_segment(str(tmp_path / 'segment-000001.bin'), CHUNKS[:2])
+    write_segment(str(tmp_path / 'segment-000002.bin'), CHUNKS[2:])
+    _write_manifest(str(tmp_path), {
+        'version': 1, 'next_segment': 3, 'live': live,
+        'segments': [{'file': 'segment-000001.bin', 'items': {'10': 'a', '20': 'a'}},
+                     {'file': 'segment-000002.bin', 'items': {'30': 'a'}}]})
+    return KnowledgeIndex(str(tmp_path))
+
+
+def test_bm25_ranks_matching_chunks_across_segments(tmp_path):
+    index = make_index(tmp_path, {'10': 'a', '20': 'a', '30': 'a'})
+    hits = index.search('想撮合客户成交赚佣金')
+    assert [hit['chunk_id'] for hit in hits] == [2]
+    assert hits[0]['content'] == CHUNKS[1][2]
+    assert [hit['item_id'] for hit in index.search('门店加盟')] == [30]
+    assert index.search('完全无关的词') == []
+
+
+def test_inactive_items_are_skipped_and_manifest_changes_are_picked_up(tmp_path):
+    index = make_index(tmp_path, {'10': 'a', '30': 'a'})
+    assert index.search('居间佣金') == []
+
+    _write_manifest(str(tmp_path), {
+        'version': 2, 'next_segment': 3, 'live': {'10': 'a', '20': 'a', '30': 'a'},
+        'segments': [{'file': 'segment-000001.bin', 'items': {'10': 'a', '20': 'a'}}]})
+    assert [hit['item_id'] for hit in index.search('居间佣金')] == [20]
+    assert index.version == 2
+
+
+def test_format_context_respects_character_budget():
+    results = [{'chunk_id': 1, 'content': '甲' * 30}, {'chunk_id': 2, 'content': '乙' * 30}]
+    text, fingerprint = format_context(results, max_chars=40)
+    assert text == '1. ' + '甲' * 30 + '\n2. ' + '乙' * 10
+    assert fingerprint and format_context([], 40) == ('', '')
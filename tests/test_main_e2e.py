@@ -215,7 +215,13 @@ class AngelaE2ETest:
             # 5. 数据库集成测试
             results['database'] = self.test_database_integration()
             
-            # 6. 真实AI分析和重复保存防护测试（核心修复验证）
+            # 6. 后台任务入队测试
+            results['background_job_analysis'] = self.test_background_job_analysis()
+
+            # 7. 分析进度SSE推送测试
+            results['analysis_progress_stream'] = self.test_analysis_progress_stream()
+
+            # 8. 真实AI分析和重复保存防护测试（核心修复验证）
             self.log("="*50, "INFO")
             self.log("🔧 开始核心修复验证: 真实AI分析和重复保存防护测试", "INFO")
             results['real_ai_analysis_and_duplicate_prevention'] = self.test_real_ai_analysis_and_duplicate_prevention()
@@ -433,6 +439,63 @@ class AngelaE2ETest:
                 self.log("❌ 分析没有成功启动", "ERROR")
             return False
 
+    def test_background_job_analysis(self):
+        """测试后台任务模式：/start_analysis立即返回任务ID，状态接口读取任务状态"""
+        self.log("开始测试后台任务分析接口", "INFO")
+
+        start_time = time.time()
+        response = self.session.post(f"{self.base_url}/start_analysis")
+        elapsed = time.time() - start_time
+
+        if response.status_code != 200:
+            self.log(f"启动分析失败: {response.status_code}", "ERROR")
+            return False
+
+        data = response.json()
+        self.log(f"启动响应: {data.get('status')} job_id={data.get('job_id')} 耗时{elapsed:.2f}秒", "DEBUG")
+
+        # 入队接口不应等待上游AI响应
+        if data.get('status') == 'processing' and data.get('job_id') and elapsed < 5:
+            status_data = self.session.get(f"{self.base_url}/check_analysis_status").json()
+            if status_data.get('job_id') == data.get('job_id'):
+                self.log("✅ 分析任务已入队，状态接口返回同一任务", "SUCCESS")
+                return True
+            self.log(f"❌ 状态接口任务ID不一致: {status_data}", "ERROR")
+            return False
+
+        self.log(f"❌ 启动接口未按后台任务模式返回: {data}", "ERROR")
+        return False
+
+    def test_analysis_progress_stream(self):
+        """测试分析进度SSE推送：返回text/event-stream并推送阶段事件"""
+        self.log("开始测试分析进度SSE推送", "INFO")
+
+        try:
+            response = self.session.get(f"{self.base_url}/analysis_events", stream=True, timeout=60)
+        except requests.RequestException as e:
+            self.log(f"SSE连接失败: {str(e)}", "ERROR")
+            return False
+
+        if response.status_code != 200 or 'text/event-stream' not in response.headers.get('Content-Type', ''):
+            self.log(f"❌ SSE接口响应异常: {response.status_code} {response.headers.get('Content-Type')}", "ERROR")
+            return False
+
+        events = []
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith('event: '):
+                    events.append(line[len('event: '):])
+                    if events[-1] in ('stage', 'done'):
+                        break
+        finally:
+            response.close()
+
+        if 'stage' in events or 'done' in events:
+            self.log(f"✅ 收到进度推送事件: {events}", "SUCCESS")
+            return True
+        self.log(f"❌ 未收到阶段事件: {events}", "ERROR")
+        return False
+
     def add_new_test_case(self, test_name, test_function):
         """添加新的测试用例（扩展接口）"""
         setattr(self, f"test_{test_name}", test_function)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""模型配置缓存测试 - 检查间隔内不查询数据库，版本号变化时重新加载"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model_config_cache
+
+
+class FakeSession:
+    def rollback(self):
+        pass
+
+
+def _cache(monkeypatch, versions):
+    loads = []
+    checks = []
+
+    def current_version(db_session, namespace):
+        checks.append(namespace)
+        return versions[-1]
+
+    def loader(db_session):
+        loads.append(versions[-1])
+        return {'main_analysis': {'model': f'model-v{versions[-1]}'}}
+
+    monkeypatch.setattr(model_config_cache, 'current_version', current_version)
+    return model_config_cache.ConfigCache('model_configs', loader), loads, checks
+
+
+def test_cached_within_check_interval(monkeypatch):
+    cache, loads, checks = _cache(monkeypatch, [1])
+    for _ in range(5):
+        assert cache.get(FakeSession())['main_analysis']['model'] == 'model-v1'
+    assert loads == [1]
+    assert len(checks) == 1
+
+
+def test_reloads_only_when_version_changes(monkeypatch):
+    versions = [1]
+    cache, loads, checks = _cache(monkeypatch, versions)
+    monkeypatch.setattr(model_config_cache, 'CHECK_SECONDS', 0)
+
+    cache.get(FakeSession())
+    cache.get(FakeSession())
+    assert loads == [1]
+
+    versions.append(2)
+    assert cache.get(FakeSession())['main_analysis']['model'] == 'model-v2'
+    assert loads == [1, 2]
+    assert len(checks) == 3
+
+
+def test_invalidate_reloads_immediately(monkeypatch):
+    cache, loads, _ = _cache(monkeypatch, [1])
+    cache.get(FakeSession())
+    cache.invalidate()
+    cache.get(FakeSession())
+    assert loads == [1, 1]
+
+
+def test_keeps_cached_values_when_database_unavailable(monkeypatch):
+    cache, _, _ = _cache(monkeypatch, [1])
+    monkeypatch.setattr(model_config_cache, 'CHECK_SECONDS', 0)
+    cache.get(FakeSession())
+
+    def unavailable(db_session, namespace):
+        raise RuntimeError('database is down')
+
+    monkeypatch.setattr(model_config_cache, 'current_version', unavailable)
+    assert cache.get(FakeSession())['main_analysis']['model'] == 'model-v1'
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""提示词token预算测试 - 计数、按优先级裁剪、max_tokens不超过上下文窗口"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import prompt_budget
+from prompt_budget import PromptAssembler, Section, count_tokens, truncate_to_tokens
+
+MODEL = 'gpt-4o-mini'
+
+
+def test_count_tokens_is_positive_and_monotonic():
+    assert count_tokens('', MODEL) == 0
+    short, long = count_tokens('收入管道', MODEL), count_tokens('收入管道' * 50, MODEL)
+    assert 0 < short < long
+    if not prompt_budget.TIKTOKEN_AVAILABLE:
+        assert count_tokens('中文abc', MODEL) == 3
+
+
+def test_truncate_stays_within_limit():
+    text = '这是一段很长的知识库内容。' * 100
+    truncated = truncate_to_tokens(text, 50, MODEL)
+    assert truncated.endswith(prompt_budget.TRUNCATION_MARK)
+    assert count_tokens(truncated, MODEL) <= 50
+    assert truncate_to_tokens('短文本', 50, MODEL) == '短文本'
+
+
+def build(input_budget, configured_max_tokens=4000, model=MODEL):
+    assembler = PromptAssembler(model, configured_max_tokens, input_budget=input_budget)
+    assembler.add_message('system', [Section('system', '系统提示' * 20, required=True)])
+    assembler.add_message('user', [
+        Section('project', '【项目名称】咖啡店\n', required=True),
+        Section('project_description', '项目背景' * 50, priority=2000),
+        Section('person_1', '人物一' * 50, priority=1000),
+        Section('person_2', '人物二' * 50, priority=999),
+        Section('knowledge', '知识库' * 200, priority=0),
+    ])
+    return assembler.build()
+
+
+def test_within_budget_keeps_everything():
+    messages, budget = build(input_budget=100000)
+    assert budget.trimmed == []
+    assert [message['role'] for message in messages] == ['system', 'user']
+    assert messages[1]['content'].endswith('知识库')
+    assert budget.prompt_tokens == sum(budget.section_tokens.values()) + 3 * 2 + 3
+
+
+def test_lowest_priority_sections_are_trimmed_first():
+    _, full = build(input_budget=100000)
+    budget_limit = full.prompt_tokens - full.section_tokens['knowledge'] - 20
+    messages, budget = build(input_budget=budget_limit)
+    assert budget.prompt_tokens <= budget_limit
+    assert budget.trimmed == ['knowledge', 'person_2']
+    assert budget.section_tokens['knowledge'] == 0
+    assert budget.section_tokens['person_1'] == full.section_tokens['person_1']
+    assert '系统提示' * 20 == messages[0]['content']
+
+
+def test_max_tokens_clamped_to_context_window():
+    _, budget = build(input_budget=100000, configured_max_tokens=10000, model='gpt-4')
+    assert budget.max_tokens == min(10000, 8192 - budget.prompt_tokens)
+    assert prompt_budget.context_window('gpt-4o-2024-08-06') == 128000
+    assert prompt_budget.context_window('unknown-model') == prompt_budget.DEFAULT_CONTEXT_WINDOW
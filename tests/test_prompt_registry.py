@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""提示词注册表测试 - 缓存内容、文件变化时重新加载、指纹随内容变化"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_registry import PromptRegistry
+
+
+def write_prompt(path, content, mtime):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.utime(path, (mtime, mtime))
+
+
+def test_cached_until_file_changes(tmp_path):
+    path = tmp_path / 'system_prompt.txt'
+    write_prompt(path, '你是Angela v1\n', 1000)
+    registry = PromptRegistry(str(tmp_path), {'system': 'system_prompt.txt'})
+
+    first = registry.get('system')
+    assert first.content == '你是Angela v1'
+    assert registry.get('system') is first
+
+    write_prompt(path, '你是Angela v2', 2000)
+    second = registry.get('system')
+    assert second.content == '你是Angela v2'
+    assert second.fingerprint != first.fingerprint
+
+
+def test_missing_file_keeps_last_good_version(tmp_path):
+    path = tmp_path / 'assistant_prompt.txt'
+    write_prompt(path, '输出JSON', 1000)
+    registry = PromptRegistry(str(tmp_path), {'assistant': 'assistant_prompt.txt'})
+    loaded = registry.get('assistant')
+
+    os.remove(path)
+    assert registry.get('assistant') is loaded
+    assert registry.reload()['assistant']['is_fallback'] is True
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""额度账本测试 - 额度显示字段，以及预留/确认/退回在数据库上的条件更新"""
+
+import os
+import sys
+import threading
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis_jobs
+import quota_ledger
+
+
+def test_usage_values():
+    assert quota_ledger.usage_values(10, 3) == {
+        'ai_quota': 10, 'used_quota': 3, 'remaining_quota': 7,
+        'quota_display': '3/10', 'quota_usage_percentage': 30.0,
+    }
+
+
+def test_usage_values_edge_cases():
+    assert quota_ledger.usage_values(0, 0)['quota_usage_percentage'] == 100
+    exhausted = quota_ledger.usage_values(5, 7)
+    assert exhausted['remaining_quota'] == 0
+    assert exhausted['quota_usage_percentage'] == 100
+
+
+def test_reservation_states_are_distinct():
+    assert len({quota_ledger.RESERVED, quota_ledger.CHARGED, quota_ledger.RELEASED}) == 3
+
+
+# ---------- 数据库 ----------
+
+@pytest.fixture
+def ctx():
+    from db_app import app, create_user
+
+    with app.app_context():
+        yield app, create_user(f'137{uuid.uuid4().int % 10 ** 8:08d}', ai_quota=3)
+
+
+def _used_quota(db, user_id):
+    from models import User
+
+    db.session.expire_all()
+    return db.session.get(User, user_id).used_quota
+
+
+def _reserved_job(db, user_id):
+    assert quota_ledger.reserve(db.session, user_id) is not None
+    job = analysis_jobs.create(db.session, user_id, quota_state=quota_ledger.RESERVED)
+    db.session.commit()
+    return job.id
+
+
+def test_concurrent_reserve_stops_at_quota(ctx):
+    from db_app import db
+
+    app, user_id = ctx
+    barrier = threading.Barrier(8)
+    results = []
+
+    def reserve():
+        with app.app_context():
+            barrier.wait()
+            results.append(quota_ledger.reserve(db.session, user_id))
+            db.session.commit()
+
+    threads = [threading.Thread(target=reserve) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(result for result in results if result is not None) == [(1, 3), (2, 3), (3, 3)]
+    assert _used_quota(db, user_id) == 3
+
+
+def test_charge_after_release_is_rejected(ctx):
+    from db_app import db
+
+    _, user_id = ctx
+    job_id = _reserved_job(db, user_id)
+    assert quota_ledger.release(db.session, job_id) is True
+    assert quota_ledger.charge(db.session, job_id) is False
+    db.session.commit()
+    assert _used_quota(db, user_id) == 0
+
+
+def test_release_is_idempotent(ctx):
+    from db_app import db
+
+    _, user_id = ctx
+    charged = _reserved_job(db, user_id)
+    released = _reserved_job(db, user_id)
+    assert quota_ledger.charge(db.session, charged) is True
+    db.session.commit()
+
+    assert quota_ledger.release(db.session, released) is True
+    assert quota_ledger.release(db.session, released) is False
+    assert quota_ledger.release(db.session, charged) is False
+    assert _used_quota(db, user_id) == 1
+
+
+def test_release_stale_returns_reservations_of_finished_jobs(ctx):
+    from db_app import db
+    from models import AnalysisJob
+
+    _, user_id = ctx
+    finished = _reserved_job(db, user_id)
+    running = _reserved_job(db, user_id)
+    db.session.get(AnalysisJob, finished).state = 'failed'
+    db.session.commit()
+
+    assert quota_ledger.release_stale(db.session) == 1
+    assert quota_ledger.release_stale(db.session) == 0
+    db.session.expire_all()
+    assert db.session.get(AnalysisJob, finished).quota_state == quota_ledger.RELEASED
+    assert db.session.get(AnalysisJob, running).quota_state == quota_ledger.RESERVED
+    assert _used_quota(db, user_id) == 1
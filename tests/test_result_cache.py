@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""结果缓存键测试 - 规范化后相同的输入得到相同的键，提示词或模型配置变化时键随之变化"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from result_cache import compute_cache_key
+
+FORM = {
+    'projectName': '社区生活服务集合店',
+    'projectDescription': '在居民区开设综合性生活服务店',
+    'keyPersons': [{'name': '张经理', 'role': 'store_owner', 'resources': ['客户'], 'notes': ''}],
+    'externalResources': [],
+}
+MODEL = {'model': 'gpt-4o', 'temperature': 0.7, 'max_tokens': 2500, 'timeout': 45}
+
+
+def test_whitespace_key_order_and_empty_fields_are_normalized():
+    variant = {
+        'externalResources': [],
+        'keyPersons': [{'role': 'store_owner', 'name': ' 张经理 ', 'resources': ['客户 ']}],
+        'projectDescription': '在居民区开设综合性生活服务店\n',
+        'projectName': '  社区生活服务集合店',
+    }
+    assert compute_cache_key(FORM, 'sys', 'asst', MODEL) == compute_cache_key(variant, 'sys', 'asst', MODEL)
+
+
+def test_prompt_and_model_changes_change_the_key():
+    base = compute_cache_key(FORM, 'sys', 'asst', MODEL)
+    assert compute_cache_key(FORM, 'sys v2', 'asst', MODEL) != base
+    assert compute_cache_key(FORM, 'sys', 'asst v2', MODEL) != base
+    assert compute_cache_key(FORM, 'sys', 'asst', dict(MODEL, temperature=0.3)) != base
+    # 超时时间不影响生成内容，不参与缓存键
+    assert compute_cache_key(FORM, 'sys', 'asst', dict(MODEL, timeout=90)) == base
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""结果摘要测试 - 历史列表用到的字段从分析结果中计算"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from result_summary import summarize
+
+
+def test_summary_collects_names_and_distinct_income_types():
+    summary = summarize({'pipelines': [
+        {'name': '撮合平台', 'income_mechanism': {'type': '居间'}},
+        {'name': '联营门店', 'income_mechanism': {'type': '股份+居间'}},
+        {'name': '无机制'},
+    ]})
+    assert summary == {'pipeline_count': 3, 'pipeline_names': ['撮合平台', '联营门店', '无机制'],
+                       'income_types': ['居间', '股份']}
+
+
+def test_summary_of_missing_or_malformed_result():
+    empty = {'pipeline_count': 0, 'pipeline_names': [], 'income_types': []}
+    assert summarize(None) == empty
+    assert summarize({'pipelines': '解析失败'}) == empty
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""全文搜索测试 - 中文分词元规则"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import _query_tokens, tokenize
+
+
+def test_cjk_runs_index_unigrams_and_bigrams():
+    assert tokenize('咖啡店 Coffee2go，居间') == ['咖', '啡', '店', '咖啡', '啡店', 'coffee2go', '居', '间', '居间']
+
+
+def test_query_uses_bigrams_and_deduplicates():
+    assert _query_tokens('咖啡店 咖啡') == ['咖啡', '啡店']
+    assert _query_tokens('店') == ['店']
+    assert _query_tokens('，。!') == []
+
+
+def test_every_query_token_is_an_indexed_token():
+    text = '社区团购团长分成计划'
+    indexed = set(tokenize(text))
+    for query in ('团购', '团长分成', '计划', '社'):
+        assert set(_query_tokens(query)) <= indexed
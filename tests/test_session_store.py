@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""服务端session测试 - 只有内容真正变化的key才需要写回，以及在SQLite上的读写、过期、合并和更换id"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import DatabaseSessionInterface, ServerSession
+
+
+def test_unchanged_session_has_no_changes_even_if_marked_modified():
+    session = ServerSession({'analysis_status': 'processing', '_user_id': '1'}, sid='x')
+    session['analysis_status'] = 'processing'
+    session.modified = True
+    assert session.changes() == ({}, [])
+
+
+def test_changed_and_deleted_keys():
+    session = ServerSession({'analysis_status': 'processing', 'analysis_error': 'x', '_flashes': []}, sid='x')
+    session['analysis_status'] = 'completed'
+    session['analysis_result_id'] = 7
+    session.pop('analysis_error')
+    session['_flashes'].append(('info', '完成'))  # 原地修改同样能检测到
+    updated, deleted = session.changes()
+    assert updated == {'analysis_status': 'completed', 'analysis_result_id': 7, '_flashes': [('info', '完成')]}
+    assert deleted == ['analysis_error']
+
+
+def test_user_change_is_detected():
+    session = ServerSession({'_user_id': '1', 'x': 1}, sid='x')
+    session['x'] = 2
+    assert not session.user_changed()
+    session['_user_id'] = '2'
+    assert session.user_changed()
+    session.pop('_user_id')
+    assert session.user_changed()
+    assert ServerSession(new=True).user_changed() is False
+
+
+# ---------- 数据库 ----------
+
+@pytest.fixture
+def store():
+    from db_app import app
+
+    interface = DatabaseSessionInterface()
+    with app.app_context():
+        yield app, interface
+
+
+def _open(app, interface, cookie=None):
+    headers = {'Cookie': f'{app.config["SESSION_COOKIE_NAME"]}={cookie}'} if cookie else {}
+    with app.test_request_context(headers=headers):
+        from flask import request
+
+        return interface.open_session(app, request)
+
+
+def _save(app, interface, session):
+    """保存session，返回下发的cookie值（没有下发时为None）"""
+    response = app.response_class()
+    interface.save_session(app, session, response)
+    for header in response.headers.getlist('Set-Cookie'):
+        name, _, rest = header.partition('=')
+        if name == app.config['SESSION_COOKIE_NAME']:
+            return rest.split(';')[0]
+    return None
+
+
+def _row(sid):
+    from db_app import db
+    from models import WebSession
+
+    db.session.expire_all()
+    return db.session.get(WebSession, sid)
+
+
+def test_round_trip(store):
+    app, interface = store
+    session = _open(app, interface)
+    assert session.new
+    session['analysis_status'] = 'processing'
+    cookie = _save(app, interface, session)
+    assert cookie and session.sid in cookie
+
+    session = _open(app, interface, cookie)
+    assert not session.new
+    assert dict(session) == {'analysis_status': 'processing'}
+    # 内容没变、不需要续期时不写数据库、不下发cookie
+    session.modified = True
+    assert _save(app, interface, session) is None
+    assert _open(app, interface, cookie.replace(cookie[-4:], 'abcd')).new
+
+
+def test_expired_session_is_not_loaded(store):
+    from db_app import db
+
+    app, interface = store
+    session = _open(app, interface)
+    session['x'] = 1
+    cookie = _save(app, interface, session)
+    _row(session.sid).expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+
+    reopened = _open(app, interface, cookie)
+    assert reopened.new and dict(reopened) == {}
+    assert reopened.sid != session.sid
+
+
+def test_concurrent_requests_merge_their_own_keys(store):
+    app, interface = store
+    session = _open(app, interface)
+    session.update({'a': 1, 'b': 1, 'c': 1})
+    cookie = _save(app, interface, session)
+
+    first, second = _open(app, interface, cookie), _open(app, interface, cookie)
+    first['a'] = 2
+    second['b'] = 2
+    second.pop('c')
+    _save(app, interface, first)
+    _save(app, interface, second)
+    assert dict(_open(app, interface, cookie)) == {'a': 2, 'b': 2}
+
+
+def test_login_and_logout_issue_a_new_session_id(store):
+    app, interface = store
+    session = _open(app, interface)
+    session['csrf'] = 't'
+    anonymous = _save(app, interface, session)
+    anonymous_sid = session.sid
+
+    # 登录：旧id失效，数据带到新id
+    session = _open(app, interface, anonymous)
+    session['_user_id'] = '7'
+    logged_in = _save(app, interface, session)
+    assert logged_in and session.sid != anonymous_sid
+    assert _row(anonymous_sid) is None
+    assert _open(app, interface, anonymous).new
+    assert dict(_open(app, interface, logged_in)) == {'csrf': 't', '_user_id': '7'}
+
+    # 退出：再换一次id
+    session = _open(app, interface, logged_in)
+    logged_in_sid = session.sid
+    session.pop('_user_id')
+    logged_out = _save(app, interface, session)
+    assert logged_out and session.sid != logged_in_sid
+    assert _row(logged_in_sid) is None
+    assert dict(_open(app, interface, logged_out)) == {'csrf': 't'}
+
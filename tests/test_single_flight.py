@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""进行中请求合并测试 - leader/follower交接、租约过期接手和心跳续期（临时SQLite数据库）"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import single_flight
+
+
+@pytest.fixture
+def ctx(monkeypatch):
+    from db_app import app, db
+
+    monkeypatch.setattr(single_flight, 'POLL_INTERVAL', 0.05)
+    with app.app_context():
+        yield app, db, uuid.uuid4().hex
+
+
+def _lock(db, key):
+    from models import InflightLock
+
+    db.session.expire_all()
+    lock = db.session.get(InflightLock, key)
+    db.session.commit()
+    return lock
+
+
+def _insert_foreign_lock(db, key, expires_in):
+    """其他进程持有的锁"""
+    from models import InflightLock
+
+    now = datetime.utcnow()
+    db.session.add(InflightLock(lock_key=key, owner='other-host:1:1', acquired_at=now,
+                                expires_at=now + timedelta(seconds=expires_in)))
+    db.session.commit()
+
+
+def _in_thread(app, func):
+    """在新线程（各自的应用上下文和session）中执行，返回结果列表（结束后才有值）"""
+    results = []
+
+    def run():
+        with app.app_context():
+            results.append(func())
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, results
+
+
+def test_local_follower_waits_for_leader_release(ctx):
+    from db_app import db
+
+    app, _, key = ctx
+    leader = single_flight.acquire(db.session, key)
+    assert leader.is_leader and _lock(db, key) is not None
+
+    thread, results = _in_thread(app, lambda: single_flight.acquire(db.session, key))
+    time.sleep(0.3)
+    assert thread.is_alive()
+
+    leader.release()
+    thread.join(2)
+    assert not thread.is_alive()
+    assert results[0].is_leader is False
+    assert _lock(db, key) is None
+
+
+def test_follower_of_other_process_waits_while_lease_is_renewed(ctx):
+    from db_app import db
+    from models import InflightLock
+
+    app, _, key = ctx
+    _insert_foreign_lock(db, key, expires_in=0.5)
+    thread, results = _in_thread(app, lambda: single_flight.acquire(db.session, key))
+
+    # leader的心跳续期：超过最初的到期时间仍在等待
+    time.sleep(0.3)
+    db.session.get(InflightLock, key).expires_at = datetime.utcnow() + timedelta(seconds=60)
+    db.session.commit()
+    time.sleep(0.5)
+    assert thread.is_alive()
+
+    db.session.delete(db.session.get(InflightLock, key))
+    db.session.commit()
+    thread.join(2)
+    assert results[0].is_leader is False
+
+
+def test_follower_takes_over_expired_lease(ctx):
+    from db_app import db
+
+    app, _, key = ctx
+    _insert_foreign_lock(db, key, expires_in=0.3)
+    lease = single_flight.acquire(db.session, key, wait=False)
+    assert lease.waiting and not lease.is_leader
+
+    started_at = time.time()
+    lease.wait()
+    assert lease.is_leader
+    assert time.time() - started_at < 2
+    assert _lock(db, key).owner == single_flight._owner()
+    lease.release()
+    assert _lock(db, key) is None
+
+
+def test_wait_async_polls_without_blocking_the_loop(ctx):
+    from db_app import db
+
+    app, _, key = ctx
+    _insert_foreign_lock(db, key, expires_in=0.3)
+    lease = single_flight.acquire(db.session, key, wait=False)
+    calls = []
+
+    async def run_sync(func, *args):
+        calls.append(func)
+        return func(*args)
+
+    async def run():
+        ticks = 0
+        waiter = asyncio.ensure_future(lease.wait_async(run_sync))
+        while not waiter.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return ticks
+
+    assert asyncio.run(run()) > 10
+    assert lease.is_leader and calls
+    lease.release()
+
+
+def test_heartbeat_renews_held_leases(ctx, monkeypatch):
+    from db_app import db
+
+    app, _, key = ctx
+    monkeypatch.setattr(single_flight, 'LEASE_SECONDS', 1)
+    lease = single_flight.acquire(db.session, key)
+    expires_at = _lock(db, key).expires_at
+
+    monkeypatch.setattr(single_flight, 'LEASE_SECONDS', 120)
+    assert single_flight.renew_leases() >= 1
+    assert _lock(db, key).expires_at > expires_at + timedelta(seconds=60)
+
+    lease.release()
+    assert key not in single_flight._held
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""结构化日志测试 - 载荷延迟序列化、采样、脱敏和JSON输出"""
+
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import structured_logging
+from structured_logging import ContextFilter, JsonFormatter, Payload, log_payload
+
+
+class Exploding:
+    """序列化时报错，用于确认未开启时没有序列化"""
+
+    def items(self):
+        raise AssertionError('payload should not be serialized')
+
+
+def _logger(level):
+    logger = logging.getLogger(f'test_structured_logging.{level}')
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.handlers[:] = []
+    return logger
+
+
+def test_payload_skipped_when_not_enabled():
+    structured_logging.start_trace(sampled=False)
+    log_payload(_logger(logging.INFO), 'form', Exploding())
+
+
+def test_sampled_trace_logs_payload_at_info():
+    logger = _logger(logging.INFO)
+    records = []
+    logger.addHandler(type('Collect', (logging.Handler,), {'emit': lambda self, record: records.append(record)})())
+
+    structured_logging.start_trace('trace-1', sampled=True)
+    log_payload(logger, 'form', {'projectName': '项目', 'password': 'secret'})
+    assert records[0].levelno == logging.INFO
+    message = records[0].getMessage()
+    assert '项目' in message and 'secret' not in message
+
+
+def test_redact_nested_keys():
+    redacted = structured_logging.redact({'user': {'api_key': 'sk-1', 'name': 'a'}, 'items': [{'Password': 'x'}],
+                                          'max_tokens': 10})
+    assert redacted == {'user': {'api_key': '***', 'name': 'a'}, 'items': [{'Password': '***'}], 'max_tokens': 10}
+
+
+def test_payload_truncated(monkeypatch):
+    monkeypatch.setattr(structured_logging, 'PAYLOAD_MAX_CHARS', 10)
+    assert str(Payload({'text': 'x' * 100})).startswith('{"text": "')
+    assert '共' in str(Payload({'text': 'x' * 100}))
+
+
+def test_json_formatter_with_trace_and_phone_redaction():
+    structured_logging.start_trace('abc', sampled=False)
+    record = logging.LogRecord('app', logging.INFO, __file__, 1, '用户 %s 登录', ('18302196515',), None)
+    record.job_id = 'job-1'
+    ContextFilter().filter(record)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == '用户 183****6515 登录'
+    assert entry['trace_id'] == 'abc'
+    assert entry['job_id'] == 'job-1'
+    assert entry['level'] == 'INFO' and entry['logger'] == 'app'
+
+
+def test_parse_levels():
+    assert structured_logging.parse_levels('app=debug, httpx=WARNING,,bad') == {'app': 'DEBUG', 'httpx': 'WARNING'}
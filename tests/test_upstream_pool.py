@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""上游连接池测试 - 连续调用、流式调用和重试复用同一个连接（使用本地桩服务）"""
+
+import asyncio
+import os
+import sys
+import threading
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_upstream import StubUpstream
+import circuit_breaker
+from upstream_pool import UpstreamPool
+
+
+def start_stub():
+    stub = StubUpstream(delay=0.01)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    port = asyncio.run_coroutine_threadsafe(stub.start(), loop).result()
+    return f'http://127.0.0.1:{port}/v1'
+
+
+def test_calls_and_retries_reuse_one_connection():
+    import openai_service
+
+    pool = UpstreamPool(start_stub(), api_key='stub')
+    original = openai_service.upstream_pool
+    openai_service.upstream_pool = pool
+    try:
+        kwargs = dict(model='stub', messages=[{'role': 'user', 'content': 'x'}])
+        ai = openai_service.AngelaAI()
+        ai._call_openai_with_retry(**kwargs)
+        events = []
+        response = ai._call_openai_with_retry(stream_callback=events.append, **kwargs)
+        assert response.choices[0].message.content
+        assert [event['key'] for event in events][0] == 'overview'
+        pool.client().chat.completions.create(**kwargs, timeout=pool.attempt_timeout(5, 1))
+    finally:
+        openai_service.upstream_pool = original
+
+    stats = pool.stats()
+    assert stats['requests'] == 3
+    assert stats['retries'] == 1
+    assert stats['connections_opened'] == 1
+    assert stats['pool']['idle'] == 1
+    pool.close()
+
+
+def test_retry_timeout_replaces_the_per_call_timeout():
+    pool = UpstreamPool('http://127.0.0.1:1/v1', api_key='stub')
+    assert pool.attempt_timeout(20, 0) == 20
+    assert pool.attempt_timeout(None, 0) is None
+    # 重试按调用方的（自适应）超时放宽，不使用固定的下限
+    assert pool.attempt_timeout(20, 1) == 25.0
+    assert pool.attempt_timeout(160, 2) == circuit_breaker.ADAPTIVE_TIMEOUT_MAX
+    # 调用方的超时已超过上限时不缩短
+    assert pool.attempt_timeout(300, 1) == 300
+    retry = pool.attempt_timeout(httpx.Timeout(40.0, connect=10.0), 1)
+    assert (retry.read, retry.connect) == (50.0, 10.0)
+    assert pool.stats()['retries'] == 4
+
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""对冲请求测试 - 两个本地桩服务分别作为主上游和备用上游"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_upstream import StubUpstream
+from circuit_breaker import Permit
+from upstream_pool import UpstreamPool
+from upstream_providers import Provider
+
+KWARGS = dict(model='stub', messages=[{'role': 'user', 'content': 'x'}])
+
+
+def start_stubs(*delays):
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    stubs, providers = [], []
+    for index, delay in enumerate(delays):
+        stub = StubUpstream(delay=delay)
+        port = asyncio.run_coroutine_threadsafe(stub.start(), loop).result()
+        name = 'primary' if index == 0 else f'alternate{index}'
+        pool = UpstreamPool(f'http://127.0.0.1:{port}/v1', api_key='stub')
+        stubs.append(stub)
+        providers.append(Provider(name, pool.base_url, pool))
+    return stubs, providers
+
+
+def make_route(providers, hedge_delay):
+    permit = Permit('primary', 30)
+    return SimpleNamespace(primary=providers[0], permit=permit,
+                           alternate=providers[1], hedge_delay=hedge_delay)
+
+
+def make_app():
+    """带数据库的最小Flask应用：流式片段回调与后台任务的report一样需要应用上下文和db.session"""
+    from flask import Flask
+    from flask_sqlalchemy import SQLAlchemy
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db = SQLAlchemy(app)
+    return app, db
+
+
+def test_slow_primary_is_hedged_and_alternate_wins():
+    import openai_service
+    from sqlalchemy import text
+
+    stubs, providers = start_stubs(3.0, 0.01)
+    route = make_route(providers, 0.2)
+    app, db = make_app()
+    events = []
+
+    def report_section(event):
+        # 在对冲线程中执行；没有应用上下文时会抛出异常，片段被丢弃
+        db.session.execute(text('SELECT 1'))
+        events.append(event)
+
+    started_at = time.time()
+    with app.app_context():
+        response = openai_service.AngelaAI()._call_openai_with_retry(
+            stream_callback=report_section, permit=route.permit, route=route, **KWARGS)
+
+    assert time.time() - started_at < 2
+    assert response.choices[0].message.content
+    # 只有胜出的一路推送片段
+    assert [event['key'] for event in events].count('overview') == 1
+    assert [sample[3] for sample in route.permit.samples] == ['alternate1']
+    assert stubs[1].requests == 1
+
+
+def test_fast_primary_does_not_fire_hedge():
+    import openai_service
+
+    stubs, providers = start_stubs(0.01, 0.01)
+    route = make_route(providers, 1.0)
+    openai_service.AngelaAI()._call_openai_with_retry(permit=route.permit, route=route, **KWARGS)
+
+    assert stubs[0].requests == 1
+    assert stubs[1].requests == 0
+    assert route.permit.samples[0][0] is True
+
+
+def test_async_hedge_cancels_loser(monkeypatch):
+    import openai_service
+
+    stubs, providers = start_stubs(3.0, 0.01)
+    route = make_route(providers, 0.2)
+    records = []
+    monkeypatch.setattr(openai_service.usage_ledger.ledger, 'record', lambda **values: records.append(values))
+
+    async def run():
+        started_at = time.time()
+        response = await openai_service.AngelaAI()._acall_openai_with_retry(
+            permit=route.permit, route=route, **KWARGS)
+        return response, time.time() - started_at
+
+    response, elapsed = asyncio.run(run())
+    assert elapsed < 2
+    assert response.choices[0].message.content
+    assert [sample[3] for sample in route.permit.samples] == ['alternate1']
+    # 落败的一路也记入用量账本
+    outcomes = {values['provider']: (values['success'], values['hedge_lost']) for values in records}
+    assert outcomes == {'alternate1': (True, False), 'primary': (False, True)}
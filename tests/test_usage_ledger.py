@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""用量账本测试 - token估算、费用计算和按日汇总"""
+
+import os
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import usage_ledger
+
+
+def entry(**values):
+    base = {'created_at': datetime(2026, 1, 1, 20, 0), 'user_id': 1, 'model': 'gpt-4o', 'provider': 'default',
+            'prompt_tokens': None, 'completion_tokens': None, 'latency_ms': 100, 'retries': 0,
+            'cache_hit': False, 'success': True, 'hedge_lost': False, 'messages': None, 'completion_text': None}
+    base.update(values)
+    return base
+
+
+def test_prices_match_longest_prefix():
+    assert usage_ledger.price_for('gpt-4o-mini-2024-07-18') == usage_ledger.MODEL_PRICES['gpt-4o-mini']
+    assert usage_ledger.price_for('gpt-4o-2024-08-06') == usage_ledger.MODEL_PRICES['gpt-4o']
+    assert usage_ledger.price_for('unknown') == (0.0, 0.0)
+    assert usage_ledger.cost_of('gpt-4o', 1_000_000, 1_000_000) == 12.5
+
+
+def test_finalize_uses_reported_usage_or_estimates():
+    usage = SimpleNamespace(prompt_tokens=100, completion_tokens=20)
+    row = usage_ledger.finalize(entry(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens,
+                                      messages=[{'content': 'x'}]))
+    assert (row['prompt_tokens'], row['completion_tokens'], row['tokens_estimated']) == (100, 20, False)
+    assert 'messages' not in row
+
+    row = usage_ledger.finalize(entry(messages=[{'role': 'user', 'content': '咖啡店'}], completion_text='{"a": 1}'))
+    assert row['tokens_estimated'] is True
+    assert row['prompt_tokens'] > 0 and row['completion_tokens'] > 0
+    assert row['cost'] > 0
+
+
+def test_cache_hits_and_failures_cost_nothing():
+    for values in ({'cache_hit': True}, {'success': False, 'messages': [{'content': '很长的提示词'}]}):
+        row = usage_ledger.finalize(entry(**values))
+        assert (row['prompt_tokens'], row['completion_tokens'], row['cost']) == (0, 0, 0)
+
+
+def test_rollup_groups_by_local_day_user_model_provider():
+    rows = [usage_ledger.finalize(entry(prompt_tokens=10, completion_tokens=5)),
+            usage_ledger.finalize(entry(prompt_tokens=10, completion_tokens=5, retries=2)),
+            usage_ledger.finalize(entry(cache_hit=True, provider='')),
+            usage_ledger.finalize(entry(user_id=None, success=False))]
+    totals = {(row['user_id'], row['provider']): row for row in usage_ledger.rollup(rows)}
+    assert len(totals) == 3
+    main = totals[(1, 'default')]
+    # 20:00 UTC 是北京时间次日
+    assert main['day'].isoformat() == '2026-01-02'
+    # 每次重试是单独的一行，汇总时按行计数
+    assert (main['calls'], main['retries'], main['prompt_tokens'], main['completion_tokens']) == (2, 1, 20, 10)
+    assert totals[(1, '')]['cache_hits'] == 1
+    assert totals[(0, 'default')]['failures'] == 1
+
+
+def test_hedge_losers_are_billed_for_the_prompt_budget():
+    row = usage_ledger.finalize(entry(success=False, hedge_lost=True, budget_prompt_tokens=1200,
+                                      messages=[{'content': '不会重新计数'}]))
+    assert (row['prompt_tokens'], row['completion_tokens'], row['tokens_estimated']) == (1200, 0, True)
+    assert 'budget_prompt_tokens' not in row
+    assert usage_ledger.rollup([row])[0]['failures'] == 0
+
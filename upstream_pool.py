@@ -0,0 +1,219 @@
+"""上游API连接池 - 每个进程复用同一组长连接，重试不再新建客户端
+
+- 同步客户端按进程懒加载：preload_app时master进程不会创建连接，fork出的worker各自持有连接池
+- 异步客户端按事件循环懒加载（httpx.AsyncClient不能跨事件循环使用）
+- 重试时只放宽单次请求的timeout参数（attempt_timeout），共用同一个连接池，已建立的TLS连接可以直接复用
+- 空闲连接超过 keepalive_expiry 后关闭，取出空闲连接前httpcore会检查连接是否已被对端断开
+- 安装h2后启用HTTP/2（由TLS的ALPN协商，上游不支持时自动使用HTTP/1.1）
+- 通过httpcore的trace事件统计新建连接和TLS握手次数，stats()提供连接池使用情况
+"""
+import importlib.util
+import logging
+import os
+import threading
+import time
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+logger = logging.getLogger(__name__)
+
+POOL_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_MAX_CONNECTIONS', 10))
+POOL_MAX_KEEPALIVE = int(os.environ.get('UPSTREAM_MAX_KEEPALIVE', 5))
+POOL_KEEPALIVE_EXPIRY = float(os.environ.get('UPSTREAM_KEEPALIVE_EXPIRY', 30))
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('AI_ASYNC_MAX_CONNECTIONS', 200))
+
+# auto: 安装了h2时启用；true: 强制启用（未安装h2时记录警告并回退）；false: 只用HTTP/1.1
+_HTTP2_SETTING = os.environ.get('UPSTREAM_HTTP2', 'auto').lower()
+H2_AVAILABLE = importlib.util.find_spec('h2') is not None
+if _HTTP2_SETTING == 'true' and not H2_AVAILABLE:
+    logger.warning("UPSTREAM_HTTP2=true 但未安装h2（pip install 'httpx[http2]'），使用HTTP/1.1")
+HTTP2_ENABLED = H2_AVAILABLE and _HTTP2_SETTING != 'false'
+
+DEFAULT_TIMEOUT = httpx.Timeout(120.0, connect=30.0)  # 连接30秒，读取120秒
+# 重试时单次请求的超时放宽为调用方超时的倍数（不超过熔断器自适应超时的上限）
+RETRY_TIMEOUT_MULTIPLIER = float(os.environ.get('UPSTREAM_RETRY_TIMEOUT_MULTIPLIER', 1.25))
+
+
+class UpstreamPool:
+    """进程内共享的上游客户端和连接统计"""
+
+    def __init__(self, base_url, api_key=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self._lock = threading.Lock()
+        self._pid = None
+        self._client = None
+        self._http_client = None
+        self._async_client = None
+        self._async_http_client = None
+        self._async_loop = None
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self._counters = {
+            'requests': 0,
+            'responses': 0,
+            'errors': 0,
+            'retries': 0,
+            'connections_opened': 0,
+            'tls_handshakes': 0,
+        }
+        self._latency_total = 0.0
+        self._started_at = time.time()
+
+    def _incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _api_key(self):
+        return self.api_key or os.environ.get("OPENAI_API_KEY")
+
+    # ---------- httpx事件钩子：统计请求和新建连接 ----------
+
+    def _trace(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            self._incr('connections_opened')
+        elif event_name == 'connection.start_tls.complete':
+            self._incr('tls_handshakes')
+
+    async def _atrace(self, event_name, info):
+        self._trace(event_name, info)
+
+    def _on_request(self, request):
+        request.extensions['trace'] = self._trace
+        request.extensions['pool_started_at'] = time.time()
+        self._incr('requests')
+
+    async def _aon_request(self, request):
+        self._on_request(request)
+        request.extensions['trace'] = self._atrace
+
+    def _on_response(self, response):
+        started_at = response.request.extensions.get('pool_started_at')
+        with self._lock:
+            self._counters['responses'] += 1
+            if response.status_code >= 500:
+                self._counters['errors'] += 1
+            if started_at:
+                self._latency_total += time.time() - started_at
+
+    async def _aon_response(self, response):
+        self._on_response(response)
+
+    # ---------- 客户端 ----------
+
+    def client(self):
+        """当前进程的同步客户端（fork后首次调用时重新创建）"""
+        if self._pid == os.getpid() and self._client is not None:
+            return self._client
+        with self._lock:
+            if self._pid != os.getpid() or self._client is None:
+                self._http_client = httpx.Client(
+                    http2=HTTP2_ENABLED,
+                    limits=httpx.Limits(max_connections=POOL_MAX_CONNECTIONS,
+                                        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                                        keepalive_expiry=POOL_KEEPALIVE_EXPIRY),
+                    timeout=DEFAULT_TIMEOUT,
+                    event_hooks={'request': [self._on_request], 'response': [self._on_response]})
+                # 重试由调用方的重试循环统一控制（并计入熔断统计），关闭SDK内置的重试
+                self._client = OpenAI(api_key=self._api_key(), base_url=self.base_url,
+                                      timeout=DEFAULT_TIMEOUT, max_retries=0,
+                                      http_client=self._http_client)
+                if self._pid != os.getpid():
+                    self._reset_counters()
+                self._pid = os.getpid()
+                logger.info(f"上游连接池已创建: {self.base_url}, HTTP/2: {HTTP2_ENABLED}, "
+                            f"连接上限 {POOL_MAX_CONNECTIONS}")
+        return self._client
+
+    def async_client(self):
+        """当前事件循环使用的异步客户端"""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self._async_http_client = httpx.AsyncClient(
+                http2=HTTP2_ENABLED,
+                limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS,
+                                    max_keepalive_connections=ASYNC_MAX_CONNECTIONS // 4,
+                                    keepalive_expiry=POOL_KEEPALIVE_EXPIRY),
+                timeout=DEFAULT_TIMEOUT,
+                event_hooks={'request': [self._aon_request], 'response': [self._aon_response]})
+            self._async_client = AsyncOpenAI(api_key=self._api_key(), base_url=self.base_url,
+                                             timeout=DEFAULT_TIMEOUT, max_retries=0,
+                                             http_client=self._async_http_client)
+            self._async_loop = loop
+        return self._async_client
+
+    def attempt_timeout(self, timeout, attempt):
+        """第attempt次请求（0为首次）的timeout参数：重试时放宽为 timeout * RETRY_TIMEOUT_MULTIPLIER，
+        不超过 circuit_breaker.ADAPTIVE_TIMEOUT_MAX
+
+        timeout: 调用方的单次请求超时（模型配置或熔断器按p95自适应的秒数），会覆盖客户端的默认超时，
+        所以重试的超时必须通过这个参数传入；为None时使用客户端的默认超时
+        """
+        from circuit_breaker import ADAPTIVE_TIMEOUT_MAX
+
+        if attempt == 0:
+            return timeout
+        self._incr('retries')
+        if timeout is None:
+            return None
+        if isinstance(timeout, httpx.Timeout):
+            if timeout.read is None:
+                return timeout
+            read = min(timeout.read * RETRY_TIMEOUT_MULTIPLIER, max(ADAPTIVE_TIMEOUT_MAX, timeout.read))
+            return httpx.Timeout(read, connect=timeout.connect)
+        return round(min(timeout * RETRY_TIMEOUT_MULTIPLIER, max(ADAPTIVE_TIMEOUT_MAX, timeout)), 1)
+
+    def close(self):
+        """关闭同步连接池（进程退出或测试清理时调用）"""
+        with self._lock:
+            if self._http_client is not None and self._pid == os.getpid():
+                self._http_client.close()
+            self._client = None
+            self._http_client = None
+
+    # ---------- 统计 ----------
+
+    @staticmethod
+    def _pool_usage(http_client):
+        """读取httpcore连接池中各连接的状态（内部结构，读取失败时返回None）"""
+        pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+        connections = getattr(pool, 'connections', None)
+        if connections is None:
+            return None
+        usage = {'connections': 0, 'idle': 0, 'active': 0, 'http2': 0}
+        for connection in list(connections):
+            usage['connections'] += 1
+            if connection.is_idle():
+                usage['idle'] += 1
+            else:
+                usage['active'] += 1
+            if 'HTTP/2' in connection.info():
+                usage['http2'] += 1
+        return usage
+
+    def stats(self):
+        """本进程连接池的使用情况（每个gunicorn worker各自统计）"""
+        with self._lock:
+            counters = dict(self._counters)
+            latency_total = self._latency_total
+        responses = counters['responses']
+        requests = counters['requests']
+        return {
+            'pid': os.getpid(),
+            'base_url': self.base_url,
+            'http2_enabled': HTTP2_ENABLED,
+            'max_connections': POOL_MAX_CONNECTIONS,
+            'max_keepalive_connections': POOL_MAX_KEEPALIVE,
+            'keepalive_expiry': POOL_KEEPALIVE_EXPIRY,
+            'uptime_seconds': round(time.time() - self._started_at, 1),
+            **counters,
+            # 复用率：没有新建TCP连接的请求占比
+            'connection_reuse_ratio': round(1 - counters['connections_opened'] / requests, 3) if requests else None,
+            'avg_latency_ms': round(latency_total / responses * 1000, 1) if responses else None,
+            'pool': self._pool_usage(self._http_client) if self._pid == os.getpid() else None,
+            'async_pool': self._pool_usage(self._async_http_client),
+        }
@@ -0,0 +1,322 @@
+"""多上游提供方和对冲请求 - 主上游迟迟没有响应时向备用上游再发一次，先返回的结果胜出
+
+- 上游列表来自 upstream_providers 表（按priority排序），环境变量 OPENAI_BASE_URL 对应的
+  default 上游始终可用；每个上游有独立的连接池和熔断器
+- 主上游：按优先级第一个熔断器放行的上游；熔断打开的上游被跳过，全部打开时才使用备用方案
+- 对冲延迟：主上游近期成功调用耗时的百分位数（默认p90），即只有最慢的约10%请求会触发对冲；
+  主上游在延迟内报错时立即向备用上游发起请求
+- 流式调用以首个内容片段为"响应"：先输出片段的上游胜出，另一路随即取消，
+  因此调用方只会收到一路的片段
+- 异步路径直接取消落败的任务；同步路径的流式请求在读取下一行时停止，
+  非流式请求无法中途打断，在后台线程中结束后丢弃结果
+- 熔断器探测请求不做对冲，探测结果只反映主上游本身
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+from circuit_breaker import CircuitOpenError, get_breaker, percentile
+from upstream_pool import UpstreamPool
+
+logger = logging.getLogger(__name__)
+
+HEDGING_ENABLED = os.environ.get('HEDGING_ENABLED', 'true').lower() == 'true'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 0.9))
+HEDGE_DELAY_DEFAULT = float(os.environ.get('HEDGE_DELAY_DEFAULT', 30))  # 样本不足时使用
+HEDGE_DELAY_MIN = float(os.environ.get('HEDGE_DELAY_MIN', 2))
+HEDGE_DELAY_MAX = float(os.environ.get('HEDGE_DELAY_MAX', 60))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_THREADS = int(os.environ.get('HEDGE_THREADS', 16))
+REGISTRY_CACHE_SECONDS = 60
+DELAY_CACHE_SECONDS = 30
+
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix='hedge')
+
+
+class HedgeCancelled(Exception):
+    """对冲竞争中落败，本路请求已放弃"""
+
+
+class HedgeRace:
+    """一次对冲竞争：第一个声明胜出的上游获胜，其余上游的请求随后放弃"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.winner = None
+
+    def entrant(self, name):
+        return Entrant(self, name)
+
+    def claim(self, name):
+        with self._lock:
+            if self.winner is None:
+                self.winner = name
+            return self.winner == name
+
+
+class Entrant:
+    """参与竞争的一路请求，传给流式读取函数用于声明胜出和检查是否已落败"""
+
+    def __init__(self, race, name):
+        self.race = race
+        self.name = name
+
+    def claim(self):
+        if not self.race.claim(self.name):
+            raise HedgeCancelled(f"{self.name} 对冲落败")
+
+    def check(self):
+        winner = self.race.winner
+        if winner is not None and winner != self.name:
+            raise HedgeCancelled(f"{self.name} 对冲落败")
+
+
+class Provider:
+    """一个可用的上游：标识、地址、模型名覆盖和对应的连接池"""
+
+    def __init__(self, name, base_url, pool, model_name=None, priority=0):
+        self.name = name
+        self.base_url = base_url
+        self.pool = pool
+        self.model_name = model_name
+        self.priority = priority
+
+    def __repr__(self):
+        return f'<Provider {self.name}: {self.base_url}>'
+
+
+class ProviderRegistry:
+    """进程内的上游列表缓存，以及各上游的连接池"""
+
+    def __init__(self, default_pool):
+        self.default_pool = default_pool
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._providers = None
+        self._loaded_at = 0.0
+        self._delays = {}  # provider -> (计算时间, 延迟秒数)
+        self._counters = {'hedged_calls': 0, 'hedges_fired': 0, 'alternate_wins': 0}
+
+    def default_provider(self):
+        return Provider('default', self.default_pool.base_url, self.default_pool)
+
+    def _pool_for(self, name, base_url, api_key_env):
+        key = (name, base_url, api_key_env)
+        if name == 'default' and base_url == self.default_pool.base_url and api_key_env == 'OPENAI_API_KEY':
+            return self.default_pool
+        with self._lock:
+            if key not in self._pools:
+                api_key = os.environ.get(api_key_env)
+                if not api_key:
+                    logger.warning(f"上游 {name} 的API密钥环境变量 {api_key_env} 未设置")
+                self._pools[key] = UpstreamPool(base_url, api_key=api_key)
+            return self._pools[key]
+
+    def providers(self, db_session=None):
+        """按优先级排序的可用上游，数据库不可用时只返回default"""
+        if self._providers is not None and time.time() - self._loaded_at < REGISTRY_CACHE_SECONDS:
+            return self._providers
+        if db_session is None:
+            return self._providers or [self.default_provider()]
+
+        from models import UpstreamProvider
+
+        try:
+            rows = db_session.query(UpstreamProvider).order_by(
+                UpstreamProvider.priority, UpstreamProvider.id).all()
+            entries = [(row.name, row.base_url, row.api_key_env, row.model_name, row.priority, row.is_active)
+                       for row in rows]
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            logger.warning(f"读取上游列表失败，只使用default上游: {str(e)}")
+            return [self.default_provider()]
+
+        providers = []
+        if not any(name == 'default' for name, *_ in entries):
+            providers.append(self.default_provider())
+        for name, base_url, api_key_env, model_name, priority, is_active in entries:
+            if is_active:
+                providers.append(Provider(name, base_url, self._pool_for(name, base_url, api_key_env),
+                                          model_name=model_name, priority=priority))
+        providers.sort(key=lambda provider: provider.priority)
+        with self._lock:
+            self._providers = providers
+            self._loaded_at = time.time()
+        return providers
+
+    def invalidate(self):
+        """后台修改上游后立即重新读取（其他进程在缓存过期后生效）"""
+        with self._lock:
+            self._providers = None
+
+    # ---------- 路由 ----------
+
+    def route(self, db_session, default_timeout):
+        """选择本次调用的主上游、熔断许可和对冲的备用上游
+
+        所有上游的熔断器都打开时抛出CircuitOpenError。
+        """
+        providers = self.providers(db_session)
+        last_error = None
+        for index, provider in enumerate(providers):
+            try:
+                permit = get_breaker(provider.name).before_call(db_session, default_timeout)
+            except CircuitOpenError as e:
+                last_error = e
+                logger.warning(f"上游 {provider.name} 熔断中，尝试下一个上游")
+                continue
+            alternate = None
+            if HEDGING_ENABLED and not permit.probe:
+                alternate = next((candidate for candidate in providers[index + 1:]
+                                  if get_breaker(candidate.name).is_closed(db_session)), None)
+            hedge_delay = self.hedge_delay(db_session, provider.name) if alternate else None
+            return SimpleNamespace(primary=provider, permit=permit,
+                                   alternate=alternate, hedge_delay=hedge_delay)
+        raise last_error
+
+    def hedge_delay(self, db_session, provider_name):
+        """主上游近期成功耗时的百分位数（秒），样本不足时使用HEDGE_DELAY_DEFAULT"""
+        cached = self._delays.get(provider_name)
+        if cached is not None and time.time() - cached[0] < DELAY_CACHE_SECONDS:
+            return cached[1]
+        delay = HEDGE_DELAY_DEFAULT
+        try:
+            latencies = get_breaker(provider_name).recent_latencies(db_session)
+        except Exception as e:
+            db_session.rollback()
+            logger.warning(f"计算对冲延迟失败: {str(e)}")
+            latencies = []
+        if len(latencies) >= HEDGE_MIN_SAMPLES:
+            delay = percentile(latencies, HEDGE_PERCENTILE) / 1000
+        delay = round(min(HEDGE_DELAY_MAX, max(HEDGE_DELAY_MIN, delay)), 2)
+        with self._lock:
+            self._delays[provider_name] = (time.time(), delay)
+        return delay
+
+    # ---------- 统计 ----------
+
+    def _incr(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        """本进程的对冲次数和各上游连接池使用情况"""
+        with self._lock:
+            counters = dict(self._counters)
+            delays = {name: delay for name, (_, delay) in self._delays.items()}
+        providers = self._providers or [self.default_provider()]
+        return {
+            'hedging_enabled': HEDGING_ENABLED,
+            'hedge_percentile': HEDGE_PERCENTILE,
+            'hedge_delays': delays,
+            **counters,
+            'providers': [{'name': provider.name, 'priority': provider.priority,
+                           'pool': provider.pool.stats()} for provider in providers],
+        }
+
+
+def _in_app_context(call):
+    """对冲线程没有Flask应用上下文：调用方在应用上下文中时，每一路在同一应用的新上下文中执行
+
+    流式片段回调（推送进度、写任务表）因此可以使用db.session，每一路使用各自的session。
+    """
+    from flask import current_app, has_app_context
+
+    if not has_app_context():
+        return call
+    app = current_app._get_current_object()
+
+    def run(*args):
+        with app.app_context():
+            return call(*args)
+    return run
+
+
+def run_hedged(registry, call, primary, alternate, delay):
+    """同步对冲：call(provider, entrant)在对冲线程中执行，返回(胜出的上游, 响应)
+
+    两路都失败时抛出主上游的异常。
+    """
+    call = _in_app_context(call)
+    race = HedgeRace()
+    registry._incr('hedged_calls')
+    futures = {_hedge_executor.submit(call, primary, race.entrant(primary.name)): primary}
+    pending = set(futures)
+    errors = {}
+    hedged = False
+    started_at = time.time()
+    while pending:
+        done, pending = wait(pending, timeout=None if hedged else delay, return_when=FIRST_COMPLETED)
+        for future in done:
+            provider = futures[future]
+            try:
+                response = future.result()
+            except HedgeCancelled:
+                continue
+            except Exception as e:
+                errors[provider.name] = e
+                continue
+            if race.claim(provider.name):
+                _log_winner(registry, provider, primary, hedged, started_at)
+                return provider, response
+        # 主上游在延迟内未开始响应（流式未输出片段）或已失败：向备用上游发起请求
+        if not hedged and race.winner is None:
+            hedged = True
+            registry._incr('hedges_fired')
+            logger.info(f"主上游 {primary.name} {time.time() - started_at:.1f}秒未响应，"
+                        f"向备用上游 {alternate.name} 发起对冲请求")
+            future = _hedge_executor.submit(call, alternate, race.entrant(alternate.name))
+            futures[future] = alternate
+            pending.add(future)
+    raise errors.get(primary.name) or next(iter(errors.values()))
+
+
+async def arun_hedged(registry, call, primary, alternate, delay):
+    """异步对冲：call(provider, entrant)为协程函数，胜出后取消另一路任务"""
+    race = HedgeRace()
+    registry._incr('hedged_calls')
+    tasks = {asyncio.ensure_future(call(primary, race.entrant(primary.name))): primary}
+    pending = set(tasks)
+    errors = {}
+    hedged = False
+    started_at = time.time()
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=None if hedged else delay,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                provider = tasks[task]
+                try:
+                    response = task.result()
+                except HedgeCancelled:
+                    continue
+                except Exception as e:
+                    errors[provider.name] = e
+                    continue
+                if race.claim(provider.name):
+                    _log_winner(registry, provider, primary, hedged, started_at)
+                    return provider, response
+            if not hedged and race.winner is None:
+                hedged = True
+                registry._incr('hedges_fired')
+                logger.info(f"主上游 {primary.name} {time.time() - started_at:.1f}秒未响应，"
+                            f"向备用上游 {alternate.name} 发起对冲请求")
+                task = asyncio.ensure_future(call(alternate, race.entrant(alternate.name)))
+                tasks[task] = alternate
+                pending.add(task)
+        raise errors.get(primary.name) or next(iter(errors.values()))
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _log_winner(registry, provider, primary, hedged, started_at):
+    if provider is not primary:
+        registry._incr('alternate_wins')
+    if hedged:
+        logger.info(f"对冲请求由 {provider.name} 胜出，耗时 {time.time() - started_at:.2f}秒")
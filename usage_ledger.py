@@ -0,0 +1,305 @@
+"""用量账本 - 每次上游调用的token数、费用、耗时，按用户和日期汇总
+
+- 记录: 每次发往上游的请求记录一行（失败的重试、对冲中落败的一路也各记一行）：模型、上游、用户、
+  prompt/completion token数（取自response.usage，上游没有返回时在后台按本地计数估算）、
+  本次请求的耗时、第几次重试、是否成功，以及提示词的token预算（prompt_budget：输入预算、
+  max_tokens、各片段token数、被裁剪的片段）；命中结果缓存时记录一行cache_hit
+- 计费: 失败的请求不计token；对冲落败的一路已被上游受理，没有返回usage时按提示词token数估算
+- 写入: record() 只把记录放入进程内缓冲，由后台线程每 USAGE_FLUSH_INTERVAL 秒
+  （或缓冲达到 USAGE_FLUSH_BATCH 条时）批量写入 usage_records，请求路径上不访问数据库；
+  数据库不可用时缓冲最多保留 USAGE_MAX_BUFFER 条，超出丢弃最早的记录
+- 汇总: 写入明细的同一事务中按 (日期, 用户, 模型, 上游) 累加到 usage_daily（INSERT ... ON CONFLICT），
+  按用户和按日期的费用报表只查询汇总表，不扫描明细
+- 费用: 按 MODEL_PRICES（美元/百万token，按模型名前缀最长匹配）计算，
+  可用 USAGE_MODEL_PRICES='{"模型前缀": [输入单价, 输出单价]}' 覆盖或补充
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', 5))
+FLUSH_BATCH = int(os.environ.get('USAGE_FLUSH_BATCH', 200))
+MAX_BUFFER = int(os.environ.get('USAGE_MAX_BUFFER', 10000))
+
+# 模型名前缀 -> (输入, 输出) 美元/百万token
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4.1-nano': (0.1, 0.4),
+    'gpt-4.1-mini': (0.4, 1.6),
+    'gpt-4.1': (2.0, 8.0),
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-4': (30.0, 60.0),
+    'gpt-3.5-turbo': (0.5, 1.5),
+    'o3-mini': (1.1, 4.4),
+    'o4-mini': (1.1, 4.4),
+}
+MODEL_PRICES.update({prefix: tuple(prices) for prefix, prices in
+                     json.loads(os.environ.get('USAGE_MODEL_PRICES') or '{}').items()})
+
+# 按北京时间（UTC+8）划分日期，与页面上的时间显示一致
+DAY_OFFSET = timedelta(hours=8)
+
+# 汇总表中累加的列
+ROLLUP_COLUMNS = ('calls', 'cache_hits', 'failures', 'retries', 'prompt_tokens', 'completion_tokens',
+                  'cost', 'latency_ms')
+
+
+def price_for(model):
+    matches = [prefix for prefix in MODEL_PRICES if (model or '').startswith(prefix)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else (0.0, 0.0)
+
+
+def cost_of(model, prompt_tokens, completion_tokens):
+    """一次调用的费用（美元）"""
+    input_price, output_price = price_for(model)
+    return ((prompt_tokens or 0) * input_price + (completion_tokens or 0) * output_price) / 1_000_000
+
+
+def _estimate_tokens(entry, prompt_tokens=None):
+    """上游没有返回usage时按本地计数估算（在后台线程中执行）；prompt_tokens为组装提示词时的计数"""
+    import prompt_budget
+
+    model = entry['model']
+    messages = entry.pop('messages', None) or []
+    if prompt_tokens is None:
+        prompt_tokens = sum(prompt_budget.count_tokens(message.get('content') or '', model)
+                            for message in messages)
+    completion_tokens = prompt_budget.count_tokens(entry.pop('completion_text', None) or '', model)
+    return prompt_tokens, completion_tokens
+
+
+def finalize(entry):
+    """缓冲中的记录 -> usage_records的一行：补齐估算的token数和费用"""
+    row = dict(entry)
+    budget_prompt_tokens = row.pop('budget_prompt_tokens', None)
+    if row['prompt_tokens'] is not None and row['completion_tokens'] is not None:
+        row['tokens_estimated'] = False
+    elif row['cache_hit'] or not (row['success'] or row.get('hedge_lost')):
+        # 缓存命中没有调用上游；失败的请求没有返回结果，不计token
+        row.update(prompt_tokens=0, completion_tokens=0, tokens_estimated=False)
+    else:
+        prompt_tokens, completion_tokens = _estimate_tokens(row, budget_prompt_tokens)
+        row['prompt_tokens'] = prompt_tokens if row['prompt_tokens'] is None else row['prompt_tokens']
+        row['completion_tokens'] = completion_tokens if row['completion_tokens'] is None else row['completion_tokens']
+        row['tokens_estimated'] = True
+    row.pop('messages', None)
+    row.pop('completion_text', None)
+    row['cost'] = cost_of(row['model'], row['prompt_tokens'], row['completion_tokens'])
+    return row
+
+
+def rollup(rows):
+    """按 (日期, 用户, 模型, 上游) 累加一批明细，返回汇总表的增量行"""
+    totals = {}
+    for row in rows:
+        key = ((row['created_at'] + DAY_OFFSET).date(), row['user_id'] or 0, row['model'], row['provider'])
+        values = totals.get(key)
+        if values is None:
+            values = totals[key] = dict(zip(('day', 'user_id', 'model', 'provider'), key),
+                                        **{column: 0 for column in ROLLUP_COLUMNS})
+        values['calls'] += 1
+        values['cache_hits'] += 1 if row['cache_hit'] else 0
+        values['failures'] += 0 if row['success'] or row.get('hedge_lost') else 1
+        values['retries'] += 1 if row['retries'] else 0
+        values['prompt_tokens'] += row['prompt_tokens']
+        values['completion_tokens'] += row['completion_tokens']
+        values['cost'] += row['cost']
+        values['latency_ms'] += row['latency_ms']
+    return list(totals.values())
+
+
+def _upsert_daily(dialect_name):
+    """汇总表的累加写入：INSERT ... ON CONFLICT (day, user_id, model, provider) DO UPDATE"""
+    from models import UsageDaily
+
+    if dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    table = UsageDaily.__table__
+    statement = dialect_insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=['day', 'user_id', 'model', 'provider'],
+        set_={column: table.c[column] + statement.excluded[column] for column in ROLLUP_COLUMNS})
+
+
+class UsageLedger:
+    """进程内缓冲 + 后台批量写入"""
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self._buffer = []
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        app.extensions['usage_ledger'] = self
+
+    def record(self, model, provider=None, user_id=None, usage=None, messages=None, completion_text=None,
+               latency_ms=0, retries=0, cache_hit=False, success=True, hedge_lost=False, budget=None,
+               cache_key=None):
+        """记录一次上游请求（或一次缓存命中），只写入内存缓冲
+
+        usage: 上游返回的usage（prompt_tokens / completion_tokens），没有时按messages和completion_text估算
+        retries: 第几次重试（0为首次请求）
+        budget: prompt_budget.PromptAssembler.build() 返回的token预算，记录在同一行
+        """
+        if self.app is None:
+            return
+        entry = {
+            'created_at': datetime.utcnow(),
+            'user_id': user_id,
+            'model': (model or '')[:100],
+            'provider': (provider or '')[:50],
+            'prompt_tokens': getattr(usage, 'prompt_tokens', None),
+            'completion_tokens': getattr(usage, 'completion_tokens', None),
+            'latency_ms': latency_ms or 0,
+            'retries': retries,
+            'cache_hit': cache_hit,
+            'success': success,
+            'hedge_lost': hedge_lost,
+            'cache_key': cache_key,
+            'tokenizer': getattr(budget, 'tokenizer', None),
+            'input_budget': getattr(budget, 'input_budget', None),
+            'max_tokens': getattr(budget, 'max_tokens', None),
+            'section_tokens': getattr(budget, 'section_tokens', None),
+            'trimmed_sections': getattr(budget, 'trimmed', None),
+            'budget_prompt_tokens': getattr(budget, 'prompt_tokens', None),
+            'messages': messages,
+            'completion_text': completion_text,
+        }
+        with self._lock:
+            self._buffer.append(entry)
+            if len(self._buffer) > MAX_BUFFER:
+                overflow = len(self._buffer) - MAX_BUFFER
+                del self._buffer[:overflow]
+                self._dropped += overflow
+            full = len(self._buffer) >= FLUSH_BATCH
+        self._ensure_started()
+        if full:
+            self._wake.set()
+
+    def _ensure_started(self):
+        """启动本进程的写入线程（fork之后需要重新创建）"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name='usage-ledger', daemon=True).start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"写入用量账本失败: {str(e)}")
+
+    def flush(self):
+        """把缓冲中的记录写入数据库，返回写入的条数；失败时记录放回缓冲，下次再写"""
+        from models import UsageRecord
+
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            logger.warning(f"用量账本缓冲已满，丢弃了 {dropped} 条记录")
+        if not batch or self.app is None:
+            return 0
+
+        rows = [finalize(entry) for entry in batch]
+        with self.app.app_context():
+            session = self.db.session
+            try:
+                session.execute(insert(UsageRecord), rows)
+                session.execute(_upsert_daily(session.get_bind().dialect.name), rollup(rows))
+                session.commit()
+            except Exception:
+                session.rollback()
+                with self._lock:
+                    self._buffer[:0] = batch
+                raise
+        return len(rows)
+
+
+ledger = UsageLedger()
+
+
+# ---------- 报表（只查询汇总表） ----------
+
+def _since(days):
+    return (datetime.utcnow() + DAY_OFFSET).date() - timedelta(days=days - 1)
+
+
+def _totals():
+    from models import UsageDaily
+
+    return [func.sum(getattr(UsageDaily, column)).label(column) for column in ROLLUP_COLUMNS]
+
+
+def _summary(row):
+    values = {column: getattr(row, column) or 0 for column in ROLLUP_COLUMNS}
+    upstream_calls = values['calls'] - values['cache_hits']
+    values['cost'] = round(float(values['cost']), 6)
+    latency_ms = values.pop('latency_ms')
+    values['avg_latency_ms'] = int(latency_ms / upstream_calls) if upstream_calls else 0
+    return values
+
+
+def daily_totals(db_session, days=30):
+    """最近days天每天的调用数、token数和费用（按日期升序）"""
+    from models import UsageDaily
+
+    rows = db_session.execute(
+        select(UsageDaily.day, *_totals())
+        .where(UsageDaily.day >= _since(days))
+        .group_by(UsageDaily.day)
+        .order_by(UsageDaily.day)).all()
+    return [dict(day=row.day.isoformat(), **_summary(row)) for row in rows]
+
+
+def user_totals(db_session, days=30, limit=20):
+    """最近days天费用最高的用户"""
+    from models import User, UsageDaily
+
+    rows = db_session.execute(
+        select(UsageDaily.user_id, *_totals())
+        .where(UsageDaily.day >= _since(days))
+        .group_by(UsageDaily.user_id)
+        .order_by(func.sum(UsageDaily.cost).desc())
+        .limit(limit)).all()
+    names = {user.id: user for user in db_session.execute(
+        select(User.id, User.name, User.phone).where(User.id.in_([row.user_id for row in rows])))}
+    return [dict(user_id=row.user_id or None,
+                 name=names[row.user_id].name if row.user_id in names else None,
+                 phone=names[row.user_id].phone if row.user_id in names else None,
+                 **_summary(row)) for row in rows]
+
+
+def model_totals(db_session, days=30):
+    """最近days天按模型和上游的汇总"""
+    from models import UsageDaily
+
+    rows = db_session.execute(
+        select(UsageDaily.model, UsageDaily.provider, *_totals())
+        .where(UsageDaily.day >= _since(days))
+        .group_by(UsageDaily.model, UsageDaily.provider)
+        .order_by(func.sum(UsageDaily.cost).desc())).all()
+    return [dict(model=row.model, provider=row.provider, **_summary(row)) for row in rows]
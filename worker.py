@@ -0,0 +1,10 @@
+"""独立的后台任务worker进程
+
+JOB_WORKER_MODE=external 时web进程只负责入队，由该进程领取并执行AI分析任务：
+
+    JOB_WORKERS=8 python worker.py
+"""
+from app import job_queue
+
+if __name__ == '__main__':
+    job_queue.run_forever()